@@ -1,14 +1,24 @@
+from __future__ import annotations
+
 import os
 import re  # Added for sanitizing filenames
 import json
 import threading
 import traceback
-import tkinter as tk
 import shutil
-from tkinter import filedialog, messagebox, ttk
-from tkinter.scrolledtext import ScrolledText
+# La GUI necesita tkinter, el modo sin interfaz (run_headless) no: en nodos de
+# cálculo Python puede estar compilado sin _tkinter.  Sin él, las clases de la
+# GUI se definen sobre ``object`` y solo se puede usar el motor.
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+    from tkinter.scrolledtext import ScrolledText
+except ImportError:  # pragma: no cover
+    tk = filedialog = messagebox = ttk = ScrolledText = None  # type: ignore
+_TkRoot = tk.Tk if tk is not None else object
+_TkToplevel = tk.Toplevel if tk is not None else object
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 from pydicom.uid import ExplicitVRLittleEndian
 import sys
 import multiprocessing
@@ -188,6 +198,985 @@ def looks_like_dicom(path: str) -> bool:
         return False
 
 
+# -------------------------------------------------------------------------
+# Escaneo concurrente de cabeceras DICOM
+# -------------------------------------------------------------------------
+# Leer la cabecera de cada corte es una operación dominada por la latencia
+# de E/S (especialmente en unidades de red), por lo que un pool de hilos
+# acotado acelera mucho la búsqueda de series sin cambiar su resultado.
+DEFAULT_SCAN_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def iter_dicom_candidates(folder: str):
+    """Yield ``(path, name)`` for every regular file below ``folder``.
+
+    The traversal uses ``os.scandir`` and visits entries in the same order
+    as ``os.walk`` (files of a directory first, then its subdirectories),
+    so callers that rely on the walk order for tie-breaking keep the same
+    results.  Symlinked directories are not followed, matching the
+    ``os.walk`` default.  Unreadable directories are skipped silently.
+    """
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except OSError:
+        return
+    subdirs = []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.name
+        except OSError:
+            continue
+    for sub in subdirs:
+        yield from iter_dicom_candidates(sub)
+
+
+# Etiquetas de paciente/estudio/serie que se copian al RTSTRUCT; se guardan
+# en el registro para poder crearlo sin volver a leer la serie
+RTSTRUCT_STUDY_TAGS = [
+    "PatientID", "PatientBirthDate", "PatientSex", "PatientAge", "PatientSize",
+    "PatientWeight", "StudyInstanceUID", "StudyID", "StudyDate", "StudyTime",
+    "StudyDescription", "AccessionNumber", "ReferringPhysicianName", "SeriesDate",
+    "SeriesTime", "SeriesDescription", "FrameOfReferenceUID",
+]
+
+# Etiquetas que se leen (y se guardan en el índice) para cada fichero
+HEADER_INDEX_TAGS = [
+    "Modality", "SeriesInstanceUID", "InstanceNumber", "ImagePositionPatient",
+    "ImageOrientationPatient", "PatientName", "Rows", "Columns", "PixelSpacing",
+    "SliceThickness", "SOPClassUID", "SOPInstanceUID",
+] + RTSTRUCT_STUDY_TAGS
+
+
+def read_header_record(path: str, name: str) -> dict:
+    """Read the header fields AURA needs from a single file.
+
+    The returned record always contains ``path`` and ``is_dicom``.  Files
+    that neither end in ``.dcm`` nor look like DICOM are reported with
+    ``is_dicom=False`` without being parsed.  For DICOM files the tags in
+    ``HEADER_INDEX_TAGS`` are read with ``stop_before_pixels``; missing
+    values are stored as ``None`` (``InstanceNumber`` defaults to zero and
+    ``PatientName`` to an empty string, as in the original scanners).
+    ``study_tags`` holds the ``RTSTRUCT_STUDY_TAGS`` present in the file as
+    strings.  Read errors are propagated so the caller can report them.
+    """
+    record = {"path": path, "is_dicom": False}
+    if not (name.lower().endswith(".dcm") or looks_like_dicom(path)):
+        return record
+    ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_INDEX_TAGS)
+
+    def floats(value):
+        try:
+            return [float(v) for v in value]
+        except Exception:
+            return None
+
+    def text(keyword):
+        value = ds.get(keyword)
+        return None if value is None else str(value)
+
+    meta = getattr(ds, "file_meta", None)
+    uid = ds.get("SeriesInstanceUID")
+    record.update({
+        "is_dicom": True,
+        "modality": getattr(ds, "Modality", None),
+        "series_uid": str(uid) if uid is not None else None,
+        "instance_number": int(ds.get("InstanceNumber", 0) or 0),
+        "position": floats(ds.get("ImagePositionPatient")),
+        "patient_name": str(ds.get("PatientName", "")),
+        "rows": int(ds.Rows) if "Rows" in ds else None,
+        "columns": int(ds.Columns) if "Columns" in ds else None,
+        "pixel_spacing": floats(ds.get("PixelSpacing")),
+        "orientation": floats(ds.get("ImageOrientationPatient")),
+        "slice_thickness": floats([ds.SliceThickness])[0] if ds.get("SliceThickness") not in (None, "") else None,
+        "sop_class_uid": text("SOPClassUID") or (str(meta.MediaStorageSOPClassUID)
+                                                 if meta is not None and "MediaStorageSOPClassUID" in meta else None),
+        "sop_instance_uid": text("SOPInstanceUID") or (str(meta.MediaStorageSOPInstanceUID)
+                                                       if meta is not None and "MediaStorageSOPInstanceUID" in meta else None),
+        "study_tags": {kw: text(kw) for kw in RTSTRUCT_STUDY_TAGS if kw in ds},
+    })
+    return record
+
+
+def scan_dicom_headers(folder: str, max_workers: Optional[int] = None, on_error=None,
+                       index=None, stats: Optional[dict] = None) -> list[dict]:
+    """Return header records for every file below ``folder``.
+
+    Headers are read concurrently with a bounded thread pool of
+    ``max_workers`` threads (``DEFAULT_SCAN_WORKERS`` when omitted) and
+    returned in traversal order, so consumers see the same order as a
+    sequential scan.  When ``index`` (a :class:`DicomHeaderIndex`) is
+    given, files whose size and modification time match the stored entry
+    are served from it and only new or modified files are parsed; the
+    fresh records are written back at the end.  ``on_error(path, exc)`` is
+    invoked for files that look like DICOM but cannot be read.  If
+    ``stats`` is a dict it receives ``files``, ``read`` and ``cached``
+    counters.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    folder = os.path.abspath(folder)
+    workers = max(1, int(max_workers or DEFAULT_SCAN_WORKERS))
+    candidates = list(iter_dicom_candidates(folder))
+    cached = index.lookup_many([path for path, _ in candidates]) if index is not None else {}
+
+    def read(candidate):
+        path, name = candidate
+        try:
+            st = os.stat(path)
+            hit = cached.get(path)
+            if hit is not None and hit["size"] == st.st_size and hit["mtime_ns"] == st.st_mtime_ns:
+                return hit, False
+            record = read_header_record(path, name)
+            record["size"] = st.st_size
+            record["mtime_ns"] = st.st_mtime_ns
+            return record, True
+        except Exception as e:
+            return e, path
+
+    records: list[dict] = []
+    fresh: list[dict] = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result, extra in pool.map(read, candidates):
+            if isinstance(result, Exception):
+                if on_error is not None:
+                    on_error(extra, result)
+                continue
+            records.append(result)
+            if extra:
+                fresh.append(result)
+
+    if index is not None:
+        try:
+            index.store_many(fresh)
+            index.forget_missing(folder, [path for path, _ in candidates])
+        except Exception as e:
+            logger.warning(f"Could not update the DICOM header index: {e}")
+    if stats is not None:
+        stats.update({"files": len(candidates), "read": len(fresh),
+                      "cached": len(records) - len(fresh)})
+    return records
+
+
+def read_patient_name(folder: str, index=None) -> Optional[str]:
+    """Return the raw ``PatientName`` of the first DICOM file below ``folder``.
+
+    Files are visited in traversal order and the search stops at the
+    first readable DICOM file, so normally only one header is parsed.
+    Entries in ``index`` that are still valid avoid even that read.
+    Returns ``None`` if no DICOM file could be read.
+    """
+    for path, name in iter_dicom_candidates(os.path.abspath(folder)):
+        try:
+            st = os.stat(path)
+            hit = index.lookup_many([path]).get(path) if index is not None else None
+            if hit is not None and hit["size"] == st.st_size and hit["mtime_ns"] == st.st_mtime_ns:
+                record = hit
+            else:
+                record = read_header_record(path, name)
+                record["size"] = st.st_size
+                record["mtime_ns"] = st.st_mtime_ns
+                if index is not None:
+                    index.store_many([record])
+        except Exception:
+            continue
+        if record.get("is_dicom"):
+            return record.get("patient_name") or ""
+    return None
+
+
+# -------------------------------------------------------------------------
+# Índice persistente de cabeceras DICOM
+# -------------------------------------------------------------------------
+DICOM_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".aura_cache", "dicom_index.sqlite3")
+
+
+class DicomHeaderIndex:
+    """On-disk index of DICOM header records keyed by path, size and mtime.
+
+    Re-scanning a batch root only has to ``stat`` each file: entries whose
+    size and modification time are unchanged are served from the SQLite
+    database and only new or modified files are parsed again.  Non-DICOM
+    files are recorded too so they are not sniffed on every run.  The
+    database uses WAL mode so several AURA processes can share it.  The
+    index is a cache: if its schema version does not match it is simply
+    rebuilt.
+    """
+
+    SCHEMA_VERSION = 3
+    _COLUMNS = (
+        "path", "size", "mtime_ns", "is_dicom", "modality", "series_uid",
+        "instance_number", "position", "patient_name", "rows", "columns",
+        "pixel_spacing", "orientation", "slice_thickness", "sop_class_uid",
+        "sop_instance_uid", "study_tags",
+    )
+    _JSON_COLUMNS = {"position", "pixel_spacing", "orientation", "study_tags"}
+
+    def __init__(self, db_path: str = DICOM_INDEX_PATH):
+        import sqlite3
+
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS headers")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, is_dicom INTEGER, "
+                "modality TEXT, series_uid TEXT, instance_number INTEGER, position TEXT, "
+                "patient_name TEXT, rows INTEGER, columns INTEGER, pixel_spacing TEXT, "
+                "orientation TEXT, slice_thickness REAL, sop_class_uid TEXT, "
+                "sop_instance_uid TEXT, study_tags TEXT)"
+            )
+            self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._conn.commit()
+
+    def _to_row(self, record: dict) -> tuple:
+        row = []
+        for col in self._COLUMNS:
+            value = record.get(col)
+            if col in self._JSON_COLUMNS and value is not None:
+                value = json.dumps(value)
+            elif col == "is_dicom":
+                value = int(bool(value))
+            row.append(value)
+        return tuple(row)
+
+    def _from_row(self, row) -> dict:
+        record = dict(zip(self._COLUMNS, row))
+        for col in self._JSON_COLUMNS:
+            if record[col] is not None:
+                record[col] = json.loads(record[col])
+        record["is_dicom"] = bool(record["is_dicom"])
+        return record
+
+    def lookup_many(self, paths: list[str]) -> dict[str, dict]:
+        """Return the stored records for ``paths`` (missing paths are omitted)."""
+        found: dict[str, dict] = {}
+        cols = ", ".join(self._COLUMNS)
+        with self._lock:
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                marks = ", ".join("?" * len(chunk))
+                for row in self._conn.execute(f"SELECT {cols} FROM headers WHERE path IN ({marks})", chunk):
+                    record = self._from_row(row)
+                    found[record["path"]] = record
+        return found
+
+    def store_many(self, records: list[dict]) -> None:
+        """Insert or replace ``records`` (they must carry ``size`` and ``mtime_ns``)."""
+        if not records:
+            return
+        marks = ", ".join("?" * len(self._COLUMNS))
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO headers ({', '.join(self._COLUMNS)}) VALUES ({marks})",
+                [self._to_row(r) for r in records],
+            )
+            self._conn.commit()
+
+    def forget_missing(self, folder: str, seen_paths: list[str]) -> None:
+        """Drop entries below ``folder`` that were not seen in the last scan."""
+        prefix = os.path.join(os.path.abspath(folder), "")
+        seen = set(seen_paths)
+        with self._lock:
+            stale = [
+                (path,) for (path,) in self._conn.execute(
+                    "SELECT path FROM headers WHERE path >= ? AND path < ?",
+                    (prefix, prefix + "\uffff"),
+                )
+                if path not in seen
+            ]
+            if stale:
+                self._conn.executemany("DELETE FROM headers WHERE path = ?", stale)
+                self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# -------------------------------------------------------------------------
+# Descubrimiento de estudios (una sola pasada por carpeta de paciente)
+# -------------------------------------------------------------------------
+class SeriesInfo:
+    """A CT series found during discovery.
+
+    ``files`` and ``records`` are sorted by ``InstanceNumber`` (ties keep
+    the traversal order).  The geometry accessors read the header record
+    of the first slice, which is what the rest of the pipeline used to
+    re-read from disk.  ``volume`` optionally holds the decoded
+    ``(volume, geometry)`` pair from :func:`load_series_volume` when it was
+    prefetched (batch pipeline); consumers fall back to loading it.
+    ``mask_grid`` is set by the segmentation to ``(shape, affine)``, the RAS
+    affine of the voxel indices of its masks, when that geometry is known.
+    """
+
+    def __init__(self, uid: str, records: list[dict]):
+        self.uid = uid
+        self.records = sorted(records, key=lambda r: r["instance_number"])
+        self.files = [r["path"] for r in self.records]
+        self.volume: Optional[tuple] = None
+        self.mask_grid: Optional[tuple] = None
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @property
+    def num_slices(self) -> int:
+        return len(self.files)
+
+    @property
+    def first(self) -> dict:
+        return self.records[0]
+
+    @property
+    def rows(self) -> Optional[int]:
+        return self.first.get("rows")
+
+    @property
+    def columns(self) -> Optional[int]:
+        return self.first.get("columns")
+
+    @property
+    def pixel_spacing(self) -> Optional[list[float]]:
+        return self.first.get("pixel_spacing")
+
+    @property
+    def orientation(self) -> Optional[list[float]]:
+        return self.first.get("orientation")
+
+    @property
+    def slice_thickness(self) -> Optional[float]:
+        return self.first.get("slice_thickness")
+
+    @property
+    def positions(self) -> list[Optional[list[float]]]:
+        return [r.get("position") for r in self.records]
+
+
+class StudyInfo:
+    """Result of scanning one patient folder once.
+
+    Holds the raw ``PatientName`` of the first DICOM file found (any
+    modality) and every CT series in discovery order.
+    """
+
+    def __init__(self, folder: str, raw_patient_name: Optional[str], series: list[SeriesInfo]):
+        self.folder = folder
+        self.raw_patient_name = raw_patient_name
+        self.series = series
+
+    @property
+    def patient_name(self) -> str:
+        """Patient family name, falling back like the original ``_dicom_name``."""
+        if self.raw_patient_name is None:
+            return "Patient"
+        pn = pydicom.valuerep.PersonName(self.raw_patient_name)
+        # Prefer the family name attribute when available
+        return str(getattr(pn, "family_name", pn)) or "Paciente"
+
+    def primary_series(self) -> SeriesInfo:
+        """Return the largest CT series, raising if the folder has none."""
+        if not self.series:
+            raise RuntimeError("No CT images were found in the folder")
+        return max(self.series, key=lambda s: s.num_slices)
+
+
+def discover_study(folder: str, max_workers: Optional[int] = None, on_error=None,
+                   index=None, stats: Optional[dict] = None) -> StudyInfo:
+    """Walk ``folder`` once and describe the study it contains.
+
+    The patient name and every CT series (with sorted files and geometry
+    tags) come from the same header scan, see :func:`scan_dicom_headers`.
+    """
+    records = scan_dicom_headers(folder, max_workers=max_workers, on_error=on_error,
+                                 index=index, stats=stats)
+    raw_name = next((r.get("patient_name") or "" for r in records if r.get("is_dicom")), None)
+    by_uid: dict[str, list[dict]] = defaultdict(list)
+    for rec in records:
+        if rec.get("is_dicom") and rec.get("modality") == "CT" and rec.get("series_uid"):
+            by_uid[rec["series_uid"]].append(rec)
+    series = [SeriesInfo(uid, recs) for uid, recs in by_uid.items()]
+    return StudyInfo(folder, raw_name, series)
+
+
+# -------------------------------------------------------------------------
+# Ejecución por etapas (pipeline de lotes)
+# -------------------------------------------------------------------------
+# Cada etapa corre en su propio hilo y las etapas se comunican mediante
+# colas acotadas: mientras el paciente N se segmenta, el N+1 se lee y
+# decodifica y el N-1 se exporta.  Las colas acotadas limitan la memoria a
+# unos pocos volúmenes en vuelo.
+_PIPELINE_END = object()
+
+
+def run_staged_pipeline(items, stages, queue_size: int = 1, should_stop=None,
+                        on_error=None, on_finish=None) -> None:
+    """Run ``items`` through ``stages`` with one thread per stage.
+
+    Each stage is a callable ``stage(job) -> job``; returning ``None``
+    drops the job (for example when there is nothing to export).  An
+    exception in a stage only affects that job: ``on_error(job, stage_index,
+    exc)`` is called and the job leaves the pipeline.  ``on_finish(job)`` is
+    called whenever a job leaves the pipeline (completed, dropped or
+    failed).  Once ``should_stop()`` returns True no new item is started
+    and queued jobs are discarded without calling ``on_finish``; the call
+    returns when every stage has drained.
+    """
+    import queue
+
+    stop = should_stop or (lambda: False)
+    queues = [queue.Queue(maxsize=max(1, int(queue_size))) for _ in range(len(stages) - 1)]
+
+    def handle(job, k):
+        try:
+            out = stages[k](job)
+        except Exception as e:
+            if on_error is not None:
+                on_error(job, k, e)
+            out = None
+        if out is None or k == len(stages) - 1:
+            if on_finish is not None:
+                on_finish(job)
+            return None
+        return out
+
+    def first_stage():
+        try:
+            for job in items:
+                if stop():
+                    break
+                out = handle(job, 0)
+                if out is not None:
+                    queues[0].put(out)
+        finally:
+            if queues:
+                queues[0].put(_PIPELINE_END)
+
+    def later_stage(k):
+        inbox = queues[k - 1]
+        outbox = queues[k] if k < len(queues) else None
+        while True:
+            job = inbox.get()
+            if job is _PIPELINE_END:
+                break
+            if stop():
+                continue  # seguir vaciando la cola para no bloquear etapas previas
+            out = handle(job, k)
+            if out is not None and outbox is not None:
+                outbox.put(out)
+        if outbox is not None:
+            outbox.put(_PIPELINE_END)
+
+    if len(stages) == 1:
+        first_stage()
+        return
+    threads = [threading.Thread(target=first_stage, name="pipeline-stage-0", daemon=True)]
+    threads += [
+        threading.Thread(target=later_stage, args=(k,), name=f"pipeline-stage-{k}", daemon=True)
+        for k in range(1, len(stages))
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+# -------------------------------------------------------------------------
+# Decodificación de volúmenes y conversión a NIfTI en memoria
+# -------------------------------------------------------------------------
+# El volumen final (Z, Y, X) float32 se reserva una sola vez a partir de la
+# primera cabecera y cada hilo decodifica y reescala su corte directamente en
+# su posición, de modo que el pico de memoria es aproximadamente un volumen.
+# pydicom y los decodificadores de imagen liberan el GIL durante la E/S y la
+# descompresión, así que el tiempo escala con el número de núcleos.
+DEFAULT_DECODE_WORKERS = os.cpu_count() or 1
+
+
+def decode_series_volume(files: list[str], max_workers: Optional[int] = None,
+                         on_error=None, on_progress=None):
+    """Decode ``files`` into a preallocated ``(Z, Y, X)`` float32 HU volume.
+
+    Slices keep the order of ``files``.  Slices that cannot be read, have
+    no ``PixelData`` or whose shape differs from the first readable header
+    are skipped (``on_error(index, path, exc)`` is called for each) and the
+    remaining slices are compacted in place.  ``on_progress(done, total)``
+    is called as slices finish.  Returns ``(volume, headers)`` where
+    ``headers`` are the datasets of the kept slices without pixel data.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    shape = None
+    for pth in files:
+        try:
+            ds = pydicom.dcmread(pth, stop_before_pixels=True, specific_tags=["Rows", "Columns"])
+            shape = (int(ds.Rows), int(ds.Columns))
+            break
+        except Exception:
+            continue
+    if shape is None:
+        raise RuntimeError("No readable slices in series")
+
+    total = len(files)
+    vol = np.empty((total,) + shape, dtype=np.float32)
+    headers: list = [None] * total
+    lock = threading.Lock()
+    done = [0]
+
+    def decode(k: int) -> None:
+        pth = files[k]
+        try:
+            ds = pydicom.dcmread(pth)
+            if not hasattr(ds, "PixelData"):
+                raise ValueError("slice has no PixelData")
+            arr = ds.pixel_array
+            if arr.shape != shape:
+                raise ValueError(f"slice shape {arr.shape} differs from {shape}")
+            slot = vol[k]
+            np.copyto(slot, arr.astype(np.int16, copy=False))
+            slope = float(ds.get("RescaleSlope", 1))
+            intercept = float(ds.get("RescaleIntercept", 0))
+            if slope != 1.0:
+                slot *= slope
+            if intercept != 0.0:
+                slot += intercept
+            del ds.PixelData  # conservar solo la cabecera
+            headers[k] = ds
+        except Exception as e:
+            if on_error is not None:
+                on_error(k, pth, e)
+        if on_progress is not None:
+            with lock:
+                done[0] += 1
+                count = done[0]
+            on_progress(count, total)
+
+    workers = max(1, min(int(max_workers or DEFAULT_DECODE_WORKERS), total))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(decode, range(total)))
+
+    good = [k for k, ds in enumerate(headers) if ds is not None]
+    for j, k in enumerate(good):
+        if j != k:
+            vol[j] = vol[k]
+    return vol[:len(good)], [headers[k] for k in good]
+
+
+def _series_affine(orientation, pixel_spacing, positions, slice_thickness) -> np.ndarray:
+    """RAS affine of ``(column, row, slice)`` indices for slices at ``positions``."""
+    row_vec = np.array(orientation[:3], dtype=float)
+    col_vec = np.array(orientation[3:], dtype=float)
+    first_pos = np.array(positions[0], dtype=float)
+    if len(positions) > 1:
+        step = (np.array(positions[-1], dtype=float) - first_pos) / (len(positions) - 1)
+    else:
+        step = np.cross(row_vec, col_vec) * (slice_thickness or 1.0)
+    affine = np.eye(4, dtype=float)
+    affine[:3, 0] = row_vec * float(pixel_spacing[1])
+    affine[:3, 1] = col_vec * float(pixel_spacing[0])
+    affine[:3, 2] = step
+    affine[:3, 3] = first_pos
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine  # LPS -> RAS
+
+
+def series_geometry(headers: list) -> dict:
+    """Describe the geometry of decoded slices (see :func:`decode_series_volume`).
+
+    ``files`` and ``positions`` have one entry per kept slice, in volume
+    order, and ``affine`` maps ``(column, row, slice)`` indices of that
+    volume to RAS millimetres, the NIfTI convention.  ``spacing`` is
+    ``(Z, Y, X)`` as used by the SegResNet pipeline and ``rescale`` the
+    ``(slope, intercept)`` each slice was converted to HU with.
+    """
+    first = headers[0]
+    orientation = [float(v) for v in first.ImageOrientationPatient]
+    pixel_spacing = [float(x) for x in first.PixelSpacing]
+    positions = [[float(v) for v in ds.ImagePositionPatient] for ds in headers]
+    try:
+        slice_thickness = float(first.SliceThickness)
+    except Exception:
+        slice_thickness = None
+    affine = _series_affine(orientation, pixel_spacing, positions, slice_thickness)
+    z_spacing = slice_thickness or float(np.linalg.norm(affine[:3, 2])) or 5.0
+    return {
+        "files": [os.path.abspath(str(ds.filename)) for ds in headers],
+        "rows": int(first.Rows),
+        "columns": int(first.Columns),
+        "pixel_spacing": pixel_spacing,
+        "slice_thickness": slice_thickness,
+        "orientation": orientation,
+        "positions": positions,
+        "rescale": [[float(ds.get("RescaleSlope", 1)), float(ds.get("RescaleIntercept", 0))]
+                    for ds in headers],
+        "spacing": [z_spacing] + pixel_spacing,
+        "affine": affine.tolist(),
+    }
+
+
+def _reorder_cached_volume(vol: np.ndarray, geometry: dict, files: list[str]):
+    """Return ``vol``/``geometry`` with slices in the order of ``files``.
+
+    Cache entries are keyed by the set of files, so a caller may list the
+    same series in a different order (by name instead of InstanceNumber).
+    The memmap is returned untouched when the order already matches.
+    """
+    rank = {os.path.abspath(p): i for i, p in enumerate(files)}
+    perm = np.argsort([rank.get(p, -1) for p in geometry["files"]], kind="stable")
+    if np.array_equal(perm, np.arange(len(perm))):
+        return vol, geometry
+    geometry = dict(geometry)
+    geometry["files"] = [geometry["files"][i] for i in perm]
+    geometry["positions"] = [geometry["positions"][i] for i in perm]
+    geometry["rescale"] = [geometry["rescale"][i] for i in perm]
+    geometry["affine"] = _series_affine(geometry["orientation"], geometry["pixel_spacing"],
+                                        geometry["positions"], geometry["slice_thickness"]).tolist()
+    return vol[perm], geometry
+
+
+# -------------------------------------------------------------------------
+# Caché de volúmenes por serie (memmap)
+# -------------------------------------------------------------------------
+# SegResNet, TotalSegmentator y LNQ2023 necesitan el mismo volumen en HU.
+# Se guarda una vez por máquina como ``.npy`` (abierto con memmap) más un
+# JSON con la geometría; la clave combina SeriesInstanceUID y un hash de la
+# conjunto de ficheros con su tamaño y fecha, así que cualquier cambio en la
+# serie produce una entrada nueva.
+VOLUME_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".aura_cache", "volumes")
+DEFAULT_VOLUME_CACHE_MAX_GB = 20.0
+
+
+class SeriesVolumeCache:
+    """Directory of decoded series volumes shared by all backends.
+
+    Each entry is ``<key>.npy`` (float32 ``(Z, Y, X)`` HU volume) plus
+    ``<key>.json`` (the :func:`series_geometry` of the kept slices).  Both
+    files are written to a temporary name and renamed into place, the JSON
+    last, so a present sidecar always means a complete entry.  Entries are
+    evicted least recently used first once the directory exceeds
+    ``max_bytes``.
+    """
+
+    def __init__(self, root: str = VOLUME_CACHE_DIR, max_bytes: Optional[int] = None):
+        self.root = root
+        self.max_bytes = int(max_bytes if max_bytes is not None else DEFAULT_VOLUME_CACHE_MAX_GB * 2**30)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key_for(uid: str, files: list[str]) -> str:
+        digest = hashlib.sha1()
+        for pth in sorted(files):
+            st = os.stat(pth)
+            digest.update(f"{os.path.abspath(pth)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+        safe_uid = re.sub(r"[^0-9A-Za-z.]", "_", str(uid))[:64]
+        return f"{safe_uid}_{digest.hexdigest()[:16]}"
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.root, key)
+        return base + ".npy", base + ".json"
+
+    def get(self, key: str):
+        """Return ``(volume, geometry)`` for ``key`` or ``None`` on a miss.
+
+        The volume is a copy-on-write memmap, so callers may modify it
+        without touching the cached file.
+        """
+        npy_path, json_path = self._paths(key)
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                geometry = json.load(f)
+            vol = np.load(npy_path, mmap_mode="c")
+        except (OSError, ValueError):
+            return None
+        if vol.ndim != 3 or vol.shape[0] != len(geometry.get("positions", ())):
+            return None
+        if len(geometry.get("rescale", ())) != vol.shape[0]:
+            return None  # entrada de una versión anterior, sin rescale
+        try:
+            os.utime(json_path)  # marca de uso para la política LRU
+        except OSError:
+            pass
+        return vol, geometry
+
+    def put(self, key: str, vol: np.ndarray, geometry: dict) -> None:
+        npy_path, json_path = self._paths(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(npy_path + suffix, "wb") as f:
+            np.save(f, np.ascontiguousarray(vol, dtype=np.float32))
+        os.replace(npy_path + suffix, npy_path)
+        with open(json_path + suffix, "w", encoding="utf-8") as f:
+            json.dump(geometry, f)
+        os.replace(json_path + suffix, json_path)
+        self.prune()
+
+    def entries(self) -> list[tuple[float, str, int]]:
+        """Complete entries as ``(last_used, key, size_bytes)``."""
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                key = entry.name[:-5]
+                npy_path, json_path = self._paths(key)
+                try:
+                    size = os.path.getsize(npy_path) + entry.stat().st_size
+                    used = entry.stat().st_mtime
+                except OSError:
+                    continue
+                entries.append((used, key, size))
+        return entries
+
+    def remove(self, key: str) -> None:
+        for pth in self._paths(key)[::-1]:
+            try:
+                os.remove(pth)
+            except OSError:
+                pass
+
+    def prune(self) -> None:
+        """Evict least recently used entries until the cache fits ``max_bytes``."""
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self) -> int:
+        """Remove every entry; returns the number of bytes freed."""
+        freed = 0
+        for _, key, size in self.entries():
+            self.remove(key)
+            freed += size
+        return freed
+
+
+def load_series_volume(files: list[str], uid: Optional[str] = None, cache=None,
+                       max_workers: Optional[int] = None, on_error=None, on_progress=None,
+                       stats: Optional[dict] = None):
+    """Return ``(volume, geometry)`` for a series, using ``cache`` if given.
+
+    On a cache hit the volume is a memmap of the stored ``.npy``; otherwise
+    the slices are decoded with :func:`decode_series_volume` and the result
+    is stored for the next caller.  Cache failures never prevent decoding.
+    When ``stats`` is a dict it receives ``cached`` (bool).
+    """
+    key = None
+    if cache is not None:
+        try:
+            if uid is None:
+                ds = pydicom.dcmread(files[0], stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+                uid = str(ds.SeriesInstanceUID)
+            key = cache.key_for(uid, files)
+            hit = cache.get(key)
+        except Exception as e:
+            logger.warning(f"Series volume cache unavailable: {e}")
+            key, hit = None, None
+        if hit is not None:
+            if stats is not None:
+                stats["cached"] = True
+            return _reorder_cached_volume(hit[0], hit[1], files)
+
+    vol, headers = decode_series_volume(files, max_workers=max_workers,
+                                        on_error=on_error, on_progress=on_progress)
+    if not headers:
+        raise RuntimeError("No decodable slices in series")
+    geometry = series_geometry(headers)
+    if key is not None:
+        try:
+            cache.put(key, vol, geometry)
+        except Exception as e:
+            logger.warning(f"Could not store series volume in cache: {e}")
+    if stats is not None:
+        stats["cached"] = False
+    return vol, geometry
+
+
+# TotalSegmentator acepta directamente un ``Nifti1Image``.  Construirlo aquí
+# una sola vez evita que cada task vuelva a ejecutar dicom2nifti sobre la
+# carpeta completa y escriba/lea un ``.nii.gz`` temporal.
+NIFTI_OUTPUT_AXCODES = ("L", "A", "S")  # misma orientación que dicom2nifti
+
+
+def series_to_nifti(files: list[str], max_workers: Optional[int] = None,
+                    uid: Optional[str] = None, cache=None, volume: Optional[tuple] = None):
+    """Build a ``Nifti1Image`` (HU, float32) from the slices of one series.
+
+    Slices are ordered along the slice normal using ``ImagePositionPatient``
+    and the affine is derived from the DICOM geometry (LPS converted to
+    RAS).  The result is reoriented to LAS, the layout that
+    ``dicom2nifti.dicom_series_to_nifti(reorient_nifti=True)`` produces, so
+    downstream code sees the same array as with the folder-based input.
+    The decoded volume comes from :func:`load_series_volume` unless an
+    already loaded ``(volume, geometry)`` pair is passed as ``volume``.
+    """
+    if nib is None:
+        raise RuntimeError("nibabel is required to build the NIfTI image")
+
+    if volume is not None:
+        vol, geometry = volume
+    else:
+        vol, geometry = load_series_volume(files, uid=uid, cache=cache, max_workers=max_workers)
+    if vol.shape[0] < 2:
+        raise RuntimeError("At least two slices with pixel data are required")
+
+    orientation = np.array(geometry["orientation"], dtype=float)
+    normal = np.cross(orientation[:3], orientation[3:])
+    positions = np.array(geometry["positions"], dtype=float)
+    order = np.argsort(positions @ normal, kind="stable")
+    if np.array_equal(order, np.arange(len(order))):
+        affine = np.array(geometry["affine"], dtype=float)
+    else:
+        if np.array_equal(order, np.arange(len(order))[::-1]):
+            vol = vol[::-1]  # vista, sin copia
+        else:
+            vol = vol[order]
+        affine = _series_affine(geometry["orientation"], geometry["pixel_spacing"],
+                                positions[order], geometry["slice_thickness"])
+
+    # (Z, Y, X) -> (i=columna, j=fila, k=corte) como en NIfTI, sin copiar
+    img = nib.Nifti1Image(vol.transpose(2, 1, 0), affine)
+    current = nib.orientations.io_orientation(affine)
+    target = nib.orientations.axcodes2ornt(NIFTI_OUTPUT_AXCODES)
+    img = img.as_reoriented(nib.orientations.ornt_transform(current, target))
+    img.header.set_xyzt_units(2)
+    return img
+
+
+def totalseg_accepts_nifti(func) -> bool:
+    """Return True if ``totalsegmentator()`` accepts a ``Nifti1Image`` input.
+
+    Upstream TotalSegmentator annotates ``input`` as
+    ``Union[str, Path, Nifti1Image]``; older builds (``totalsegmentatorv2``)
+    wrap it in ``Path()`` and would fail on an image object.
+    """
+    try:
+        import inspect
+        param = inspect.signature(func).parameters.get("input")
+    except (TypeError, ValueError):
+        return False
+    return param is not None and "Nifti1Image" in str(param.annotation)
+
+
+# -------------------------------------------------------------------------
+# Caché de resultados de segmentación
+# -------------------------------------------------------------------------
+# Volver a procesar un paciente (otro suavizado, otra carpeta de salida...)
+# no necesita repetir la inferencia: el mapa de etiquetas de cada task se
+# guarda con una clave que combina el hash del volumen en HU, la task, la
+# resolución, el roi_subset y la versión de TotalSegmentator.
+SEG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".aura_cache", "segmentations")
+DEFAULT_SEG_CACHE_MAX_GB = 10.0
+
+
+def volume_content_hash(vol: np.ndarray, affine) -> str:
+    """SHA-1 of a volume's voxels (as float32), shape and affine."""
+    digest = hashlib.sha1()
+    digest.update(f"{tuple(vol.shape)}\n".encode("utf-8"))
+    digest.update(np.asarray(affine, dtype=np.float64).round(5).tobytes())
+    for plane in vol:  # plano a plano para no copiar memmaps completos
+        digest.update(np.ascontiguousarray(plane, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def totalseg_version(func) -> str:
+    """Version string of the TotalSegmentator package providing ``func``."""
+    package = func.__module__.split(".")[0]
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+        for dist in (package, "TotalSegmentator"):
+            try:
+                return f"{dist}=={version(dist)}"
+            except PackageNotFoundError:
+                continue
+    except ImportError:
+        pass
+    # Copia sin metadatos (p. ej. la incluida en models/): usar su fichero
+    try:
+        st = os.stat(sys.modules[func.__module__].__file__)
+        return f"{package}@{st.st_size}:{st.st_mtime_ns}"
+    except (KeyError, AttributeError, TypeError, OSError):
+        return f"{package}@unknown"
+
+
+class SegmentationResultCache(SeriesVolumeCache):
+    """Raw TotalSegmentator label maps keyed by input content and task settings.
+
+    Entries use the same ``<key>.npy`` + ``<key>.json`` layout and LRU
+    eviction as :class:`SeriesVolumeCache`.  The ``.npy`` holds the label
+    map exactly as returned (``(X, Y, Z)``, uint8 or uint16) and the JSON its
+    affine, voxel sizes and the settings it was computed with.
+    """
+
+    def __init__(self, root: str = SEG_CACHE_DIR, max_bytes: Optional[int] = None):
+        super().__init__(root, max_bytes if max_bytes is not None else int(DEFAULT_SEG_CACHE_MAX_GB * 2**30))
+
+    @staticmethod
+    def key_for(content_hash: str, task: str, fast: bool, roi_subset, version: str) -> str:
+        desc = json.dumps([content_hash, task, bool(fast), sorted(roi_subset) if roi_subset else None, version])
+        safe_task = re.sub(r"[^0-9A-Za-z_]", "_", task)[:32]
+        return f"{safe_task}_{hashlib.sha1(desc.encode('utf-8')).hexdigest()[:20]}"
+
+    def get(self, key: str):
+        """Return ``(labels, meta)`` for ``key`` or ``None`` on a miss."""
+        npy_path, json_path = self._paths(key)
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            labels = np.load(npy_path)
+        except (OSError, ValueError):
+            return None
+        if list(labels.shape) != meta.get("shape"):
+            return None
+        try:
+            os.utime(json_path)  # marca de uso para la política LRU
+        except OSError:
+            pass
+        return labels, meta
+
+    def put(self, key: str, labels: np.ndarray, meta: dict) -> None:
+        labels = np.asarray(labels)
+        dtype = np.uint8 if labels.size == 0 or labels.max() < 256 else np.uint16
+        meta = dict(meta, shape=list(labels.shape), created=datetime.now().isoformat(timespec="seconds"))
+        npy_path, json_path = self._paths(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(npy_path + suffix, "wb") as f:
+            np.save(f, labels.astype(dtype, copy=False))
+        os.replace(npy_path + suffix, npy_path)
+        with open(json_path + suffix, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(json_path + suffix, json_path)
+        self.prune()
+
+    def summary(self) -> dict:
+        """Entry count, size and per-task breakdown, for the command line."""
+        tasks: dict[str, int] = {}
+        entries = self.entries()
+        for _, key, _ in entries:
+            try:
+                with open(self._paths(key)[1], "r", encoding="utf-8") as f:
+                    task = json.load(f).get("task", "?")
+            except (OSError, ValueError):
+                task = "?"
+            tasks[task] = tasks.get(task, 0) + 1
+        return {
+            "root": self.root,
+            "entries": len(entries),
+            "bytes": sum(size for _, _, size in entries),
+            "max_bytes": self.max_bytes,
+            "tasks": tasks,
+            "oldest_use": datetime.fromtimestamp(min(e[0] for e in entries)).isoformat(timespec="seconds") if entries else None,
+        }
+
+
 # -------------------------------------------------------------------------
 # Logging
 # -------------------------------------------------------------------------
@@ -943,60 +1932,138 @@ def build_organ_to_tasks_map(task_labels: dict[str, dict[str, int]]) -> dict[str
     return organ_to_tasks
 
 
-def get_optimal_task_for_organ(organ: str, organ_to_tasks: dict[str, list[str]]) -> str:
-    """
-    Determina la task óptima para segmentar un órgano específico.
+# Tiempos medidos por task (segundos) para el planificador.  Se guardan por
+# perfil "<dispositivo>:<resolución>" (p. ej. "gpu:full", "cpu:fast") en
+# ~/.aura_cache/task_runtimes.json; mientras una task no se haya medido se usa
+# una estimación a priori igual para todas, de modo que el plan minimiza el
+# número de tasks.
+TASK_RUNTIMES_PATH = os.path.join(os.path.expanduser("~"), ".aura_cache", "task_runtimes.json")
+DEFAULT_TASK_RUNTIME_S = {"gpu:full": 60.0, "gpu:fast": 20.0, "cpu:full": 600.0, "cpu:fast": 120.0}
+TASK_RUNTIME_SAMPLES = 10
+
+
+def task_runtime_profile(device: str, fast: bool) -> str:
+    """Profile key for runtime measurements: ``"gpu"``/``"cpu"`` plus resolution."""
+    return f"{'gpu' if str(device).startswith(('gpu', 'cuda')) else 'cpu'}:{'fast' if fast else 'full'}"
 
-    Prioridad:
-    1. 'total' si está disponible (más rápida, órganos principales)
-    2. Task más específica disponible
-    3. Primera task disponible
-    """
-    tasks = organ_to_tasks.get(organ, [])
 
-    if not tasks:
-        return 'total'  # fallback
+class TaskRuntimeStats:
+    """Persisted per-task runtimes, keyed by :func:`task_runtime_profile`.
 
-    # Priorizar 'total' si está disponible
-    if 'total' in tasks:
-        return 'total'
+    The last :data:`TASK_RUNTIME_SAMPLES` measurements of each task are kept
+    and their median is the estimate.  The JSON file is rewritten atomically
+    after each measurement.
+    """
 
-    # Preferir tasks específicas sobre genéricas
-    priority_order = ['body', 'liver_vessels', 'head_glands_cavities',
-                     'headneck_muscles', 'oculomotor_muscles']
+    def __init__(self, path: str = TASK_RUNTIMES_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self._samples: dict[str, dict[str, list[float]]] = data if isinstance(data, dict) else {}
+
+    def record(self, profile: str, task: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(profile, {}).setdefault(task, [])
+            samples.append(round(float(seconds), 2))
+            del samples[:-TASK_RUNTIME_SAMPLES]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._samples, f, indent=1)
+            os.replace(tmp, self.path)
+
+    def estimate(self, profile: str, task: str) -> Optional[float]:
+        """Median measured runtime of ``task`` or ``None`` if never measured."""
+        samples = self._samples.get(profile, {}).get(task)
+        if not samples:
+            return None
+        return float(np.median(samples))
 
-    for priority_task in priority_order:
-        if priority_task in tasks:
-            return priority_task
+    def cost_function(self, profile: str):
+        """``task -> seconds`` using measurements, or the profile's prior."""
+        prior = DEFAULT_TASK_RUNTIME_S.get(profile, DEFAULT_TASK_RUNTIME_S["gpu:full"])
 
-    return tasks[0]
+        def cost(task: str) -> float:
+            measured = self.estimate(profile, task)
+            return measured if measured is not None else prior
+        return cost
 
 
 def compute_required_tasks(
     selected_organs: set[str],
     organ_to_tasks: dict[str, list[str]],
-    task_labels: dict[str, dict[str, int]]
+    task_labels: dict[str, dict[str, int]],
+    task_cost=None,
 ) -> dict[str, set[str]]:
     """
     Determina qué tasks ejecutar y qué órganos solicitar de cada una.
 
+    Resuelve un recubrimiento de conjuntos ponderado: elige de forma voraz
+    la task con menor coste por órgano nuevo cubierto y después descarta las
+    tasks cuyos órganos ya cubren las demás.  ``task_cost(task)`` devuelve el
+    tiempo estimado en segundos; sin él todas las tasks cuestan lo mismo.
+    Los empates se resuelven a favor de 'total'.
+
     Returns:
         Dict donde key=task_name, value=set de órganos a solicitar
     """
-    task_assignments: dict[str, set[str]] = {}
-
+    cost = task_cost or (lambda task: 1.0)
+    candidates: dict[str, set[str]] = {}
     for organ in selected_organs:
-        optimal_task = get_optimal_task_for_organ(organ, organ_to_tasks)
+        for task in organ_to_tasks.get(organ, []):
+            if task in task_labels and organ in task_labels[task]:
+                candidates.setdefault(task, set()).add(organ)
+    costs = {task: max(float(cost(task)), 1e-6) for task in candidates}
+
+    def rank(task: str, covered: int):
+        return (costs[task] / covered, task != 'total', task)
+
+    uncovered = set().union(*candidates.values()) if candidates else set()
+    chosen: list[str] = []
+    while uncovered:
+        best = min(
+            (t for t in candidates if t not in chosen and candidates[t] & uncovered),
+            key=lambda t: rank(t, len(candidates[t] & uncovered)),
+        )
+        chosen.append(best)
+        uncovered -= candidates[best]
 
-        # Verificar que la task realmente contiene el órgano
-        if optimal_task in task_labels and organ in task_labels[optimal_task]:
-            if optimal_task not in task_assignments:
-                task_assignments[optimal_task] = set()
-            task_assignments[optimal_task].add(organ)
+    # Quitar tasks redundantes, empezando por la más cara
+    for task in sorted(chosen, key=lambda t: (-costs[t], t)):
+        others = set().union(*(candidates[t] for t in chosen if t != task))
+        if candidates[task] <= others:
+            chosen.remove(task)
 
+    # Cada órgano se pide a la task elegida más barata que lo contiene
+    task_assignments: dict[str, set[str]] = {}
+    for organ in selected_organs:
+        owners = [t for t in chosen if organ in candidates[t]]
+        if owners:
+            owner = min(owners, key=lambda t: (costs[t], t != 'total', t))
+            task_assignments.setdefault(owner, set()).add(organ)
     return task_assignments
 
 
+def estimate_plan_seconds(task_assignments: dict[str, set[str]], task_cost) -> float:
+    """Estimated runtime of a plan returned by :func:`compute_required_tasks`."""
+    return float(sum(task_cost(task) for task in task_assignments))
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
 # Categorización de órganos para la UI
 ORGAN_CATEGORIES = {
     "Abdomen": [
@@ -1122,9 +2189,10 @@ class LNQ2023Backend(LymphNodeBackend):
     Requiere anatomical priors generados por TotalSegmentator.
     """
 
-    def __init__(self, device='cpu', totalseg_cache=None):
+    def __init__(self, device='cpu', totalseg_cache=None, volume_cache=None):
         super().__init__(device)
         self.totalseg_cache = totalseg_cache  # Para reutilizar segmentaciones previas
+        self.volume_cache = volume_cache  # SeriesVolumeCache compartida (opcional)
         self.model_path = None
 
     def load_model(self):
@@ -1191,7 +2259,7 @@ class LNQ2023Backend(LymphNodeBackend):
                 quiet=True
             )
 
-            seg_data = seg_img.get_fdata().astype(np.uint16)
+            seg_data = np.asanyarray(seg_img.dataobj).astype(np.uint16, copy=False)
 
             # Generar prior channels (simplificado)
             # En producción, esto debería incluir registro atlas-to-patient
@@ -1251,7 +2319,7 @@ class LNQ2023Backend(LymphNodeBackend):
                 # Leer resultado
                 result_file = os.path.join(output_dir, os.listdir(output_dir)[0])
                 result_img = nib.load(result_file)
-                mask = result_img.get_fdata().astype(np.uint8)
+                mask = np.asanyarray(result_img.dataobj)
 
                 # Transponer si es necesario (depende de orientación DICOM)
                 if mask.ndim == 3:
@@ -1263,11 +2331,14 @@ class LNQ2023Backend(LymphNodeBackend):
             raise RuntimeError(f"LNQ2023 segmentation failed: {e}")
 
     def _dicom_to_nifti(self, dicom_dir: str, output_dir: str) -> str:
-        """Convierte serie DICOM a NIfTI."""
+        """Convierte serie DICOM a NIfTI.
+
+        El volumen se obtiene de la caché de volúmenes compartida cuando está
+        disponible, en lugar de decodificar la serie de nuevo, y se devuelve
+        a los valores almacenados en el DICOM (sin rescale) como antes.
+        """
         try:
             import nibabel as nib  # type: ignore
-            import pydicom
-            from scipy.ndimage import zoom  # type: ignore
 
             # Leer archivos DICOM
             dicom_files = sorted([
@@ -1279,17 +2350,13 @@ class LNQ2023Backend(LymphNodeBackend):
             if not dicom_files:
                 raise ValueError("No DICOM files found")
 
-            # Leer slices
-            slices = [pydicom.dcmread(f) for f in dicom_files]
-            slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
-
-            # Crear volumen 3D
-            img_shape = list(slices[0].pixel_array.shape)
-            img_shape.append(len(slices))
-            volume = np.zeros(img_shape, dtype=np.int16)
-
-            for i, s in enumerate(slices):
-                volume[:, :, i] = s.pixel_array
+            # Volumen (Z, Y, X) ordenado por posición Z -> (Y, X, Z)
+            vol, geometry = load_series_volume(dicom_files, cache=self.volume_cache)
+            z_pos = [p[2] for p in geometry["positions"]]
+            order = np.argsort(z_pos, kind="stable")
+            rescale = np.asarray(geometry["rescale"], dtype=np.float32)[order]
+            stored = (vol[order] - rescale[:, 1, None, None]) / rescale[:, 0, None, None]
+            volume = np.rint(stored).astype(np.int16).transpose(1, 2, 0)
 
             # Crear NIfTI
             nifti_img = nib.Nifti1Image(volume, np.eye(4))
@@ -1406,8 +2473,9 @@ class LymphNodeSegmentationEngine:
         }
     }
 
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', volume_cache=None):
         self.device = device
+        self.volume_cache = volume_cache  # SeriesVolumeCache del motor principal (opcional)
         self.backends: dict[str, LymphNodeBackend] = {}
 
     def load_backend(self, backend_name: str, **kwargs):
@@ -1423,6 +2491,7 @@ class LymphNodeSegmentationEngine:
             model_type = backend_name.split('_')[1]
             backend = backend_class(model_type=model_type, device=self.device)
         else:
+            kwargs.setdefault('volume_cache', self.volume_cache)
             backend = backend_class(device=self.device, **kwargs)
 
         # Cargar modelo
@@ -1667,48 +2736,1289 @@ def _resize_with_numpy(pred_array, target_shape):
     return resized
 
 
-# ============================================================================
-# VENTANA UNIFICADA DE SELECCIÓN DE ÓRGANOS
-# ============================================================================
+# -------------------------------------------------------------------------
+# Máscaras compactas (bounding box)
+# -------------------------------------------------------------------------
+# Una máscara de órgano ocupa una fracción mínima del volumen del CT; con
+# 100+ órganos las máscaras booleanas completas suman gigabytes de ceros que
+# se mantienen vivos hasta que termina el RTSTRUCT.  CompactMask guarda solo
+# la caja envolvente y su recorte (opcionalmente empaquetado a 1 bit/voxel).
+class CompactMask:
+    """Binary mask stored as a bounding box plus the cropped array.
+
+    ``shape`` is the shape of the full volume and ``bbox`` a tuple of slices
+    into it (``None`` for an empty mask).  The crop is kept as a bool array
+    or, when ``packed``, as ``np.packbits`` output.  Operations that need
+    context around the structure (hole filling, smoothing, dilation) run on
+    ``expanded(margin)``; ``to_dense()`` rebuilds the full-size mask only for
+    consumers that require it (rt_utils).
+    """
 
+    __slots__ = ("shape", "bbox", "packed", "_data", "_crop_shape")
 
-class UnifiedOrganSelector(tk.Toplevel):
-    """
-    Ventana mejorada para selección de órganos con:
-    - Categorías colapsables
-    - Búsqueda en tiempo real
-    - Vista previa de tasks necesarias
-    - Selección por presets comunes
-    """
+    def __init__(self, shape, bbox=None, crop: Optional[np.ndarray] = None, packed: bool = False):
+        self.shape = tuple(int(s) for s in shape)
+        self.packed = bool(packed)
+        self.bbox = None
+        self._data: Optional[np.ndarray] = None
+        self._crop_shape: tuple = (0,) * len(self.shape)
+        if bbox is None or crop is None:
+            return
+        crop = np.asarray(crop, dtype=bool)
+        # Ajustar la caja al contenido real (la limpieza/suavizado puede encogerla)
+        inner = self._bounds(crop)
+        if inner is None:
+            return
+        self.bbox = tuple(
+            slice(int(outer.start) + int(sl.start), int(outer.start) + int(sl.stop))
+            for outer, sl in zip(bbox, inner)
+        )
+        crop = crop[inner]
+        self._crop_shape = crop.shape
+        self._data = np.packbits(crop, axis=None) if self.packed else np.ascontiguousarray(crop)
+
+    @staticmethod
+    def _bounds(crop: np.ndarray):
+        """Slices of the non-zero extent of ``crop``, or ``None`` if empty."""
+        bounds = []
+        for axis in range(crop.ndim):
+            other = tuple(a for a in range(crop.ndim) if a != axis)
+            nz = np.flatnonzero(crop.any(axis=other))
+            if nz.size == 0:
+                return None
+            bounds.append(slice(int(nz[0]), int(nz[-1]) + 1))
+        return tuple(bounds)
+
+    @classmethod
+    def from_dense(cls, mask: np.ndarray, packed: bool = False) -> "CompactMask":
+        mask = np.asarray(mask)
+        full = tuple(slice(0, s) for s in mask.shape)
+        return cls(mask.shape, full, mask.astype(bool, copy=False), packed=packed)
+
+    @classmethod
+    def from_labels(cls, labels: np.ndarray, label_ids: dict[str, int],
+                    packed: bool = False) -> dict[str, "CompactMask"]:
+        """Split a label volume into compact masks, one per entry of ``label_ids``.
+
+        The bounding boxes of all labels come from a single
+        ``scipy.ndimage.find_objects`` pass; each mask is then compared only
+        inside its own box.  Labels absent from the volume are omitted.
+        """
+        labels = np.asarray(labels)
+        wanted = {name: int(idx) for name, idx in label_ids.items() if int(idx) > 0}
+        if not wanted or labels.size == 0:
+            return {}
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = labels.astype(np.int32)
+        boxes = cls.label_boxes(labels, max(wanted.values()))
+        result: dict[str, CompactMask] = {}
+        for name, idx in wanted.items():
+            if boxes is not None:
+                box = boxes[idx - 1]
+                if box is None:
+                    continue
+                mask = cls(labels.shape, box, labels[box] == idx, packed=packed)
+            else:
+                mask = cls.from_dense(labels == idx, packed=packed)
+            if mask.any():
+                result[name] = mask
+        return result
 
-    def __init__(self, parent, task_labels: dict[str, dict[str, int]],
-                 current_selection: set[str], callback):
-        super().__init__(parent)
+    @staticmethod
+    def label_boxes(labels: np.ndarray, max_label: int) -> Optional[list]:
+        """Bounding box of labels ``1..max_label`` (``None`` if absent).
 
-        self.task_labels = task_labels
-        self.organ_to_tasks = build_organ_to_tasks_map(task_labels)
-        self.callback = callback
+        One ``scipy.ndimage.find_objects`` pass; returns ``None`` when scipy
+        is not available.
+        """
+        if not SCIPY_AVAILABLE:
+            return None
+        try:
+            import scipy.ndimage as ndi  # type: ignore
+            return ndi.find_objects(labels, max_label=int(max_label))
+        except Exception:
+            return None
 
-        # Estado
-        self.selected_organs: set[str] = set(current_selection)
-        self.organ_vars: dict[str, tk.BooleanVar] = {}
-        self.category_frames: dict[str, tuple] = {}
-        self.organ_checkboxes: dict[str, ttk.Checkbutton] = {}
+    @classmethod
+    def union(cls, masks, packed: Optional[bool] = None) -> "CompactMask":
+        """Logical OR of several masks over the same volume."""
+        masks = [m if isinstance(m, CompactMask) else cls.from_dense(m) for m in masks]
+        if not masks:
+            raise ValueError("CompactMask.union() needs at least one mask")
+        if packed is None:
+            packed = masks[0].packed
+        shape = masks[0].shape
+        present = [m for m in masks if m.bbox is not None]
+        if not present:
+            return cls(shape, packed=packed)
+        starts = [min(m.bbox[a].start for m in present) for a in range(len(shape))]
+        stops = [max(m.bbox[a].stop for m in present) for a in range(len(shape))]
+        crop = np.zeros([b - a for a, b in zip(starts, stops)], dtype=bool)
+        for m in present:
+            region = tuple(slice(s.start - o, s.stop - o) for s, o in zip(m.bbox, starts))
+            crop[region] |= m.crop
+        return cls(shape, tuple(slice(a, b) for a, b in zip(starts, stops)), crop, packed=packed)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def crop(self) -> np.ndarray:
+        """Bool array of the bounding box contents."""
+        if self._data is None:
+            return np.zeros(self._crop_shape, dtype=bool)
+        if self.packed:
+            count = int(np.prod(self._crop_shape))
+            return np.unpackbits(self._data, count=count).view(bool).reshape(self._crop_shape)
+        return self._data
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self._data is None else int(self._data.nbytes)
+
+    def any(self) -> bool:
+        return self._data is not None
+
+    def count(self) -> int:
+        """Number of voxels set."""
+        if self._data is None:
+            return 0
+        if self.packed:
+            return int(np.unpackbits(self._data).sum())
+        return int(np.count_nonzero(self._data))
+
+    sum = count  # compatibilidad con el código que trataba máscaras como ndarray
+
+    def expanded(self, margin) -> tuple:
+        """``(bbox, crop)`` grown by ``margin`` voxels per axis, clipped to the volume."""
+        if np.isscalar(margin):
+            margin = (margin,) * self.ndim
+        if self.bbox is None:
+            return None, np.zeros(self._crop_shape, dtype=bool)
+        bbox = tuple(
+            slice(max(0, s.start - int(m)), min(n, s.stop + int(m)))
+            for s, m, n in zip(self.bbox, margin, self.shape)
+        )
+        crop = np.zeros([s.stop - s.start for s in bbox], dtype=bool)
+        crop[tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(self.bbox, bbox))] = self.crop
+        return bbox, crop
 
-        self._setup_window()
-        self._create_widgets()
-        self._update_task_preview()
+    def apply(self, func, margin=0) -> "CompactMask":
+        """Run ``func`` on the (expanded) crop and wrap the result.
 
-    def _setup_window(self):
-        self.title("Select Organs for Segmentation")
-        self.geometry("900x700")
-        self.transient(self.master)
-        self.grab_set()
+        ``margin`` must cover the reach of ``func`` so that the result equals
+        running it on the full volume.
+        """
+        if self.bbox is None:
+            return self
+        bbox, crop = self.expanded(margin)
+        return CompactMask(self.shape, bbox, func(crop), packed=self.packed)
+
+    def transpose(self, axes) -> "CompactMask":
+        out = CompactMask(tuple(self.shape[a] for a in axes), packed=self.packed)
+        if self.bbox is not None:
+            out.bbox = tuple(self.bbox[a] for a in axes)
+            crop = np.ascontiguousarray(self.crop.transpose(axes))
+            out._crop_shape = crop.shape
+            out._data = np.packbits(crop, axis=None) if self.packed else crop
+        return out
+
+    def to_dense(self, dtype=bool) -> np.ndarray:
+        out = np.zeros(self.shape, dtype=dtype)
+        if self.bbox is not None:
+            out[self.bbox] = self.crop
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(bool if dtype is None else dtype)
+
+    def __repr__(self) -> str:
+        box = None if self.bbox is None else [(s.start, s.stop) for s in self.bbox]
+        return f"CompactMask(shape={self.shape}, bbox={box}, packed={self.packed})"
 
-    def _create_widgets(self):
-        # Header con búsqueda
-        header = ttk.Frame(self, padding=10)
-        header.pack(fill="x")
+
+# -------------------------------------------------------------------------
+# Correspondencia entre la rejilla de la segmentación y la del RTSTRUCT
+# -------------------------------------------------------------------------
+# rt_utils espera máscaras (Rows, Cols, Slices) con los cortes ordenados por
+# su posición a lo largo de la normal.  Con la afín de la predicción (salida
+# de TotalSegmentator o metadatos de MONAI) y la geometría DICOM, la
+# correspondencia se calcula una vez por paciente.  En el caso habitual es
+# una permutación de ejes con inversiones, que se aplica al recorte de cada
+# CompactMask sin reconstruir el volumen completo ni probar transposiciones.
+def rtstruct_grid_affine(series_data) -> np.ndarray:
+    """RAS affine of the ``(row, column, slice)`` indices of an rt_utils mask.
+
+    ``series_data`` are the datasets of the RTStruct, already sorted along
+    the slice normal.
+    """
+    first = series_data[0]
+    try:
+        slice_thickness = float(first.SliceThickness)
+    except Exception:
+        slice_thickness = None
+    affine = _series_affine([float(v) for v in first.ImageOrientationPatient],
+                            [float(v) for v in first.PixelSpacing],
+                            [[float(v) for v in ds.ImagePositionPatient] for ds in series_data],
+                            slice_thickness)
+    return affine[:, [1, 0, 2, 3]]
+
+
+class MaskGridMapper:
+    """Map :class:`CompactMask` objects from one voxel grid onto another.
+
+    ``index`` is the 4x4 matrix taking destination voxel indices to source
+    voxel indices.  When its linear part is a signed permutation and the
+    offsets are integers (same voxels, different axis order or direction)
+    masks are re-indexed by transposing and flipping their crop; otherwise
+    they are resampled with nearest neighbour inside the destination box
+    covered by the mask.  Either way the full-size volume is never built.
+    """
+
+    TOLERANCE = 1e-3
+
+    def __init__(self, src_shape, dst_shape, index, source: str = "affine"):
+        self.src_shape = tuple(int(s) for s in src_shape)
+        self.dst_shape = tuple(int(s) for s in dst_shape)
+        self.index = np.asarray(index, dtype=float)
+        self.source = source
+        self.axes: Optional[tuple] = None  # eje de origen de cada eje de destino
+        self.signs: Optional[tuple] = None
+        self.offsets: Optional[tuple] = None
+        linear = self.index[:3, :3]
+        rounded = np.rint(linear)
+        offsets = self.index[:3, 3]
+        if (np.allclose(linear, rounded, atol=self.TOLERANCE)
+                and (np.abs(rounded).sum(axis=0) == 1).all()
+                and (np.abs(rounded).sum(axis=1) == 1).all()
+                and np.allclose(offsets, np.rint(offsets), atol=self.TOLERANCE)):
+            self.axes = tuple(int(np.argmax(np.abs(rounded[:, i]))) for i in range(3))
+            self.signs = tuple(int(rounded[a, i]) for i, a in enumerate(self.axes))
+            self.offsets = tuple(int(np.rint(offsets[a])) for a in self.axes)
+
+    @classmethod
+    def from_affines(cls, src_shape, src_affine, dst_shape, dst_affine) -> "MaskGridMapper":
+        """Mapper between two grids given the RAS affines of their indices."""
+        index = np.linalg.solve(np.asarray(src_affine, dtype=float), np.asarray(dst_affine, dtype=float))
+        return cls(src_shape, dst_shape, index, "affine")
+
+    @classmethod
+    def from_shapes(cls, src_shape, dst_shape, max_distortion: float = 0.3) -> Optional["MaskGridMapper"]:
+        """Mapper for masks without geometry, from their shapes alone.
+
+        Tries the ``(Z, Y, X) -> (Y, X, Z)`` transpose, then any axis order
+        giving ``dst_shape``; failing that the mask is scaled onto the
+        destination axis by axis unless the scale factors differ by more
+        than ``max_distortion``, like :func:`smart_resize_prediction`.
+        Returns ``None`` when no mapping applies.
+        """
+        src_shape = tuple(int(s) for s in src_shape)
+        dst_shape = tuple(int(s) for s in dst_shape)
+        if len(src_shape) != 3 or len(dst_shape) != 3:
+            return None
+        perms = [(1, 2, 0), (0, 1, 2), (2, 1, 0), (0, 2, 1), (1, 0, 2), (2, 0, 1)]
+        for perm in perms:
+            if tuple(src_shape[a] for a in perm) == dst_shape:
+                index = np.eye(4)
+                index[:3, :3] = 0.0
+                for i, a in enumerate(perm):
+                    index[a, i] = 1.0
+                return cls(src_shape, dst_shape, index, "shape")
+        # Escalado eje a eje, alineando los centros de vóxel
+        scales = [a / b for a, b in zip(src_shape, dst_shape)]
+        if (max(scales) - min(scales)) / min(scales) > max_distortion:
+            return None
+        index = np.eye(4)
+        for i, s in enumerate(scales):
+            index[i, i] = s
+            index[i, 3] = 0.5 * s - 0.5
+        return cls(src_shape, dst_shape, index, "shape")
+
+    @property
+    def exact(self) -> bool:
+        return self.axes is not None
+
+    def describe(self) -> str:
+        if not self.exact:
+            return "nearest-neighbour resampling"
+        flipped = [i for i, s in enumerate(self.signs) if s < 0]
+        return f"axes {self.axes}" + (f", flipped {flipped}" if flipped else "")
+
+    def map(self, mask) -> CompactMask:
+        """Return ``mask`` (compact or dense) on the destination grid."""
+        if not isinstance(mask, CompactMask):
+            mask = CompactMask.from_dense(mask)
+        if mask.shape != self.src_shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match the source grid {self.src_shape}")
+        if mask.bbox is None:
+            return CompactMask(self.dst_shape, packed=mask.packed)
+        if self.exact:
+            return self._reindex(mask)
+        return self._resample(mask)
+
+    def _reindex(self, mask: CompactMask) -> CompactMask:
+        crop = mask.crop.transpose(self.axes)
+        box, keep, flip = [], [], []
+        for i, (a, sign, off) in enumerate(zip(self.axes, self.signs, self.offsets)):
+            src = mask.bbox[a]
+            # índice origen = sign * índice destino + off
+            if sign > 0:
+                start, stop = src.start - off, src.stop - off
+            else:
+                start, stop = off - src.stop + 1, off - src.start + 1
+                flip.append(i)
+            lo, hi = max(start, 0), min(stop, self.dst_shape[i])
+            if lo >= hi:
+                return CompactMask(self.dst_shape, packed=mask.packed)
+            box.append(slice(lo, hi))
+            keep.append(slice(lo - start, hi - start))
+        if flip:
+            crop = np.flip(crop, axis=tuple(flip))
+        return CompactMask(self.dst_shape, tuple(box), crop[tuple(keep)], packed=mask.packed)
+
+    def _resample(self, mask: CompactMask) -> CompactMask:
+        # Caja de destino que cubre los vóxeles de la máscara
+        inverse = np.linalg.inv(self.index)
+        edges = [(s.start - 0.5, s.stop - 0.5) for s in mask.bbox]
+        corners = np.array([[x, y, z, 1.0] for x in edges[0] for y in edges[1] for z in edges[2]])
+        dst = (inverse @ corners.T)[:3]
+        lo = np.maximum(np.floor(dst.min(axis=1)).astype(int), 0)
+        hi = np.minimum(np.ceil(dst.max(axis=1)).astype(int) + 1, self.dst_shape)
+        if (lo >= hi).any():
+            return CompactMask(self.dst_shape, packed=mask.packed)
+        linear = self.index[:3, :3]
+        src_start = np.array([s.start for s in mask.bbox], dtype=float)
+        offset = linear @ lo + self.index[:3, 3] - src_start
+        out_shape = tuple(int(h - l) for l, h in zip(lo, hi))
+        crop = mask.crop
+        if SCIPY_AVAILABLE:
+            import scipy.ndimage as ndi  # type: ignore
+            out = ndi.affine_transform(crop.view(np.uint8), linear, offset=offset, output_shape=out_shape,
+                                       order=0, mode="grid-constant", cval=0) > 0
+        else:
+            out = np.zeros(out_shape, dtype=bool)
+            grid = np.indices(out_shape[1:], dtype=float).reshape(2, -1)
+            for u in range(out_shape[0]):
+                pts = np.vstack([np.full(grid.shape[1], float(u)), grid])
+                src = np.floor(linear @ pts + offset[:, None] + 0.5).astype(int)  # como scipy (order=0)
+                inside = ((src >= 0) & (src < np.array(crop.shape)[:, None])).all(axis=0)
+                values = np.zeros(grid.shape[1], dtype=bool)
+                values[inside] = crop[tuple(src[:, inside])]
+                out[u] = values.reshape(out_shape[1:])
+        bbox = tuple(slice(int(l), int(h)) for l, h in zip(lo, hi))
+        return CompactMask(self.dst_shape, bbox, out, packed=mask.packed)
+
+
+# -------------------------------------------------------------------------
+# Suavizado morfológico con radio en milímetros
+# -------------------------------------------------------------------------
+# Cierre + apertura con una bola de radio físico mediante transformadas de
+# distancia: el coste no depende del radio y respeta el espaciado anisótropo,
+# a diferencia de repetir N iteraciones de un elemento 3x3x3.
+def morphological_smooth_mm(mask: np.ndarray, radius_mm: float, spacing) -> np.ndarray:
+    """Closing followed by opening with a ball of ``radius_mm`` millimetres.
+
+    Each dilation/erosion is a threshold on a Euclidean distance transform
+    computed with the voxel ``spacing`` (Z, Y, X), so the radius is exact in
+    mm even on anisotropic grids and the cost does not grow with it.  The
+    array is padded with background first: voxels outside it count as
+    background, so cropping the input to the structure's bounding box gives
+    the same result as the full volume.
+    """
+    import scipy.ndimage as ndi  # type: ignore
+
+    spacing = tuple(float(s) for s in spacing)
+    radius_mm = float(radius_mm)
+    pad = [int(np.ceil(radius_mm / s)) + 1 for s in spacing]
+    work = np.pad(np.asarray(mask, dtype=bool), [(p, p) for p in pad])
+    if not work.any():
+        return np.zeros(mask.shape, dtype=bool)
+    # Cierre: dilatar y erosionar
+    dilated = ndi.distance_transform_edt(~work, sampling=spacing) <= radius_mm
+    closed = ndi.distance_transform_edt(dilated, sampling=spacing) > radius_mm
+    # Apertura: erosionar y dilatar
+    eroded = ndi.distance_transform_edt(closed, sampling=spacing) > radius_mm
+    if not eroded.any():
+        return np.zeros(mask.shape, dtype=bool)
+    opened = ndi.distance_transform_edt(~eroded, sampling=spacing) <= radius_mm
+    return opened[tuple(slice(p, p + n) for p, n in zip(pad, mask.shape))]
+
+
+# -------------------------------------------------------------------------
+# Postprocesado de máscaras por órgano en paralelo
+# -------------------------------------------------------------------------
+# Rellenado de agujeros, etiquetado de componentes y suavizado son llamadas
+# de scipy.ndimage que liberan el GIL, así que los órganos se procesan en un
+# pool de hilos.  Se hace durante la exportación, mientras el pool de
+# procesos extrae los contornos de los órganos anteriores, así que los dos
+# pools se reparten los núcleos.  En lote la exportación se solapa además con
+# la lectura y la segmentación del siguiente paciente (que también usa CPU
+# con GPU: preprocesado y remuestreo), y la etapa se queda con la mitad.
+def default_export_workers(contours: bool = True, pipelined: bool = False,
+                           postprocess: int = 0, contour: int = 0) -> tuple[int, int]:
+    """``(threads, processes)`` for mask postprocessing and contour extraction.
+
+    Both pools run side by side during the export and share one core
+    budget: every core, or half of them when ``pipelined`` with other batch
+    stages.  Counts given as ``postprocess``/``contour`` (> 0) are kept and
+    the automatic ones take the rest; without ``contours`` postprocessing
+    gets the whole budget.
+    """
+    cores = os.cpu_count() or 1
+    budget = max(1, cores // 2) if pipelined else cores
+    if postprocess <= 0:
+        postprocess = budget - contour if contour > 0 else (budget // 2 if contours else budget)
+    if contour <= 0:
+        contour = budget - postprocess
+    return max(1, postprocess), max(1, contour)
+
+
+# -------------------------------------------------------------------------
+# Flujo de máscaras por órgano para la exportación
+# -------------------------------------------------------------------------
+# La segmentación solo conserva sus mapas de etiquetas (un volumen entero por
+# task) y la caja de cada etiqueta.  La exportación del RTSTRUCT recorre los
+# órganos de uno en uno: recorte, limpieza, suavizado, contornos y la máscara
+# se descarta.  Las estructuras derivadas (pulmones, body, skin) se acumulan
+# al paso y se emiten al final, así que la memoria no crece con el número de
+# órganos seleccionados.
+LUNG_LOBES = {
+    "lung_left": ("lung_upper_lobe_left", "lung_lower_lobe_left"),
+    "lung_right": ("lung_upper_lobe_right", "lung_middle_lobe_right", "lung_lower_lobe_right"),
+}
+
+
+class MaskStream:
+    """Organ masks of one segmentation, built one at a time from label maps.
+
+    ``add_labels`` registers a label volume and the organs wanted from it;
+    organs already provided by an earlier map are skipped, so the first
+    task that finds an organ wins.  ``AutoSegEngine._iter_masks`` turns the
+    stream into ``(name, CompactMask)`` pairs.  With ``derive`` the lung
+    lobes are merged into ``lung_left``/``lung_right`` and ``body``/``skin``
+    are derived when ``selection`` asks for them and no task produced them.
+    """
+
+    def __init__(self, selection=None, derive: bool = False):
+        self.selection = set(selection or ())
+        self.derive = bool(derive)
+        self.spacing: Optional[Tuple[float, float, float]] = None
+        self.sources: list[dict] = []
+        self._names: dict[str, int] = {}
+
+    def add_labels(self, labels: np.ndarray, label_ids: dict[str, int], smooth: bool = True,
+                   spacing: Optional[Tuple[float, float, float]] = None, packed: bool = False,
+                   context: str = "") -> list[str]:
+        """Register the organs of ``label_ids`` present in ``labels``.
+
+        Returns the names added.  ``labels`` is kept (not copied) until the
+        stream has been consumed.
+        """
+        labels = np.asarray(labels)
+        wanted = {name: int(idx) for name, idx in label_ids.items()
+                  if int(idx) > 0 and name not in self._names}
+        if not wanted or labels.size == 0:
+            return []
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = labels.astype(np.int32)
+        boxes = CompactMask.label_boxes(labels, max(wanted.values()))
+        organs: dict[str, tuple] = {}
+        for name, idx in wanted.items():
+            if boxes is not None:
+                box = boxes[idx - 1] if idx <= len(boxes) else None
+            else:
+                box = CompactMask._bounds(labels == idx)
+            if box is not None:
+                organs[name] = (idx, box)
+        if not organs:
+            return []
+        if self.spacing is None:
+            self.spacing = spacing
+        self.sources.append({"labels": labels, "organs": organs, "smooth": bool(smooth),
+                             "spacing": spacing, "packed": bool(packed), "context": context})
+        for name in organs:
+            self._names[name] = len(self.sources) - 1
+        return list(organs)
+
+    def names(self) -> list[str]:
+        """Organs found by the segmentation, before derived structures."""
+        return list(self._names)
+
+    def __contains__(self, name) -> bool:
+        return name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __bool__(self) -> bool:
+        return bool(self._names)
+
+    @staticmethod
+    def crops(source: dict):
+        """Yield ``(name, CompactMask)`` for the organs of one source, lazily."""
+        labels = source["labels"]
+        for name, (idx, box) in source["organs"].items():
+            yield name, CompactMask(labels.shape, box, labels[box] == idx, packed=source["packed"])
+
+
+
+# -------------------------------------------------------------------------
+# Exportación de la serie CT junto al RTSTRUCT
+# -------------------------------------------------------------------------
+# "copy" duplica cada corte (comportamiento histórico); "hardlink" y
+# "reflink" crean la carpeta CT sin copiar datos cuando origen y destino
+# están en el mismo sistema de ficheros (si no, se copia); "reference" no
+# escribe la carpeta CT: el RTSTRUCT referencia la serie original por UID.
+CT_EXPORT_MODES = ("copy", "hardlink", "reflink", "reference")
+
+# ioctl FICLONE de Linux (btrfs, XFS, bcachefs...)
+_FICLONE = 0x40049409
+
+
+def _reflink_file(src: str, dst: str) -> None:
+    """Clone ``src`` into ``dst`` sharing its data blocks (Linux only)."""
+    import fcntl  # no existe en Windows
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except BaseException:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        raise
+    shutil.copystat(src, dst)
+
+
+def export_series_file(src: str, dst: str, mode: str) -> str:
+    """Place ``src`` at ``dst`` using ``mode``; return the mode actually used.
+
+    ``hardlink`` and ``reflink`` fall back to a plain copy when the
+    filesystem or platform does not support them.
+    """
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    elif mode == "reflink":
+        try:
+            _reflink_file(src, dst)
+            return "reflink"
+        except (OSError, ImportError):
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _rtstruct_from_datasets(series_data: list):
+    """Sort ``series_data`` like rt_utils and wrap it in a new ``RTStruct``."""
+    from rt_utils import ds_helper, image_helper  # type: ignore
+    from rt_utils.rtstruct import RTStruct  # type: ignore
+
+    if not series_data:
+        raise ValueError("No DICOM images given for the RTSTRUCT")
+    series_data.sort(key=image_helper.get_slice_position)
+    return RTStruct(series_data, ds_helper.create_rtstruct_dataset(series_data))
+
+
+def rtstruct_from_files(files):
+    """``RTStructBuilder.create_new`` for an explicit list of slice files.
+
+    rt_utils only accepts a folder and reads every file in it; this builds
+    the same RTSTRUCT from the files of one series, wherever they live.
+    """
+    return _rtstruct_from_datasets([pydicom.dcmread(f) for f in files])
+
+
+def series_header_datasets(series: SeriesInfo) -> list:
+    """Header-only datasets for ``series`` rebuilt from its discovery records.
+
+    They carry exactly what rt_utils reads to create an RTSTRUCT (UIDs,
+    patient/study tags and slice geometry).  Raises ``ValueError`` when a
+    record lacks any of it, e.g. files scanned without the SOP UIDs.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage
+
+    datasets = []
+    for rec in series.records:
+        if not rec.get("sop_instance_uid") or any(
+                rec.get(key) is None for key in ("position", "orientation", "pixel_spacing", "rows", "columns")):
+            raise ValueError(f"Incomplete header record for {rec.get('path')}")
+        sop_class = rec.get("sop_class_uid") or CTImageStorage
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = sop_class
+        ds.file_meta.MediaStorageSOPInstanceUID = rec["sop_instance_uid"]
+        ds.SOPClassUID = sop_class
+        ds.SOPInstanceUID = rec["sop_instance_uid"]
+        ds.Modality = rec.get("modality") or "CT"
+        ds.SeriesInstanceUID = series.uid
+        ds.PatientName = rec.get("patient_name") or ""
+        for keyword, value in (rec.get("study_tags") or {}).items():
+            if value is not None:
+                setattr(ds, keyword, value)
+        ds.InstanceNumber = rec.get("instance_number", 0)
+        ds.ImagePositionPatient = rec["position"]
+        ds.ImageOrientationPatient = rec["orientation"]
+        ds.PixelSpacing = rec["pixel_spacing"]
+        if rec.get("slice_thickness") is not None:
+            ds.SliceThickness = rec["slice_thickness"]
+        ds.Rows = rec["rows"]
+        ds.Columns = rec["columns"]
+        datasets.append(ds)
+    return datasets
+
+
+def rtstruct_from_series(series: SeriesInfo):
+    """New RTSTRUCT for ``series`` built from discovery headers (no file reads).
+
+    Falls back to reading the slice files when the records are incomplete.
+    """
+    try:
+        series_data = series_header_datasets(series)
+    except ValueError as e:
+        logger.info(f"{e}; reading the series files for the RTSTRUCT")
+        return rtstruct_from_files(series.files)
+    return _rtstruct_from_datasets(series_data)
+
+
+# -------------------------------------------------------------------------
+# Extracción de contornos en paralelo
+# -------------------------------------------------------------------------
+# rt_utils recorre cada ROI corte a corte (OpenCV + bucles de Python) en un
+# solo núcleo.  Aquí el recorte de cada máscara se reparte en bloques de
+# cortes entre procesos, que devuelven los contornos ya en coordenadas de
+# paciente; después se ensamblan en el ROIContourSequence igual que add_roi.
+# Opcionalmente se simplifican con Douglas-Peucker (contour_tolerance_mm).
+CONTOUR_SLAB_SLICES = 32
+# Por debajo de este número de cortes (sumando todos los ROIs) arrancar los
+# procesos cuesta más que extraer los contornos en el proceso principal
+CONTOUR_POOL_MIN_SLICES = 4000
+
+
+def _contour_bytes(values) -> int:
+    """Length of ``values`` once written as a DICOM DS multi-value."""
+    return sum(len(repr(v)) for v in values) + max(0, len(values) - 1)
+
+
+def extract_slab_contours(crop: np.ndarray, offset, transform: np.ndarray,
+                          tolerance_px: float = 0.0) -> tuple:
+    """Planar contours of ``crop`` (Rows, Cols, Slices) located at ``offset``.
+
+    ``offset`` is the (row, col, slice) index of ``crop[0, 0, 0]`` in the
+    series and ``transform`` the pixel-to-patient matrix of rt_utils.
+    Returns ``(planes, stats)``: ``planes`` holds ``(slice_index,
+    [ContourData, ...])`` for every non-empty slice, with the same points
+    as ``RTStruct.add_roi`` (approximated contours, no pin hole).  With
+    ``tolerance_px > 0`` each contour is simplified with Douglas-Peucker
+    (``cv2.approxPolyDP``) and ``stats`` compares it with the full one:
+    point counts, the pixel area enclosed by each set of polygons and the
+    ContourData bytes that are kept.  Runs in worker processes.
+    """
+    import cv2  # type: ignore
+
+    row0, col0, z0 = (int(o) for o in offset)
+    planes = []
+    stats = {"points": 0, "kept": 0, "bytes_kept": 0, "area": 0, "area_kept": 0}
+    for k in range(crop.shape[2]):
+        plane = crop[:, :, k]
+        if not plane.any():
+            continue
+        contours, _ = cv2.findContours(plane.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            raise ValueError(f"No contour found in non-empty slice {z0 + k}")
+        kept = contours
+        if tolerance_px > 0:
+            # Un contorno de menos de 3 puntos no encierra área: se deja tal cual
+            kept = [c if len(c) < 3 else cv2.approxPolyDP(c, tolerance_px, True) for c in contours]
+            kept = [d if len(d) >= 3 or len(c) < 3 else c for c, d in zip(contours, kept)]
+            full = np.zeros(plane.shape, np.uint8)
+            cv2.fillPoly(full, list(contours), 1)
+            simple = np.zeros(plane.shape, np.uint8)
+            cv2.fillPoly(simple, list(kept), 1)
+            stats["area"] += int(full.sum())
+            stats["area_kept"] += int(simple.sum())
+        data = []
+        for contour, simplified in zip(contours, kept):
+            pts = simplified.reshape(-1, 2).astype(np.int64)
+            vec = np.column_stack((pts[:, 0] + col0, pts[:, 1] + row0,
+                                   np.full(len(pts), z0 + k), np.ones(len(pts))))
+            values = np.ravel(vec.dot(transform.T)[:, :3]).tolist()
+            data.append(values)
+            stats["points"] += len(contour)
+            stats["kept"] += len(pts)
+            if tolerance_px > 0:
+                stats["bytes_kept"] += _contour_bytes(values)
+        planes.append((z0 + k, data))
+    return planes, stats
+
+
+class ContourPool:
+    """Contour extraction for a sequence of ROIs on one reusable process pool.
+
+    ``submit(mask)`` cuts a ``CompactMask`` (Rows, Cols, Slices) into slabs
+    of ``CONTOUR_SLAB_SLICES`` slices and queues them; ``result(handle)``
+    returns ``(planes, stats)`` as :func:`extract_slab_contours`, merged in
+    slice order, or raises the error of a failed slab.  The pool of
+    ``workers`` processes starts once ``expected_slices`` (or, when
+    unknown, the slices submitted so far) reach ``CONTOUR_POOL_MIN_SLICES``;
+    before that, with ``workers <= 1`` or if the pool breaks, slabs run
+    in-process.  ``tolerance_mm`` enables Douglas-Peucker decimation with
+    that maximum in-plane deviation.  Use it as a context manager.
+    """
+
+    def __init__(self, transform: np.ndarray, workers: int = 1, tolerance_mm: float = 0.0,
+                 expected_slices: Optional[int] = None):
+        self.transform = transform
+        # tolerancia en píxeles respecto al lado mayor del píxel: el error en mm
+        # nunca supera tolerance_mm en ninguna dirección del plano
+        pixel_mm = max(float(np.linalg.norm(transform[:3, 0])), float(np.linalg.norm(transform[:3, 1])), 1e-6)
+        self.tolerance_px = max(0.0, float(tolerance_mm)) / pixel_mm
+        self.workers = max(1, int(workers))
+        self.expected_slices = expected_slices
+        if expected_slices is not None and expected_slices < CONTOUR_POOL_MIN_SLICES:
+            self.workers = 1
+        self._pool = None
+        self._seen = 0
+
+    def __enter__(self) -> "ContourPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _executor(self):
+        if self.workers <= 1:
+            return None
+        if self._pool is None:
+            if max(self._seen, self.expected_slices or 0) < CONTOUR_POOL_MIN_SLICES:
+                return None
+            from concurrent.futures import ProcessPoolExecutor
+            try:
+                # spawn: el proceso principal tiene hilos (GUI, pipeline) y fork no es seguro
+                ctx = multiprocessing.get_context("spawn")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            except Exception as e:
+                self._broken(e)
+        return self._pool
+
+    def _broken(self, error) -> None:
+        logger.warning(f"Contour process pool unavailable ({error}); extracting in-process")
+        self.workers = 1
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _run(self, crop, offset):
+        try:
+            return extract_slab_contours(crop, offset, self.transform, self.tolerance_px)
+        except Exception as e:
+            return e
+
+    def submit(self, mask: CompactMask) -> list:
+        """Queue the slabs of ``mask``; returns the handle for :meth:`result`."""
+        jobs = []
+        if not mask.any():
+            return jobs
+        # un píxel de fondo alrededor: OpenCV ve el mismo entorno que en el corte completo
+        bbox, crop = mask.expanded(1)
+        row0, col0, z0 = (sl.start for sl in bbox)
+        self._seen += crop.shape[2]
+        pool = self._executor()
+        for start in range(0, crop.shape[2], CONTOUR_SLAB_SLICES):
+            slab, offset = crop[:, :, start:start + CONTOUR_SLAB_SLICES], (row0, col0, z0 + start)
+            job = None
+            if pool is not None:
+                try:
+                    job = pool.submit(extract_slab_contours, slab, offset, self.transform, self.tolerance_px)
+                except Exception as e:
+                    self._broken(e)
+                    pool = None
+            jobs.append((slab, offset, job if job is not None else self._run(slab, offset)))
+        return jobs
+
+    def result(self, jobs: list) -> tuple:
+        """``(planes, stats)`` of a handle returned by :meth:`submit`."""
+        import pickle
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+
+        planes: list = []
+        stats = {"points": 0, "kept": 0, "bytes_kept": 0, "area": 0, "area_kept": 0}
+        for slab, offset, job in jobs:
+            if isinstance(job, Future):
+                try:
+                    job = job.result()
+                except (BrokenProcessPool, pickle.PicklingError) as e:
+                    self._broken(e)
+                    job = self._run(slab, offset)
+                except Exception as e:
+                    job = e
+            if isinstance(job, Exception):
+                raise job
+            slab_planes, slab_stats = job
+            planes.extend(slab_planes)
+            for key, value in slab_stats.items():
+                stats[key] += value
+        return planes, stats
+
+
+def compute_roi_contours(masks: dict, transform: np.ndarray, workers: int = 1,
+                         tolerance_mm: float = 0.0) -> dict:
+    """Contours for every ``CompactMask`` in ``masks`` (Rows, Cols, Slices).
+
+    Runs the masks through a :class:`ContourPool` of ``workers`` processes.
+    Returns ``{name: (planes, stats)}`` with the planes of
+    :func:`extract_slab_contours` in slice order and their summed stats, or
+    ``{name: exception}`` for masks that failed.  Empty masks are omitted.
+    """
+    masks = {name: mask for name, mask in masks.items() if mask.any()}
+    expected = sum(mask.bbox[2].stop - mask.bbox[2].start + 2 for mask in masks.values())
+    out: dict = {}
+    with ContourPool(transform, workers, tolerance_mm, expected_slices=expected) as pool:
+        handles = {name: pool.submit(mask) for name, mask in masks.items()}
+        for name, handle in handles.items():
+            try:
+                out[name] = pool.result(handle)
+            except Exception as e:
+                out[name] = e
+    return out
+
+
+def add_roi_contours(rtstruct, planes: list, name: str, color) -> None:
+    """Append a ROI built from precomputed contours to ``rtstruct``.
+
+    Produces the same ROIContourSequence, StructureSetROISequence and
+    RTROIObservationsSequence items as ``rtstruct.add_roi`` would for the
+    mask the contours came from.
+    """
+    from pydicom.dataset import Dataset
+    from pydicom.sequence import Sequence
+    from rt_utils import ds_helper  # type: ignore
+    from rt_utils.utils import ROIData  # type: ignore
+
+    number = len(rtstruct.ds.StructureSetROISequence) + 1
+    roi_data = ROIData(None, color, number, name, rtstruct.frame_of_reference_uid)
+    roi_contour = Dataset()
+    roi_contour.ROIDisplayColor = roi_data.color
+    roi_contour.ContourSequence = Sequence([
+        ds_helper.create_contour(rtstruct.series_data[z], data)
+        for z, contours in planes for data in contours
+    ])
+    roi_contour.ReferencedROINumber = str(number)
+    rtstruct.ds.ROIContourSequence.append(roi_contour)
+    rtstruct.ds.StructureSetROISequence.append(ds_helper.create_structure_set_roi(roi_data))
+    rtstruct.ds.RTROIObservationsSequence.append(ds_helper.create_rtroi_observation(roi_data))
+
+
+# -------------------------------------------------------------------------
+# Exportación DICOM-SEG y NIfTI multietiqueta
+# -------------------------------------------------------------------------
+# Las herramientas de investigación leen volúmenes de etiquetas, no
+# contornos.  Además del RTSTRUCT (o en su lugar) se puede escribir un
+# objeto DICOM Segmentation y/o un NIfTI uint8 multietiqueta con la tabla de
+# nombres de TotalSegmentator, ambos sobre la rejilla del RTSTRUCT y sin
+# pasar por los contornos.  El SEG binario admite solapes: cada estructura
+# es su propio segmento, guardado tal cual llega del flujo de máscaras.  El
+# NIfTI solo tiene una etiqueta por vóxel y sale de un mapa de etiquetas.
+EXPORT_FORMATS = ("rtstruct", "seg", "nifti")
+
+
+class SegmentLabelMap:
+    """uint8 label volume on the RTSTRUCT grid (Rows, Cols, Slices).
+
+    Structures are numbered from 1 in the order they are added (at most
+    255).  Each voxel holds one label: where structures overlap the smaller
+    one keeps the voxel, so organs stay visible inside ``body`` or the
+    lungs whatever the order they arrive in.
+    """
+
+    MAX_LABELS = 255
+
+    def __init__(self, shape):
+        self.labels = np.zeros(tuple(int(s) for s in shape), dtype=np.uint8)
+        self.names: dict[int, str] = {}
+        self.sizes = np.zeros(self.MAX_LABELS + 1, dtype=np.int64)
+        self.overlap = 0  # vóxeles reclamados por más de una estructura
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, mask: CompactMask) -> Optional[int]:
+        """Paint ``mask`` with the next label and return it (``None`` if full or empty)."""
+        if len(self.names) >= self.MAX_LABELS or not mask.any():
+            return None
+        if mask.shape != self.labels.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match the label map {self.labels.shape}")
+        label = len(self.names) + 1
+        count = mask.count()
+        region = self.labels[mask.bbox]
+        inside = mask.crop
+        current = region[inside]
+        self.overlap += int(np.count_nonzero(current))
+        # fondo, o una estructura mayor que la nueva
+        take = self.sizes[current] > count
+        take |= current == 0
+        current[take] = label
+        region[inside] = current
+        self.sizes[label] = count
+        self.names[label] = name
+        return label
+
+
+def _add_label_map_extension():
+    """``nifti_ext_header.add_label_map_to_nifti`` of the bundled TotalSegmentator."""
+    try:
+        from totalsegmentatorv2.nifti_ext_header import add_label_map_to_nifti  # type: ignore
+    except ImportError:
+        from totalsegmentator.nifti_ext_header import add_label_map_to_nifti  # type: ignore
+    return add_label_map_to_nifti
+
+
+def write_label_nifti(label_map: SegmentLabelMap, grid_affine, path: str) -> None:
+    """Save ``label_map`` as a uint8 multilabel NIfTI.
+
+    ``grid_affine`` is the RAS affine of the (row, column, slice) indices
+    (:func:`rtstruct_grid_affine`).  The image is reoriented to LAS like the
+    NIfTI files of TotalSegmentator and the label names are stored in the
+    header extension written by ``add_label_map_to_nifti``.
+    """
+    if nib is None:
+        raise RuntimeError("nibabel is required to write NIfTI files")
+    # (fila, columna, corte) -> (i=columna, j=fila, k=corte) como en NIfTI
+    affine = np.asarray(grid_affine, dtype=float)[:, [1, 0, 2, 3]]
+    img = nib.Nifti1Image(label_map.labels.transpose(1, 0, 2), affine)
+    current = nib.orientations.io_orientation(affine)
+    target = nib.orientations.axcodes2ornt(NIFTI_OUTPUT_AXCODES)
+    img = img.as_reoriented(nib.orientations.ornt_transform(current, target))
+    img.set_data_dtype(np.uint8)
+    img.header.set_xyzt_units(2)
+    try:
+        add_label_map_to_nifti = _add_label_map_extension()
+    except ImportError:
+        logger.warning("nifti_ext_header not available; %s is written without label names", path)
+    else:
+        img = add_label_map_to_nifti(img, dict(label_map.names))
+    nib.save(img, path)
+
+
+class SegmentFrames:
+    """Segments of a binary DICOM-SEG on the RTSTRUCT grid (Rows, Cols, Slices).
+
+    Every structure added becomes its own segment, numbered from 1 in
+    arrival order, with its mask kept bit-packed inside its bounding box.
+    Segments may overlap: ``body`` keeps the voxels of the organs inside it.
+    Frames are only built when the file is written, one at a time.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(int(s) for s in shape)
+        self.segments: list[tuple[str, CompactMask]] = []
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def add(self, name: str, mask: CompactMask) -> Optional[int]:
+        """Store ``mask`` as the next segment and return its number (``None`` if empty)."""
+        if not mask.any():
+            return None
+        if mask.shape != self.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match the segmentation {self.shape}")
+        if not mask.packed:
+            mask = CompactMask(mask.shape, mask.bbox, mask.crop, packed=True)
+        self.segments.append((name, mask))
+        return len(self.segments)
+
+    def frames(self):
+        """Yield ``(segment number, slice index, frame)`` for the non-empty frames.
+
+        Frames are full (Rows, Cols) boolean planes, by segment and then by
+        slice, the order the DICOM-SEG stores them in.
+        """
+        frame = np.zeros(self.shape[:2], dtype=bool)
+        for number, (_, mask) in enumerate(self.segments, start=1):
+            rows, cols, slices = mask.bbox
+            crop = mask.crop
+            for k in range(crop.shape[2]):
+                plane = crop[:, :, k]
+                if not plane.any():
+                    continue
+                frame[:] = False
+                frame[rows, cols] = plane
+                yield number, slices.start + k, frame
+
+
+def _dicom_lab(rgb) -> list[int]:
+    """sRGB colour as the scaled CIELab triplet of RecommendedDisplayCIELabValue."""
+    c = np.asarray(rgb, dtype=float) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = np.array([[0.4124564, 0.3575761, 0.1804375],
+                    [0.2126729, 0.7151522, 0.0721750],
+                    [0.0193339, 0.1191920, 0.9503041]]) @ c
+    xyz /= np.array([0.95047, 1.0, 1.08883])  # blanco D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = (116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2]))
+    scaled = (lab[0] / 100.0, (lab[1] + 128) / 255.0, (lab[2] + 128) / 255.0)
+    return [int(round(min(max(v, 0.0), 1.0) * 65535)) for v in scaled]
+
+
+def _code_item(value: str, scheme: str, meaning: str):
+    from pydicom.dataset import Dataset
+
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+# Atributos de tipo 2 de paciente/estudio: se copian de la imagen fuente y
+# se escriben vacíos si la serie no los trae
+SEG_TYPE2_PATIENT_TAGS = (
+    "PatientID", "PatientName", "PatientBirthDate", "PatientSex",
+    "AccessionNumber", "StudyID", "StudyDate", "StudyTime", "ReferringPhysicianName",
+)
+
+
+def write_dicom_seg(segments: SegmentFrames, source_images: list, path: str) -> int:
+    """Save ``segments`` as a binary DICOM Segmentation of ``source_images``.
+
+    ``source_images`` are the datasets of the RTSTRUCT grid in slice order
+    (``rtstruct.series_data``); headers without pixel data are enough.
+    Each segment gets one bit-packed frame per slice it covers, so
+    overlapping segments keep all their voxels; empty frames are omitted.
+    The dataset follows the layout highdicom produces but is written
+    directly with pydicom, one frame at a time.  Returns the number of
+    frames written.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.sequence import Sequence
+    from pydicom.uid import generate_uid
+
+    if not len(segments):
+        raise ValueError("There are no segments to write")
+    if len(source_images) != segments.shape[2]:
+        raise ValueError(f"{len(source_images)} source images for {segments.shape[2]} slices")
+    first = source_images[0]
+    seg_class = "1.2.840.10008.5.1.4.1.1.66.4"  # Segmentation Storage
+    now = datetime.now()
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = seg_class
+    ds.SOPClassUID = seg_class
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.ImageType = ["DERIVED", "PRIMARY"]
+    ds.InstanceCreationDate = ds.ContentDate = now.strftime("%Y%m%d")
+    ds.InstanceCreationTime = ds.ContentTime = now.strftime("%H%M%S")
+    for keyword in SEG_TYPE2_PATIENT_TAGS:
+        setattr(ds, keyword, first.get(keyword, None))
+    # Juego de caracteres de la serie; las cabeceras del índice no lo traen,
+    # y un nombre con acentos sin declararlo no es ASCII válido: UTF-8
+    if "SpecificCharacterSet" in first:
+        ds.SpecificCharacterSet = first.SpecificCharacterSet
+    elif not all(str(ds.get(keyword) or "").isascii() for keyword in SEG_TYPE2_PATIENT_TAGS):
+        ds.SpecificCharacterSet = "ISO_IR 192"
+    ds.StudyInstanceUID = first.StudyInstanceUID
+    ds.FrameOfReferenceUID = first.FrameOfReferenceUID
+    ds.PositionReferenceIndicator = first.get("PositionReferenceIndicator", None)
+    ds.Modality = "SEG"
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = 1
+    ds.Manufacturer = "AURA"
+    ds.ManufacturerModelName = "AURA"
+    ds.SoftwareVersions = "1.0"
+    ds.DeviceSerialNumber = "1"
+    ds.ContentLabel = "AURA"
+    ds.ContentDescription = None
+    ds.ContentCreatorName = None
+
+    # Imagen: marcos binarios de 1 bit
+    ds.SegmentationType = "BINARY"
+    ds.SegmentsOverlap = "YES" if len(segments) > 1 else "NO"
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows, ds.Columns = segments.shape[:2]
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+    ds.LossyImageCompression = "00"
+    ds.PresentationLUTShape = "IDENTITY"
+
+    algorithm = Dataset()
+    algorithm.AlgorithmFamilyCodeSequence = Sequence([_code_item("123110", "DCM", "Artificial Intelligence")])
+    algorithm.AlgorithmName = "AURA"
+    algorithm.AlgorithmVersion = "1.0"
+    descriptions = []
+    for number, (name, _) in enumerate(segments.segments, start=1):
+        item = Dataset()
+        item.SegmentNumber = number
+        item.SegmentLabel = dicom_safe_name(name)[:64]
+        item.SegmentedPropertyCategoryCodeSequence = Sequence([
+            _code_item("91723000", "SCT", "Anatomical Structure")])
+        item.SegmentedPropertyTypeCodeSequence = Sequence([_code_item("91772007", "SCT", "Organ")])
+        item.SegmentAlgorithmType = "AUTOMATIC"
+        item.SegmentAlgorithmName = "AURA"
+        item.SegmentationAlgorithmIdentificationSequence = Sequence([algorithm])
+        item.RecommendedDisplayCIELabValue = _dicom_lab(get_organ_color(name))
+        descriptions.append(item)
+    ds.SegmentSequence = Sequence(descriptions)
+
+    # Geometría común a todos los marcos
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = list(first.PixelSpacing)
+    if "SliceThickness" in first:
+        pixel_measures.SliceThickness = first.SliceThickness
+    if len(source_images) > 1:
+        positions = np.array([[float(v) for v in img.ImagePositionPatient] for img in source_images])
+        spacing = np.linalg.norm(positions[-1] - positions[0]) / (len(source_images) - 1)
+        pixel_measures.SpacingBetweenSlices = f"{spacing:.6g}"
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = list(first.ImageOrientationPatient)
+    shared = Dataset()
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    dimension_uid = generate_uid()
+    organization = Dataset()
+    organization.DimensionOrganizationUID = dimension_uid
+    ds.DimensionOrganizationSequence = Sequence([organization])
+    dimensions = []
+    for pointer, group, label in ((0x0062000B, 0x0062000A, "Referenced Segment Number"),
+                                  (0x00200032, 0x00209113, "Image Position Patient")):
+        item = Dataset()
+        item.DimensionOrganizationUID = dimension_uid
+        item.DimensionIndexPointer = pointer
+        item.FunctionalGroupPointer = group
+        item.DimensionDescriptionLabel = label
+        dimensions.append(item)
+    ds.DimensionIndexSequence = Sequence(dimensions)
+
+    references = []
+    for img in source_images:
+        item = Dataset()
+        item.ReferencedSOPClassUID = img.SOPClassUID
+        item.ReferencedSOPInstanceUID = img.SOPInstanceUID
+        references.append(item)
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = first.SeriesInstanceUID
+    referenced_series.ReferencedInstanceSequence = Sequence(references)
+    ds.ReferencedSeriesSequence = Sequence([referenced_series])
+
+    # Marcos: un grupo funcional por marco y los bits seguidos, sin
+    # alinear a byte entre marcos (el resto se arrastra al siguiente)
+    source_purpose = _code_item("121322", "DCM", "Source image for image processing operation")
+    derivation_code = _code_item("113076", "DCM", "Segmentation")
+    per_frame = []
+    frame_contents = []
+    chunks = []
+    carry = np.zeros(0, dtype=bool)
+    for number, z, frame in segments.frames():
+        img = source_images[z]
+        source = Dataset()
+        source.ReferencedSOPClassUID = img.SOPClassUID
+        source.ReferencedSOPInstanceUID = img.SOPInstanceUID
+        source.SpatialLocationsPreserved = "YES"
+        source.PurposeOfReferenceCodeSequence = Sequence([source_purpose])
+        derivation = Dataset()
+        derivation.SourceImageSequence = Sequence([source])
+        derivation.DerivationCodeSequence = Sequence([derivation_code])
+        content = Dataset()  # DimensionIndexValues al final, ver abajo
+        frame_contents.append((content, number, z))
+        position = Dataset()
+        position.ImagePositionPatient = list(img.ImagePositionPatient)
+        segment = Dataset()
+        segment.ReferencedSegmentNumber = number
+        group = Dataset()
+        group.DerivationImageSequence = Sequence([derivation])
+        group.FrameContentSequence = Sequence([content])
+        group.PlanePositionSequence = Sequence([position])
+        group.SegmentIdentificationSequence = Sequence([segment])
+        per_frame.append(group)
+
+        bits = np.concatenate((carry, frame.ravel())) if carry.size else frame.ravel()
+        whole = bits.size - bits.size % 8
+        chunks.append(np.packbits(bits[:whole], bitorder="little").tobytes())
+        carry = bits[whole:].copy()
+    if carry.size:
+        chunks.append(np.packbits(carry, bitorder="little").tobytes())
+    # El índice de la posición cuenta solo las posiciones que usan los
+    # marcos, en el orden de los cortes (de 1 en adelante)
+    position_index = {z: i for i, z in enumerate(sorted({z for _, _, z in frame_contents}), start=1)}
+    for content, number, z in frame_contents:
+        content.DimensionIndexValues = [number, position_index[z]]
+    pixel_data = b"".join(chunks)
+    if len(pixel_data) % 2:
+        pixel_data += b"\0"
+    ds.NumberOfFrames = len(per_frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+    ds.PixelData = pixel_data
+
+    try:
+        pydicom.dcmwrite(path, ds, enforce_file_format=True)
+    except TypeError:  # pydicom < 3
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        pydicom.dcmwrite(path, ds, write_like_original=False)
+    return len(per_frame)
+
+# ============================================================================
+# VENTANA UNIFICADA DE SELECCIÓN DE ÓRGANOS
+# ============================================================================
+
+
+class UnifiedOrganSelector(_TkToplevel):
+    """
+    Ventana mejorada para selección de órganos con:
+    - Categorías colapsables
+    - Búsqueda en tiempo real
+    - Vista previa de tasks necesarias
+    - Selección por presets comunes
+    """
+
+    def __init__(self, parent, task_labels: dict[str, dict[str, int]],
+                 current_selection: set[str], callback, task_cost=None):
+        super().__init__(parent)
+
+        self.task_labels = task_labels
+        self.organ_to_tasks = build_organ_to_tasks_map(task_labels)
+        self.callback = callback
+        # Coste estimado por task (segundos) para el planificador
+        self.task_cost = task_cost
+
+        # Estado
+        self.selected_organs: set[str] = set(current_selection)
+        self.organ_vars: dict[str, tk.BooleanVar] = {}
+        self.category_frames: dict[str, tuple] = {}
+        self.organ_checkboxes: dict[str, ttk.Checkbutton] = {}
+
+        self._setup_window()
+        self._create_widgets()
+        self._update_task_preview()
+
+    def _setup_window(self):
+        self.title("Select Organs for Segmentation")
+        self.geometry("900x700")
+        self.transient(self.master)
+        self.grab_set()
+
+    def _create_widgets(self):
+        # Header con búsqueda
+        header = ttk.Frame(self, padding=10)
+        header.pack(fill="x")
 
         ttk.Label(header, text="Search:", font=("Arial", 10)).pack(side="left", padx=5)
         self.search_var = tk.StringVar()
@@ -1780,6 +4090,11 @@ class UnifiedOrganSelector(tk.Toplevel):
         self.download_label = ttk.Label(right_frame, text="", foreground="gray")
         self.download_label.pack(anchor="w")
 
+        ttk.Label(right_frame, text="Estimated Time:",
+                 font=("Arial", 9)).pack(anchor="w", pady=(10,0))
+        self.time_label = ttk.Label(right_frame, text="", foreground="gray")
+        self.time_label.pack(anchor="w")
+
         # Footer con botones
         footer = ttk.Frame(self, padding=10)
         footer.pack(fill="x")
@@ -1875,9 +4190,11 @@ class UnifiedOrganSelector(tk.Toplevel):
             self.task_preview.insert("1.0", "No organs selected")
             self.task_preview.configure(state="disabled")
             self.download_label.configure(text="0 models")
+            self.time_label.configure(text="")
             return
 
-        task_assignments = compute_required_tasks(selected, self.organ_to_tasks, self.task_labels)
+        task_assignments = compute_required_tasks(selected, self.organ_to_tasks, self.task_labels,
+                                                  task_cost=self.task_cost)
 
         # Mostrar info
         self.task_preview.configure(state="normal")
@@ -1885,7 +4202,11 @@ class UnifiedOrganSelector(tk.Toplevel):
 
         for task_name, organs in sorted(task_assignments.items()):
             self.task_preview.insert("end", f"• {task_name}\n", "task")
-            self.task_preview.insert("end", f"  ({len(organs)} organs)\n\n")
+            if self.task_cost is not None:
+                eta = format_duration(self.task_cost(task_name))
+                self.task_preview.insert("end", f"  ({len(organs)} organs, ~{eta})\n\n")
+            else:
+                self.task_preview.insert("end", f"  ({len(organs)} organs)\n\n")
 
         self.task_preview.configure(state="disabled")
 
@@ -1893,6 +4214,9 @@ class UnifiedOrganSelector(tk.Toplevel):
         num_tasks = len(task_assignments)
         size_mb = num_tasks * 150  # ~150MB por task
         self.download_label.configure(text=f"~{size_mb} MB ({num_tasks} models)")
+        if self.task_cost is not None:
+            total = estimate_plan_seconds(task_assignments, self.task_cost)
+            self.time_label.configure(text=f"~{format_duration(total)} per patient")
 
     def _select_all(self):
         for var in self.organ_vars.values():
@@ -1910,82 +4234,53 @@ class UnifiedOrganSelector(tk.Toplevel):
     def _apply(self):
         """Confirma selección y cierra."""
         selected = {organ for organ, var in self.organ_vars.items() if var.get()}
-        task_assignments = compute_required_tasks(selected, self.organ_to_tasks, self.task_labels)
+        task_assignments = compute_required_tasks(selected, self.organ_to_tasks, self.task_labels,
+                                                  task_cost=self.task_cost)
 
         self.callback(selected, task_assignments)
         self.destroy()
 
 
 # -------------------------------------------------------------------------
-# App principal
+# Motor de procesamiento (sin dependencias de Tk)
 # -------------------------------------------------------------------------
-class AutoSegApp(tk.Tk):
+class AutoSegEngine:
     """
-    Ventana principal de la aplicación AURA. Esta versión se ha simplificado
-    para utilizar exclusivamente el modelo TotalSegmentator V2. Se eliminan
-    completamente las opciones de selección de modelo y resolución de la red
-    SegResNet original. Además, se incorpora un mecanismo de persistencia
-    de configuración (tema, orientación, rutas de entrada/salida, etc.) y
-    una comprobación inicial de CUDA y de la disponibilidad de la librería
-    totalsegmentator. Si totalsegmentator no está instalado y se detecta
-    soporte CUDA, se intentará instalar automáticamente mediante pip. Si
-    falla la instalación automática, se notificará al usuario mediante el
-    registro de la aplicación.
+    Lógica de segmentación y exportación de AURA, independiente de la
+    interfaz gráfica.  ``AutoSegApp`` la combina con la ventana Tk y
+    ``HeadlessAutoSeg`` la utiliza desde la línea de comandos.  Las
+    interacciones con la interfaz pasan por unos pocos métodos gancho
+    (``_log``, ``_indeterminate``, ``_ui_call``, ``_set_run_enabled``,
+    ``_output_root`` y ``_on_progress``) que cada subclase redefine.
     """
 
-    def _log_cuda_diagnostics(self):
-        """Log extended Torch/CUDA diagnostics to help troubleshoot GPU issues."""
-        try:
-            import torch as _t
-            ver = getattr(_t, '__version__', 'unknown')
-            cuda_built = getattr(_t.version, 'cuda', None) if hasattr(_t, 'version') else None
-            avail = _t.cuda.is_available() if hasattr(_t, 'cuda') else False
-            dev_count = _t.cuda.device_count() if avail else 0
-            cudnn_avail = _t.backends.cudnn.is_available() if hasattr(_t, 'backends') and hasattr(_t.backends, 'cudnn') else False
-            self._log(f"Torch version: {ver}")
-            self._log(f"Torch CUDA build: {cuda_built}")
-            self._log(f"CUDA available: {avail}; device_count: {dev_count}; cuDNN: {cudnn_avail}")
-            if 'CUDA_VISIBLE_DEVICES' in os.environ:
-                self._log(f"CUDA_VISIBLE_DEVICES={os.environ['CUDA_VISIBLE_DEVICES']}")
-            if avail:
-                for i in range(dev_count):
-                    try:
-                        name = _t.cuda.get_device_name(i)
-                        cap = _t.cuda.get_device_capability(i)
-                        self._log(f"GPU {i}: {name}; capability: {cap}")
-                    except Exception as e:
-                        self._log(f"GPU {i} info error: {e}")
-        except Exception as e:
-            self._log(f"CUDA diagnostics failed: {e}")
+    # ------------------------------------------------------------------
+    # Ganchos de interfaz (sin efecto por defecto)
+    # ------------------------------------------------------------------
+    def _log(self, msg: str):
+        logger.info(msg)
 
-    def __init__(self):
-        super().__init__()
-        # Window title and initial size
-        # Use an English title for consistency throughout the UI
-        self.title("AURA – Automatic Segmentation")
-        self.geometry("800x650")
+    def _indeterminate(self, start: bool):
+        pass
 
-        # -----------------------------------------------------------------
-        # Asignar un icono a la aplicación
-        # -----------------------------------------------------------------
-        # Cuando se genera un instalador con PyInstaller, los recursos como
-        # imágenes y archivos de icono se empaquetan junto con el ejecutable.
-        # Utilizamos la función resource_path para localizar correctamente
-        # el archivo ico.png tanto en modo desarrollo como en el ejecutable
-        # empaquetado.  El método iconphoto acepta objetos PhotoImage y
-        # funciona en Windows, macOS y Linux.  Si el archivo no está
-        # disponible o no es compatible, la asignación del icono se
-        # ignora silenciosamente.
-        try:
-            icon_png_path = resource_path("ico.png")
-            icon_image = tk.PhotoImage(file=icon_png_path)
-            # El primer argumento (False) indica que el icono aplica a la
-            # ventana principal y a todas las subventanas.
-            self.iconphoto(False, icon_image)
-        except Exception:
-            # No interrumpir la inicialización si no se puede cargar el icono
-            pass
+    def _ui_call(self, func, *args) -> None:
+        func(*args)
+
+    def _set_run_enabled(self, enabled: bool) -> None:
+        pass
+
+    def _output_root(self) -> str:
+        return self.output_root
+
+    def _on_progress(self, event: str, **fields) -> None:
+        """Structured progress notification (batch_start, patient_done, ...)."""
+        pass
 
+    # ------------------------------------------------------------------
+    # Estado y configuración
+    # ------------------------------------------------------------------
+    def _init_engine_state(self) -> None:
+        """Initialise every attribute used by the processing methods."""
         # Detectar dispositivo disponible
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # Para totalsegmentator usamos un string simple ('gpu' o 'cpu')
@@ -1999,6 +4294,8 @@ class AutoSegApp(tk.Tk):
         self.organs: list[str] = []
         self.ready = False
         self.cancel_requested = False
+        # La exportación corre a la vez que otras etapas del lote
+        self._batch_pipelined = False
 
         # Tipo de modelo fijo: siempre 'totalseg'
         self.model_type: str = "totalseg"
@@ -2031,12 +4328,37 @@ class AutoSegApp(tk.Tk):
         self.use_crop: bool = True
         # Margen de recorte (voxeles)
         self.crop_margin: int = 10
-
-        # Gestor de estilos para ttk
-        self.style = ttk.Style()
+        # Hilos usados para leer cabeceras DICOM en paralelo al buscar series
+        self.scan_workers: int = DEFAULT_SCAN_WORKERS
+        # Índice persistente de cabeceras DICOM (se abre bajo demanda)
+        self.use_dicom_index: bool = True
+        self._dicom_index: Optional[DicomHeaderIndex] = None
+        self._dicom_index_failed: bool = False
+        # Caché de volúmenes decodificados por serie (~/.aura_cache/volumes)
+        self.use_volume_cache: bool = True
+        self.volume_cache_max_gb: float = DEFAULT_VOLUME_CACHE_MAX_GB
+        self._volume_cache: Optional[SeriesVolumeCache] = None
+        self._volume_cache_failed: bool = False
+        # Caché de resultados de TotalSegmentator (~/.aura_cache/segmentations)
+        self.use_seg_cache: bool = True
+        self.seg_cache_max_gb: float = DEFAULT_SEG_CACHE_MAX_GB
+        self._seg_cache: Optional[SegmentationResultCache] = None
+        self._seg_cache_failed: bool = False
+        # Tiempos medidos por task para el planificador (~/.aura_cache/task_runtimes.json)
+        self._task_runtimes: Optional[TaskRuntimeStats] = None
 
         # Activación de limpieza y suavizado de máscaras
         self.clean_masks: bool = True
+        # Empaquetar las máscaras compactas a 1 bit/voxel (menos memoria, algo más de CPU)
+        self.pack_masks: bool = False
+        # Hilos para limpiar/suavizar órganos en paralelo y procesos para
+        # extraer contornos del RTSTRUCT (0 = reparto automático de los núcleos)
+        self.postprocess_workers: int = 0
+        self.contour_workers: int = 0
+        # Simplificación Douglas-Peucker de los contornos (0 = desactivada) y
+        # cambio de volumen máximo admitido por ROI antes de descartarla
+        self.contour_tolerance_mm: float = 0.0
+        self.contour_max_volume_change_pct: float = 1.0
         self.smooth_masks: bool = True
         self.smoothing_method: str = "gaussian"
         self.smoothing_sigma_mm: float = 3.0
@@ -2059,67 +4381,323 @@ class AutoSegApp(tk.Tk):
         # configuración.
         self.totalseg_prompted: bool = False
 
-        # Logging hacia GUI
-        self.log_handler = TextHandler(self)
-        logger.addHandler(self.log_handler)
+        # Track whether TotalSegmentator weights have been downloaded yet.  The
+        # first time a segmentation is run the models will be downloaded and
+        # cached; we inform the user about this process.
+        self.totalseg_downloaded: bool = False
 
-        # Construir interfaz
-        self._build_ui()
+        # Carpeta de salida usada por el modo sin interfaz (la GUI usa out_entry)
+        self.output_root: str = ""
+        # Cómo se exporta la serie CT junto al RTSTRUCT (ver CT_EXPORT_MODES)
+        self.ct_export_mode: str = "copy"
+        # Formatos de salida de la segmentación (ver EXPORT_FORMATS)
+        self.export_formats: list[str] = ["rtstruct"]
 
-        # Cargar configuración (si existe) para sobrescribir valores
-        self._load_config()
+    def _apply_config(self, cfg: dict) -> None:
+        """Apply the processing settings of a ``.autoseg_config.json`` dict.
 
-        # Aplicar tema tras cargar configuración
-        self.apply_theme()
+        Only keys that affect segmentation and export are handled here;
+        window-specific keys (theme, folder entries) are applied by the GUI.
+        """
+        # Orientaciones
+        self.flip_lr = bool(cfg.get('flip_lr', self.flip_lr))
+        self.flip_ap = bool(cfg.get('flip_ap', self.flip_ap))
+        self.flip_si = bool(cfg.get('flip_si', self.flip_si))
+        # Uso de recorte
+        self.use_crop = bool(cfg.get('use_crop', self.use_crop))
+        # Limpieza de máscaras
+        self.clean_masks = bool(cfg.get('clean_masks', self.clean_masks))
+        self.pack_masks = bool(cfg.get('pack_masks', self.pack_masks))
+        try:
+            self.postprocess_workers = max(0, int(cfg.get('postprocess_workers', self.postprocess_workers)))
+        except Exception:
+            pass
+        try:
+            self.contour_workers = max(0, int(cfg.get('contour_workers', self.contour_workers)))
+        except Exception:
+            pass
+        try:
+            self.contour_tolerance_mm = max(0.0, min(5.0, float(cfg.get('contour_tolerance_mm', self.contour_tolerance_mm))))
+        except Exception:
+            pass
+        try:
+            self.contour_max_volume_change_pct = max(0.0, float(
+                cfg.get('contour_max_volume_change_pct', self.contour_max_volume_change_pct)))
+        except Exception:
+            pass
+        self.smooth_masks = bool(cfg.get('smooth_masks', self.smooth_masks))
+        method_cfg = cfg.get('smoothing_method', self.smoothing_method)
+        if isinstance(method_cfg, str):
+            self.smoothing_method = method_cfg.lower()
+        if self.smoothing_method not in {'gaussian', 'morphological'}:
+            self.smoothing_method = 'gaussian'
+        sigma_cfg = cfg.get('smoothing_sigma_mm', self.smoothing_sigma_mm)
+        try:
+            self.smoothing_sigma_mm = max(0.5, min(15.0, float(sigma_cfg)))
+        except Exception:
+            pass
+        export_cfg = cfg.get('ct_export_mode', self.ct_export_mode)
+        if isinstance(export_cfg, str):
+            self.ct_export_mode = export_cfg.lower()
+        if self.ct_export_mode not in CT_EXPORT_MODES:
+            self.ct_export_mode = 'copy'
+        formats_cfg = cfg.get('export_formats', self.export_formats)
+        if isinstance(formats_cfg, str):
+            formats_cfg = formats_cfg.split(',')
+        if isinstance(formats_cfg, (list, tuple)):
+            formats = [str(f).strip().lower() for f in formats_cfg]
+            formats = [f for f in EXPORT_FORMATS if f in formats]
+            if formats:
+                self.export_formats = formats
+        default_tasks = {task: (task in DEFAULT_ENABLED_TASKS) for task in TOTALSEG_TASK_KEYS}
+        task_cfg = cfg.get('task_enabled', {})
+        if isinstance(task_cfg, dict):
+            for task in TOTALSEG_TASK_KEYS:
+                if task in task_cfg:
+                    self.task_enabled[task] = bool(task_cfg[task])
+                else:
+                    self.task_enabled[task] = default_tasks[task]
+        else:
+            self.task_enabled = default_tasks
+        # Margen de recorte
+        self.crop_margin = int(cfg.get('crop_margin', self.crop_margin))
+        self.use_dicom_index = bool(cfg.get('use_dicom_index', self.use_dicom_index))
+        self.use_volume_cache = bool(cfg.get('use_volume_cache', self.use_volume_cache))
+        try:
+            self.volume_cache_max_gb = max(0.0, float(cfg.get('volume_cache_max_gb', self.volume_cache_max_gb)))
+        except Exception:
+            pass
+        self.use_seg_cache = bool(cfg.get('use_seg_cache', self.use_seg_cache))
+        try:
+            self.seg_cache_max_gb = max(0.0, float(cfg.get('seg_cache_max_gb', self.seg_cache_max_gb)))
+        except Exception:
+            pass
+        # Hilos de lectura de cabeceras DICOM
+        try:
+            self.scan_workers = max(1, int(cfg.get('scan_workers', self.scan_workers)))
+        except Exception:
+            pass
+        # Dispositivo
+        device_str = cfg.get('device', str(self.device))
+        try:
+            new_dev = torch.device(device_str)
+            if new_dev.type == 'cuda' and torch.cuda.is_available():
+                self.device = new_dev
+                self.device_preference = 'gpu'
+            else:
+                self.device = torch.device('cpu')
+                self.device_preference = 'cpu'
+        except Exception:
+            pass
+        # Resolución para TotalSegmentator (highres indica que se utiliza
+        # el modelo de alta resolución; fast=False)
+        self.highres = bool(cfg.get('highres', self.highres))
+        # Indicar si ya se mostró el diálogo de instalación de TotalSegmentator
+        self.totalseg_prompted = bool(cfg.get('totalseg_prompted', self.totalseg_prompted))
+        self.totalseg_task = cfg.get('totalseg_task', self.totalseg_task)
+
+        # NUEVO: Cargar task_assignments
+        task_assignments_cfg = cfg.get('task_assignments', {})
+        if isinstance(task_assignments_cfg, dict):
+            # Convertir list → set
+            self._task_assignments = {
+                task: set(organs) for task, organs in task_assignments_cfg.items()
+                if isinstance(organs, list)
+            }
 
-        # Mensajes iniciales de registro
-        self._log("👷 Application started")
-        self._log(f"💻 Using {'GPU' if torch.cuda.is_available() else 'CPU'}")
-        if torch.cuda.is_available():
-            try:
-                self._log(f"🔧 GPU detected: {torch.cuda.get_device_name(0)}")
-            except Exception:
-                self._log("🔧 GPU detected but the name could not be retrieved")
+        prefs = cfg.get('organs_by_task', {})
+        if isinstance(prefs, dict):
+            cleaned: dict[str, list[str]] = {}
+            for key, organs in prefs.items():
+                if isinstance(key, str) and isinstance(organs, list):
+                    valid = [str(o) for o in organs if isinstance(o, str)]
+                    if valid:
+                        cleaned[key] = valid
+            if cleaned:
+                self.organ_preferences.update(cleaned)
+        else:
+            legacy_organs = cfg.get('organs')
+            if isinstance(legacy_organs, list):
+                key = self._selection_key(model='totalseg', task='total')
+                self.organ_preferences[key] = [str(o) for o in legacy_organs if isinstance(o, str)]
 
-        # Log de librerías disponibles
-        resize_libs = []
-        if SCIPY_AVAILABLE:
-            resize_libs.append("scipy")
-        if SKIMAGE_AVAILABLE:
-            resize_libs.append("skimage")
-        resize_libs.append("numpy")
-        self._log(f"🔧 Available resizing libraries: {', '.join(resize_libs)}")
+    # ------------------------------------------------------------------
+    # Procesamiento de pacientes
+    # ------------------------------------------------------------------
+    def _run_patient(self, folder: str) -> str:
+        """Process one patient folder and return its status.
 
-        # CUDA/Torch diagnostics to aid troubleshooting
+        The status is one of ``"ok"``, ``"errors"``, ``"no_masks"``,
+        ``"cancelled"`` or ``"failed"``.
+        """
         try:
-            self._log_cuda_diagnostics()
-        except Exception:
-            pass
+            study = self._discover_study(folder)
+            name = study.patient_name
+            self._log(f"🚀 Processing patient: {name}")
+            self._on_progress("patient_start", folder=folder, patient=name)
 
-        # Check and install TotalSegmentator if necessary
-        self._ensure_totalseg()
+            if self.cancel_requested:
+                self._log("❌ Process cancelled by user")
+                return "cancelled"
 
-        # Initial instruction message
-        self._log("Select the input and output folders and then press 'Process' to start")
+            series = self._select_ct_series(study)
 
-        # Capturar el cierre de la ventana para guardar la configuración
-        self.protocol("WM_DELETE_WINDOW", self._on_close)
+            if self.cancel_requested:
+                self._log("❌ Process cancelled by user")
+                return "cancelled"
 
-        # Track whether TotalSegmentator weights have been downloaded yet.  The
-        # first time a segmentation is run the models will be downloaded and
-        # cached; we inform the user about this process.
-        self.totalseg_downloaded: bool = False
+            masks = self._segment_from_files(series.files, series=series)
+            if not masks:
+                self._log("⚠ No segmentation results were produced; skipping RTSTRUCT creation.")
+                status = "no_masks"
+            elif self.cancel_requested:
+                self._log("❌ Process cancelled by user")
+                return "cancelled"
+            elif self._save_rt(study, masks, series=series):
+                self._log(f"✅ Processing completed for {name}")
+                status = "ok"
+            else:
+                self._log(f"⚠ Processing completed with errors for {name}")
+                status = "errors"
+            self._on_progress("patient_done", index=1, total=1, folder=folder, patient=name, status=status)
+            return status
 
-        # Automatically prepare the TotalSegmentator model.  In the original
-        # application this was triggered via a menu item, but since the
-        # application now always uses TotalSegmentator we load it on start.
-        # Running this in a thread prevents blocking the UI during import.
+        except Exception as e:
+            self._log(f"❌ Error processing patient: {e}")
+            self._log(traceback.format_exc())
+            self._on_progress("patient_done", index=1, total=1, folder=folder, patient=None,
+                              status="failed", error=str(e))
+            return "failed"
+
+    def _run_batch(self, root: str) -> dict:
+        """Process every patient sub-folder of ``root``.
+
+        Returns a summary ``{"total": n, "statuses": {folder: status}}`` where
+        patients that never reached the end of the pipeline are absent.
+        """
+        summary: dict = {"total": 0, "statuses": {}}
         try:
-            # Start the model loading process in the background
-            self._load_model_thread()
-        except Exception:
-            # If loading fails, the user will be informed via the log
-            pass
+            subs = [d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d))]
+            total = len(subs)
+            summary["total"] = total
+            if total == 0:
+                self._log("ℹ No subfolders found to process")
+                return summary
+
+            self._on_progress("batch_start", root=root, total=total)
+
+            # Tres etapas solapadas: lectura (descubrimiento + decodificación
+            # del volumen si la segmentación lo usa), segmentación y
+            # exportación del RTSTRUCT.
+            prefetch = self._prefetch_needed()
+
+            def ingest(job):
+                study = self._discover_study(job["path"])
+                job["name"] = study.patient_name
+                self._log(f"{job['index']}/{total} ➡ Processing {job['name']}...")
+                self._on_progress("patient_start", index=job["index"], total=total,
+                                  folder=job["folder"], patient=job["name"])
+                series = self._select_ct_series(study)
+                if prefetch:
+                    self._prefetch_volume(series)
+                job["study"], job["series"] = study, series
+                return job
+
+            def segment(job):
+                series = job["series"]
+                try:
+                    masks = self._segment_from_files(series.files, series=series)
+                finally:
+                    series.volume = None  # liberar el volumen decodificado
+                if self.cancel_requested:
+                    job["status"] = "cancelled"
+                    return None
+                if not masks:
+                    self._log(f"⚠ No segmentation results for {job['name']}; skipping RTSTRUCT.")
+                    job["status"] = "no_masks"
+                    return None
+                job["masks"] = masks
+                return job
+
+            def export(job):
+                success = self._save_rt(job["study"], job.pop("masks"), series=job["series"])
+                if success:
+                    self._log(f"✅ {job['name']} completed")
+                    job["status"] = "ok"
+                else:
+                    self._log(f"⚠ {job['name']} completed with errors")
+                    job["status"] = "errors"
+                return job
+
+            def on_error(job, stage, e):
+                self._log(f"❌ Error processing {job['name']}: {e}")
+                # Do not log full traceback in batch to avoid cluttering the log
+                job["status"] = "failed"
+                job["error"] = str(e)
+
+            done = [0]
+
+            def on_finish(job):
+                done[0] += 1
+                status = job.get("status", "cancelled")
+                summary["statuses"][job["folder"]] = status
+                extra = {"error": job["error"]} if "error" in job else {}
+                self._on_progress("patient_done", index=job["index"], total=total, folder=job["folder"],
+                                  patient=job["name"], status=status, **extra)
+                self._on_progress("batch_progress", done=done[0], total=total)
+
+            jobs = (
+                {"index": i, "name": folder_name, "folder": folder_name, "path": os.path.join(root, folder_name)}
+                for i, folder_name in enumerate(subs, 1)
+            )
+            self._batch_pipelined = True
+            try:
+                run_staged_pipeline(
+                    jobs,
+                    [ingest, segment, export],
+                    queue_size=1,
+                    should_stop=lambda: self.cancel_requested,
+                    on_error=on_error,
+                    on_finish=on_finish,
+                )
+            finally:
+                self._batch_pipelined = False
+            if self.cancel_requested:
+                self._log("❌ Batch processing cancelled by user")
+
+            self._log("🟢 Batch processing completed")
+
+        except Exception as e:
+            self._log(f"❌ Error in batch processing: {e}")
+            self._log(traceback.format_exc())
+            summary["error"] = str(e)
+        self._on_progress("batch_end", **summary)
+        return summary
+
+    def _log_cuda_diagnostics(self):
+        """Log extended Torch/CUDA diagnostics to help troubleshoot GPU issues."""
+        try:
+            import torch as _t
+            ver = getattr(_t, '__version__', 'unknown')
+            cuda_built = getattr(_t.version, 'cuda', None) if hasattr(_t, 'version') else None
+            avail = _t.cuda.is_available() if hasattr(_t, 'cuda') else False
+            dev_count = _t.cuda.device_count() if avail else 0
+            cudnn_avail = _t.backends.cudnn.is_available() if hasattr(_t, 'backends') and hasattr(_t.backends, 'cudnn') else False
+            self._log(f"Torch version: {ver}")
+            self._log(f"Torch CUDA build: {cuda_built}")
+            self._log(f"CUDA available: {avail}; device_count: {dev_count}; cuDNN: {cudnn_avail}")
+            if 'CUDA_VISIBLE_DEVICES' in os.environ:
+                self._log(f"CUDA_VISIBLE_DEVICES={os.environ['CUDA_VISIBLE_DEVICES']}")
+            if avail:
+                for i in range(dev_count):
+                    try:
+                        name = _t.cuda.get_device_name(i)
+                        cap = _t.cuda.get_device_capability(i)
+                        self._log(f"GPU {i}: {name}; capability: {cap}")
+                    except Exception as e:
+                        self._log(f"GPU {i} info error: {e}")
+        except Exception as e:
+            self._log(f"CUDA diagnostics failed: {e}")
 
     def _selection_key(self, model=None, task=None) -> str:
         model_name = model or self.model_type
@@ -2186,2108 +4764,2701 @@ class AutoSegApp(tk.Tk):
             logger.warning(f"Could not determine GPU availability: {e}")
 
     # ------------------------------------------------------------------
-    # GUI
+    # Transforms bundle con parámetros adaptativos
     # ------------------------------------------------------------------
-    def _build_ui(self):
+    def _build_transforms_adaptive(self, reader: str, original_spacing=None, target_pixdim=None):
         """
-        Construye la interfaz de usuario principal, incluyendo la barra de menús
-        reorganizada. Además de las secciones de "Configuración" y "Ayuda"
-        originales, ahora se incluyen nuevos menús "Aspecto", "Segmentación"
-        y "Modelo".  Cada sección agrupa opciones de forma más coherente con
-        su función. Por ejemplo, la selección del tema se mueve a "Aspecto",
-        las opciones de orientación y selección de órganos se agrupan bajo
-        "Segmentación", y la resolución, el dispositivo de cómputo y el
-        recorte automático se encuentran en "Modelo".  Se introducen
-        variables de control adicionales para las nuevas opciones.
+        Construye transformaciones adaptativas que intentan diferentes parámetros
+        hasta encontrar una configuración que funcione correctamente.
         """
-        # Create the main menu bar
-        menubar = tk.Menu(self)
-
-        # Appearance menu: visual options for the application
-        appearance_menu = tk.Menu(menubar, tearoff=0)
-        appearance_menu.add_command(label="Select theme", command=self._choose_theme)
-        menubar.add_cascade(label="Appearance", menu=appearance_menu)
-
-        # Segmentation menu: groups options related to segmentation and
-        # post‑processing of masks
-        segment_menu = tk.Menu(menubar, tearoff=0)
-        segment_menu.add_command(label="Orientation options", command=self._choose_orientation)
-        segment_menu.add_command(label="Select organs", command=self._select_organs)
-        # Variable for controlling morphological cleaning of masks
-        self.clean_masks_var = tk.BooleanVar(value=self.clean_masks)
-        segment_menu.add_checkbutton(
-            label="Mask cleaning", onvalue=True, offvalue=False,
-            variable=self.clean_masks_var, command=self._toggle_clean
-        )
-        self.smooth_masks_var = tk.BooleanVar(value=self.smooth_masks)
-        segment_menu.add_checkbutton(
-            label="Enable smoothing", onvalue=True, offvalue=False,
-            variable=self.smooth_masks_var, command=self._toggle_smoothing
-        )
-        segment_menu.add_command(label="Smoothing options", command=self._choose_smoothing)
-        # Allow the user to adjust the cropping margin
-        segment_menu.add_command(label="Crop margin", command=self._choose_crop_margin)
-        menubar.add_cascade(label="Segmentation", menu=segment_menu)
-
-        tasks_menu = tk.Menu(menubar, tearoff=0)
-        tasks_menu.add_command(label="Select tasks...", command=self._choose_tasks)
-        menubar.add_cascade(label="Tasks", menu=tasks_menu)
-
-        # Model menu: contains options relevant to TotalSegmentator
-        model_menu = tk.Menu(menubar, tearoff=0)
-        # Allow the user to change the resolution (1.5 mm vs 3 mm)
-        model_menu.add_command(label="Select resolution", command=self._choose_resolution)
-        # Allow the user to select the computation device (CPU/GPU)
-        model_menu.add_command(label="Select device", command=self._choose_device)
-        # Variable for enabling/disabling automatic body cropping
-        self.use_crop_var = tk.BooleanVar(value=self.use_crop)
-        model_menu.add_checkbutton(
-            label="Automatic body cropping", onvalue=True, offvalue=False,
-            variable=self.use_crop_var, command=self._toggle_crop
-        )
-        menubar.add_cascade(label="Model", menu=model_menu)
-
-        # Help menu: general information and access to the error report
-        help_menu = tk.Menu(menubar, tearoff=0)
-        help_menu.add_command(label="About", command=self._show_about)
-        help_menu.add_command(label="View log", command=self._show_log)
-        menubar.add_cascade(label="Help", menu=help_menu)
-
-        self.config(menu=menubar)
-
-        # Input
-        input_frame = tk.LabelFrame(self, text="Input", padx=5, pady=5)
-        input_frame.pack(fill="x", padx=10, pady=5)
-
-        tk.Label(input_frame, text="Patients folder (DICOM subfolders):").pack(anchor="w")
-        self.in_entry = tk.Entry(input_frame, width=80)
-        self.in_entry.pack(fill="x", padx=5, pady=(0, 5))
-        tk.Button(input_frame, text="Browse...", command=lambda: self._browse(self.in_entry)).pack(pady=(0, 5))
-
-        # Output
-        output_frame = tk.LabelFrame(self, text="Output", padx=5, pady=5)
-        output_frame.pack(fill="x", padx=10, pady=5)
-
-        tk.Label(output_frame, text="Destination folder (RTSTRUCT):").pack(anchor="w")
-        self.out_entry = tk.Entry(output_frame, width=80)
-        self.out_entry.pack(fill="x", padx=5, pady=(0, 5))
-        tk.Button(output_frame, text="Browse...", command=lambda: self._browse(self.out_entry)).pack(pady=(0, 5))
-
-        # Controls
-        control_frame = tk.Frame(self)
-        control_frame.pack(pady=10)
-
-        self.btn_one = tk.Button(control_frame, text="Process ONE patient",
-                                 state="disabled", command=self._run_one_thread)
-        self.btn_one.pack(side="left", padx=5)
-
-        self.btn_all = tk.Button(control_frame, text="Process ALL (batch)",
-                                 state="disabled", command=self._run_all_thread)
-        self.btn_all.pack(side="left", padx=5)
-
-        self.btn_cancel = tk.Button(control_frame, text="Cancel",
-                                    state="disabled", command=self._cancel_process,
-                                    bg="#ff4444", fg="white")
-        self.btn_cancel.pack(side="left", padx=5)
-
-        # Progress bar
-        self.progress = ttk.Progressbar(self, length=780, mode="determinate")
-        self.progress.pack(padx=10, pady=(0, 10))
+        if target_pixdim is None:
+            target_pixdim = (1.5, 1.5, 1.5) if self.highres else (3.0, 3.0, 3.0)
+        
+        # Lista de configuraciones a probar, de más conservadora a más agresiva
+        spacing_configs = [
+            # Configuración original
+            {"pixdim": target_pixdim, "mode": "bilinear"},
+            # Sin resampling espacial si el original está cerca
+            {"pixdim": None, "mode": None},
+            # Resampling más conservador
+            {"pixdim": (2.0, 2.0, 2.0), "mode": "bilinear"},
+            # Solo resamplear en plano axial
+            {"pixdim": (original_spacing[0] if original_spacing else 2.0, 2.0, 2.0), "mode": "bilinear"},
+        ]
+        
+        for i, config in enumerate(spacing_configs):
+            try:
+                # Report which spacing configuration is being tested
+                self._log(f"🔄 Trying spacing configuration {i+1}/{len(spacing_configs)}: {config}")
+                
+                transforms_list = [
+                    LoadImaged(keys="image", reader=reader, meta=True),
+                    EnsureTyped(keys="image"),
+                ]
+                
+                # Orientación siempre necesaria
+                transforms_list.append(Orientationd(keys="image", axcodes="RAS"))
+                
+                # Crop foreground opcional para reducir el volumen.  Añadimos
+                # margen para asegurar que se mantenga contexto alrededor del
+                # cuerpo, y permitimos que el recorte sea menor que el
+                # volumen original si es necesario.
+                if self.use_crop:
+                    transforms_list.append(
+                        CropForegroundd(
+                            keys="image", source_key="image",
+                            margin=self.crop_margin, allow_smaller=True
+                        )
+                    )
+                
+                # Spacing solo si está configurado.  Aplicamos límites mínimos y máximos
+                # al tamaño de voxel para evitar sobre/submuestreo excesivo.  Los
+                # valores de min_pixdim y max_pixdim son ±25 % del valor de pixdim,
+                # siguiendo la práctica de MONAI Auto3DSeg.
+                if config["pixdim"] is not None:
+                    pixdim = config["pixdim"]
+                    # calcular límites para spacing
+                    try:
+                        min_pixdim = tuple(float(p) * 0.75 for p in pixdim)
+                        max_pixdim = tuple(float(p) * 1.25 for p in pixdim)
+                    except Exception:
+                        # en caso de que pixdim no sea iterable (ninguno o float)
+                        min_pixdim = None
+                        max_pixdim = None
+                    transforms_list.append(
+                        Spacingd(
+                            keys="image",
+                            pixdim=pixdim,
+                            mode=config["mode"],
+                            min_pixdim=min_pixdim,
+                            max_pixdim=max_pixdim,
+                        )
+                    )
+                
+                # Normalización de intensidad.  Para CT es habitual recortar a
+                # [-1000, 2000] para cubrir desde el aire hasta el hueso,
+                # mapeando luego a [0, 1].  Esto proporciona un rango más
+                # amplio que el uso anterior de [-1000, 1000] y puede ayudar
+                # a preservar estructuras óseas.
+                transforms_list.extend([
+                    ScaleIntensityRanged(
+                        keys="image",
+                        a_min=-1000.0,
+                        a_max=2000.0,
+                        b_min=0.0,
+                        b_max=1.0,
+                        clip=True,
+                    ),
+                    ToTensord(keys="image"),
+                ])
+                
+                self.pre_transforms = Compose(transforms_list)
+                
+                # Post-transforms correspondientes
+                if config["pixdim"] is not None:
+                    # Siempre usar Invertd para revertir orientación y recorte,
+                    # además de las transformaciones espaciales.
+                    self.post_transforms = Compose(
+                        [
+                            Activationsd(keys="pred", sigmoid=True),
+                            AsDiscreted(keys="pred", threshold=0.5),
+                            Invertd(
+                                keys="pred",
+                                transform=self.pre_transforms,
+                                orig_keys="image",
+                                nearest_interp=True,
+                                to_tensor=False,
+                            ),
+                            EnsureTyped(keys="pred"),
+                            ToNumpyd(keys="pred"),
+                        ]
+                    )
+                else:
+                    # Aunque no haya resampling, se debe invertir para
+                    # restaurar la orientación y deshacer el recorte del
+                    # foreground.  Se omite la activación porque el modelo
+                    # retorna índices de clase directamente.
+                    self.post_transforms = Compose(
+                        [
+                            Invertd(
+                                keys="pred",
+                                transform=self.pre_transforms,
+                                orig_keys="image",
+                                nearest_interp=True,
+                                to_tensor=False,
+                            ),
+                            EnsureTyped(keys="pred"),
+                            ToNumpyd(keys="pred"),
+                        ]
+                    )
+                
+                self._log(f"✔ Configuration {i+1} prepared successfully")
+                return self.pre_transforms, config
+                
+            except Exception as e:
+                self._log(f"⚠ Configuration {i+1} failed: {e}")
+                continue
+        
+        # If all configurations fail, use minimal transforms
+        self._log("⚠ All configurations failed, using minimal transforms")
+        self.pre_transforms = Compose([
+            LoadImaged(keys="image", reader=reader, meta=True),
+            EnsureTyped(keys="image"),
+            ScaleIntensityRanged(keys="image", a_min=-1000, a_max=1000,
+                                b_min=0.0, b_max=1.0, clip=True),
+            ToTensord(keys="image"),
+        ])
+        self.post_transforms = None
+        return self.pre_transforms, {"pixdim": None, "mode": None}
 
-        # Log
-        log_frame = tk.LabelFrame(self, text="Activity log", padx=5, pady=5)
-        log_frame.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+    def _load_model(self):
+        # Restablecer estado y deshabilitar botones durante la carga
+        self.ready = False
+        self._set_run_enabled(False)
 
-        self.log = ScrolledText(log_frame, state="disabled", height=18, wrap="word")
-        self.log.pack(fill="both", expand=True, padx=5, pady=5)
+        # Show an appropriate message
+        if self.model_type == "segresnet":
+            self._log("⏳ Loading network and weights (SegResNet)...")
+        else:
+            self._log("⏳ Preparing TotalSegmentator V2...")
 
-        # Credits: small text at the bottom of the window
-        self.footer_label = tk.Label(
-            self,
-            text="by Agustin Rosich creative commons 2025 – open source, all rights reserved. This program may not be sold.",
-            font=("Arial", 8),
-            anchor="e"
+        # ----- TotalSegmentator -----
+        if self.model_type == "totalseg":
+            # Asignar etiquetas y órganos desde el diccionario de TOTALSEG
+            self._update_totalseg_labels()
+            self.model = None
+            # Verificar que la biblioteca esté disponible.  Preferir la versión v2.
+            success = False
+            try:
+                try:
+                    # Attempt to import v2 first
+                    from totalsegmentatorv2.python_api import totalsegmentator  # noqa: F401, type: ignore
+                except ImportError:
+                    # Fall back to legacy package name
+                    from totalsegmentator.python_api import totalsegmentator  # noqa: F401, type: ignore
+                success = True
+            except Exception as e:
+                self._log(
+                    f"❌ TotalSegmentator not available: {e}. Install 'totalsegmentatorv2' or 'totalsegmentator' with pip."
+                )
+
+            if success:
+                self._log("✔ TotalSegmentator imported successfully")
+                self._log(
+                    "ℹ The weights will be downloaded automatically the first time segmentation runs"
+                )
+                self.ready = True
+                self._set_run_enabled(True)
+            else:
+                self.ready = False
+
+            # Finalizar barra de progreso
+            self._indeterminate(False)
+            return
+
+        # ----- SegResNet -----
+        try:
+            # Cargar metadatos para mapear canales a órganos
+            try:
+                with open(META_JSON) as f:
+                    meta = json.load(f)
+                chdef = (
+                    meta.get("network_data_format", {})
+                    .get("outputs", {})
+                    .get("pred", {})
+                    .get("channel_def", {})
+                )
+                labels = {v: int(k) for k, v in chdef.items() if k != "0"}
+                self._log(f" ✔ {len(labels)} organs loaded from metadata.json")
+            except Exception as e:
+                self._log(f"⚠ Could not read metadata ({e}); using default values")
+                labels = FULL_LABELS.copy()
+
+            # Asegurar que todas las etiquetas posibles estén presentes
+            for k, v in FULL_LABELS.items():
+                labels.setdefault(k, v)
+            self.labels_map = labels
+            self._apply_saved_organs()
+            num_classes = max(labels.values()) + 1
+
+            # Seleccionar pesos según la resolución
+            weights_path = WEIGHTS_HIGHRES if self.highres else WEIGHTS_LOWRES
+            if not os.path.exists(weights_path):
+                raise FileNotFoundError(f"Weights file not found: {weights_path}")
+
+            self._log(
+                f"🔄 Loading weights for {'1.5 mm' if self.highres else '3 mm'}: {os.path.basename(weights_path)}"
+            )
+            obj = torch.load(weights_path, map_location=self.device)
+            if isinstance(obj, torch.nn.Module):
+                self.model = obj.to(self.device).eval()
+            else:
+                state_dict = obj.get("state_dict", obj)
+                self.model = SegResNet(
+                    spatial_dims=3,
+                    in_channels=1,
+                    out_channels=num_classes,
+                    init_filters=32,
+                    blocks_down=(1, 2, 2, 4),
+                    blocks_up=(1, 1, 1),
+                ).to(self.device)
+                self.model.load_state_dict(state_dict)
+
+            self.model.eval()
+            self._log(f" ✔ SegResNet model loaded correctly on {self.device}")
+            self.ready = True
+            self._set_run_enabled(True)
+
+        except Exception as e:
+            # Translate error when loading the SegResNet model
+            self._log(f"❌ Error loading model: {e}")
+            self._log(traceback.format_exc())
+            self.ready = False
+        finally:
+            # Stop the indeterminate progress bar when loading completes
+            self._indeterminate(False)
+
+    # ------------------------------------------------------------------
+    # Índice de cabeceras DICOM
+    # ------------------------------------------------------------------
+    def _get_dicom_index(self) -> Optional[DicomHeaderIndex]:
+        """Open the persistent header index on first use.
+
+        Returns ``None`` when the index is disabled or cannot be opened
+        (for example on a read-only home directory); scanning then falls
+        back to reading every header.
+        """
+        if not self.use_dicom_index or self._dicom_index_failed:
+            return None
+        if self._dicom_index is None:
+            try:
+                self._dicom_index = DicomHeaderIndex()
+            except Exception as e:
+                self._dicom_index_failed = True
+                self._log(f"⚠ DICOM header index unavailable, reading all headers: {e}")
+                return None
+        return self._dicom_index
+
+    def _get_volume_cache(self) -> Optional[SeriesVolumeCache]:
+        """Open the per-series volume cache on first use.
+
+        Returns ``None`` when the cache is disabled or its directory cannot
+        be created; volumes are then decoded on every use.
+        """
+        if not self.use_volume_cache or self._volume_cache_failed:
+            return None
+        if self._volume_cache is None:
+            try:
+                self._volume_cache = SeriesVolumeCache(max_bytes=int(self.volume_cache_max_gb * 2**30))
+            except Exception as e:
+                self._volume_cache_failed = True
+                self._log(f"⚠ Series volume cache unavailable, decoding every time: {e}")
+                return None
+        return self._volume_cache
+
+    def _get_seg_cache(self) -> Optional[SegmentationResultCache]:
+        """Open the segmentation result cache on first use (``None`` if disabled)."""
+        if not self.use_seg_cache or self._seg_cache_failed:
+            return None
+        if self._seg_cache is None:
+            try:
+                self._seg_cache = SegmentationResultCache(max_bytes=int(self.seg_cache_max_gb * 2**30))
+            except Exception as e:
+                self._seg_cache_failed = True
+                self._log(f"⚠ Segmentation cache unavailable, running every task: {e}")
+                return None
+        return self._seg_cache
+
+    def _get_task_runtimes(self) -> TaskRuntimeStats:
+        if self._task_runtimes is None:
+            self._task_runtimes = TaskRuntimeStats()
+        return self._task_runtimes
+
+    def _task_cost_function(self):
+        """``task -> estimated seconds`` for the current device and resolution.
+
+        Tasks in :data:`TASKS_REQUIRING_FULL` always run at full resolution,
+        so they are costed with the full-resolution measurements.
+        """
+        stats = self._get_task_runtimes()
+        full_cost = stats.cost_function(task_runtime_profile(self.device_preference, False))
+        if self.highres:
+            return full_cost
+        fast_cost = stats.cost_function(task_runtime_profile(self.device_preference, True))
+        return lambda task: full_cost(task) if task in TASKS_REQUIRING_FULL else fast_cost(task)
+
+    # ------------------------------------------------------------------
+    # Leer nombre paciente
+    # ------------------------------------------------------------------
+    def _dicom_name(self, folder: str) -> str:
+        """Attempt to extract a human–readable patient name from DICOM files.
+
+        This method walks the input folder looking for a DICOM slice.  In
+        earlier versions only files ending in ``.dcm`` were considered,
+        which excluded valid DICOM files with non‑standard or missing
+        extensions (for example files named ``IM1``).  To improve
+        robustness the search now also includes any file that appears to
+        be a DICOM according to :func:`looks_like_dicom`.  Once a valid
+        file is found we read its header with ``pydicom.dcmread`` and
+        return the patient family name, if present, or the raw value of
+        the ``PatientName`` tag.  If no valid slice is found the
+        string ``"Patient"`` is returned.  The header comes from the
+        persistent index when the file has not changed since it was
+        last read.
+        """
+        pn = read_patient_name(folder, index=self._get_dicom_index())
+        if pn is None:
+            return "Patient"
+        # Prefer the family name attribute when available
+        pn = pydicom.valuerep.PersonName(pn)
+        return str(getattr(pn, "family_name", pn)) or "Paciente"
+
+    # ------------------------------------------------------------------
+    # Descubrimiento del estudio (una pasada por paciente)
+    # ------------------------------------------------------------------
+    def _discover_study(self, folder: str) -> StudyInfo:
+        """Scan a patient folder once and return its :class:`StudyInfo`.
+
+        Every file below ``folder`` is visited a single time: the patient
+        name and all CT series (sorted files plus geometry tags) come from
+        the same header scan, so later stages never walk the folder again.
+        Only files that either end in ``.dcm`` or look like DICOM according
+        to :func:`looks_like_dicom` are parsed.  The headers are read
+        concurrently using ``self.scan_workers`` threads, and files that
+        have not changed since the previous scan are served from the
+        persistent header index (see :class:`DicomHeaderIndex`).
+        """
+        t0 = time.perf_counter()
+        stats: dict = {}
+        study = discover_study(
+            folder,
+            max_workers=self.scan_workers,
+            # Warn if reading a file believed to be DICOM fails; this may
+            # indicate a corrupt slice but should not abort
+            on_error=lambda path, e: self._log(f"⚠ Error reading {path}: {e}"),
+            index=self._get_dicom_index(),
+            stats=stats,
         )
-        self.footer_label.pack(fill="x", side="bottom", padx=10, pady=(0, 5))
+        elapsed = time.perf_counter() - t0
+        n_slices = sum(s.num_slices for s in study.series)
+        self._log(
+            f"⏱ Header scan of {folder}: {n_slices} CT slices in {len(study.series)} series, "
+            f"{elapsed:.2f} s ({self.scan_workers} workers, "
+            f"{stats.get('cached', 0)} from index, {stats.get('read', 0)} read)"
+        )
+        return study
+
+    def _select_ct_series(self, study: StudyInfo) -> SeriesInfo:
+        """Pick the largest CT series of ``study`` and log the choice."""
+        series = study.primary_series()
+        self._log(f"ℹ Selected CT series: {series.uid} ({series.num_slices} slices)")
+        return series
 
     # ------------------------------------------------------------------
-    # Visualizar log en ventana
+    # Recolectar serie CT
     # ------------------------------------------------------------------
-    def _show_log(self):
-        """
-        Open a window displaying the contents of the application log for review.
+    def _collect_ct_series(self, folder: str):
+        """Collect a continuous CT series from a directory of DICOM files.
 
-        This method creates a new top‑level window and populates it with the
-        contents of the `app.log` file located in the logging directory.  If
-        the log file cannot be read, an error message is shown instead.  The
-        text is placed into a read‑only `ScrolledText` widget for easy
-        navigation.
+        Only slices belonging to the largest CT series (identified by
+        ``SeriesInstanceUID``) are returned, sorted by instance number.
+        If no CT slices are found an exception is raised.  Kept for
+        callers that only need the file list; the processing pipeline uses
+        :meth:`_discover_study` so the folder is scanned only once.
         """
-        win = tk.Toplevel(self)
-        # Use an English title for the log window
-        win.title("Error and activity report")
-        win.geometry("600x400")
-        text = ScrolledText(win, state="normal", wrap="word")
-        text.pack(fill="both", expand=True)
-        try:
-            with open(os.path.join(log_directory, 'app.log'), 'r', encoding='utf-8') as f:
-                content = f.read()
-        except Exception as e:
-            # Fall back to a meaningful message if the log cannot be read
-            content = f"Could not read the log: {e}"
-        text.insert("1.0", content)
-        text.configure(state="disabled")
+        return self._select_ct_series(self._discover_study(folder)).files
 
     # ------------------------------------------------------------------
-    # Logging a GUI
+    # Lectura manual mejorada (fallback)
     # ------------------------------------------------------------------
-    def _log(self, msg: str):
-        ts = datetime.now().strftime("%H:%M:%S")
-        self.after(0, lambda: self._append_log_from_main(f"[{ts}] {msg}\n"))
+    def _manual_volume(self, files, series: Optional[SeriesInfo] = None):
+        """Construye volumen y meta dict manual cuando fallan lectores MONAI.
 
-    def _append_log_from_main(self, msg: str):
-        self.log.configure(state="normal")
-        self.log.insert(tk.END, msg)
-        self.log.see(tk.END)
-        self.log.configure(state="disabled")
-        self.update_idletasks()
+        El volumen decodificado se obtiene de la caché de volúmenes cuando
+        está habilitada (ver :func:`load_series_volume`).
+        """
+        self._log(f"⚙ Starting manual reading of {len(files)} slices...")
+        total = len(files)
 
-    # ------------------------------------------------------------------
-    # About
-    # ------------------------------------------------------------------
-    def _show_about(self):
-        about = tk.Toplevel(self)
-        about.title("About AURA")
-        about.geometry("430x320")
+        def on_error(k, pth, e):
+            self._log(f"   ⚠ Error in slice {k + 1}/{total}: {e}")
 
-        tk.Label(
-            about,
-            text="AURA Ver 1.02",
-            font=("Arial", 14, "bold"),
-        ).pack(pady=10)
+        def on_progress(done, total):
+            if done % 20 == 0 or done == total:
+                self._log(f"   ✔ Processed {done}/{total} slices")
 
-        tk.Label(
-            about,
-            text=(
-                "Application for automatic segmentation of anatomical structures\n"
-                "in CT images and the generation of RTSTRUCT files.\n"
-                "Includes intelligent adaptive transformations and advanced options."
-            ),
-            wraplength=400,
-        ).pack(pady=5)
+        # Volumen numpy (Z, Y, X) float32, reservado una sola vez
+        stats: dict = {}
+        if series is not None and series.volume is not None:
+            vol, geometry = series.volume
+            self._log("   ✔ Using the prefetched series volume")
+        else:
+            vol, geometry = load_series_volume(
+                files,
+                uid=series.uid if series is not None else None,
+                cache=self._get_volume_cache(),
+                on_error=on_error,
+                on_progress=on_progress,
+                stats=stats,
+            )
+        if stats.get("cached"):
+            self._log("   ✔ Volume loaded from the series volume cache")
+        num_slices = vol.shape[0]
 
-        tk.Label(about, text="Version 1.1").pack(pady=5)
-        tk.Label(
-            about,
-            text="© 2025 Agustin Rosich – Open source software under MIT license.\n"
-                 "Automatic DICOM segmentation tool powered by AI. For academic and supervised clinical use.",
-            font=("Arial", 8),
-            justify="center",
-        ).pack(pady=5)
+        if num_slices < 10:
+            raise RuntimeError("Too many damaged slices to build volume")
 
-        # Provide a clear Close button in English
-        ttk.Button(about, text="Close", command=about.destroy).pack(pady=10)
+        # Canal (C, Z, Y, X)
+        vol = vol[np.newaxis, ...]  # C=1
+        tensor_vol = torch.from_numpy(vol)
 
-    # ------------------------------------------------------------------
-    # Menu para seleccionar resolución
-    # ------------------------------------------------------------------
-    def _choose_resolution(self):
-        """Allow the user to change the model resolution."""
-        win = tk.Toplevel(self)
-        win.title("Choose model resolution")
-        win.geometry("300x200")
+        # Matriz afín aproximada
+        pixel_spacing = [float(x) for x in geometry["pixel_spacing"]]  # [row, col] = [Y, X]
 
-        var = tk.StringVar(value='1.5' if self.highres else '3')
-        tk.Label(win, text="Select model resolution:").pack(pady=10)
-        tk.Radiobutton(win, text="High (1.5 mm)", variable=var, value='1.5').pack(anchor="w", padx=20)
-        tk.Radiobutton(win, text="Low (3 mm)", variable=var, value='3').pack(anchor="w", padx=20)
-        tk.Button(win, text="Confirm", command=lambda: self._set_resolution(var.get(), win)).pack(pady=10)
+        # Espacio entre cortes: usar SliceThickness si está; si no, derivar de ImagePositionPatient
+        slice_thickness = geometry.get("slice_thickness")
+        if slice_thickness is None:
+            try:
+                pos_first = np.array(geometry["positions"][0], dtype=float)
+                pos_last = np.array(geometry["positions"][-1], dtype=float)
+                slice_thickness = np.linalg.norm(pos_last - pos_first) / max(num_slices - 1, 1)
+            except Exception:
+                slice_thickness = 5.0  # fallback por defecto
 
-    def _set_resolution(self, value: str, window: tk.Toplevel):
-        self.highres = (value == '1.5')
-        self._log(f"🔧 Resolution selected: {'1.5 mm' if self.highres else '3 mm'}")
-        window.destroy()
+        orientation = geometry["orientation"]
+        row_vec = np.array(orientation[0:3], dtype=float)
+        col_vec = np.array(orientation[3:6], dtype=float)
+        slice_vec = np.cross(row_vec, col_vec)
 
-    # ------------------------------------------------------------------
-    # Tema de la aplicación
-    # ------------------------------------------------------------------
-    def apply_theme(self):
+        affine = np.eye(4, dtype=float)
+        # columnas del afín: X, Y, Z en espacio físico
+        affine[0:3, 0] = row_vec * pixel_spacing[1]  # X
+        affine[0:3, 1] = col_vec * pixel_spacing[0]  # Y
+        affine[0:3, 2] = slice_vec * slice_thickness  # Z
+        affine[0:3, 3] = np.array(geometry["positions"][0], dtype=float)  # origen
+
+        spacing = [slice_thickness, pixel_spacing[0], pixel_spacing[1]]  # (Z, Y, X) como data
+
+        meta_dict = {
+            "original_affine": affine.copy(),
+            "affine": affine.copy(),
+            "spatial_shape": vol.shape[1:],  # (Z, Y, X)
+            "original_channel_dim": "no_channel",
+            "filename_or_obj": files[0],
+            "space": "physical",
+            "original_spacing": spacing,
+            "spacing": spacing,
+            "original_orientation": orientation,
+            # Afín RAS de los índices (Z, Y, X) del volumen, derivada de la geometría DICOM
+            "volume_affine": np.asarray(geometry["affine"], dtype=float)[:, [2, 1, 0, 3]],
+        }
+
+        # Summarize manual volume reading results in English
+        self._log(f"✔ Manual volume reading complete: {num_slices} slices, volume {vol.shape}")
+        self._log(f"✔ Detected spacing: {spacing}")
+        self._log("✔ Affine matrix manually reconstructed")
+
+        meta_tensor_vol = MetaTensor(vol, affine=affine, meta=meta_dict)
+        return tensor_vol, meta_dict, meta_tensor_vol, spacing
+
+    def _clean_mask(self, mask: CompactMask) -> CompactMask:
+        """Fill holes and keep the largest connected component.
+
+        Works inside the bounding box: everything outside it is background,
+        so the result equals cleaning the full-size mask.
         """
-        Aplica los colores definidos en el tema actual a los widgets principales.
-        Cambia los colores de fondo y primer plano de los elementos de la
-        interfaz.  Este método puede invocarse después de cambiar
-        `self.style_name` para actualizar dinámicamente la apariencia.
+        def largest_component(crop: np.ndarray) -> np.ndarray:
+            import scipy.ndimage as _ndi  # type: ignore
+            # Rellenar agujeros dentro del órgano
+            filled = _ndi.binary_fill_holes(crop)
+            # Etiquetar componentes conectados y quedarse con la mayor
+            labels_, num = _ndi.label(filled)
+            if num > 0:
+                counts = np.bincount(labels_.ravel())
+                # La etiqueta 0 es fondo; ignorarla
+                if counts.size > 1:
+                    return labels_ == int(np.argmax(counts[1:]) + 1)
+            return filled
+
+        if not mask.any():
+            return mask
+        try:
+            return mask.apply(largest_component)
+        except Exception:
+            # Si scipy no está disponible o falla, se usa la máscara original
+            return mask
+
+    def _export_workers(self, contours: bool = True) -> tuple[int, int]:
+        """``(postprocess threads, contour processes)`` for one export.
+
+        See :func:`default_export_workers`; the budget is halved while a
+        batch pipeline runs the other stages at the same time.
         """
-        theme = THEME_OPTIONS.get(self.style_name, THEME_OPTIONS["azure"])
-        bg = theme["bg"]
-        fg = theme["fg"]
-        accent = theme["accent"]
+        return default_export_workers(contours, self._batch_pipelined,
+                                      int(self.postprocess_workers), int(self.contour_workers))
+
+    def _postprocess_iter(self, items, smooth: bool = True,
+                          spacing: Optional[Tuple[float, float, float]] = None,
+                          context: str = "", total: Optional[int] = None, workers: int = 1):
+        """Clean and (optionally) smooth masks on ``workers`` threads.
+
+        ``items`` yields ``(name, CompactMask)`` and is consumed lazily: at
+        most two masks per thread are in flight.  Yields the non-empty
+        results in input order and logs the per-organ timing.  ``context``
+        is appended to the log lines (e.g. the task name).
+        """
+        def work(item):
+            name, mask = item
+            t0 = time.perf_counter()
+            try:
+                if self.clean_masks:
+                    mask = self._clean_mask(mask)
+                t1 = time.perf_counter()
+                if smooth:
+                    mask = self._smooth_mask(mask, spacing)
+                t2 = time.perf_counter()
+                return name, mask, t1 - t0, t2 - t1, None
+            except Exception as e:
+                return name, None, 0.0, 0.0, e
+
+        totals = {"count": 0, "clean": 0.0, "smooth": 0.0}
+
+        def report(result):
+            name, mask, t_clean, t_smooth, error = result
+            totals["count"] += 1
+            if error is not None:
+                self._log(f"⚠ Error building mask for {name}{context}: {error}")
+                return None
+            totals["clean"] += t_clean
+            totals["smooth"] += t_smooth
+            pixel_count = mask.count()
+            if pixel_count <= 0:
+                return None
+            self._log(
+                f"✔ Mask for {name}{context}: {mask.shape}, {pixel_count} pixels "
+                f"(clean {t_clean:.2f}s, smooth {t_smooth:.2f}s)"
+            )
+            return name, mask
+
+        workers = max(1, int(workers))
+        if total is not None:
+            workers = max(1, min(workers, total))
+        t_start = time.perf_counter()
+        if workers == 1:
+            for item in items:
+                done = report(work(item))
+                if done is not None:
+                    yield done
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for item in items:
+                    pending.append(pool.submit(work, item))
+                    if len(pending) >= 2 * workers:
+                        done = report(pending.popleft().result())
+                        if done is not None:
+                            yield done
+                while pending:
+                    done = report(pending.popleft().result())
+                    if done is not None:
+                        yield done
+        if totals["count"]:
+            self._log(
+                f"⏱ Postprocessed {totals['count']} masks{context} in {time.perf_counter() - t_start:.2f}s "
+                f"with {workers} threads (clean {totals['clean']:.2f}s, smooth {totals['smooth']:.2f}s "
+                "summed per organ)"
+            )
 
-        # Configurar raíz
-        self.configure(bg=bg)
+    def _iter_masks(self, stream: MaskStream, workers: int = 1):
+        """Yield ``(name, CompactMask)`` for every organ of ``stream``.
 
-        # Configurar ttk estilos
+        Masks are cropped from the label maps and postprocessed one at a
+        time on ``workers`` threads.  With ``stream.derive`` the lung lobes are held back and
+        merged into ``lung_left``/``lung_right`` (smoothed again if
+        enabled), and ``body``/``skin`` are derived when selected but not
+        segmented: the body is the union of every organ, accumulated in a
+        single volume as they go by.  Derived structures come last, in the
+        order body, skin, lungs.
+        """
+        selection = stream.selection
+        body_aliases = {"body_trunc", "body_extremities"}
+        derive_body = (stream.derive and "body" not in stream
+                       and bool(selection.intersection(body_aliases | {"body", "skin"})))
+        want_skin = stream.derive and "skin" in selection and "skin" not in stream
+        lung_of = {lobe: lung for lung, lobes in LUNG_LOBES.items() for lobe in lobes} if stream.derive else {}
+        lobes: dict[str, CompactMask] = {}
+        union: Optional[np.ndarray] = None
+        body: Optional[CompactMask] = None
+
+        for source in stream.sources:
+            items = MaskStream.crops(source)
+            for name, mask in self._postprocess_iter(items, smooth=source["smooth"], spacing=source["spacing"],
+                                                     context=source["context"], total=len(source["organs"]),
+                                                     workers=workers):
+                if derive_body:
+                    if union is None:
+                        union = np.zeros(mask.shape, dtype=bool)
+                    if mask.any():
+                        union[mask.bbox] |= mask.crop
+                if name == "body" and want_skin:
+                    body = mask
+                if name in lung_of:
+                    lobes[name] = mask
+                    continue
+                yield name, mask
+
+        spacing = stream.spacing
+        if derive_body and union is not None and union.any():
+            derived = CompactMask.from_dense(union, packed=self.pack_masks)
+            union = None
+            if self.smooth_masks:
+                derived = self._smooth_mask(derived, spacing)
+            missing_aliases = body_aliases.intersection(selection)
+            if missing_aliases:
+                self._log("💭 Note: body aliases %s were requested but only 'body' could be derived." % ', '.join(sorted(missing_aliases)))
+            self._log("🧩 Derived 'body' mask from existing segmentations.")
+            body = derived if want_skin else None
+            yield "body", derived
+
+        if want_skin and body is not None:
+            skin = self._derive_skin_from_body(body)
+            body = None
+            if skin is not None and skin.any():
+                if self.smooth_masks:
+                    skin = self._smooth_mask(skin, spacing)
+                self._log("🧩 Derived 'skin' mask from the body volume.")
+                yield "skin", skin
+
+        for lung, names in LUNG_LOBES.items():
+            found = [n for n in names if n in lobes]
+            if not found:
+                continue
+            merged = CompactMask.union([lobes.pop(n) for n in found])
+            if not merged.any():
+                continue
+            # Aplicar suavizado si está habilitado
+            if self.smooth_masks:
+                merged = self._smooth_mask(merged, spacing)
+            self._log(f"🫁 Fusionados {len(found)} lóbulos en '{lung}': {', '.join(found)}")
+            yield lung, merged
+
+    def _smoothing_params(self, spacing: Optional[Tuple[float, float, float]] = None) -> dict:
+        """Resolve the configured smoothing into voxel units for ``spacing``."""
+        method = (self.smoothing_method or 'gaussian').lower()
         try:
-            self.style.theme_use('default')
+            sigma_mm = float(self.smoothing_sigma_mm)
         except Exception:
-            pass
-        # Asignar colores genéricos a todos los widgets
-        self.style.configure('.', background=bg, foreground=fg, font=("Segoe UI", 10))
-        self.style.configure('TButton', background=theme['button_bg'], foreground=theme['button_fg'], borderwidth=1)
-        self.style.map('TButton', background=[('active', theme['accent'])], foreground=[('active', theme['button_fg'])])
-        self.style.configure('TLabel', background=bg, foreground=fg)
-        self.style.configure('TLabelframe', background=bg, foreground=fg)
-        self.style.configure('TLabelframe.Label', background=bg, foreground=fg)
-        self.style.configure('TFrame', background=bg, foreground=fg)
-        self.style.configure('TCheckbutton', background=bg, foreground=fg)
-        self.style.configure('TMenubutton', background=bg, foreground=fg)
-        self.style.configure('TProgressbar', troughcolor=bg, background=theme['progress_fg'])
+            sigma_mm = 3.0
+        sigma_mm = max(0.5, min(15.0, sigma_mm))
 
-        # Configurar widgets Tk (no ttk) manualmente
-        # Entradas, botones y texto
-        for widget in [self.in_entry, self.out_entry, self.btn_one, self.btn_all, self.footer_label, self.log]:
-            try:
-                widget.configure(bg=bg, fg=fg, insertbackground=fg)
-            except Exception:
-                pass
+        if spacing and len(spacing) == 3 and all(s > 0 for s in spacing):
+            spacing = tuple(float(s) for s in spacing)
+        else:
+            spacing = (1.0, 1.0, 1.0)
+        sigma_vox = tuple(max(0.2, sigma_mm / s) for s in spacing)
+        iterations = max(1, int(round(sigma_mm / max(min(spacing), 1e-3))))
+        return {"method": method, "sigma_mm": sigma_mm, "sigma_vox": sigma_vox,
+                "spacing": spacing, "iterations": iterations}
+
+    def _smooth_mask(self, mask, spacing: Optional[Tuple[float, float, float]] = None):
+        """Smooth mask boundaries based on the configured method.
+
+        Only the bounding box of the structure, grown by the reach of the
+        filter, is processed, so the result equals filtering the full volume
+        while the cost follows the organ size.  Accepts a dense array or a
+        :class:`CompactMask` and returns the same kind.
+        """
+        if not self.smooth_masks:
+            return mask
+        if not isinstance(mask, CompactMask):
+            if mask.size == 0 or not np.any(mask):
+                return mask
+            return self._smooth_mask(CompactMask.from_dense(mask), spacing).to_dense(mask.dtype)
+        if not mask.any():
+            return mask
 
-        # Log específico: cambiar color de fondo y texto
-        self.log.configure(background=bg, foreground=fg)
+        params = self._smoothing_params(spacing)
+        if params["method"] == 'gaussian':
+            # gaussian_filter trunca el núcleo a 4σ (truncate=4.0); fuera de la
+            # caja el resultado es siempre < 0.5
+            margin = tuple(int(4.0 * s + 0.5) + 1 for s in params["sigma_vox"])
+        elif params["method"] == 'morphological' and SCIPY_AVAILABLE:
+            # morphological_smooth_mm ya rellena con fondo su propio margen
+            margin = 0
+        else:
+            margin = 2 * params["iterations"] + 1
+        return mask.apply(lambda crop: self._smooth_array(crop, params), margin=margin)
 
-        # Actualizar recursivamente contenedores
-        def update_children(w):
-            for child in w.winfo_children():
+    def _smooth_array(self, mask_bool: np.ndarray, params: dict) -> np.ndarray:
+        """Apply the smoothing described by ``params`` to a bool array."""
+        method = params["method"]
+
+        if method == 'gaussian':
+            sigma_vox = params["sigma_vox"]
+            blurred = None
+            if SCIPY_AVAILABLE:
                 try:
-                    # Cambiar color de fondo de widgets Tk heredados
-                    if isinstance(child, (tk.Frame, tk.LabelFrame)):
-                        child.configure(bg=bg)
-                    elif isinstance(child, tk.Label):
-                        child.configure(bg=bg, fg=fg)
-                    elif isinstance(child, tk.Button):
-                        child.configure(bg=theme['button_bg'], fg=theme['button_fg'], activebackground=accent)
+                    import scipy.ndimage as ndi  # type: ignore
+                    blurred = ndi.gaussian_filter(mask_bool.astype(np.float32), sigma=sigma_vox, mode='nearest')
                 except Exception:
-                    pass
-                update_children(child)
-        update_children(self)
+                    blurred = None
+            if blurred is None and SKIMAGE_AVAILABLE:
+                try:
+                    from skimage.filters import gaussian  # type: ignore
+                    blurred = gaussian(mask_bool.astype(float), sigma=sigma_vox, preserve_range=True)
+                except Exception:
+                    blurred = None
+            if blurred is None:
+                return mask_bool
+            return blurred >= 0.5
 
-    def _choose_theme(self):
-        """Display a window to select the UI theme."""
-        win = tk.Toplevel(self)
-        win.title("Select theme")
-        win.geometry("250x200")
-        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
+        if method == 'morphological':
+            result = mask_bool
+            try:
+                if SCIPY_AVAILABLE:
+                    result = morphological_smooth_mm(mask_bool, params["sigma_mm"], params["spacing"])
+                elif SKIMAGE_AVAILABLE:
+                    from skimage.morphology import ball, binary_closing, binary_opening  # type: ignore
+                    struct = ball(max(1, params["iterations"]))
+                    result = binary_closing(result, struct)
+                    result = binary_opening(result, struct)
+            except Exception:
+                result = mask_bool
+            return result
+
+        return mask_bool
+
+    def _derive_skin_from_body(self, body_mask):
+        """Construct a thin skin shell from a body mask (dense or compact)."""
+        if isinstance(body_mask, CompactMask):
+            if not body_mask.any():
+                return None
+            # 1 voxel de dilatación/erosión más el borde
+            bbox, crop = body_mask.expanded(2)
+            skin = self._derive_skin_from_body(crop)
+            if skin is None:
+                return None
+            return CompactMask(body_mask.shape, bbox, skin, packed=body_mask.packed)
+        if body_mask.size == 0 or not np.any(body_mask):
+            return None
+        body_bool = body_mask.astype(bool)
+        skin: Optional[np.ndarray] = None
+
+        if SCIPY_AVAILABLE:
+            try:
+                import scipy.ndimage as ndi  # type: ignore
 
-        var = tk.StringVar(value=self.style_name)
-        tk.Label(
-            win,
-            text="Interface theme:",
-            bg=THEME_OPTIONS[self.style_name]['bg'],
-            fg=THEME_OPTIONS[self.style_name]['fg'],
-        ).pack(pady=10)
-        for name in THEME_OPTIONS.keys():
-            ttk.Radiobutton(win, text=name.capitalize(), variable=var, value=name).pack(anchor="w", padx=20, pady=2)
-        ttk.Button(win, text="Confirm", command=lambda: self._set_theme(var.get(), win)).pack(pady=10)
+                struct = np.ones((3, 3, 3), dtype=bool)
+                dilated = ndi.binary_dilation(body_bool, structure=struct, iterations=1)
+                eroded = ndi.binary_erosion(body_bool, structure=struct, iterations=1)
+                skin = np.logical_and(dilated, np.logical_not(eroded))
+            except Exception:
+                skin = None
 
-    def _set_theme(self, value: str, window: tk.Toplevel):
-        """Establece el tema actual y actualiza la interfaz."""
-        self.style_name = value
-        self.apply_theme()
-        window.destroy()
-        self._log(f"🎨 Theme selected: {value}")
+        if skin is None and SKIMAGE_AVAILABLE:
+            try:
+                from skimage.morphology import ball, dilation, erosion  # type: ignore
 
-        # Guardar configuración actualizada
-        self._save_config()
+                struct = ball(1)
+                dilated = dilation(body_bool, struct)
+                eroded = erosion(body_bool, struct)
+                skin = np.logical_and(dilated, np.logical_not(eroded))
+            except Exception:
+                skin = None
 
-    # ------------------------------------------------------------------
-    # Opciones de orientación (flip) de la tomografía
-    # ------------------------------------------------------------------
-    def _choose_orientation(self):
-        """Window to select axis inversions for the CT volume."""
-        win = tk.Toplevel(self)
-        win.title("Orientation options")
-        win.geometry("300x220")
-        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
+        if skin is None:
+            return None
+        if not skin.any():
+            return None
+        return skin.astype(body_mask.dtype)
 
-        tk.Label(
-            win,
-            text="Flip volume axes (select those that apply)",
-            bg=THEME_OPTIONS[self.style_name]['bg'],
-            fg=THEME_OPTIONS[self.style_name]['fg'],
-        ).pack(pady=10)
+    def _orient_prediction(self, pred: np.ndarray, affine, series: Optional[SeriesInfo]) -> np.ndarray:
+        """Record the voxel grid of ``pred`` or apply the manual axis inversions.
 
-        var_lr = tk.BooleanVar(value=self.flip_lr)
-        var_ap = tk.BooleanVar(value=self.flip_ap)
-        var_si = tk.BooleanVar(value=self.flip_si)
+        With the RAS ``affine`` of ``pred``'s indices the grid is stored in
+        ``series.mask_grid`` and ``_save_rt`` maps the masks onto the DICOM
+        grid from the geometry, so the ``flip_*`` settings are not used.
+        Without it (or without ``series``) the inversions are applied as
+        configured.
+        """
+        if affine is not None and series is not None and pred.ndim == 3:
+            try:
+                affine = np.asarray(affine, dtype=float).reshape(4, 4)
+                if np.isfinite(affine).all() and abs(np.linalg.det(affine[:3, :3])) > 1e-6:
+                    series.mask_grid = (tuple(int(s) for s in pred.shape), affine)
+                    return pred
+            except Exception as e:
+                self._log(f"⚠ Invalid segmentation affine, using axis inversions: {e}")
+        try:
+            if self.flip_si:
+                pred = np.flip(pred, axis=0)
+            if self.flip_ap:
+                pred = np.flip(pred, axis=1)
+            if self.flip_lr:
+                pred = np.flip(pred, axis=2)
+            if self.flip_lr or self.flip_ap or self.flip_si:
+                self._log("🔁 Axis inversions applied to the segmentation")
+        except Exception as e:
+            self._log(f"⚠ Error applying axis inversions: {e}")
+        return pred
 
-        ttk.Checkbutton(win, text="Left/right axis (X)", variable=var_lr).pack(anchor="w", padx=20, pady=2)
-        ttk.Checkbutton(win, text="Anterior/posterior axis (Y)", variable=var_ap).pack(anchor="w", padx=20, pady=2)
-        ttk.Checkbutton(win, text="Superior/inferior axis (Z)", variable=var_si).pack(anchor="w", padx=20, pady=2)
+    def _segment_from_files(self, series_files, series: Optional[SeriesInfo] = None):
+        # Si el tipo de modelo es TotalSegmentator, delegamos en el método
+        # especializado y omitimos las transformaciones adaptativas.  Esto
+        # simplifica el flujo, ya que TotalSegmentator gestiona su propio
+        # preprocesamiento y no utiliza Sliding-Window.  La función
+        # devuelve un diccionario con máscaras binarias por órgano.
+        # ``series`` (opcional) aporta la geometría ya leída en el
+        # descubrimiento del estudio.
+        if series is not None:
+            series.mask_grid = None
+        if self.model_type == "totalseg":
+            return self._segment_totalseg(series_files, series=series)
 
-        ttk.Button(
-            win,
-            text="Confirm",
-            command=lambda: self._set_orientation(var_lr.get(), var_ap.get(), var_si.get(), win),
-        ).pack(pady=10)
+        using_pre = False
+        sample = None
+        meta = None
+        original_spacing = None
+        applied_config = None
 
-    def _set_orientation(self, lr: bool, ap: bool, si: bool, window: tk.Toplevel):
-        """Guarda las preferencias de orientación."""
-        self.flip_lr = lr
-        self.flip_ap = ap
-        self.flip_si = si
-        window.destroy()
-        axes = []
-        if lr:
-            axes.append('X')
-        if ap:
-            axes.append('Y')
-        if si:
-            axes.append('Z')
-        self._log(f"🧭 Axis inversions enabled: {', '.join(axes) if axes else 'none'}")
+        # Detect the original spacing of the first DICOM slice (from the
+        # discovery headers when available)
+        try:
+            if series is not None and series.pixel_spacing:
+                pixel_spacing = list(series.pixel_spacing)
+                slice_thickness = series.slice_thickness or 5.0
+            else:
+                first_ds = pydicom.dcmread(series_files[0], stop_before_pixels=True)
+                pixel_spacing = [float(x) for x in first_ds.PixelSpacing]
+                try:
+                    slice_thickness = float(first_ds.SliceThickness)
+                except:
+                    slice_thickness = 5.0
+            original_spacing = [slice_thickness, pixel_spacing[0], pixel_spacing[1]]
+            # Log the detected original spacing (Z, Y, X)
+            self._log(f"📏 Detected original spacing: {original_spacing}")
+        except Exception as e:
+            # Warn if we could not detect the original spacing
+            self._log(f"⚠ Could not detect original spacing: {e}")
 
-        # Guardar configuración actualizada
-        self._save_config()
+        # Try standard readers with adaptive configurations
+        for reader in ("PydicomReader", "ITKReader"):
+            try:
+                self._log(f"🔄 Trying {reader}...")
+                transforms, config = self._build_transforms_adaptive(reader, original_spacing)
+                applied_config = config
+                
+                sample = transforms({"image": series_files})
+                img = sample["image"].unsqueeze(0).to(self.device)  # añadir batch
+                meta = sample["image_meta_dict"]
+                
+                self._log(f"✔ {reader} successful with configuration: {config}")
+                using_pre = True
+                break
+                
+            except Exception as e:
+                self._log(f"⚠ {reader} failed: {e}")
+                continue
 
-    # ------------------------------------------------------------------
-    # Alternar el uso del recorte foreground
-    # ------------------------------------------------------------------
-    def _toggle_crop(self):
-        """Toggle the flag to enable or disable automatic body cropping."""
-        self.use_crop = bool(self.use_crop_var.get())
-        state = 'enabled' if self.use_crop else 'disabled'
-        self._log(f"🔧 Automatic body cropping {state}")
+        # Fallback to improved manual mode if all readers fail
+        if not using_pre:
+            self._log("⚠ All readers failed; starting adaptive manual mode...")
+            tensor_vol, meta_dict, meta_tensor_vol, detected_spacing = self._manual_volume(series_files, series=series)
+            original_spacing = detected_spacing
 
-        # Guardar configuración actualizada
-        self._save_config()
+            # Diccionario inicial para modo manual
+            sample = {
+                "image": meta_tensor_vol,
+                "image_meta_dict": meta_dict,
+            }
 
-    # ------------------------------------------------------------------
-    # Alternar limpieza de máscaras
-    # ------------------------------------------------------------------
-    def _toggle_clean(self):
-        """Toggle application of morphological operations on the output masks."""
-        self.clean_masks = bool(self.clean_masks_var.get())
-        state = 'enabled' if self.clean_masks else 'disabled'
-        self._log(f"🧹 Mask cleaning {state}")
+            # Probar diferentes configuraciones para el modo manual
+            manual_configs = [
+                # Sin resampling espacial - mantener original
+                {"apply_spacing": False, "pixdim": None},
+                # Resampling conservador
+                {"apply_spacing": True, "pixdim": (3.0, 3.0, 3.0)},
+                # Solo si la diferencia es muy grande
+                {"apply_spacing": True, "pixdim": (2.0, 2.0, 2.0)},
+            ]
 
-        # Guardar configuración actualizada
-        self._save_config()
+            for i, config in enumerate(manual_configs):
+                try:
+                    # Report which manual configuration is being tested
+                    self._log(f"🔄 Trying manual configuration {i+1}/{len(manual_configs)}: {config}")
+                    
+                    transforms_list = []
+                    
+                    # Orientación básica
+                    transforms_list.append(Orientationd(keys="image", axcodes="RAS"))
 
-    # ------------------------------------------------------------------
-    # Seleccionar dispositivo (CPU/GPU)
-    # ------------------------------------------------------------------
-    def _choose_device(self):
-        """Allow the user to select between the CPU and any available GPUs."""
-        win = tk.Toplevel(self)
-        win.title("Select device")
-        win.geometry("350x250")
-        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
+                    # Crop foreground opcional.  Aplicamos margen para conservar
+                    # contexto y permitimos que el recorte sea más pequeño que
+                    # el volumen original si es necesario.
+                    if self.use_crop:
+                        transforms_list.append(
+                            CropForegroundd(
+                                keys="image",
+                                source_key="image",
+                                margin=self.crop_margin,
+                                allow_smaller=True,
+                            )
+                        )
+                    
+                    # Spacing solo si está habilitado.  Cuando se aplica
+                    # resampling, establecemos límites min/max alrededor del
+                    # target_spacing para evitar sobre/submuestreo excesivo
+                    if config["apply_spacing"] and config["pixdim"]:
+                        # Verificar si realmente necesitamos cambiar el spacing
+                        current_spacing = original_spacing
+                        target_spacing = config["pixdim"]
 
-        tk.Label(
-            win,
-            text="Select the device for inference:",
-            bg=THEME_OPTIONS[self.style_name]['bg'],
-            fg=THEME_OPTIONS[self.style_name]['fg'],
-        ).pack(pady=10)
+                        spacing_diff = max(
+                            [abs(current_spacing[i] - target_spacing[i]) / current_spacing[i] for i in range(3)]
+                        )
+
+                        if spacing_diff > 0.5:  # Solo si la diferencia es >50%
+                            # calcular límites min/max
+                            try:
+                                min_pixdim = tuple(float(p) * 0.75 for p in target_spacing)
+                                max_pixdim = tuple(float(p) * 1.25 for p in target_spacing)
+                            except Exception:
+                                min_pixdim = None
+                                max_pixdim = None
+                            transforms_list.append(
+                                Spacingd(
+                                    keys="image",
+                                    pixdim=target_spacing,
+                                    mode="bilinear",
+                                    min_pixdim=min_pixdim,
+                                    max_pixdim=max_pixdim,
+                                )
+                            )
+                            self._log(
+                                f"   📏 Applying resampling: {current_spacing} → {target_spacing} (min={min_pixdim}, max={max_pixdim})"
+                            )
+                        else:
+                            self._log(
+                                f"   📏 Spacing similar, skipping resampling (diff: {spacing_diff:.2f})"
+                            )
+                    
+                    # Normalización de intensidad.  Para CT utilizamos un
+                    # rango amplio [-1000, 2000] para capturar tejidos blandos
+                    # y óseos.  Ajustamos a [0, 1] y limitamos valores fuera
+                    # del rango.
+                    transforms_list.extend(
+                        [
+                            ScaleIntensityRanged(
+                                keys="image",
+                                a_min=-1000.0,
+                                a_max=2000.0,
+                                b_min=0.0,
+                                b_max=1.0,
+                                clip=True,
+                            ),
+                            ToTensord(keys="image"),
+                        ]
+                    )
 
-        # StringVar que almacena la selección actual.  Usamos nombres como
-        # 'cpu' o 'cuda:0', 'cuda:1', etc.  Si ya hay un dispositivo
-        # seleccionado, lo preseleccionamos.
-        current = 'cpu'
-        if isinstance(self.device, torch.device):
-            current = str(self.device)
-        elif isinstance(self.device, str):
-            current = self.device
+                    self.pre_transforms = Compose(transforms_list)
+                    
+                    # Siempre aplicamos Invertd para revertir orientación y
+                    # recorte; si además hay resampling, Invertd también
+                    # restaurará el spacing original.  Usamos los mismos
+                    # argumentos independientemente de apply_spacing.
+                    self.post_transforms = Invertd(
+                        keys="pred",
+                        transform=self.pre_transforms,
+                        orig_keys="image",
+                        meta_key_postfix="meta_dict",
+                        nearest_interp=True,
+                        to_tensor=False,
+                    )
+                    
+                    # Aplicar transformaciones
+                    sample = self.pre_transforms(sample)
+                    img = sample["image"].unsqueeze(0).to(self.device)
+                    meta = sample["image_meta_dict"]
+                    
+                    self._log(f"✔ Manual configuration {i+1} successful")
+                    applied_config = config
+                    break
+                    
+                except Exception as e:
+                    self._log(f"⚠ Manual configuration {i+1} failed: {e}")
+                    continue
+            
+            if applied_config is None:
+                raise RuntimeError("Todas las configuraciones de transformación fallaron")
 
-        var = tk.StringVar(value=current)
+        # Inference
+        self._log("⏳ Running sliding-window inference...")
+        self._log(f"📊 Input tensor shape: {img.shape}")
+        
+        with torch.no_grad():
+            # Utilizamos un tamaño de ventana deslizante más grande (64^3) para
+            # capturar estructuras anatómicas de mayor tamaño.  Esto se alinea
+            # con las recetas de Auto3DSeg donde se emplean ventanas de 96x96x96
+            # o mayores para volumetrías de cuerpo entero.  Ajusta este valor
+            # según la memoria disponible.  El superposición se mantiene al
+            # 50 % para suavizar las transiciones.
+            logits = sliding_window_inference(
+                img,
+                roi_size=(64, 64, 64),
+                sw_batch_size=1,
+                predictor=self.model,
+                overlap=0.5,
+            )
+        self._log("✔ Inference completed")
 
-        # Opción para CPU siempre disponible
-        ttk.Radiobutton(win, text="CPU", variable=var, value='cpu').pack(anchor="w", padx=20, pady=2)
+        pred = torch.argmax(logits, dim=1).cpu().numpy()[0]
+        self._log(f"📊 Initial prediction shape: {pred.shape}")
 
-        # Opciones para GPUs, si están disponibles
-        if torch.cuda.is_available():
-            count = torch.cuda.device_count()
-            for i in range(count):
-                try:
-                    name = torch.cuda.get_device_name(i)
-                except Exception:
-                    name = f"GPU {i}"
-                value = f"cuda:{i}"
-                ttk.Radiobutton(
-                    win,
-                    text=f"GPU {i}: {name}",
-                    variable=var,
-                    value=value
-                ).pack(anchor="w", padx=20, pady=2)
+        # Almacenar forma original del volumen para referencia
+        if using_pre:
+            # Recuperar forma original de la metadata
+            try:
+                original_shape = meta.get("spatial_shape", tensor_vol.shape[1:] if 'tensor_vol' in locals() else None)
+            except:
+                original_shape = None
         else:
-            # Indicate that no GPU is available
-            tk.Label(
-                win,
-                text="No GPUs detected.",
-                bg=THEME_OPTIONS[self.style_name]['bg'],
-                fg=THEME_OPTIONS[self.style_name]['fg'],
-            ).pack(pady=5)
+            original_shape = tensor_vol.shape[1:]  # (Z, Y, X)
 
-        ttk.Button(
-            win,
-            text="Confirm",
-            command=lambda: self._set_device(var.get(), win),
-        ).pack(pady=15)
+        # Apply inverse transformation and smart resizing if necessary
+        if self.post_transforms is not None:
+            try:
+                self._log("🔄 Applying inverse transformation...")
+                d_in = {
+                    "pred": pred[np.newaxis, ...],        # (C=1, Z, Y, X)
+                    "image": sample["image"],             # tensor post-pre
+                    "image_meta_dict": meta,              # meta post-pre
+                    "pred_meta_dict": deepcopy(meta),     # requerido por Invertd
+                }
+                inv = self.post_transforms(d_in)
+                pred = np.asarray(inv["pred"][0])  # quitar canal
+                self._log(f"✔ Inverse transformation applied, new shape: {pred.shape}")
+            except Exception as e:
+                self._log(f"⚠ Inverse transformation failed: {e}")
+                self._log("🔧 Trying smart resizing...")
+                
+                if original_shape is not None:
+                    pred = smart_resize_prediction(pred, original_shape)
+                    self._log(f"✔ Smart resizing applied: {pred.shape}")
+        else:
+            # No inverse transformation, check if smart resizing is needed
+            if original_shape is not None and pred.shape != original_shape:
+                self._log(f"🔧 No inverse transformation, applying smart resizing...")
+                pred = smart_resize_prediction(pred, original_shape)
 
-    def _set_device(self, value: str, window: tk.Toplevel):
-        """Establece el dispositivo seleccionado y mueve el modelo si es necesario."""
+        # Afín de los índices de pred: la del lector MONAI (Invertd devuelve
+        # la predicción a la rejilla leída) o la del volumen en modo manual
+        grid_affine = None
         try:
-            # Crear objeto torch.device a partir de la selección
-            new_device = torch.device(value)
-            # Si el dispositivo no está disponible, se mantendrá el actual
-            if new_device.type == 'cuda' and not torch.cuda.is_available():
-                messagebox.showerror("Error", "No GPU is available for selection.")
-                window.destroy()
-                return
-            self.device = new_device
-            # Mover el modelo cargado, si existe
-            if self.model is not None:
-                try:
-                    self.model = self.model.to(self.device)
-                except Exception as e:
-                    # Warn if the model could not be moved to the selected device
-                    self._log(f"⚠ Could not move the model to the new device: {e}")
-            # Registrar selección y establecer device_preference para TotalSegmentator
-            if self.device.type == 'cuda':
-                # Extract index and report
-                idx = 0
-                try:
-                    idx = int(str(self.device).split(':')[1])
-                    name = torch.cuda.get_device_name(idx)
-                    self._log(f"🔧 Device selected: GPU {idx} ({name})")
-                except Exception:
-                    self._log(f"🔧 Device selected: {self.device}")
-                # For TotalSegmentator use 'gpu' if at least one GPU is present
-                self.device_preference = 'gpu'
+            if using_pre:
+                grid_affine = meta.get("original_affine") if meta is not None else None
             else:
-                self._log("🔧 Device selected: CPU")
-                self.device_preference = 'cpu'
-
-            # Save the updated configuration
-            self._save_config()
-        except Exception as e:
-            # Catch any error that occurs during device selection
-            self._log(f"❌ Error selecting device: {e}")
-        finally:
-            # Always destroy the selection window
-            window.destroy()
+                grid_affine = meta_dict.get("volume_affine")
+            if original_shape is None or tuple(pred.shape) != tuple(int(s) for s in original_shape):
+                grid_affine = None  # la predicción no está en la rejilla original
+        except Exception:
+            grid_affine = None
+        pred = self._orient_prediction(pred, grid_affine, series)
+
+        # Solo se guarda el mapa de etiquetas y la caja de cada órgano
+        # presente; las máscaras (con limpieza opcional de agujeros y
+        # componentes sueltas) se construyen de una en una al exportar
+        wanted = {name: idx for name, idx in self.labels_map.items()
+                  if not self.organs or name in self.organs}
+        masks = MaskStream()
+        found = masks.add_labels(pred, wanted, smooth=False, packed=self.pack_masks)
+
+        self._log(f"📊 Labels found: {sorted(wanted[name] for name in found)}")
+        self._log(f"📋 Organs found: {len(masks)} (masks are built during the RTSTRUCT export)")
+        return masks
 
     # ------------------------------------------------------------------
-    # Ajustar margen de recorte
+    # Segmentación con TotalSegmentator V2
     # ------------------------------------------------------------------
-    def _choose_crop_margin(self):
-        """Display a window to adjust the crop margin in voxels."""
-        win = tk.Toplevel(self)
-        win.title("Adjust crop margin")
-        win.geometry("300x180")
-        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
-        tk.Label(
-            win,
-            text="Specify the crop margin (voxels):",
-            bg=THEME_OPTIONS[self.style_name]['bg'],
-            fg=THEME_OPTIONS[self.style_name]['fg'],
-        ).pack(pady=10)
-        # Utilizamos un IntVar para el margen
-        margin_var = tk.IntVar(value=self.crop_margin)
-        spin = tk.Spinbox(win, from_=0, to=100, textvariable=margin_var, width=5)
-        spin.pack(pady=5)
-        ttk.Button(
-            win,
-            text="Confirm",
-            command=lambda: self._set_crop_margin(margin_var.get(), win),
-        ).pack(pady=10)
+    def _segment_totalseg(self, series_files, series: Optional[SeriesInfo] = None):
+        """Realiza la segmentación usando TotalSegmentator V2.
+
+        Esta función se activa cuando `self.model_type` es 'totalseg'.  Se
+        intenta importar la API de TotalSegmentator y se ejecuta la
+        segmentación en la carpeta que contiene los cortes DICOM.  La
+        salida es un diccionario de máscaras binarias indexado por nombre
+        de órgano.  En caso de cualquier error (por ejemplo si la
+        biblioteca no está instalada) se devuelve un diccionario vacío.
+        """
+        self._last_seg_spacing = None
+        if not series_files:
+            self._log("?? No files were provided for segmentation")
+            return {}
+
+        input_dir = os.path.dirname(series_files[0])
 
-    def _set_crop_margin(self, value: int, window: tk.Toplevel):
-        """Establece un nuevo margen de recorte para el foreground."""
         try:
-            v = int(value)
-            if v < 0:
-                raise ValueError("The margin must be a non‑negative number")
-            self.crop_margin = v
-            self._log(f"🔧 Crop margin adjusted to {v} voxels")
-            # Guardar configuración actualizada
-            self._save_config()
+            try:
+                from totalsegmentatorv2.python_api import totalsegmentator  # type: ignore
+            except ImportError:
+                from totalsegmentator.python_api import totalsegmentator  # type: ignore
         except Exception as e:
-            messagebox.showerror("Error", f"Could not adjust the margin: {e}")
-        finally:
-            window.destroy()
+            self._log(
+                f"!! Could not import TotalSegmentator: {e}. Make sure to install the package via pip."
+            )
+            return {}
 
-    # ------------------------------------------------------------------
-    # Seleccionar tipo de modelo
-    # ------------------------------------------------------------------
-    def _choose_model_type(self):
-        """Muestra una ventana para seleccionar entre SegResNet y TotalSegmentator.
+        self._ensure_custom_trainer()
+
+        # Verificar y descargar modelos si es necesario
+        if not self.totalseg_downloaded:
+            self._log("🔍 Verificando modelos de TotalSegmentator...")
+            try:
+                # Intentar verificar si los modelos están descargados
+                from pathlib import Path
+
+                # TotalSegmentator guarda los modelos en ~/.totalsegmentator
+                model_dir = Path.home() / ".totalsegmentator" / "nnunet" / "results"
+
+                if not model_dir.exists() or not any(model_dir.iterdir()):
+                    self._log("📥 Modelos no encontrados. Descargando...")
+                    self._log("⏱️ Esto puede tardar varios minutos (2-5 GB).")
+                    self._log("💡 La descarga solo ocurre una vez.")
+                else:
+                    self._log("✓ Modelos encontrados en caché local.")
+            except Exception as e:
+                self._log(f"⚠️ No se pudo verificar modelos: {e}")
+                self._log("💡 Se intentará descargar durante la segmentación si es necesario.")
+
+        if self.totalseg_task == 'complete' and not self._is_task_enabled('complete'):
+            self._log("⚠ Task 'complete' disabled; skipping segmentation.")
+            return {}
+        if self.totalseg_task != 'complete' and not self._is_task_enabled(self.totalseg_task):
+            self._log(f"⚠ Task '{self.totalseg_task}' disabled; skipping segmentation.")
+            return {}
 
-        Al cambiar el tipo de modelo se actualiza ``self.model_type``, se
-        invalidan los pesos actuales y se lanza la carga del nuevo
-        modelo (o la preparación de TotalSegmentator) en un hilo
-        separado.
-        """
-        win = tk.Toplevel(self)
-        win.title("Tipo de modelo")
-        win.geometry("350x180")
+        fast = not self.highres
+        device_param = 'gpu' if (self.device_preference == 'gpu' and torch.cuda.is_available()) else 'cpu'
 
-        var = tk.StringVar(value=self.model_type)
-        options = [
-            ("SegResNet (MONAI)", "segresnet"),
-            ("TotalSegmentator V2", "totalseg"),
-        ]
+        # Convertir la serie seleccionada una sola vez (desde la caché de
+        # volúmenes) y reutilizar la imagen en todas las tasks; si falla,
+        # TotalSegmentator convierte la carpeta como antes.
+        seg_input = input_dir
+        seg_image = None
+        nifti_tmp = None
+        try:
+            t0 = time.perf_counter()
+            seg_image = series_to_nifti(
+                series.files if series is not None else series_files,
+                uid=series.uid if series is not None else None,
+                cache=self._get_volume_cache(),
+                volume=series.volume if series is not None else None,
+            )
+            self._log(
+                f"ℹ Built NIfTI volume {seg_image.shape} in memory "
+                f"({time.perf_counter() - t0:.2f}s)"
+            )
+        except Exception as e:
+            self._log(f"⚠ Could not build NIfTI in memory ({e}); TotalSegmentator will convert {input_dir}")
+        if seg_image is not None:
+            if totalseg_accepts_nifti(totalsegmentator):
+                seg_input = seg_image
+            else:
+                # Las versiones que solo aceptan rutas leen un .nii sin
+                # convertir de nuevo la carpeta DICOM en cada task
+                try:
+                    nifti_tmp = tempfile.mkdtemp(prefix="aura_totalseg_")
+                    seg_input = os.path.join(nifti_tmp, "ct.nii")
+                    nib.save(seg_image, seg_input)
+                    self._log("ℹ Installed TotalSegmentator only accepts paths; passing the volume as a temporary NIfTI file")
+                except Exception as e:
+                    seg_input = input_dir
+                    self._log(f"⚠ Could not write a temporary NIfTI ({e}); TotalSegmentator will convert {input_dir}")
 
-        ttk.Label(win, text="Selecciona el tipo de modelo:").pack(anchor="w", padx=10, pady=(10, 5))
-        for text, value in options:
-            ttk.Radiobutton(win, text=text, variable=var, value=value).pack(anchor="w", padx=20, pady=2)
+        progress_started = False
 
-        def confirm():
-            new_type = var.get()
-            if new_type != self.model_type:
-                self.model_type = new_type
-                # Registrar en el log
-                if self.model_type == "segresnet":
-                    self._log("🔧 Tipo de modelo seleccionado: SegResNet (MONAI)")
+        # Caché de resultados: la clave usa el contenido del volumen, no la ruta
+        seg_cache = self._get_seg_cache()
+        seg_version = totalseg_version(totalsegmentator) if seg_cache is not None else None
+        content_hash = None
+
+        def input_hash() -> str:
+            nonlocal content_hash
+            if content_hash is None:
+                if seg_image is None:
+                    vol, geometry = load_series_volume(
+                        series.files if series is not None else series_files,
+                        uid=series.uid if series is not None else None,
+                        cache=self._get_volume_cache(),
+                    )
+                    content_hash = volume_content_hash(vol, geometry["affine"])
                 else:
-                    self._log("🔧 Tipo de modelo seleccionado: TotalSegmentator V2")
-                # Reiniciar estado del modelo
-                self.ready = False
-                self.model = None
-                # Cargar o preparar el modelo en nuevo hilo
-                self._load_model_thread()
-            win.destroy()
+                    content_hash = volume_content_hash(np.asanyarray(seg_image.dataobj), seg_image.affine)
+            return content_hash
 
-        ttk.Button(win, text="Confirmar", command=confirm).pack(pady=15)
+        def run_task(task_name: str, label_map: dict[str, int], selected_organs, allow_roi_subset: bool = True) -> list[str]:
+            nonlocal progress_started
+            if not label_map:
+                self._log(f"?? Task '{task_name}' has no labels; skipping.")
+                return []
 
-    # ------------------------------------------------------------------
-    # Browse
-    # ------------------------------------------------------------------
-    def _browse(self, entry: tk.Entry):
-        path = filedialog.askdirectory()
-        if path:
-            entry.delete(0, tk.END)
-            entry.insert(0, path)
-            # Guardar configuración actualizada
-            self._save_config()
+            if self.cancel_requested:
+                self._log("❌ Segmentation cancelled by user")
+                return []
+
+            roi_subset = None
+            # roi_subset only works with 'total' or 'total_mr' tasks in TotalSegmentator
+            if allow_roi_subset and selected_organs and task_name in ('total', 'total_mr'):
+                candidates = [o for o in selected_organs if o in label_map]
+                roi_subset = candidates if candidates else None
+                if roi_subset:
+                    self._log(f"   📋 Requesting {len(roi_subset)} specific organs from task '{task_name}': {roi_subset}")
+            elif allow_roi_subset and selected_organs and task_name not in ('total', 'total_mr'):
+                # For other tasks, we'll filter results after segmentation
+                self._log(f"   📋 Task '{task_name}' will segment all organs, filtering {len(selected_organs)} requested afterwards")
 
-    # ------------------------------------------------------------------
-    # Transforms bundle con parámetros adaptativos
-    # ------------------------------------------------------------------
-    def _build_transforms_adaptive(self, reader: str, original_spacing=None, target_pixdim=None):
-        """
-        Construye transformaciones adaptativas que intentan diferentes parámetros
-        hasta encontrar una configuración que funcione correctamente.
-        """
-        if target_pixdim is None:
-            target_pixdim = (1.5, 1.5, 1.5) if self.highres else (3.0, 3.0, 3.0)
-        
-        # Lista de configuraciones a probar, de más conservadora a más agresiva
-        spacing_configs = [
-            # Configuración original
-            {"pixdim": target_pixdim, "mode": "bilinear"},
-            # Sin resampling espacial si el original está cerca
-            {"pixdim": None, "mode": None},
-            # Resampling más conservador
-            {"pixdim": (2.0, 2.0, 2.0), "mode": "bilinear"},
-            # Solo resamplear en plano axial
-            {"pixdim": (original_spacing[0] if original_spacing else 2.0, 2.0, 2.0), "mode": "bilinear"},
-        ]
-        
-        for i, config in enumerate(spacing_configs):
             try:
-                # Report which spacing configuration is being tested
-                self._log(f"🔄 Trying spacing configuration {i+1}/{len(spacing_configs)}: {config}")
-                
-                transforms_list = [
-                    LoadImaged(keys="image", reader=reader, meta=True),
-                    EnsureTyped(keys="image"),
-                ]
-                
-                # Orientación siempre necesaria
-                transforms_list.append(Orientationd(keys="image", axcodes="RAS"))
-                
-                # Crop foreground opcional para reducir el volumen.  Añadimos
-                # margen para asegurar que se mantenga contexto alrededor del
-                # cuerpo, y permitimos que el recorte sea menor que el
-                # volumen original si es necesario.
-                if self.use_crop:
-                    transforms_list.append(
-                        CropForegroundd(
-                            keys="image", source_key="image",
-                            margin=self.crop_margin, allow_smaller=True
+                task_fast = fast
+                if task_name in TASKS_REQUIRING_FULL and fast:
+                    task_fast = False
+                    self._log(f"⚙ Task '{task_name}' requires full mode; running without fast optimisations.")
+
+                # Warn user if task doesn't support roi_subset and might take longer
+                if task_name not in ('total', 'total_mr') and selected_organs and not task_fast:
+                    self._log(f"⏱️ Note: Task '{task_name}' must process all organs (TotalSegmentator limitation)")
+                    self._log(f"   This may take several minutes. Results will be filtered to your selection.")
+
+                # Resultado ya calculado para este volumen y configuración
+                cache_key = None
+                cached = None
+                if seg_cache is not None:
+                    try:
+                        cache_key = seg_cache.key_for(input_hash(), task_name, task_fast, roi_subset, seg_version)
+                        cached = seg_cache.get(cache_key)
+                    except Exception as e:
+                        self._log(f"⚠ Segmentation cache unavailable: {e}")
+                        cache_key = None
+
+                if cached is not None:
+                    labels, meta = cached
+                    seg_img = nib.Nifti1Image(labels, np.asarray(meta["affine"], dtype=np.float64))
+                    seg_img.header.set_zooms(meta["zooms"])
+                    self._log(f"⚡ Reusing cached result of task '{task_name}' ({meta.get('created', '?')})")
+                else:
+                    if not self.totalseg_downloaded and not progress_started:
+                        self._log("=" * 70)
+                        self._log("📥 DESCARGANDO MODELOS DE TOTALSEGMENTATOR")
+                        self._log("=" * 70)
+                        self._log("⏱️ Esto puede tardar 10-30 minutos (descargando ~2-5 GB)")
+                        self._log("💡 Esta descarga solo ocurre una vez")
+                        self._log("🌐 Se requiere conexión a Internet estable")
+                        self._log("☕ Por favor, ten paciencia...")
+                        self._log("=" * 70)
+                        self._ui_call(self._indeterminate, True)
+                        progress_started = True
+
+                    self._log(f"🔄 Running TotalSegmentator V2 task '{task_name}'{' (full mode)' if not task_fast else ''}...")
+                    orig_stdout = sys.stdout
+                    orig_stderr = sys.stderr
+                    dummy_stream = io.StringIO()
+                    try:
+                        if orig_stdout is None:
+                            sys.stdout = dummy_stream
+                        if orig_stderr is None:
+                            sys.stderr = dummy_stream
+                        t_task = time.perf_counter()
+                        seg_img = totalsegmentator(
+                            seg_input,
+                            None,
+                            ml=True,
+                            fast=task_fast,
+                            roi_subset=roi_subset,
+                            device=device_param,
+                            task=task_name,
+                            quiet=True,
                         )
-                    )
-                
-                # Spacing solo si está configurado.  Aplicamos límites mínimos y máximos
-                # al tamaño de voxel para evitar sobre/submuestreo excesivo.  Los
-                # valores de min_pixdim y max_pixdim son ±25 % del valor de pixdim,
-                # siguiendo la práctica de MONAI Auto3DSeg.
-                if config["pixdim"] is not None:
-                    pixdim = config["pixdim"]
-                    # calcular límites para spacing
+                        elapsed = time.perf_counter() - t_task
+                    finally:
+                        sys.stdout = orig_stdout
+                        sys.stderr = orig_stderr
+                    self._log(f"⏱ Task '{task_name}' finished in {elapsed:.1f}s")
                     try:
-                        min_pixdim = tuple(float(p) * 0.75 for p in pixdim)
-                        max_pixdim = tuple(float(p) * 1.25 for p in pixdim)
-                    except Exception:
-                        # en caso de que pixdim no sea iterable (ninguno o float)
-                        min_pixdim = None
-                        max_pixdim = None
-                    transforms_list.append(
-                        Spacingd(
-                            keys="image",
-                            pixdim=pixdim,
-                            mode=config["mode"],
-                            min_pixdim=min_pixdim,
-                            max_pixdim=max_pixdim,
+                        self._get_task_runtimes().record(
+                            task_runtime_profile(self.device_preference, task_fast), task_name, elapsed
                         )
-                    )
-                
-                # Normalización de intensidad.  Para CT es habitual recortar a
-                # [-1000, 2000] para cubrir desde el aire hasta el hueso,
-                # mapeando luego a [0, 1].  Esto proporciona un rango más
-                # amplio que el uso anterior de [-1000, 1000] y puede ayudar
-                # a preservar estructuras óseas.
-                transforms_list.extend([
-                    ScaleIntensityRanged(
-                        keys="image",
-                        a_min=-1000.0,
-                        a_max=2000.0,
-                        b_min=0.0,
-                        b_max=1.0,
-                        clip=True,
-                    ),
-                    ToTensord(keys="image"),
-                ])
-                
-                self.pre_transforms = Compose(transforms_list)
-                
-                # Post-transforms correspondientes
-                if config["pixdim"] is not None:
-                    # Siempre usar Invertd para revertir orientación y recorte,
-                    # además de las transformaciones espaciales.
-                    self.post_transforms = Compose(
-                        [
-                            Activationsd(keys="pred", sigmoid=True),
-                            AsDiscreted(keys="pred", threshold=0.5),
-                            Invertd(
-                                keys="pred",
-                                transform=self.pre_transforms,
-                                orig_keys="image",
-                                nearest_interp=True,
-                                to_tensor=False,
-                            ),
-                            EnsureTyped(keys="pred"),
-                            ToNumpyd(keys="pred"),
-                        ]
-                    )
-                else:
-                    # Aunque no haya resampling, se debe invertir para
-                    # restaurar la orientación y deshacer el recorte del
-                    # foreground.  Se omite la activación porque el modelo
-                    # retorna índices de clase directamente.
-                    self.post_transforms = Compose(
-                        [
-                            Invertd(
-                                keys="pred",
-                                transform=self.pre_transforms,
-                                orig_keys="image",
-                                nearest_interp=True,
-                                to_tensor=False,
-                            ),
-                            EnsureTyped(keys="pred"),
-                            ToNumpyd(keys="pred"),
-                        ]
-                    )
-                
-                self._log(f"✔ Configuration {i+1} prepared successfully")
-                return self.pre_transforms, config
-                
+                    except Exception as e:
+                        self._log(f"⚠ Could not store runtime of task '{task_name}': {e}")
+                    if cache_key is not None:
+                        try:
+                            seg_cache.put(cache_key, np.asanyarray(seg_img.dataobj), {
+                                "task": task_name,
+                                "fast": bool(task_fast),
+                                "roi_subset": sorted(roi_subset) if roi_subset else None,
+                                "version": seg_version,
+                                "affine": np.asarray(seg_img.affine).tolist(),
+                                "zooms": [float(z) for z in seg_img.header.get_zooms()[:3]],
+                            })
+                        except Exception as e:
+                            self._log(f"⚠ Could not store task '{task_name}' in the segmentation cache: {e}")
+                header = getattr(seg_img, 'header', None)
+                if header is not None:
+                    try:
+                        zooms = header.get_zooms()
+                    except Exception:
+                        zooms = None
+                    if zooms and len(zooms) >= 3:
+                        self._last_seg_spacing = (float(zooms[2]), float(zooms[1]), float(zooms[0]))
             except Exception as e:
-                self._log(f"⚠ Configuration {i+1} failed: {e}")
-                continue
-        
-        # If all configurations fail, use minimal transforms
-        self._log("⚠ All configurations failed, using minimal transforms")
-        self.pre_transforms = Compose([
-            LoadImaged(keys="image", reader=reader, meta=True),
-            EnsureTyped(keys="image"),
-            ScaleIntensityRanged(keys="image", a_min=-1000, a_max=1000,
-                                b_min=0.0, b_max=1.0, clip=True),
-            ToTensord(keys="image"),
-        ])
-        self.post_transforms = None
-        return self.pre_transforms, {"pixdim": None, "mode": None}
-
-    # ------------------------------------------------------------------
-    # Carga de modelo
-    # ------------------------------------------------------------------
-    def _load_model_thread(self):
-        self._indeterminate(True)
-        threading.Thread(target=self._load_model, daemon=True).start()
-
-    def _load_model(self):
-        # Restablecer estado y deshabilitar botones durante la carga
-        self.ready = False
-        self.btn_one["state"] = self.btn_all["state"] = "disabled"
+                msg = str(e)
+                if 'Unable to locate trainer class' in msg or 'nnUNetTrainer_4000epochs_NoMirroring' in msg:
+                    self._log(
+                        "?? TotalSegmentator failed due to a missing nnUNet trainer class. "
+                        "This may indicate that your installation of nnunetv2 or TotalSegmentator is outdated. "
+                        "Please upgrade TotalSegmentator and nnunetv2 using pip (for example, `pip install --upgrade totalsegmentatorv2 nnunetv2`) "
+                        "or ensure that the fallback trainer file could be created in your Python environment."
+                    )
+                else:
+                    self._log(f"!! Error running TotalSegmentator task '{task_name}': {e}")
+                self._log(traceback.format_exc())
+                return []
 
-        # Show an appropriate message
-        if self.model_type == "segresnet":
-            self._log("⏳ Loading network and weights (SegResNet)...")
-        else:
-            self._log("⏳ Preparing TotalSegmentator V2...")
+            self.totalseg_downloaded = True
 
-        # ----- TotalSegmentator -----
-        if self.model_type == "totalseg":
-            # Asignar etiquetas y órganos desde el diccionario de TOTALSEG
-            self._update_totalseg_labels()
-            self.model = None
-            # Verificar que la biblioteca esté disponible.  Preferir la versión v2.
-            success = False
             try:
+                # Etiquetas en su dtype entero (uint8): get_fdata() crearía una copia float64 (8x)
+                seg_data = np.asanyarray(seg_img.dataobj)  # type: ignore
+                if not np.issubdtype(seg_data.dtype, np.integer):
+                    seg_data = seg_data.astype(np.uint16)
+            except Exception:
                 try:
-                    # Attempt to import v2 first
-                    from totalsegmentatorv2.python_api import totalsegmentator  # noqa: F401, type: ignore
-                except ImportError:
-                    # Fall back to legacy package name
-                    from totalsegmentator.python_api import totalsegmentator  # noqa: F401, type: ignore
-                success = True
-            except Exception as e:
-                self._log(
-                    f"❌ TotalSegmentator not available: {e}. Install 'totalsegmentatorv2' or 'totalsegmentator' with pip."
-                )
+                    seg_data = np.asarray(seg_img).astype(np.uint16)  # type: ignore
+                except Exception as ex:
+                    self._log(f"!! Could not convert the result of TotalSegmentator to numpy: {ex}")
+                    return []
 
-            if success:
-                self._log("✔ TotalSegmentator imported successfully")
-                self._log(
-                    "ℹ The weights will be downloaded automatically the first time segmentation runs"
-                )
-                self.ready = True
-                self.btn_one["state"] = self.btn_all["state"] = "normal"
+            grid_affine = None
+            if seg_data.ndim == 3:
+                pred = np.transpose(seg_data, (2, 1, 0))
+                affine = getattr(seg_img, 'affine', None)
+                if affine is not None:
+                    grid_affine = np.asarray(affine, dtype=float)[:, [2, 1, 0, 3]]  # índices (k, j, i)
             else:
-                self.ready = False
+                pred = seg_data
 
-            # Finalizar barra de progreso
-            self._indeterminate(False)
-            return
+            pred = self._orient_prediction(pred, grid_affine, series)
 
-        # ----- SegResNet -----
-        try:
-            # Cargar metadatos para mapear canales a órganos
-            try:
-                with open(META_JSON) as f:
-                    meta = json.load(f)
-                chdef = (
-                    meta.get("network_data_format", {})
-                    .get("outputs", {})
-                    .get("pred", {})
-                    .get("channel_def", {})
-                )
-                labels = {v: int(k) for k, v in chdef.items() if k != "0"}
-                self._log(f" ✔ {len(labels)} organs loaded from metadata.json")
-            except Exception as e:
-                self._log(f"⚠ Could not read metadata ({e}); using default values")
-                labels = FULL_LABELS.copy()
+            selected_set = None if selected_organs is None else set(selected_organs)
+            wanted = {name: idx for name, idx in label_map.items()
+                      if selected_set is None or name in selected_set}
+            # Cajas envolventes de todas las etiquetas en una sola pasada; los
+            # órganos que ya aportó una task anterior se omiten
+            found = masks.add_labels(pred, wanted, smooth=True, spacing=self._last_seg_spacing,
+                                     packed=self.pack_masks, context=f" (task '{task_name}')")
+            self._log(f"?? Labels found (task '{task_name}'): {sorted(wanted[name] for name in found)}")
+            return found
 
-            # Asegurar que todas las etiquetas posibles estén presentes
-            for k, v in FULL_LABELS.items():
-                labels.setdefault(k, v)
-            self.labels_map = labels
-            self._apply_saved_organs()
-            num_classes = max(labels.values()) + 1
+        # NUEVO: Sistema unificado - usar task_assignments
+        selection = list(self.organs)
+        masks = MaskStream(selection=selection, derive=True)
 
-            # Seleccionar pesos según la resolución
-            weights_path = WEIGHTS_HIGHRES if self.highres else WEIGHTS_LOWRES
-            if not os.path.exists(weights_path):
-                raise FileNotFoundError(f"Weights file not found: {weights_path}")
+        # Obtener asignaciones de tasks (calculadas en selector unificado)
+        task_assignments = getattr(self, '_task_assignments', {})
 
-            self._log(
-                f"🔄 Loading weights for {'1.5 mm' if self.highres else '3 mm'}: {os.path.basename(weights_path)}"
-            )
-            obj = torch.load(weights_path, map_location=self.device)
-            if isinstance(obj, torch.nn.Module):
-                self.model = obj.to(self.device).eval()
-            else:
-                state_dict = obj.get("state_dict", obj)
-                self.model = SegResNet(
-                    spatial_dims=3,
-                    in_channels=1,
-                    out_channels=num_classes,
-                    init_filters=32,
-                    blocks_down=(1, 2, 2, 4),
-                    blocks_up=(1, 1, 1),
-                ).to(self.device)
-                self.model.load_state_dict(state_dict)
+        if not task_assignments:
+            # Fallback: si no hay asignaciones (configuración antigua), usar órganos seleccionados
+            if not selection:
+                self._log("⚠ No organs selected; skipping segmentation.")
+                if nifti_tmp:
+                    shutil.rmtree(nifti_tmp, ignore_errors=True)
+                return {}
 
-            self.model.eval()
-            self._log(f" ✔ SegResNet model loaded correctly on {self.device}")
-            self.ready = True
-            self.btn_one["state"] = self.btn_all["state"] = "normal"
+            # Calcular task_assignments automáticamente
+            organ_to_tasks = build_organ_to_tasks_map(TOTALSEG_TASK_LABELS)
+            task_assignments = compute_required_tasks(set(selection), organ_to_tasks, TOTALSEG_TASK_LABELS,
+                                                      task_cost=self._task_cost_function())
+            self._log(f"📦 Auto-calculated {len(task_assignments)} tasks from organ selection")
 
-        except Exception as e:
-            # Translate error when loading the SegResNet model
-            self._log(f"❌ Error loading model: {e}")
-            self._log(traceback.format_exc())
-            self.ready = False
+        # Envolver en try-finally para asegurar que la barra de progreso siempre se detenga
+        try:
+            # Ejecutar solo las tasks necesarias
+            for task_name, requested_organs in task_assignments.items():
+                # Verificar si la tarea está habilitada
+                if not self._is_task_enabled(task_name):
+                    self._log(f"⚠ Task '{task_name}' is disabled, skipping {len(requested_organs)} organs")
+                    continue
+
+                self._log(f"🔄 Running task '{task_name}' for {len(requested_organs)} organs...")
+
+                label_map = TOTALSEG_TASK_LABELS.get(task_name, {})
+                if not label_map:
+                    self._log(f"⚠ Task '{task_name}' not available, skipping")
+                    continue
+
+                # Ejecutar segmentación solo para órganos solicitados
+                requested_list = list(requested_organs)
+                run_task(task_name, label_map, requested_list)
+
+            body_map = TOTALSEG_TASK_LABELS.get('body', {})
+            body_labels = set(body_map.keys()) if body_map else {"body", "body_trunc", "body_extremities", "skin"}
+            selection_set = set(selection)
+            missing_body = {name for name in selection_set if name in body_labels and name not in masks}
+            if missing_body and self.totalseg_task not in {'body', 'body_mr'}:
+                if body_map and self._is_task_enabled('body'):
+                    self._log("?? Appending body segmentation results to satisfy body/skin selections")
+                    run_task('body', body_map, sorted(missing_body), allow_roi_subset=False)
+                elif body_map and missing_body:
+                    self._log("⚠ Body task disabled; skipping generation of body-related masks.")
+                elif not body_map:
+                    self._log("?? Body task labels are not available; skipping body task")
         finally:
-            # Stop the indeterminate progress bar when loading completes
-            self._indeterminate(False)
-    
+            # Asegurar que la barra de progreso siempre se detenga
+            if progress_started:
+                self._ui_call(self._indeterminate, False)
+            if nifti_tmp:
+                shutil.rmtree(nifti_tmp, ignore_errors=True)
+
+        # body/skin derivados y pulmones fusionados se generan al exportar
+        self._log(f"?? Organs found: {len(masks)} (masks are built during the RTSTRUCT export)")
+        return masks
+
     # ------------------------------------------------------------------
-    # Selección de órganos (SISTEMA UNIFICADO)
+    # Guardar RTSTRUCT mejorado
     # ------------------------------------------------------------------
-    def _select_organs(self):
-        """Nuevo método que usa el selector unificado."""
-        if not self.ready:
-            messagebox.showerror("Error", "Please load the model first.")
-            return
+    def _save_rt(self, study: StudyInfo, masks, series: Optional[SeriesInfo] = None):
+        """Write the CT series and the RTSTRUCT for ``study``.
+
+        ``series`` is the CT series the masks were computed on; when omitted
+        the study's primary series is used.  File list, geometry and the
+        headers the RTSTRUCT is built from come from discovery, so no CT
+        file is read again.
+        ``masks`` is the :class:`MaskStream` of the segmentation, consumed
+        one organ at a time, or a dict of ROI names to :class:`CompactMask`
+        (dense arrays are accepted too).  Each mask is brought onto the
+        RTSTRUCT grid by a :class:`MaskGridMapper` built once per mask
+        shape (from ``series.mask_grid`` when the segmentation recorded its
+        affine), its contours are extracted on a process pool
+        (``contour_workers``) and it is dropped as soon as its ROI is added,
+        so only a few masks are alive at any time.
+        How the CT slices reach the output follows ``ct_export_mode``; in
+        ``reference`` mode only the RTSTRUCT is written.  ``export_formats``
+        adds a DICOM-SEG (one :class:`SegmentFrames` segment per mask,
+        overlaps kept) and/or a multilabel NIfTI (painted into a
+        :class:`SegmentLabelMap`) from the same masks, or replaces the
+        RTSTRUCT with them (no contours are extracted then).  Returns
+        ``False`` if any of the selected formats could not be written.
+        """
+        try:
+            if series is None:
+                series = study.primary_series()
+            folder = study.folder
+            series_files = series.files
+            # Sanitizar el nombre para evitar caracteres ilegales en rutas
+            safe_name = sanitize_filename(study.patient_name)
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            odir = os.path.join(self._output_root(), f"{safe_name}_{timestamp}")
+            os.makedirs(odir, exist_ok=True)
+            # Log the output directory so the user knows where files will be written
+            self._log(f"📂 Output directory: {odir}")
 
-        def on_selection_complete(selected_organs: set[str],
-                                 task_assignments: dict[str, set[str]]):
-            """Callback cuando el usuario confirma selección."""
-            self.organs = list(selected_organs)
-            self._task_assignments = task_assignments  # Nuevo atributo
+            export_mode = self.ct_export_mode if self.ct_export_mode in CT_EXPORT_MODES else "copy"
+            if export_mode == "reference":
+                # Solo RTSTRUCT: referencia la serie original por sus UIDs
+                rt_dir = odir
+                self._log(f"🔗 Referencing CT series {series.uid} in {folder} (no CT copy)")
+            else:
+                # Exportar CTs (copia, enlace duro o reflink)
+                ct_dst = os.path.join(odir, "CT")
+                rt_dir = ct_dst
+                os.makedirs(ct_dst, exist_ok=True)
+                self._log(f"📥 Exporting CT slices ({export_mode}) from {folder} to {ct_dst}...")
+
+                used = defaultdict(int)
+                for src in series_files:
+                    fname = os.path.basename(src)
+                    dst = os.path.join(ct_dst, fname)
+                    used[export_series_file(src, dst, export_mode)] += 1
+
+                if not os.listdir(ct_dst):
+                    # Abort if no slices were exported
+                    self._log("❌ Error: No DICOM slices were exported. Aborting RTSTRUCT.")
+                    return False
 
-            # Log informativo
-            self._log(f"🔖 Selected {len(selected_organs)} organs")
-            self._log(f"📦 Will execute {len(task_assignments)} tasks:")
-            for task, organs in task_assignments.items():
-                self._log(f"   • {task}: {len(organs)} organs")
+                summary = ", ".join(f"{n} {how}" for how, n in sorted(used.items()))
+                self._log(f"✔ {len(series_files)} CT slices exported to {ct_dst} ({summary})")
+                if export_mode != "copy" and used.get("copy"):
+                    self._log(f"⚠ {export_mode} not supported for {used['copy']} slices; they were copied")
 
-            self._save_config()
+            # El RTSTRUCT se crea con las cabeceras leídas en el descubrimiento
+            self._log("🛠 Creating RTSTRUCT...")
+            try:
+                rtstruct = rtstruct_from_series(series)
+                self._log("✔ RTStructBuilder initialized successfully")
+            except Exception as e:
+                # Report failure to create the RTSTRUCT
+                self._log(f"❌ Error creating RTStructBuilder: {str(e)}")
+                return False
 
-        UnifiedOrganSelector(
-            self,
-            TOTALSEG_TASK_LABELS,
-            set(self.organs),
-            on_selection_complete
-        )
+            # Determinar forma esperada para máscaras
+            num_slices = series.num_slices
+            rows = int(series.rows)
+            cols = int(series.columns)
+            expected_rt_shape = (rows, cols, num_slices)
+            # Log the expected mask shape used by RTSTRUCT (Rows, Cols, Slices)
+            self._log(f"📐 Expected shape for RT masks (Rows,Cols,Slices): {expected_rt_shape}")
 
-    # ------------------------------------------------------------------
-    # Thread wrappers
-    # ------------------------------------------------------------------
-    def _run_all_thread(self):
-        if not self._validate_paths():
-            return
-        self.cancel_requested = False
-        self._indeterminate(True)
-        self.btn_cancel.config(state="normal")
-        self.btn_one.config(state="disabled")
-        self.btn_all.config(state="disabled")
-        threading.Thread(target=self._thread_wrapper, args=(self._process_all,), daemon=True).start()
+            # Correspondencia rejilla de la segmentación → rejilla RTSTRUCT,
+            # calculada una vez por forma de máscara
+            try:
+                dst_affine = rtstruct_grid_affine(rtstruct.series_data)
+            except Exception as e:
+                dst_affine = None
+                self._log(f"⚠ Could not derive the RTSTRUCT grid geometry: {e}")
+            mappers: dict[tuple, Optional[MaskGridMapper]] = {}
+
+            # Formatos de salida: segmentos del SEG y mapa de etiquetas solo si hacen falta
+            formats = [f for f in EXPORT_FORMATS if f in self.export_formats] or ["rtstruct"]
+            want_rt = "rtstruct" in formats
+            segments = SegmentFrames(expected_rt_shape) if "seg" in formats else None
+            label_map = SegmentLabelMap(expected_rt_shape) if "nifti" in formats else None
+            if formats != ["rtstruct"]:
+                self._log(f"🗂 Export formats: {', '.join(formats)}")
 
-    def _run_one_thread(self):
-        if not self._validate_paths():
-            return
-        self.cancel_requested = False
-        self._indeterminate(True)
-        self.btn_cancel.config(state="normal")
-        self.btn_one.config(state="disabled")
-        self.btn_all.config(state="disabled")
-        threading.Thread(target=self._thread_wrapper, args=(self._process_one,), daemon=True).start()
+            MIN_PIXELS = 5
+            tolerance_mm = max(0.0, float(self.contour_tolerance_mm or 0.0))
+            from rt_utils import image_helper  # type: ignore
+            transform = image_helper.get_pixel_to_patient_transformation_matrix(rtstruct.series_data)
+            totals = defaultdict(int)
+            added: list[str] = []
+
+            def finish(lbl, mask_for_rt, pixel_count, handle):
+                """Añadir al RTSTRUCT un ROI cuyos contornos ya están en marcha."""
+                color = [int(c) for c in get_organ_color(lbl)]
+                try:
+                    planes, stats = pool.result(handle)
+                    detail = ""
+                    if tolerance_mm > 0 and stats.get("area"):
+                        change = 100.0 * abs(stats["area_kept"] - stats["area"]) / stats["area"]
+                        if change > self.contour_max_volume_change_pct:
+                            # La simplificación deforma demasiado este ROI: contornos completos
+                            self._log(f"⚠ {lbl}: simplified contours change the volume by {change:.2f}% "
+                                      f"(> {self.contour_max_volume_change_pct:g}%), keeping full contours")
+                            full = compute_roi_contours({lbl: mask_for_rt}, transform)[lbl]
+                            if isinstance(full, Exception):
+                                raise full
+                            planes, stats = full
+                            # Sin simplificar no se cuentan bytes: calcularlos para el resumen
+                            stats["bytes_kept"] = sum(_contour_bytes(values) for _, data in planes for values in data)
+                        else:
+                            detail = f", {stats['points']} → {stats['kept']} points, volume Δ {change:.2f}%"
+                    for key, value in stats.items():
+                        totals[key] += value
+                    add_roi_contours(rtstruct, planes, dicom_safe_name(lbl), color)
+                    added.append(lbl)
+                    self._log(f"✔ ROI {lbl} added successfully ({pixel_count} pixels{detail})")
+                except Exception as e:
+                    self._log(f"❌ Error adding ROI {lbl}: {str(e)}")
+                    # No mostrar traceback completo para errores de ROI individual
 
-    def _thread_wrapper(self, func):
-        try:
-            func()
-        except Exception as e:  # pragma: no cover
-            self._log(f"❌ Error en hilo de procesamiento: {str(e)}")
-            self._log(traceback.format_exc())
-        finally:
-            self.after(0, self._indeterminate, False)
-            self.after(0, lambda: self.btn_cancel.config(state="disabled"))
-            self.after(0, lambda: self.btn_one.config(state="normal"))
-            self.after(0, lambda: self.btn_all.config(state="normal"))
-            self.cancel_requested = False
+            # Los órganos llegan de uno en uno (MaskStream) o de un dict: cada
+            # máscara se lleva a la rejilla RT, sus contornos se extraen en el
+            # pool de procesos y se descarta en cuanto el ROI está añadido.
+            # Postprocesado (hilos) y contornos (procesos) se reparten los núcleos
+            post_workers, workers = self._export_workers(contours=want_rt)
+            items = self._iter_masks(masks, post_workers) if isinstance(masks, MaskStream) else masks.items()
+            window = 2 * workers  # ROIs con contornos en curso como máximo
+            if want_rt:
+                self._log(f"✏ Extracting contours ROI by ROI (up to {workers} processes)...")
+            t_start = time.perf_counter()
+            pending = deque()
+            with ContourPool(transform, workers, tolerance_mm) as pool:
+                for lbl, mask in items:
+                    if self.cancel_requested:
+                        self._log("❌ Process cancelled by user")
+                        if hasattr(items, "close"):
+                            items.close()  # no dejar el postprocesado suspendido con su pool
+                        return False
+                    if not isinstance(mask, CompactMask):
+                        mask = CompactMask.from_dense(mask)
+                    pixel_count = mask.count()
+                    if pixel_count < MIN_PIXELS:
+                        # Skip masks that are too small to be meaningful
+                        self._log(f"⚠ {lbl}: mask too small ({pixel_count} < {MIN_PIXELS}), skipping")
+                        continue
 
-    def _cancel_process(self):
-        """Cancel the currently running segmentation process."""
-        self.cancel_requested = True
-        self._log("⚠️ Cancellation requested by user. Stopping process...")
-        self.btn_cancel.config(state="disabled")
+                    if mask.shape not in mappers:
+                        mappers[mask.shape] = self._mask_grid_mapper(mask.shape, series.mask_grid,
+                                                                     dst_affine, expected_rt_shape)
+                    mapper = mappers[mask.shape]
+                    if mapper is None:
+                        self._log(f"❌ {lbl}: Could not convert shape {mask.shape} to {expected_rt_shape}, skipping")
+                        continue
+                    try:
+                        mask_for_rt = mapper.map(mask)
+                    except Exception as e:
+                        self._log(f"❌ {lbl}: Could not map mask {mask.shape} to {expected_rt_shape}: {e}")
+                        continue
+                    del mask
+
+                    # Verificar que la máscara convertida tenga contenido
+                    pixel_count = mask_for_rt.count()
+                    if pixel_count < MIN_PIXELS:
+                        self._log(f"⚠ {lbl}: converted mask too small ({pixel_count} < {MIN_PIXELS}), skipping")
+                        continue
+
+                    if segments is not None:
+                        segments.add(lbl, mask_for_rt)
+                    if label_map is not None and label_map.add(lbl, mask_for_rt) is None:
+                        self._log(f"⚠ {lbl}: more than {SegmentLabelMap.MAX_LABELS} structures, "
+                                  "not included in the label map")
+                    if not want_rt:
+                        added.append(lbl)
+                        continue
+                    pending.append((lbl, mask_for_rt, pixel_count, pool.submit(mask_for_rt)))
+                    del mask_for_rt
+                    while len(pending) > window:
+                        finish(*pending.popleft())
+                while pending:
+                    finish(*pending.popleft())
+            rois_added = len(added)
+            contour_time = time.perf_counter() - t_start
+            if want_rt:
+                self._log(f"⏱ Contours of {rois_added} ROIs extracted in {contour_time:.2f}s")
+
+            if tolerance_mm > 0 and totals["kept"]:
+                # bytes por punto de lo que se escribe, extrapolado a los puntos eliminados
+                saved = totals["bytes_kept"] / totals["kept"] * (totals["points"] - totals["kept"])
+                self._log(
+                    f"✂ Contour simplification ({tolerance_mm:g} mm): {totals['points']} → {totals['kept']} points "
+                    f"(-{100.0 * (1 - totals['kept'] / totals['points']):.1f}%), "
+                    f"~{saved / 1024:.0f} KB less contour data"
+                )
+
+            if rois_added == 0:
+                self._log("⚠ No valid ROIs were added")
+                return False
+
+            failed: list[str] = []
+            if want_rt:
+                output_path = os.path.join(rt_dir, "rtss.dcm")
+                self._log(f"💾 Attempting to save RTSTRUCT to {output_path}...")
+                try:
+                    from pydicom.uid import ExplicitVRLittleEndian
+                    rtstruct.ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+                    rtstruct.ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                    rtstruct.ds.is_implicit_VR = False
+                    rtstruct.ds.is_little_endian = True
+
+                    t_save = time.perf_counter()
+                    rtstruct.save(output_path)
+                    save_time = time.perf_counter() - t_save
+                    self._log(f"✅ RTSTRUCT saved successfully with {rois_added} ROIs")
+
+                    if os.path.exists(output_path):
+                        file_size = os.path.getsize(output_path) / 1024
+                        self._log(f"📏 RTSTRUCT file size: {file_size:.2f} KB "
+                                  f"(contours {contour_time:.2f}s + save {save_time:.2f}s)")
+                        if file_size < 10:
+                            self._log("⚠ Warning: The RTSTRUCT file is very small; it may be empty.")
+                    else:
+                        self._log("❌ Error: The RTSTRUCT file was not created")
+                        failed.append("rtstruct")
+
+                except Exception as e:
+                    self._log(f"❌ Error saving RTSTRUCT: {str(e)}")
+                    failed.append("rtstruct")
 
-    # ------------------------------------------------------------------
-    # Validación de paths
-    # ------------------------------------------------------------------
-    def _validate_paths(self):
-        folder = self.in_entry.get().strip()
-        outdir = self.out_entry.get().strip()
+            failed += self._save_label_exports(segments, label_map, formats, rt_dir,
+                                               rtstruct.series_data, dst_affine)
+            if failed:
+                self._log(f"❌ Not written: {', '.join(failed)}")
+            return not failed
 
-        if not folder or not outdir:
-            messagebox.showerror("Error", "Please select input and output folders.")
+        except Exception as e:
+            # Manejar cualquier excepción no contemplada en _save_rt
+            self._log(f"‼ Error inesperado en _save_rt: {str(e)}")
+            self._log(traceback.format_exc())
             return False
 
-        if not os.path.isdir(folder):
-            messagebox.showerror("Error", f"The input folder does not exist:\n{folder}")
-            return False
+    def _save_label_exports(self, segments: Optional[SegmentFrames], label_map: Optional[SegmentLabelMap],
+                            formats, out_dir: str, series_data: list, grid_affine) -> list[str]:
+        """Write the DICOM-SEG and/or multilabel NIfTI selected in ``formats``.
 
-        if not os.path.isdir(outdir):
+        The SEG comes from ``segments`` (overlapping structures kept whole)
+        and the NIfTI from ``label_map``; size and write time of each file
+        are logged like the RTSTRUCT ones so the formats can be compared.
+        Returns the formats that could not be written.
+        """
+        if label_map is not None and label_map.overlap:
+            self._log(f"ℹ {label_map.overlap} voxels belong to several structures; "
+                      "the NIfTI label map keeps the smallest one")
+        failed = []
+        for fmt in formats:
+            if fmt == "seg":
+                name, path = "DICOM-SEG", os.path.join(out_dir, "seg.dcm")
+            elif fmt == "nifti":
+                name, path = "NIfTI label map", os.path.join(out_dir, "labels.nii.gz")
+            else:
+                continue
+            self._log(f"💾 Writing {name} to {path}...")
+            t0 = time.perf_counter()
             try:
-                os.makedirs(outdir, exist_ok=True)
+                if fmt == "seg":
+                    frames = write_dicom_seg(segments, series_data, path)
+                    detail = f"{len(segments)} segments, {frames} frames"
+                else:
+                    if grid_affine is None:
+                        raise RuntimeError("the RTSTRUCT grid geometry is not available")
+                    write_label_nifti(label_map, grid_affine, path)
+                    detail = f"{len(label_map)} labels"
+                elapsed = time.perf_counter() - t0
+                file_size = os.path.getsize(path) / 1024
             except Exception as e:
-                messagebox.showerror("Error", f"Could not create the output folder:\n{outdir}\nError: {e}")
-                return False
-        return True
+                self._log(f"❌ Error writing {name}: {str(e)}")
+                failed.append(fmt)
+                continue
+            self._log(f"✅ {name} saved successfully ({detail})")
+            self._log(f"📏 {name} file size: {file_size:.2f} KB (written in {elapsed:.2f}s)")
+        return failed
 
-    # ------------------------------------------------------------------
-    # Progreso
-    # ------------------------------------------------------------------
-    def _indeterminate(self, start: bool):
+    def _mask_grid_mapper(self, shape, grid, dst_affine, dst_shape) -> Optional[MaskGridMapper]:
+        """Build the mapper taking masks of ``shape`` onto the RTSTRUCT grid.
+
+        ``grid`` is the ``(shape, affine)`` recorded by the segmentation
+        (``SeriesInfo.mask_grid``); with it and ``dst_affine`` the mapping
+        follows from the geometry.  Otherwise the legacy shape heuristics of
+        :meth:`MaskGridMapper.from_shapes` are used.
         """
-        Start or stop the indeterminate progress bar.
+        if len(shape) != 3:
+            return None
+        if grid is not None and dst_affine is not None and tuple(grid[0]) == tuple(shape):
+            try:
+                mapper = MaskGridMapper.from_affines(shape, grid[1], dst_shape, dst_affine)
+                self._log(f"🧭 Mask grid {tuple(shape)} → RT grid {tuple(dst_shape)} from the affines: {mapper.describe()}")
+                return mapper
+            except Exception as e:
+                self._log(f"⚠ Could not map the mask grid from its affine: {e}")
+        if grid is not None:
+            self._log(f"⚠ Mask grid {tuple(shape)} has no usable geometry; guessing from shapes "
+                      "(axis inversions were not applied)")
+        mapper = MaskGridMapper.from_shapes(shape, dst_shape)
+        if mapper is not None:
+            self._log(f"📐 Mask grid {tuple(shape)} → RT grid {tuple(dst_shape)} from shapes: {mapper.describe()}")
+        return mapper
 
-        This helper wraps calls to the Tk progress widget in a try/except
-        to avoid crashing if the underlying Tk widgets have already been
-        destroyed (for example, after the user closes the main window).
+    def _is_task_enabled(self, task_name: str) -> bool:
+        return bool(self.task_enabled.get(task_name, False))
+
+    def _ensure_custom_trainer(self) -> None:
+        """
+        Ensure that the custom nnUNet trainer required by some TotalSegmentator
+        models exists. TotalSegmentator v2 models reference a class named
+        ``nnUNetTrainer_4000epochs_NoMirroring`` which is not part of the
+        standard nnunetv2 distribution. When this class cannot be imported,
+        this method attempts to create a fallback implementation in the
+        nnunetv2 package directory. If the directory is not writable or
+        nnunetv2 is unavailable, a warning is logged and the method returns.
         """
         try:
-            if start:
-                # Switch to indeterminate mode and start the animation
-                self.progress.configure(mode="indeterminate")
-                self.progress.start()
-            else:
-                # Stop the animation and reset back to determinate mode
-                self.progress.stop()
-                self.progress.configure(mode="determinate", value=0)
-        except tk.TclError:
-            # If the widget no longer exists (application has been closed),
-            # silently ignore the error instead of crashing.  This prevents
-            # the "can't invoke winfo" exception seen in crash logs.
-            pass
+            from importlib.util import find_spec  # type: ignore
+            # If the module already exists, nothing to do
+            if find_spec('nnunetv2.training.nnUNetTrainer.nnUNetTrainer_4000epochs_NoMirroring'):
+                return
+            import nnunetv2.training.nnUNetTrainer as trainer_mod  # type: ignore
+            trainer_dir = os.path.dirname(trainer_mod.__file__)
+            custom_path = os.path.join(trainer_dir, 'nnUNetTrainer_4000epochs_NoMirroring.py')
+            # Only create the file if it does not already exist
+            if not os.path.exists(custom_path):
+                try:
+                    with open(custom_path, 'w', encoding='utf-8') as f:
+                        f.write('from .nnUNetTrainer import nnUNetTrainer\n\n')
+                        f.write('class nnUNetTrainer_4000epochs_NoMirroring(nnUNetTrainer):\n')
+                        f.write('    """Fallback trainer created by AURA.\n')
+                        f.write('\n')
+                        f.write('    This class exists solely to satisfy TotalSegmentator\n')
+                        f.write('    references during inference and derives behaviour from\n')
+                        f.write('    the default nnUNetTrainer. It disables mirroring and\n')
+                        f.write('    increases the epoch count. These settings are irrelevant\n')
+                        f.write('    for inference but match the original TotalSegmentator\n')
+                        f.write('    training configuration.\n')
+                        f.write('    """\n')
+                        f.write('    def __init__(self, *args, **kwargs):\n')
+                        f.write('        super().__init__(*args, **kwargs)\n')
+                        f.write('        # Do not use mirroring during training/inference\n')
+                        f.write('        self.allowed_mirroring_axes = None\n')
+                        f.write('        # Increase maximum number of epochs\n')
+                        f.write('        self.max_num_epochs = 4000\n')
+                except Exception as exc:
+                    # If writing fails, inform the user via the log
+                    self._log(f"⚠ Could not create fallback nnUNet trainer: {exc}")
+        except Exception as exc:
+            # If nnunetv2 is not installed or another error occurs, log and return
+            self._log(f"⚠ Could not ensure custom trainer class: {exc}")
 
-    # ------------------------------------------------------------------
-    # Leer nombre paciente
-    # ------------------------------------------------------------------
-    def _dicom_name(self, folder: str) -> str:
-        """Attempt to extract a human–readable patient name from DICOM files.
+    def _prefetch_needed(self) -> bool:
+        """True when segmentation reads the decoded volume of the series.
 
-        This method walks the input folder looking for a DICOM slice.  In
-        earlier versions only files ending in ``.dcm`` were considered,
-        which excluded valid DICOM files with non‑standard or missing
-        extensions (for example files named ``IM1``).  To improve
-        robustness the search now also includes any file that appears to
-        be a DICOM according to :func:`looks_like_dicom`.  Once a valid
-        file is found we read its header with ``pydicom.dcmread`` and
-        return the patient family name, if present, or the raw value of
-        the ``PatientName`` tag.  If no valid slice is found the
-        string ``"Patient"`` is returned.
+        TotalSegmentator gets the NIfTI built from it (as an image, or as a
+        temporary file for versions that only accept paths) and the
+        segmentation cache hashes it.  SegResNet reads the series through
+        MONAI and only decodes it itself when those readers fail, so a
+        prefetched volume would just be held in memory.
         """
-        for root, _, files in os.walk(folder):
-            for f in files:
-                # Only consider files that either use the standard .dcm
-                # extension or appear to be DICOM when inspected.  Using
-                # looks_like_dicom allows us to handle datasets like
-                # Siemens where slices are named IM0, IM1, etc.
-                full_path = os.path.join(root, f)
-                if not (f.lower().endswith(".dcm") or looks_like_dicom(full_path)):
-                    continue
-                try:
-                    ds = pydicom.dcmread(full_path, stop_before_pixels=True)
-                    pn = ds.get("PatientName", "")
-                    # Prefer the family name attribute when available
-                    return str(getattr(pn, "family_name", pn)) or "Paciente"
-                except Exception:
-                    continue
-        return "Patient"
+        return self.model_type == "totalseg"
 
-    # ------------------------------------------------------------------
-    # Recolectar serie CT
-    # ------------------------------------------------------------------
-    def _collect_ct_series(self, folder: str):
-        """Collect a continuous CT series from a directory of DICOM files.
+    def _prefetch_volume(self, series: SeriesInfo) -> None:
+        """Decode ``series`` ahead of segmentation (batch pipeline ingest stage).
 
-        Only slices belonging to the largest CT series (identified by
-        ``SeriesInstanceUID``) are returned.  Historically this method
-        filtered exclusively on filenames ending in ``.dcm``.  To allow
-        processing of DICOM datasets without a file extension we now
-        inspect every file and skip it only when it neither ends with
-        ``.dcm`` nor looks like a DICOM slice according to
-        :func:`looks_like_dicom`.  For each candidate file we read a
-        minimal header (Modality, SeriesInstanceUID, InstanceNumber) to
-        identify CT modality and grouping.  If no CT slices are found an
-        exception is raised.  The returned list is sorted by the
-        instance number.
+        The result is kept on ``series.volume`` and also stored in the
+        volume cache when enabled.  Failures are only logged: segmentation
+        then decodes the series itself and reports the real error.
         """
-        series = defaultdict(list)
-        for root, _, files in os.walk(folder):
-            for f in files:
-                full_path = os.path.join(root, f)
-                # Skip non‑DICOM files quickly by checking extension and
-                # heuristic; this avoids attempting to read arbitrary data
-                # with pydicom.
-                if not (f.lower().endswith(".dcm") or looks_like_dicom(full_path)):
-                    continue
-                try:
-                    ds = pydicom.dcmread(full_path, stop_before_pixels=True,
-                                         specific_tags=["Modality", "SeriesInstanceUID", "InstanceNumber"])
-                    if getattr(ds, 'Modality', None) != "CT":
-                        continue
-                    # Use instance number to sort slices; missing values
-                    # default to zero.
-                    inst_num = int(ds.get("InstanceNumber", 0))
-                    series[str(ds.SeriesInstanceUID)].append((inst_num, full_path))
-                except Exception as e:
-                    # Warn if reading a file believed to be DICOM fails; this
-                    # may indicate a corrupt slice but should not abort
-                    self._log(f"⚠ Error reading {full_path}: {e}")
-                    continue
+        try:
+            series.volume = load_series_volume(series.files, uid=series.uid,
+                                               cache=self._get_volume_cache())
+        except Exception as e:
+            series.volume = None
+            self._log(f"⚠ Could not prefetch volume for series {series.uid}: {e}")
 
-        if not series:
-            raise RuntimeError("No CT images were found in the folder")
 
-        best_uid = max(series, key=lambda k: len(series[k]))
-        files = [path for (inst, path) in sorted(series[best_uid], key=lambda x: x[0])]
-        self._log(f"ℹ Selected CT series: {best_uid} ({len(files)} slices)")
-        return files
+# -------------------------------------------------------------------------
+# App principal
+# -------------------------------------------------------------------------
+class AutoSegApp(AutoSegEngine, _TkRoot):
+    """
+    Ventana principal de la aplicación AURA. Esta versión se ha simplificado
+    para utilizar exclusivamente el modelo TotalSegmentator V2. Se eliminan
+    completamente las opciones de selección de modelo y resolución de la red
+    SegResNet original. Además, se incorpora un mecanismo de persistencia
+    de configuración (tema, orientación, rutas de entrada/salida, etc.) y
+    una comprobación inicial de CUDA y de la disponibilidad de la librería
+    totalsegmentator. Si totalsegmentator no está instalado y se detecta
+    soporte CUDA, se intentará instalar automáticamente mediante pip. Si
+    falla la instalación automática, se notificará al usuario mediante el
+    registro de la aplicación.
+    """
 
-    # ------------------------------------------------------------------
-    # Lectura manual mejorada (fallback)
-    # ------------------------------------------------------------------
-    def _manual_volume(self, files):
-        """Construye volumen y meta dict manual cuando fallan lectores MONAI."""
-        self._log(f"⚙ Starting manual reading of {len(files)} slices...")
-        good_slices = []
-        headers = []
+    def __init__(self):
+        super().__init__()
+        # Window title and initial size
+        # Use an English title for consistency throughout the UI
+        self.title("AURA – Automatic Segmentation")
+        self.geometry("800x650")
 
-        for i, pth in enumerate(files, 1):
-            try:
-                ds = pydicom.dcmread(pth)
-                if not hasattr(ds, "PixelData"):
-                    self._log(f"   ⚠ Slice {i}/{len(files)} has no PixelData, skipping")
-                    continue
+        # -----------------------------------------------------------------
+        # Asignar un icono a la aplicación
+        # -----------------------------------------------------------------
+        # Cuando se genera un instalador con PyInstaller, los recursos como
+        # imágenes y archivos de icono se empaquetan junto con el ejecutable.
+        # Utilizamos la función resource_path para localizar correctamente
+        # el archivo ico.png tanto en modo desarrollo como en el ejecutable
+        # empaquetado.  El método iconphoto acepta objetos PhotoImage y
+        # funciona en Windows, macOS y Linux.  Si el archivo no está
+        # disponible o no es compatible, la asignación del icono se
+        # ignora silenciosamente.
+        try:
+            icon_png_path = resource_path("ico.png")
+            icon_image = tk.PhotoImage(file=icon_png_path)
+            # El primer argumento (False) indica que el icono aplica a la
+            # ventana principal y a todas las subventanas.
+            self.iconphoto(False, icon_image)
+        except Exception:
+            # No interrumpir la inicialización si no se puede cargar el icono
+            pass
 
-                arr = ds.pixel_array.astype(np.int16)
+        # Estado de procesamiento (compartido con el modo sin interfaz)
+        self._init_engine_state()
 
-                slope = float(ds.get("RescaleSlope", 1))
-                intercept = float(ds.get("RescaleIntercept", 0))
-                hu = arr * slope + intercept
+        # Gestor de estilos para ttk
+        self.style = ttk.Style()
 
-                good_slices.append(hu)
-                headers.append(ds)
+        # Logging hacia GUI
+        self.log_handler = TextHandler(self)
+        logger.addHandler(self.log_handler)
 
-                if i % 20 == 0 or i == len(files):
-                    self._log(f"   ✔ Processed {i}/{len(files)} slices")
-            except Exception as e:
-                self._log(f"   ⚠ Error in slice {i}/{len(files)}: {e}")
+        # Construir interfaz
+        self._build_ui()
 
-        if len(good_slices) < 10:
-            raise RuntimeError("Too many damaged slices to build volume")
+        # Cargar configuración (si existe) para sobrescribir valores
+        self._load_config()
 
-        # Volumen numpy (Z, Y, X)
-        vol = np.stack(good_slices, axis=0).astype(np.float32)
+        # Aplicar tema tras cargar configuración
+        self.apply_theme()
 
-        # Canal (C, Z, Y, X)
-        vol = vol[np.newaxis, ...]  # C=1
-        tensor_vol = torch.from_numpy(vol)
+        # Mensajes iniciales de registro
+        self._log("👷 Application started")
+        self._log(f"💻 Using {'GPU' if torch.cuda.is_available() else 'CPU'}")
+        if torch.cuda.is_available():
+            try:
+                self._log(f"🔧 GPU detected: {torch.cuda.get_device_name(0)}")
+            except Exception:
+                self._log("🔧 GPU detected but the name could not be retrieved")
 
-        # Matriz afín aproximada
-        first_ds = headers[0]
-        last_ds = headers[-1]
+        # Log de librerías disponibles
+        resize_libs = []
+        if SCIPY_AVAILABLE:
+            resize_libs.append("scipy")
+        if SKIMAGE_AVAILABLE:
+            resize_libs.append("skimage")
+        resize_libs.append("numpy")
+        self._log(f"🔧 Available resizing libraries: {', '.join(resize_libs)}")
 
-        pixel_spacing = [float(x) for x in first_ds.PixelSpacing]  # [row, col] = [Y, X]
-        
-        # Espacio entre cortes: usar SliceThickness si está; si no, derivar de ImagePositionPatient
+        # CUDA/Torch diagnostics to aid troubleshooting
         try:
-            slice_thickness = float(first_ds.SliceThickness)
+            self._log_cuda_diagnostics()
         except Exception:
-            try:
-                pos_first = np.array(first_ds.ImagePositionPatient, dtype=float)
-                pos_last = np.array(last_ds.ImagePositionPatient, dtype=float)
-                slice_thickness = np.linalg.norm(pos_last - pos_first) / max(len(headers) - 1, 1)
-            except Exception:
-                slice_thickness = 5.0  # fallback por defecto
+            pass
 
-        row_vec = np.array(first_ds.ImageOrientationPatient[0:3], dtype=float)
-        col_vec = np.array(first_ds.ImageOrientationPatient[3:6], dtype=float)
-        slice_vec = np.cross(row_vec, col_vec)
+        # Check and install TotalSegmentator if necessary
+        self._ensure_totalseg()
 
-        affine = np.eye(4, dtype=float)
-        # columnas del afín: X, Y, Z en espacio físico
-        affine[0:3, 0] = row_vec * pixel_spacing[1]  # X
-        affine[0:3, 1] = col_vec * pixel_spacing[0]  # Y
-        affine[0:3, 2] = slice_vec * slice_thickness  # Z
-        affine[0:3, 3] = np.array(first_ds.ImagePositionPatient, dtype=float)  # origen
+        # Initial instruction message
+        self._log("Select the input and output folders and then press 'Process' to start")
 
-        spacing = [slice_thickness, pixel_spacing[0], pixel_spacing[1]]  # (Z, Y, X) como data
+        # Capturar el cierre de la ventana para guardar la configuración
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
 
-        meta_dict = {
-            "original_affine": affine.copy(),
-            "affine": affine.copy(),
-            "spatial_shape": vol.shape[1:],  # (Z, Y, X)
-            "original_channel_dim": "no_channel",
-            "filename_or_obj": files[0],
-            "space": "physical",
-            "original_spacing": spacing,
-            "spacing": spacing,
-            "original_orientation": first_ds.ImageOrientationPatient,
-        }
+        # Automatically prepare the TotalSegmentator model.  In the original
+        # application this was triggered via a menu item, but since the
+        # application now always uses TotalSegmentator we load it on start.
+        # Running this in a thread prevents blocking the UI during import.
+        try:
+            # Start the model loading process in the background
+            self._load_model_thread()
+        except Exception:
+            # If loading fails, the user will be informed via the log
+            pass
 
-        # Summarize manual volume reading results in English
-        self._log(f"✔ Manual volume reading complete: {len(good_slices)} slices, volume {vol.shape}")
-        self._log(f"✔ Detected spacing: {spacing}")
-        self._log("✔ Affine matrix manually reconstructed")
+    # ------------------------------------------------------------------
+    # GUI
+    # ------------------------------------------------------------------
+    def _build_ui(self):
+        """
+        Construye la interfaz de usuario principal, incluyendo la barra de menús
+        reorganizada. Además de las secciones de "Configuración" y "Ayuda"
+        originales, ahora se incluyen nuevos menús "Aspecto", "Segmentación"
+        y "Modelo".  Cada sección agrupa opciones de forma más coherente con
+        su función. Por ejemplo, la selección del tema se mueve a "Aspecto",
+        las opciones de orientación y selección de órganos se agrupan bajo
+        "Segmentación", y la resolución, el dispositivo de cómputo y el
+        recorte automático se encuentran en "Modelo".  Se introducen
+        variables de control adicionales para las nuevas opciones.
+        """
+        # Create the main menu bar
+        menubar = tk.Menu(self)
 
-        meta_tensor_vol = MetaTensor(vol, affine=affine, meta=meta_dict)
-        return tensor_vol, meta_dict, meta_tensor_vol, spacing
+        # Appearance menu: visual options for the application
+        appearance_menu = tk.Menu(menubar, tearoff=0)
+        appearance_menu.add_command(label="Select theme", command=self._choose_theme)
+        menubar.add_cascade(label="Appearance", menu=appearance_menu)
 
-    def _smooth_mask(self, mask: np.ndarray, spacing: Optional[Tuple[float, float, float]] = None) -> np.ndarray:
-        """Smooth mask boundaries based on the configured method."""
-        if not self.smooth_masks:
-            return mask
-        if mask.size == 0 or not np.any(mask):
-            return mask
+        # Segmentation menu: groups options related to segmentation and
+        # post‑processing of masks
+        segment_menu = tk.Menu(menubar, tearoff=0)
+        segment_menu.add_command(label="Orientation options", command=self._choose_orientation)
+        segment_menu.add_command(label="Select organs", command=self._select_organs)
+        # Variable for controlling morphological cleaning of masks
+        self.clean_masks_var = tk.BooleanVar(value=self.clean_masks)
+        segment_menu.add_checkbutton(
+            label="Mask cleaning", onvalue=True, offvalue=False,
+            variable=self.clean_masks_var, command=self._toggle_clean
+        )
+        self.smooth_masks_var = tk.BooleanVar(value=self.smooth_masks)
+        segment_menu.add_checkbutton(
+            label="Enable smoothing", onvalue=True, offvalue=False,
+            variable=self.smooth_masks_var, command=self._toggle_smoothing
+        )
+        segment_menu.add_command(label="Smoothing options", command=self._choose_smoothing)
+        # Allow the user to adjust the cropping margin
+        segment_menu.add_command(label="Crop margin", command=self._choose_crop_margin)
+        menubar.add_cascade(label="Segmentation", menu=segment_menu)
 
-        method = (self.smoothing_method or 'gaussian').lower()
-        try:
-            sigma_mm = float(self.smoothing_sigma_mm)
-        except Exception:
-            sigma_mm = 3.0
-        sigma_mm = max(0.5, min(15.0, sigma_mm))
+        tasks_menu = tk.Menu(menubar, tearoff=0)
+        tasks_menu.add_command(label="Select tasks...", command=self._choose_tasks)
+        menubar.add_cascade(label="Tasks", menu=tasks_menu)
 
-        if spacing and len(spacing) == 3 and all(s > 0 for s in spacing):
-            sigma_vox = tuple(max(0.2, sigma_mm / s) for s in spacing)
-            min_spacing = min(spacing)
-        else:
-            sigma_vox = (sigma_mm, sigma_mm, sigma_mm)
-            min_spacing = 1.0
+        # Model menu: contains options relevant to TotalSegmentator
+        model_menu = tk.Menu(menubar, tearoff=0)
+        # Allow the user to change the resolution (1.5 mm vs 3 mm)
+        model_menu.add_command(label="Select resolution", command=self._choose_resolution)
+        # Allow the user to select the computation device (CPU/GPU)
+        model_menu.add_command(label="Select device", command=self._choose_device)
+        # Variable for enabling/disabling automatic body cropping
+        self.use_crop_var = tk.BooleanVar(value=self.use_crop)
+        model_menu.add_checkbutton(
+            label="Automatic body cropping", onvalue=True, offvalue=False,
+            variable=self.use_crop_var, command=self._toggle_crop
+        )
+        menubar.add_cascade(label="Model", menu=model_menu)
 
-        mask_bool = mask.astype(bool)
+        # Help menu: general information and access to the error report
+        help_menu = tk.Menu(menubar, tearoff=0)
+        help_menu.add_command(label="About", command=self._show_about)
+        help_menu.add_command(label="View log", command=self._show_log)
+        menubar.add_cascade(label="Help", menu=help_menu)
 
-        if method == 'gaussian':
-            blurred = None
-            if SCIPY_AVAILABLE:
-                try:
-                    import scipy.ndimage as ndi  # type: ignore
-                    blurred = ndi.gaussian_filter(mask_bool.astype(np.float32), sigma=sigma_vox, mode='nearest')
-                except Exception:
-                    blurred = None
-            if blurred is None and SKIMAGE_AVAILABLE:
-                try:
-                    from skimage.filters import gaussian  # type: ignore
-                    blurred = gaussian(mask_bool.astype(float), sigma=sigma_vox, preserve_range=True)
-                except Exception:
-                    blurred = None
-            if blurred is None:
-                return mask
-            return (blurred >= 0.5).astype(mask.dtype)
+        self.config(menu=menubar)
 
-        if method == 'morphological':
-            result = mask_bool
-            iterations = max(1, int(round(sigma_mm / max(min_spacing, 1e-3))))
-            try:
-                if SCIPY_AVAILABLE:
-                    import scipy.ndimage as ndi  # type: ignore
-                    struct = np.ones((3, 3, 3), dtype=bool)
-                    result = ndi.binary_closing(result, structure=struct, iterations=iterations)
-                    result = ndi.binary_opening(result, structure=struct, iterations=iterations)
-                elif SKIMAGE_AVAILABLE:
-                    from skimage.morphology import ball, binary_closing, binary_opening  # type: ignore
-                    struct = ball(max(1, iterations))
-                    result = binary_closing(result, struct)
-                    result = binary_opening(result, struct)
-            except Exception:
-                result = mask_bool
-            return result.astype(mask.dtype)
+        # Input
+        input_frame = tk.LabelFrame(self, text="Input", padx=5, pady=5)
+        input_frame.pack(fill="x", padx=10, pady=5)
 
-        return mask
+        tk.Label(input_frame, text="Patients folder (DICOM subfolders):").pack(anchor="w")
+        self.in_entry = tk.Entry(input_frame, width=80)
+        self.in_entry.pack(fill="x", padx=5, pady=(0, 5))
+        tk.Button(input_frame, text="Browse...", command=lambda: self._browse(self.in_entry)).pack(pady=(0, 5))
 
-    def _derive_skin_from_body(self, body_mask: np.ndarray) -> Optional[np.ndarray]:
-        """Construct a thin skin shell from a body mask."""
-        if body_mask.size == 0 or not np.any(body_mask):
-            return None
-        body_bool = body_mask.astype(bool)
-        skin: Optional[np.ndarray] = None
+        # Output
+        output_frame = tk.LabelFrame(self, text="Output", padx=5, pady=5)
+        output_frame.pack(fill="x", padx=10, pady=5)
 
-        if SCIPY_AVAILABLE:
-            try:
-                import scipy.ndimage as ndi  # type: ignore
+        tk.Label(output_frame, text="Destination folder (RTSTRUCT):").pack(anchor="w")
+        self.out_entry = tk.Entry(output_frame, width=80)
+        self.out_entry.pack(fill="x", padx=5, pady=(0, 5))
+        tk.Button(output_frame, text="Browse...", command=lambda: self._browse(self.out_entry)).pack(pady=(0, 5))
 
-                struct = np.ones((3, 3, 3), dtype=bool)
-                dilated = ndi.binary_dilation(body_bool, structure=struct, iterations=1)
-                eroded = ndi.binary_erosion(body_bool, structure=struct, iterations=1)
-                skin = np.logical_and(dilated, np.logical_not(eroded))
-            except Exception:
-                skin = None
+        # Controls
+        control_frame = tk.Frame(self)
+        control_frame.pack(pady=10)
 
-        if skin is None and SKIMAGE_AVAILABLE:
-            try:
-                from skimage.morphology import ball, dilation, erosion  # type: ignore
+        self.btn_one = tk.Button(control_frame, text="Process ONE patient",
+                                 state="disabled", command=self._run_one_thread)
+        self.btn_one.pack(side="left", padx=5)
 
-                struct = ball(1)
-                dilated = dilation(body_bool, struct)
-                eroded = erosion(body_bool, struct)
-                skin = np.logical_and(dilated, np.logical_not(eroded))
-            except Exception:
-                skin = None
+        self.btn_all = tk.Button(control_frame, text="Process ALL (batch)",
+                                 state="disabled", command=self._run_all_thread)
+        self.btn_all.pack(side="left", padx=5)
 
-        if skin is None:
-            return None
-        if not skin.any():
-            return None
-        return skin.astype(body_mask.dtype)
+        self.btn_cancel = tk.Button(control_frame, text="Cancel",
+                                    state="disabled", command=self._cancel_process,
+                                    bg="#ff4444", fg="white")
+        self.btn_cancel.pack(side="left", padx=5)
 
-    def _ensure_body_related_masks(self, masks: dict[str, np.ndarray], selection: Optional[set[str]]) -> None:
-        """Guarantee presence of body-related structures using fallbacks."""
-        if not masks:
-            return
+        # Progress bar
+        self.progress = ttk.Progressbar(self, length=780, mode="determinate")
+        self.progress.pack(padx=10, pady=(0, 10))
 
-        selection_set = set(selection or [])
-        body_aliases = {"body_trunc", "body_extremities"}
-        body_needed = bool(selection_set.intersection(body_aliases | {"body", "skin"}))
-
-        if body_needed and "body" not in masks:
-            combined: Optional[np.ndarray] = None
-            for mask in masks.values():
-                bool_mask = mask.astype(bool)
-                combined = bool_mask if combined is None else np.logical_or(combined, bool_mask)  # type: ignore[arg-type]
-            if combined is not None and combined.any():
-                derived = combined.astype(bool)
-                if self.smooth_masks:
-                    derived = self._smooth_mask(derived, self._last_seg_spacing)
-                masks["body"] = derived
-                missing_aliases = body_aliases.intersection(selection_set)
-                if missing_aliases:
-                    self._log("💭 Note: body aliases %s were requested but only 'body' could be derived." % ', '.join(sorted(missing_aliases)))
-                self._log("🧩 Derived 'body' mask from existing segmentations.")
-
-        if "skin" not in masks and "body" in masks and (selection_set and "skin" in selection_set):
-            skin = self._derive_skin_from_body(masks["body"])
-            if skin is not None and skin.any():
-                if self.smooth_masks:
-                    skin = self._smooth_mask(skin, self._last_seg_spacing)
-                masks["skin"] = skin
-                self._log("🧩 Derived 'skin' mask from the body volume.")
+        # Log
+        log_frame = tk.LabelFrame(self, text="Activity log", padx=5, pady=5)
+        log_frame.pack(fill="both", expand=True, padx=10, pady=(0, 10))
 
-    def _merge_lung_lobes(self, masks: dict[str, np.ndarray]) -> None:
-        """Fusiona automáticamente los lóbulos pulmonares en pulmón derecho e izquierdo.
+        self.log = ScrolledText(log_frame, state="disabled", height=18, wrap="word")
+        self.log.pack(fill="both", expand=True, padx=5, pady=5)
 
-        Busca las máscaras de los lóbulos individuales (lung_upper_lobe_left,
-        lung_lower_lobe_left, etc.) y las combina en dos máscaras:
-        lung_left y lung_right.
+        # Credits: small text at the bottom of the window
+        self.footer_label = tk.Label(
+            self,
+            text="by Agustin Rosich creative commons 2025 – open source, all rights reserved. This program may not be sold.",
+            font=("Arial", 8),
+            anchor="e"
+        )
+        self.footer_label.pack(fill="x", side="bottom", padx=10, pady=(0, 5))
 
-        Args:
-            masks: Diccionario de máscaras que será modificado in-place
+    # ------------------------------------------------------------------
+    # Visualizar log en ventana
+    # ------------------------------------------------------------------
+    def _show_log(self):
         """
-        # Definir los lóbulos que pertenecen a cada pulmón
-        left_lobes = ["lung_upper_lobe_left", "lung_lower_lobe_left"]
-        right_lobes = ["lung_upper_lobe_right", "lung_middle_lobe_right", "lung_lower_lobe_right"]
-
-        # Fusionar lóbulos izquierdos
-        left_lung = None
-        found_left_lobes = []
-        for lobe_name in left_lobes:
-            if lobe_name in masks:
-                found_left_lobes.append(lobe_name)
-                lobe_mask = masks[lobe_name].astype(bool)
-                if left_lung is None:
-                    left_lung = lobe_mask
-                else:
-                    left_lung = np.logical_or(left_lung, lobe_mask)
-
-        # Fusionar lóbulos derechos
-        right_lung = None
-        found_right_lobes = []
-        for lobe_name in right_lobes:
-            if lobe_name in masks:
-                found_right_lobes.append(lobe_name)
-                lobe_mask = masks[lobe_name].astype(bool)
-                if right_lung is None:
-                    right_lung = lobe_mask
-                else:
-                    right_lung = np.logical_or(right_lung, lobe_mask)
-
-        # Agregar las máscaras fusionadas y eliminar los lóbulos individuales
-        if left_lung is not None and left_lung.any():
-            # Aplicar suavizado si está habilitado
-            if self.smooth_masks:
-                left_lung = self._smooth_mask(left_lung, self._last_seg_spacing)
-            masks["lung_left"] = left_lung.astype(np.uint8)
-            self._log(f"🫁 Fusionados {len(found_left_lobes)} lóbulos en 'lung_left': {', '.join(found_left_lobes)}")
-            # Eliminar lóbulos individuales
-            for lobe_name in found_left_lobes:
-                del masks[lobe_name]
-
-        if right_lung is not None and right_lung.any():
-            # Aplicar suavizado si está habilitado
-            if self.smooth_masks:
-                right_lung = self._smooth_mask(right_lung, self._last_seg_spacing)
-            masks["lung_right"] = right_lung.astype(np.uint8)
-            self._log(f"🫁 Fusionados {len(found_right_lobes)} lóbulos en 'lung_right': {', '.join(found_right_lobes)}")
-            # Eliminar lóbulos individuales
-            for lobe_name in found_right_lobes:
-                del masks[lobe_name]
-
-    def _segment_from_files(self, series_files):
-        # Si el tipo de modelo es TotalSegmentator, delegamos en el método
-        # especializado y omitimos las transformaciones adaptativas.  Esto
-        # simplifica el flujo, ya que TotalSegmentator gestiona su propio
-        # preprocesamiento y no utiliza Sliding-Window.  La función
-        # devuelve un diccionario con máscaras binarias por órgano.
-        if self.model_type == "totalseg":
-            return self._segment_totalseg(series_files)
-
-        using_pre = False
-        sample = None
-        meta = None
-        original_spacing = None
-        applied_config = None
+        Open a window displaying the contents of the application log for review.
 
-        # Detect the original spacing of the first DICOM slice
+        This method creates a new top‑level window and populates it with the
+        contents of the `app.log` file located in the logging directory.  If
+        the log file cannot be read, an error message is shown instead.  The
+        text is placed into a read‑only `ScrolledText` widget for easy
+        navigation.
+        """
+        win = tk.Toplevel(self)
+        # Use an English title for the log window
+        win.title("Error and activity report")
+        win.geometry("600x400")
+        text = ScrolledText(win, state="normal", wrap="word")
+        text.pack(fill="both", expand=True)
         try:
-            first_ds = pydicom.dcmread(series_files[0], stop_before_pixels=True)
-            pixel_spacing = [float(x) for x in first_ds.PixelSpacing]
-            try:
-                slice_thickness = float(first_ds.SliceThickness)
-            except:
-                slice_thickness = 5.0
-            original_spacing = [slice_thickness, pixel_spacing[0], pixel_spacing[1]]
-            # Log the detected original spacing (Z, Y, X)
-            self._log(f"📏 Detected original spacing: {original_spacing}")
+            with open(os.path.join(log_directory, 'app.log'), 'r', encoding='utf-8') as f:
+                content = f.read()
         except Exception as e:
-            # Warn if we could not detect the original spacing
-            self._log(f"⚠ Could not detect original spacing: {e}")
-
-        # Try standard readers with adaptive configurations
-        for reader in ("PydicomReader", "ITKReader"):
-            try:
-                self._log(f"🔄 Trying {reader}...")
-                transforms, config = self._build_transforms_adaptive(reader, original_spacing)
-                applied_config = config
-                
-                sample = transforms({"image": series_files})
-                img = sample["image"].unsqueeze(0).to(self.device)  # añadir batch
-                meta = sample["image_meta_dict"]
-                
-                self._log(f"✔ {reader} successful with configuration: {config}")
-                using_pre = True
-                break
-                
-            except Exception as e:
-                self._log(f"⚠ {reader} failed: {e}")
-                continue
+            # Fall back to a meaningful message if the log cannot be read
+            content = f"Could not read the log: {e}"
+        text.insert("1.0", content)
+        text.configure(state="disabled")
 
-        # Fallback to improved manual mode if all readers fail
-        if not using_pre:
-            self._log("⚠ All readers failed; starting adaptive manual mode...")
-            tensor_vol, meta_dict, meta_tensor_vol, detected_spacing = self._manual_volume(series_files)
-            original_spacing = detected_spacing
+    # ------------------------------------------------------------------
+    # Logging a GUI
+    # ------------------------------------------------------------------
+    def _log(self, msg: str):
+        ts = datetime.now().strftime("%H:%M:%S")
+        self.after(0, lambda: self._append_log_from_main(f"[{ts}] {msg}\n"))
 
-            # Diccionario inicial para modo manual
-            sample = {
-                "image": meta_tensor_vol,
-                "image_meta_dict": meta_dict,
-            }
+    def _append_log_from_main(self, msg: str):
+        self.log.configure(state="normal")
+        self.log.insert(tk.END, msg)
+        self.log.see(tk.END)
+        self.log.configure(state="disabled")
+        self.update_idletasks()
 
-            # Probar diferentes configuraciones para el modo manual
-            manual_configs = [
-                # Sin resampling espacial - mantener original
-                {"apply_spacing": False, "pixdim": None},
-                # Resampling conservador
-                {"apply_spacing": True, "pixdim": (3.0, 3.0, 3.0)},
-                # Solo si la diferencia es muy grande
-                {"apply_spacing": True, "pixdim": (2.0, 2.0, 2.0)},
-            ]
+    # ------------------------------------------------------------------
+    # About
+    # ------------------------------------------------------------------
+    def _show_about(self):
+        about = tk.Toplevel(self)
+        about.title("About AURA")
+        about.geometry("430x320")
 
-            for i, config in enumerate(manual_configs):
-                try:
-                    # Report which manual configuration is being tested
-                    self._log(f"🔄 Trying manual configuration {i+1}/{len(manual_configs)}: {config}")
-                    
-                    transforms_list = []
-                    
-                    # Orientación básica
-                    transforms_list.append(Orientationd(keys="image", axcodes="RAS"))
+        tk.Label(
+            about,
+            text="AURA Ver 1.02",
+            font=("Arial", 14, "bold"),
+        ).pack(pady=10)
 
-                    # Crop foreground opcional.  Aplicamos margen para conservar
-                    # contexto y permitimos que el recorte sea más pequeño que
-                    # el volumen original si es necesario.
-                    if self.use_crop:
-                        transforms_list.append(
-                            CropForegroundd(
-                                keys="image",
-                                source_key="image",
-                                margin=self.crop_margin,
-                                allow_smaller=True,
-                            )
-                        )
-                    
-                    # Spacing solo si está habilitado.  Cuando se aplica
-                    # resampling, establecemos límites min/max alrededor del
-                    # target_spacing para evitar sobre/submuestreo excesivo
-                    if config["apply_spacing"] and config["pixdim"]:
-                        # Verificar si realmente necesitamos cambiar el spacing
-                        current_spacing = original_spacing
-                        target_spacing = config["pixdim"]
+        tk.Label(
+            about,
+            text=(
+                "Application for automatic segmentation of anatomical structures\n"
+                "in CT images and the generation of RTSTRUCT files.\n"
+                "Includes intelligent adaptive transformations and advanced options."
+            ),
+            wraplength=400,
+        ).pack(pady=5)
 
-                        spacing_diff = max(
-                            [abs(current_spacing[i] - target_spacing[i]) / current_spacing[i] for i in range(3)]
-                        )
+        tk.Label(about, text="Version 1.1").pack(pady=5)
+        tk.Label(
+            about,
+            text="© 2025 Agustin Rosich – Open source software under MIT license.\n"
+                 "Automatic DICOM segmentation tool powered by AI. For academic and supervised clinical use.",
+            font=("Arial", 8),
+            justify="center",
+        ).pack(pady=5)
 
-                        if spacing_diff > 0.5:  # Solo si la diferencia es >50%
-                            # calcular límites min/max
-                            try:
-                                min_pixdim = tuple(float(p) * 0.75 for p in target_spacing)
-                                max_pixdim = tuple(float(p) * 1.25 for p in target_spacing)
-                            except Exception:
-                                min_pixdim = None
-                                max_pixdim = None
-                            transforms_list.append(
-                                Spacingd(
-                                    keys="image",
-                                    pixdim=target_spacing,
-                                    mode="bilinear",
-                                    min_pixdim=min_pixdim,
-                                    max_pixdim=max_pixdim,
-                                )
-                            )
-                            self._log(
-                                f"   📏 Applying resampling: {current_spacing} → {target_spacing} (min={min_pixdim}, max={max_pixdim})"
-                            )
-                        else:
-                            self._log(
-                                f"   📏 Spacing similar, skipping resampling (diff: {spacing_diff:.2f})"
-                            )
-                    
-                    # Normalización de intensidad.  Para CT utilizamos un
-                    # rango amplio [-1000, 2000] para capturar tejidos blandos
-                    # y óseos.  Ajustamos a [0, 1] y limitamos valores fuera
-                    # del rango.
-                    transforms_list.extend(
-                        [
-                            ScaleIntensityRanged(
-                                keys="image",
-                                a_min=-1000.0,
-                                a_max=2000.0,
-                                b_min=0.0,
-                                b_max=1.0,
-                                clip=True,
-                            ),
-                            ToTensord(keys="image"),
-                        ]
-                    )
+        # Provide a clear Close button in English
+        ttk.Button(about, text="Close", command=about.destroy).pack(pady=10)
 
-                    self.pre_transforms = Compose(transforms_list)
-                    
-                    # Siempre aplicamos Invertd para revertir orientación y
-                    # recorte; si además hay resampling, Invertd también
-                    # restaurará el spacing original.  Usamos los mismos
-                    # argumentos independientemente de apply_spacing.
-                    self.post_transforms = Invertd(
-                        keys="pred",
-                        transform=self.pre_transforms,
-                        orig_keys="image",
-                        meta_key_postfix="meta_dict",
-                        nearest_interp=True,
-                        to_tensor=False,
-                    )
-                    
-                    # Aplicar transformaciones
-                    sample = self.pre_transforms(sample)
-                    img = sample["image"].unsqueeze(0).to(self.device)
-                    meta = sample["image_meta_dict"]
-                    
-                    self._log(f"✔ Manual configuration {i+1} successful")
-                    applied_config = config
-                    break
-                    
-                except Exception as e:
-                    self._log(f"⚠ Manual configuration {i+1} failed: {e}")
-                    continue
-            
-            if applied_config is None:
-                raise RuntimeError("Todas las configuraciones de transformación fallaron")
+    # ------------------------------------------------------------------
+    # Menu para seleccionar resolución
+    # ------------------------------------------------------------------
+    def _choose_resolution(self):
+        """Allow the user to change the model resolution."""
+        win = tk.Toplevel(self)
+        win.title("Choose model resolution")
+        win.geometry("300x200")
 
-        # Inference
-        self._log("⏳ Running sliding-window inference...")
-        self._log(f"📊 Input tensor shape: {img.shape}")
-        
-        with torch.no_grad():
-            # Utilizamos un tamaño de ventana deslizante más grande (64^3) para
-            # capturar estructuras anatómicas de mayor tamaño.  Esto se alinea
-            # con las recetas de Auto3DSeg donde se emplean ventanas de 96x96x96
-            # o mayores para volumetrías de cuerpo entero.  Ajusta este valor
-            # según la memoria disponible.  El superposición se mantiene al
-            # 50 % para suavizar las transiciones.
-            logits = sliding_window_inference(
-                img,
-                roi_size=(64, 64, 64),
-                sw_batch_size=1,
-                predictor=self.model,
-                overlap=0.5,
-            )
-        self._log("✔ Inference completed")
+        var = tk.StringVar(value='1.5' if self.highres else '3')
+        tk.Label(win, text="Select model resolution:").pack(pady=10)
+        tk.Radiobutton(win, text="High (1.5 mm)", variable=var, value='1.5').pack(anchor="w", padx=20)
+        tk.Radiobutton(win, text="Low (3 mm)", variable=var, value='3').pack(anchor="w", padx=20)
+        tk.Button(win, text="Confirm", command=lambda: self._set_resolution(var.get(), win)).pack(pady=10)
 
-        pred = torch.argmax(logits, dim=1).cpu().numpy()[0]
-        self._log(f"📊 Initial prediction shape: {pred.shape}")
+    def _set_resolution(self, value: str, window: tk.Toplevel):
+        self.highres = (value == '1.5')
+        self._log(f"🔧 Resolution selected: {'1.5 mm' if self.highres else '3 mm'}")
+        window.destroy()
 
-        # Almacenar forma original del volumen para referencia
-        if using_pre:
-            # Recuperar forma original de la metadata
-            try:
-                original_shape = meta.get("spatial_shape", tensor_vol.shape[1:] if 'tensor_vol' in locals() else None)
-            except:
-                original_shape = None
-        else:
-            original_shape = tensor_vol.shape[1:]  # (Z, Y, X)
+    # ------------------------------------------------------------------
+    # Tema de la aplicación
+    # ------------------------------------------------------------------
+    def apply_theme(self):
+        """
+        Aplica los colores definidos en el tema actual a los widgets principales.
+        Cambia los colores de fondo y primer plano de los elementos de la
+        interfaz.  Este método puede invocarse después de cambiar
+        `self.style_name` para actualizar dinámicamente la apariencia.
+        """
+        theme = THEME_OPTIONS.get(self.style_name, THEME_OPTIONS["azure"])
+        bg = theme["bg"]
+        fg = theme["fg"]
+        accent = theme["accent"]
 
-        # Apply inverse transformation and smart resizing if necessary
-        if self.post_transforms is not None:
-            try:
-                self._log("🔄 Applying inverse transformation...")
-                d_in = {
-                    "pred": pred[np.newaxis, ...],        # (C=1, Z, Y, X)
-                    "image": sample["image"],             # tensor post-pre
-                    "image_meta_dict": meta,              # meta post-pre
-                    "pred_meta_dict": deepcopy(meta),     # requerido por Invertd
-                }
-                inv = self.post_transforms(d_in)
-                pred = np.asarray(inv["pred"][0])  # quitar canal
-                self._log(f"✔ Inverse transformation applied, new shape: {pred.shape}")
-            except Exception as e:
-                self._log(f"⚠ Inverse transformation failed: {e}")
-                self._log("🔧 Trying smart resizing...")
-                
-                if original_shape is not None:
-                    pred = smart_resize_prediction(pred, original_shape)
-                    self._log(f"✔ Smart resizing applied: {pred.shape}")
-        else:
-            # No inverse transformation, check if smart resizing is needed
-            if original_shape is not None and pred.shape != original_shape:
-                self._log(f"🔧 No inverse transformation, applying smart resizing...")
-                pred = smart_resize_prediction(pred, original_shape)
+        # Configurar raíz
+        self.configure(bg=bg)
 
-        # Apply axis inversions according to user configuration
+        # Configurar ttk estilos
         try:
-            if self.flip_si:
-                pred = np.flip(pred, axis=0)
-            if self.flip_ap:
-                pred = np.flip(pred, axis=1)
-            if self.flip_lr:
-                pred = np.flip(pred, axis=2)
-            if self.flip_lr or self.flip_ap or self.flip_si:
-                self._log("🔁 Axis inversions applied to the segmentation")
-        except Exception as e:
-            self._log(f"⚠ Error applying axis inversions: {e}")
+            self.style.theme_use('default')
+        except Exception:
+            pass
+        # Asignar colores genéricos a todos los widgets
+        self.style.configure('.', background=bg, foreground=fg, font=("Segoe UI", 10))
+        self.style.configure('TButton', background=theme['button_bg'], foreground=theme['button_fg'], borderwidth=1)
+        self.style.map('TButton', background=[('active', theme['accent'])], foreground=[('active', theme['button_fg'])])
+        self.style.configure('TLabel', background=bg, foreground=fg)
+        self.style.configure('TLabelframe', background=bg, foreground=fg)
+        self.style.configure('TLabelframe.Label', background=bg, foreground=fg)
+        self.style.configure('TFrame', background=bg, foreground=fg)
+        self.style.configure('TCheckbutton', background=bg, foreground=fg)
+        self.style.configure('TMenubutton', background=bg, foreground=fg)
+        self.style.configure('TProgressbar', troughcolor=bg, background=theme['progress_fg'])
 
-        # Construir máscaras solo para órganos presentes
-        unique_idxs = set(np.unique(pred))
-        masks: dict[str, np.ndarray] = {}
-        
-        self._log(f"📊 Unique indices found: {sorted(unique_idxs)}")
-        
-        for name, idx in self.labels_map.items():
-            # Omite órganos no seleccionados por el usuario
-            if self.organs and name not in self.organs:
-                continue
-            
-            # Si el índice no aparece en la predicción, saltamos
-            if idx not in unique_idxs:
-                continue
-                
+        # Configurar widgets Tk (no ttk) manualmente
+        # Entradas, botones y texto
+        for widget in [self.in_entry, self.out_entry, self.btn_one, self.btn_all, self.footer_label, self.log]:
             try:
-                mask = (pred == idx)  # booleano
-                pixel_count = int(mask.sum())
+                widget.configure(bg=bg, fg=fg, insertbackground=fg)
+            except Exception:
+                pass
 
-                # Opcionalmente aplicar operaciones morfológicas para
-                # eliminar agujeros y pequeñas componentes desconectadas.
-                if self.clean_masks and pixel_count > 0:
-                    try:
-                        # Importar scipy.ndimage solo cuando sea necesario
-                        import scipy.ndimage as _ndi  # type: ignore
-                        # Rellenar agujeros dentro del órgano
-                        filled = _ndi.binary_fill_holes(mask)
-                        # Etiquetar componentes conectados
-                        labels, num = _ndi.label(filled)
-                        if num > 0:
-                            # Seleccionar la mayor componente
-                            counts = np.bincount(labels.flatten())
-                            # La etiqueta 0 es fondo; ignorarla
-                            if counts.size > 1:
-                                largest_label = int(np.argmax(counts[1:]) + 1)
-                                mask = (labels == largest_label)
-                                pixel_count = int(mask.sum())
-                            else:
-                                mask = filled
-                                pixel_count = int(mask.sum())
-                    except Exception:
-                        # Si scipy no está disponible o falla, se usa la máscara original
-                        pass
-
-                    if pixel_count > 0:
-                        masks[name] = mask
-                        # Report mask details in English
-                        self._log(
-                            f"✔ Mask for {name}: {mask.shape}, {pixel_count} pixels"
-                        )
+        # Log específico: cambiar color de fondo y texto
+        self.log.configure(background=bg, foreground=fg)
 
-            except Exception as e:
-                self._log(f"⚠ Error building mask for {name}: {e}")
-                continue
-        
-        self._log(f"📋 Total masks generated: {len(masks)}")
-        return masks
+        # Actualizar recursivamente contenedores
+        def update_children(w):
+            for child in w.winfo_children():
+                try:
+                    # Cambiar color de fondo de widgets Tk heredados
+                    if isinstance(child, (tk.Frame, tk.LabelFrame)):
+                        child.configure(bg=bg)
+                    elif isinstance(child, tk.Label):
+                        child.configure(bg=bg, fg=fg)
+                    elif isinstance(child, tk.Button):
+                        child.configure(bg=theme['button_bg'], fg=theme['button_fg'], activebackground=accent)
+                except Exception:
+                    pass
+                update_children(child)
+        update_children(self)
+
+    def _choose_theme(self):
+        """Display a window to select the UI theme."""
+        win = tk.Toplevel(self)
+        win.title("Select theme")
+        win.geometry("250x200")
+        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
+
+        var = tk.StringVar(value=self.style_name)
+        tk.Label(
+            win,
+            text="Interface theme:",
+            bg=THEME_OPTIONS[self.style_name]['bg'],
+            fg=THEME_OPTIONS[self.style_name]['fg'],
+        ).pack(pady=10)
+        for name in THEME_OPTIONS.keys():
+            ttk.Radiobutton(win, text=name.capitalize(), variable=var, value=name).pack(anchor="w", padx=20, pady=2)
+        ttk.Button(win, text="Confirm", command=lambda: self._set_theme(var.get(), win)).pack(pady=10)
+
+    def _set_theme(self, value: str, window: tk.Toplevel):
+        """Establece el tema actual y actualiza la interfaz."""
+        self.style_name = value
+        self.apply_theme()
+        window.destroy()
+        self._log(f"🎨 Theme selected: {value}")
+
+        # Guardar configuración actualizada
+        self._save_config()
 
     # ------------------------------------------------------------------
-    # Segmentación con TotalSegmentator V2
+    # Opciones de orientación (flip) de la tomografía
     # ------------------------------------------------------------------
-    def _segment_totalseg(self, series_files):
-        """Realiza la segmentación usando TotalSegmentator V2.
+    def _choose_orientation(self):
+        """Window to select axis inversions for the CT volume."""
+        win = tk.Toplevel(self)
+        win.title("Orientation options")
+        win.geometry("300x220")
+        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
 
-        Esta función se activa cuando `self.model_type` es 'totalseg'.  Se
-        intenta importar la API de TotalSegmentator y se ejecuta la
-        segmentación en la carpeta que contiene los cortes DICOM.  La
-        salida es un diccionario de máscaras binarias indexado por nombre
-        de órgano.  En caso de cualquier error (por ejemplo si la
-        biblioteca no está instalada) se devuelve un diccionario vacío.
-        """
-        self._last_seg_spacing = None
-        if not series_files:
-            self._log("?? No files were provided for segmentation")
-            return {}
+        tk.Label(
+            win,
+            text="Flip volume axes (select those that apply)",
+            bg=THEME_OPTIONS[self.style_name]['bg'],
+            fg=THEME_OPTIONS[self.style_name]['fg'],
+        ).pack(pady=10)
 
-        input_dir = os.path.dirname(series_files[0])
+        var_lr = tk.BooleanVar(value=self.flip_lr)
+        var_ap = tk.BooleanVar(value=self.flip_ap)
+        var_si = tk.BooleanVar(value=self.flip_si)
 
-        try:
-            try:
-                from totalsegmentatorv2.python_api import totalsegmentator  # type: ignore
-            except ImportError:
-                from totalsegmentator.python_api import totalsegmentator  # type: ignore
-        except Exception as e:
-            self._log(
-                f"!! Could not import TotalSegmentator: {e}. Make sure to install the package via pip."
-            )
-            return {}
+        ttk.Checkbutton(win, text="Left/right axis (X)", variable=var_lr).pack(anchor="w", padx=20, pady=2)
+        ttk.Checkbutton(win, text="Anterior/posterior axis (Y)", variable=var_ap).pack(anchor="w", padx=20, pady=2)
+        ttk.Checkbutton(win, text="Superior/inferior axis (Z)", variable=var_si).pack(anchor="w", padx=20, pady=2)
 
-        self._ensure_custom_trainer()
+        ttk.Button(
+            win,
+            text="Confirm",
+            command=lambda: self._set_orientation(var_lr.get(), var_ap.get(), var_si.get(), win),
+        ).pack(pady=10)
 
-        # Verificar y descargar modelos si es necesario
-        if not self.totalseg_downloaded:
-            self._log("🔍 Verificando modelos de TotalSegmentator...")
-            try:
-                # Intentar verificar si los modelos están descargados
-                from pathlib import Path
+    def _set_orientation(self, lr: bool, ap: bool, si: bool, window: tk.Toplevel):
+        """Guarda las preferencias de orientación."""
+        self.flip_lr = lr
+        self.flip_ap = ap
+        self.flip_si = si
+        window.destroy()
+        axes = []
+        if lr:
+            axes.append('X')
+        if ap:
+            axes.append('Y')
+        if si:
+            axes.append('Z')
+        self._log(f"🧭 Axis inversions enabled: {', '.join(axes) if axes else 'none'}")
 
-                # TotalSegmentator guarda los modelos en ~/.totalsegmentator
-                model_dir = Path.home() / ".totalsegmentator" / "nnunet" / "results"
+        # Guardar configuración actualizada
+        self._save_config()
 
-                if not model_dir.exists() or not any(model_dir.iterdir()):
-                    self._log("📥 Modelos no encontrados. Descargando...")
-                    self._log("⏱️ Esto puede tardar varios minutos (2-5 GB).")
-                    self._log("💡 La descarga solo ocurre una vez.")
-                else:
-                    self._log("✓ Modelos encontrados en caché local.")
-            except Exception as e:
-                self._log(f"⚠️ No se pudo verificar modelos: {e}")
-                self._log("💡 Se intentará descargar durante la segmentación si es necesario.")
+    # ------------------------------------------------------------------
+    # Alternar el uso del recorte foreground
+    # ------------------------------------------------------------------
+    def _toggle_crop(self):
+        """Toggle the flag to enable or disable automatic body cropping."""
+        self.use_crop = bool(self.use_crop_var.get())
+        state = 'enabled' if self.use_crop else 'disabled'
+        self._log(f"🔧 Automatic body cropping {state}")
 
-        if self.totalseg_task == 'complete' and not self._is_task_enabled('complete'):
-            self._log("⚠ Task 'complete' disabled; skipping segmentation.")
-            return {}
-        if self.totalseg_task != 'complete' and not self._is_task_enabled(self.totalseg_task):
-            self._log(f"⚠ Task '{self.totalseg_task}' disabled; skipping segmentation.")
-            return {}
+        # Guardar configuración actualizada
+        self._save_config()
 
-        fast = not self.highres
-        device_param = 'gpu' if (self.device_preference == 'gpu' and torch.cuda.is_available()) else 'cpu'
+    # ------------------------------------------------------------------
+    # Alternar limpieza de máscaras
+    # ------------------------------------------------------------------
+    def _toggle_clean(self):
+        """Toggle application of morphological operations on the output masks."""
+        self.clean_masks = bool(self.clean_masks_var.get())
+        state = 'enabled' if self.clean_masks else 'disabled'
+        self._log(f"🧹 Mask cleaning {state}")
 
-        progress_started = False
+        # Guardar configuración actualizada
+        self._save_config()
 
-        def run_task(task_name: str, label_map: dict[str, int], selected_organs, allow_roi_subset: bool = True) -> dict[str, np.ndarray]:
-            nonlocal progress_started
-            if not label_map:
-                self._log(f"?? Task '{task_name}' has no labels; skipping.")
-                return {}
+    # ------------------------------------------------------------------
+    # Seleccionar dispositivo (CPU/GPU)
+    # ------------------------------------------------------------------
+    def _choose_device(self):
+        """Allow the user to select between the CPU and any available GPUs."""
+        win = tk.Toplevel(self)
+        win.title("Select device")
+        win.geometry("350x250")
+        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
 
-            if self.cancel_requested:
-                self._log("❌ Segmentation cancelled by user")
-                return {}
+        tk.Label(
+            win,
+            text="Select the device for inference:",
+            bg=THEME_OPTIONS[self.style_name]['bg'],
+            fg=THEME_OPTIONS[self.style_name]['fg'],
+        ).pack(pady=10)
 
-            roi_subset = None
-            # roi_subset only works with 'total' or 'total_mr' tasks in TotalSegmentator
-            if allow_roi_subset and selected_organs and task_name in ('total', 'total_mr'):
-                candidates = [o for o in selected_organs if o in label_map]
-                roi_subset = candidates if candidates else None
-                if roi_subset:
-                    self._log(f"   📋 Requesting {len(roi_subset)} specific organs from task '{task_name}': {roi_subset}")
-            elif allow_roi_subset and selected_organs and task_name not in ('total', 'total_mr'):
-                # For other tasks, we'll filter results after segmentation
-                self._log(f"   📋 Task '{task_name}' will segment all organs, filtering {len(selected_organs)} requested afterwards")
+        # StringVar que almacena la selección actual.  Usamos nombres como
+        # 'cpu' o 'cuda:0', 'cuda:1', etc.  Si ya hay un dispositivo
+        # seleccionado, lo preseleccionamos.
+        current = 'cpu'
+        if isinstance(self.device, torch.device):
+            current = str(self.device)
+        elif isinstance(self.device, str):
+            current = self.device
 
-            try:
-                if not self.totalseg_downloaded and not progress_started:
-                    self._log("=" * 70)
-                    self._log("📥 DESCARGANDO MODELOS DE TOTALSEGMENTATOR")
-                    self._log("=" * 70)
-                    self._log("⏱️ Esto puede tardar 10-30 minutos (descargando ~2-5 GB)")
-                    self._log("💡 Esta descarga solo ocurre una vez")
-                    self._log("🌐 Se requiere conexión a Internet estable")
-                    self._log("☕ Por favor, ten paciencia...")
-                    self._log("=" * 70)
-                    self.after(0, self._indeterminate, True)
-                    progress_started = True
+        var = tk.StringVar(value=current)
 
-                task_fast = fast
-                if task_name in TASKS_REQUIRING_FULL and fast:
-                    task_fast = False
-                    self._log(f"⚙ Task '{task_name}' requires full mode; running without fast optimisations.")
+        # Opción para CPU siempre disponible
+        ttk.Radiobutton(win, text="CPU", variable=var, value='cpu').pack(anchor="w", padx=20, pady=2)
+
+        # Opciones para GPUs, si están disponibles
+        if torch.cuda.is_available():
+            count = torch.cuda.device_count()
+            for i in range(count):
+                try:
+                    name = torch.cuda.get_device_name(i)
+                except Exception:
+                    name = f"GPU {i}"
+                value = f"cuda:{i}"
+                ttk.Radiobutton(
+                    win,
+                    text=f"GPU {i}: {name}",
+                    variable=var,
+                    value=value
+                ).pack(anchor="w", padx=20, pady=2)
+        else:
+            # Indicate that no GPU is available
+            tk.Label(
+                win,
+                text="No GPUs detected.",
+                bg=THEME_OPTIONS[self.style_name]['bg'],
+                fg=THEME_OPTIONS[self.style_name]['fg'],
+            ).pack(pady=5)
 
-                # Warn user if task doesn't support roi_subset and might take longer
-                if task_name not in ('total', 'total_mr') and selected_organs and not task_fast:
-                    self._log(f"⏱️ Note: Task '{task_name}' must process all organs (TotalSegmentator limitation)")
-                    self._log(f"   This may take several minutes. Results will be filtered to your selection.")
+        ttk.Button(
+            win,
+            text="Confirm",
+            command=lambda: self._set_device(var.get(), win),
+        ).pack(pady=15)
 
-                self._log(f"🔄 Running TotalSegmentator V2 task '{task_name}'{' (full mode)' if not task_fast else ''}...")
-                orig_stdout = sys.stdout
-                orig_stderr = sys.stderr
-                dummy_stream = io.StringIO()
+    def _set_device(self, value: str, window: tk.Toplevel):
+        """Establece el dispositivo seleccionado y mueve el modelo si es necesario."""
+        try:
+            # Crear objeto torch.device a partir de la selección
+            new_device = torch.device(value)
+            # Si el dispositivo no está disponible, se mantendrá el actual
+            if new_device.type == 'cuda' and not torch.cuda.is_available():
+                messagebox.showerror("Error", "No GPU is available for selection.")
+                window.destroy()
+                return
+            self.device = new_device
+            # Mover el modelo cargado, si existe
+            if self.model is not None:
                 try:
-                    if orig_stdout is None:
-                        sys.stdout = dummy_stream
-                    if orig_stderr is None:
-                        sys.stderr = dummy_stream
-                    seg_img = totalsegmentator(
-                        input_dir,
-                        None,
-                        ml=True,
-                        fast=task_fast,
-                        roi_subset=roi_subset,
-                        device=device_param,
-                        task=task_name,
-                        quiet=True,
-                    )
-                finally:
-                    sys.stdout = orig_stdout
-                    sys.stderr = orig_stderr
-                header = getattr(seg_img, 'header', None)
-                if header is not None:
-                    try:
-                        zooms = header.get_zooms()
-                    except Exception:
-                        zooms = None
-                    if zooms and len(zooms) >= 3:
-                        self._last_seg_spacing = (float(zooms[2]), float(zooms[1]), float(zooms[0]))
-            except Exception as e:
-                msg = str(e)
-                if 'Unable to locate trainer class' in msg or 'nnUNetTrainer_4000epochs_NoMirroring' in msg:
-                    self._log(
-                        "?? TotalSegmentator failed due to a missing nnUNet trainer class. "
-                        "This may indicate that your installation of nnunetv2 or TotalSegmentator is outdated. "
-                        "Please upgrade TotalSegmentator and nnunetv2 using pip (for example, `pip install --upgrade totalsegmentatorv2 nnunetv2`) "
-                        "or ensure that the fallback trainer file could be created in your Python environment."
-                    )
-                else:
-                    self._log(f"!! Error running TotalSegmentator task '{task_name}': {e}")
-                self._log(traceback.format_exc())
-                return {}
+                    self.model = self.model.to(self.device)
+                except Exception as e:
+                    # Warn if the model could not be moved to the selected device
+                    self._log(f"⚠ Could not move the model to the new device: {e}")
+            # Registrar selección y establecer device_preference para TotalSegmentator
+            if self.device.type == 'cuda':
+                # Extract index and report
+                idx = 0
+                try:
+                    idx = int(str(self.device).split(':')[1])
+                    name = torch.cuda.get_device_name(idx)
+                    self._log(f"🔧 Device selected: GPU {idx} ({name})")
+                except Exception:
+                    self._log(f"🔧 Device selected: {self.device}")
+                # For TotalSegmentator use 'gpu' if at least one GPU is present
+                self.device_preference = 'gpu'
+            else:
+                self._log("🔧 Device selected: CPU")
+                self.device_preference = 'cpu'
 
-            self.totalseg_downloaded = True
+            # Save the updated configuration
+            self._save_config()
+        except Exception as e:
+            # Catch any error that occurs during device selection
+            self._log(f"❌ Error selecting device: {e}")
+        finally:
+            # Always destroy the selection window
+            window.destroy()
 
-            try:
-                seg_data = seg_img.get_fdata().astype(np.uint16)  # type: ignore
-            except Exception:
-                try:
-                    seg_data = np.asarray(seg_img).astype(np.uint16)  # type: ignore
-                except Exception as ex:
-                    self._log(f"!! Could not convert the result of TotalSegmentator to numpy: {ex}")
-                    return {}
+    # ------------------------------------------------------------------
+    # Ajustar margen de recorte
+    # ------------------------------------------------------------------
+    def _choose_crop_margin(self):
+        """Display a window to adjust the crop margin in voxels."""
+        win = tk.Toplevel(self)
+        win.title("Adjust crop margin")
+        win.geometry("300x180")
+        win.configure(bg=THEME_OPTIONS[self.style_name]['bg'])
+        tk.Label(
+            win,
+            text="Specify the crop margin (voxels):",
+            bg=THEME_OPTIONS[self.style_name]['bg'],
+            fg=THEME_OPTIONS[self.style_name]['fg'],
+        ).pack(pady=10)
+        # Utilizamos un IntVar para el margen
+        margin_var = tk.IntVar(value=self.crop_margin)
+        spin = tk.Spinbox(win, from_=0, to=100, textvariable=margin_var, width=5)
+        spin.pack(pady=5)
+        ttk.Button(
+            win,
+            text="Confirm",
+            command=lambda: self._set_crop_margin(margin_var.get(), win),
+        ).pack(pady=10)
 
-            if seg_data.ndim == 3:
-                pred = np.transpose(seg_data, (2, 1, 0))
-            else:
-                pred = seg_data
+    def _set_crop_margin(self, value: int, window: tk.Toplevel):
+        """Establece un nuevo margen de recorte para el foreground."""
+        try:
+            v = int(value)
+            if v < 0:
+                raise ValueError("The margin must be a non‑negative number")
+            self.crop_margin = v
+            self._log(f"🔧 Crop margin adjusted to {v} voxels")
+            # Guardar configuración actualizada
+            self._save_config()
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not adjust the margin: {e}")
+        finally:
+            window.destroy()
 
-            try:
-                if self.flip_si:
-                    pred = np.flip(pred, axis=0)
-                if self.flip_ap:
-                    pred = np.flip(pred, axis=1)
-                if self.flip_lr:
-                    pred = np.flip(pred, axis=2)
-                if self.flip_lr or self.flip_ap or self.flip_si:
-                    self._log("?? Axis inversions applied to the segmentation")
-            except Exception as axis_error:
-                self._log(f"?? Error applying axis inversions: {axis_error}")
-
-            unique_idxs = set(np.unique(pred))
-            self._log(f"?? Unique indices found (task '{task_name}'): {sorted(unique_idxs)}")
-
-            masks: dict[str, np.ndarray] = {}
-            selected_set = None if selected_organs is None else set(selected_organs)
-            for name, idx in label_map.items():
-                if selected_set is not None and name not in selected_set:
-                    continue
-                if idx not in unique_idxs:
-                    continue
-                try:
-                    mask = (pred == idx)
-                    pixel_count = int(mask.sum())
-                    if pixel_count <= 0:
-                        continue
-                    if self.clean_masks:
-                        try:
-                            import scipy.ndimage as _ndi  # type: ignore
-                            filled = _ndi.binary_fill_holes(mask)
-                            labels_, num = _ndi.label(filled)
-                            if num > 0:
-                                counts = np.bincount(labels_.flatten())
-                                if counts.size > 1:
-                                    largest_label = int(np.argmax(counts[1:]) + 1)
-                                    mask = (labels_ == largest_label)
-                                    pixel_count = int(mask.sum())
-                                else:
-                                    mask = filled
-                                    pixel_count = int(mask.sum())
-                        except Exception:
-                            pass
-                    mask = self._smooth_mask(mask, self._last_seg_spacing)
-                    pixel_count = int(mask.sum())
-                    masks[name] = mask
-                    self._log(f"?? Mask for {name} (task '{task_name}'): {mask.shape}, {pixel_count} pixels")
-                except Exception as build_error:
-                    self._log(f"?? Error building mask for {name} (task '{task_name}'): {build_error}")
-                    continue
+    # ------------------------------------------------------------------
+    # Seleccionar tipo de modelo
+    # ------------------------------------------------------------------
+    def _choose_model_type(self):
+        """Muestra una ventana para seleccionar entre SegResNet y TotalSegmentator.
 
-            return masks
+        Al cambiar el tipo de modelo se actualiza ``self.model_type``, se
+        invalidan los pesos actuales y se lanza la carga del nuevo
+        modelo (o la preparación de TotalSegmentator) en un hilo
+        separado.
+        """
+        win = tk.Toplevel(self)
+        win.title("Tipo de modelo")
+        win.geometry("350x180")
 
-        # NUEVO: Sistema unificado - usar task_assignments
-        selection = list(self.organs)
-        masks: dict[str, np.ndarray] = {}
+        var = tk.StringVar(value=self.model_type)
+        options = [
+            ("SegResNet (MONAI)", "segresnet"),
+            ("TotalSegmentator V2", "totalseg"),
+        ]
 
-        # Obtener asignaciones de tasks (calculadas en selector unificado)
-        task_assignments = getattr(self, '_task_assignments', {})
+        ttk.Label(win, text="Selecciona el tipo de modelo:").pack(anchor="w", padx=10, pady=(10, 5))
+        for text, value in options:
+            ttk.Radiobutton(win, text=text, variable=var, value=value).pack(anchor="w", padx=20, pady=2)
 
-        if not task_assignments:
-            # Fallback: si no hay asignaciones (configuración antigua), usar órganos seleccionados
-            if not selection:
-                self._log("⚠ No organs selected; skipping segmentation.")
-                return {}
+        def confirm():
+            new_type = var.get()
+            if new_type != self.model_type:
+                self.model_type = new_type
+                # Registrar en el log
+                if self.model_type == "segresnet":
+                    self._log("🔧 Tipo de modelo seleccionado: SegResNet (MONAI)")
+                else:
+                    self._log("🔧 Tipo de modelo seleccionado: TotalSegmentator V2")
+                # Reiniciar estado del modelo
+                self.ready = False
+                self.model = None
+                # Cargar o preparar el modelo en nuevo hilo
+                self._load_model_thread()
+            win.destroy()
 
-            # Calcular task_assignments automáticamente
-            organ_to_tasks = build_organ_to_tasks_map(TOTALSEG_TASK_LABELS)
-            task_assignments = compute_required_tasks(set(selection), organ_to_tasks, TOTALSEG_TASK_LABELS)
-            self._log(f"📦 Auto-calculated {len(task_assignments)} tasks from organ selection")
+        ttk.Button(win, text="Confirmar", command=confirm).pack(pady=15)
 
-        # Envolver en try-finally para asegurar que la barra de progreso siempre se detenga
-        try:
-            # Ejecutar solo las tasks necesarias
-            for task_name, requested_organs in task_assignments.items():
-                # Verificar si la tarea está habilitada
-                if not self._is_task_enabled(task_name):
-                    self._log(f"⚠ Task '{task_name}' is disabled, skipping {len(requested_organs)} organs")
-                    continue
+    # ------------------------------------------------------------------
+    # Browse
+    # ------------------------------------------------------------------
+    def _browse(self, entry: tk.Entry):
+        path = filedialog.askdirectory()
+        if path:
+            entry.delete(0, tk.END)
+            entry.insert(0, path)
+            # Guardar configuración actualizada
+            self._save_config()
 
-                self._log(f"🔄 Running task '{task_name}' for {len(requested_organs)} organs...")
+    # ------------------------------------------------------------------
+    # Carga de modelo
+    # ------------------------------------------------------------------
+    def _load_model_thread(self):
+        self._indeterminate(True)
+        threading.Thread(target=self._load_model, daemon=True).start()
 
-                label_map = TOTALSEG_TASK_LABELS.get(task_name, {})
-                if not label_map:
-                    self._log(f"⚠ Task '{task_name}' not available, skipping")
-                    continue
+    # ------------------------------------------------------------------
+    # Selección de órganos (SISTEMA UNIFICADO)
+    # ------------------------------------------------------------------
+    def _select_organs(self):
+        """Nuevo método que usa el selector unificado."""
+        if not self.ready:
+            messagebox.showerror("Error", "Please load the model first.")
+            return
 
-                # Ejecutar segmentación solo para órganos solicitados
-                requested_list = list(requested_organs)
-                task_masks = run_task(task_name, label_map, requested_list)
+        def on_selection_complete(selected_organs: set[str],
+                                 task_assignments: dict[str, set[str]]):
+            """Callback cuando el usuario confirma selección."""
+            self.organs = list(selected_organs)
+            self._task_assignments = task_assignments  # Nuevo atributo
 
-                # Agregar máscaras al resultado
-                for organ, mask in task_masks.items():
-                    if organ not in masks:
-                        masks[organ] = mask
+            # Log informativo
+            self._log(f"🔖 Selected {len(selected_organs)} organs")
+            self._log(f"📦 Will execute {len(task_assignments)} tasks:")
+            for task, organs in task_assignments.items():
+                self._log(f"   • {task}: {len(organs)} organs")
 
-            body_map = TOTALSEG_TASK_LABELS.get('body', {})
-            body_labels = set(body_map.keys()) if body_map else {"body", "body_trunc", "body_extremities", "skin"}
-            selection_set = set(selection)
-            missing_body = {name for name in selection_set if name in body_labels and name not in masks}
-            if missing_body and self.totalseg_task not in {'body', 'body_mr'}:
-                if body_map and self._is_task_enabled('body'):
-                    self._log("?? Appending body segmentation results to satisfy body/skin selections")
-                    body_masks = run_task('body', body_map, None, allow_roi_subset=False)
-                    for name, mask in body_masks.items():
-                        if name in missing_body and name not in masks:
-                            masks[name] = mask
-                elif body_map and missing_body:
-                    self._log("⚠ Body task disabled; skipping generation of body-related masks.")
-                elif not body_map:
-                    self._log("?? Body task labels are not available; skipping body task")
+            self._save_config()
+
+        UnifiedOrganSelector(
+            self,
+            TOTALSEG_TASK_LABELS,
+            set(self.organs),
+            on_selection_complete,
+            task_cost=self._task_cost_function(),
+        )
+
+    # ------------------------------------------------------------------
+    # Thread wrappers
+    # ------------------------------------------------------------------
+    def _run_all_thread(self):
+        if not self._validate_paths():
+            return
+        self.cancel_requested = False
+        self._indeterminate(True)
+        self.btn_cancel.config(state="normal")
+        self.btn_one.config(state="disabled")
+        self.btn_all.config(state="disabled")
+        threading.Thread(target=self._thread_wrapper, args=(self._process_all,), daemon=True).start()
 
-            self._ensure_body_related_masks(masks, selection_set)
+    def _run_one_thread(self):
+        if not self._validate_paths():
+            return
+        self.cancel_requested = False
+        self._indeterminate(True)
+        self.btn_cancel.config(state="normal")
+        self.btn_one.config(state="disabled")
+        self.btn_all.config(state="disabled")
+        threading.Thread(target=self._thread_wrapper, args=(self._process_one,), daemon=True).start()
 
-            # Fusionar automáticamente los lóbulos pulmonares
-            self._merge_lung_lobes(masks)
+    def _thread_wrapper(self, func):
+        try:
+            func()
+        except Exception as e:  # pragma: no cover
+            self._log(f"❌ Error en hilo de procesamiento: {str(e)}")
+            self._log(traceback.format_exc())
         finally:
-            # Asegurar que la barra de progreso siempre se detenga
-            if progress_started:
-                self.after(0, self._indeterminate, False)
+            self.after(0, self._indeterminate, False)
+            self.after(0, lambda: self.btn_cancel.config(state="disabled"))
+            self.after(0, lambda: self.btn_one.config(state="normal"))
+            self.after(0, lambda: self.btn_all.config(state="normal"))
+            self.cancel_requested = False
+
+    def _cancel_process(self):
+        """Cancel the currently running segmentation process."""
+        self.cancel_requested = True
+        self._log("⚠️ Cancellation requested by user. Stopping process...")
+        self.btn_cancel.config(state="disabled")
 
-        self._log(f"?? Total masks generated: {len(masks)}")
-        return masks
     # ------------------------------------------------------------------
-    # Guardar RTSTRUCT mejorado
+    # Validación de paths
     # ------------------------------------------------------------------
-    def _save_rt(self, folder: str, masks: dict, name: str, series_files=None):
-        try:
-            # Sanitizar el nombre para evitar caracteres ilegales en rutas
-            safe_name = sanitize_filename(name)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            odir = os.path.join(self.out_entry.get(), f"{safe_name}_{timestamp}")
-            os.makedirs(odir, exist_ok=True)
-            # Log the output directory so the user knows where files will be written
-            self._log(f"📂 Output directory: {odir}")
-
-            # Copiar CTs
-            ct_dst = os.path.join(odir, "CT")
-            os.makedirs(ct_dst, exist_ok=True)
-            # Inform the user that we are copying the DICOM CT files into the RTSTRUCT folder
-            self._log(f"📥 Copying CT slices from {folder} to {ct_dst}...")
-
-            if series_files is None:
-                series_files = self._collect_ct_series(folder)
-
-            for src in series_files:
-                fname = os.path.basename(src)
-                dst = os.path.join(ct_dst, fname)
-                shutil.copy2(src, dst)
+    def _validate_paths(self):
+        folder = self.in_entry.get().strip()
+        outdir = self.out_entry.get().strip()
 
-            if not os.listdir(ct_dst):
-                # Abort if no slices were copied
-                self._log("❌ Error: No DICOM slices were copied. Aborting RTSTRUCT.")
-                return False
+        if not folder or not outdir:
+            messagebox.showerror("Error", "Please select input and output folders.")
+            return False
 
-            self._log(f"✔ {len(series_files)} CT slices copied to {ct_dst}")
+        if not os.path.isdir(folder):
+            messagebox.showerror("Error", f"The input folder does not exist:\n{folder}")
+            return False
 
-            # Create an RTSTRUCT on top of the newly copied series
-            self._log("🛠 Creating RTSTRUCT...")
+        if not os.path.isdir(outdir):
             try:
-                rtstruct = RTStructBuilder.create_new(dicom_series_path=ct_dst)
-                self._log("✔ RTStructBuilder initialized successfully")
+                os.makedirs(outdir, exist_ok=True)
             except Exception as e:
-                # Report failure to create the RTSTRUCT
-                self._log(f"❌ Error creating RTStructBuilder: {str(e)}")
+                messagebox.showerror("Error", f"Could not create the output folder:\n{outdir}\nError: {e}")
                 return False
+        return True
 
-            # Determinar forma esperada para máscaras
-            sample_ds = pydicom.dcmread(series_files[0], stop_before_pixels=True)
-            num_slices = len(series_files)
-            rows = int(sample_ds.Rows)
-            cols = int(sample_ds.Columns)
-            expected_rt_shape = (rows, cols, num_slices)
-            # Log the expected mask shape used by RTSTRUCT (Rows, Cols, Slices)
-            self._log(f"📐 Expected shape for RT masks (Rows,Cols,Slices): {expected_rt_shape}")
-
-            rois_added = 0
-            MIN_PIXELS = 5
-
-            for lbl, mask in masks.items():
-                if mask.sum() < MIN_PIXELS:
-                    # Skip masks that are too small to be meaningful
-                    self._log(f"⚠ {lbl}: mask too small ({mask.sum()} < {MIN_PIXELS}), skipping")
-                    continue
-
-                # Intentar diferentes estrategias de conversión de forma
-                mask_for_rt = None
-                conversion_successful = False
-
-                # Estrategia 1: Formas estándar conocidas
-                if mask.shape == (num_slices, rows, cols):
-                    mask_for_rt = np.transpose(mask, (1, 2, 0))  # (Z,Y,X) -> (Y,X,Z)
-                    self._log(f"  - {lbl}: Standard transpose {mask.shape} → {mask_for_rt.shape}")
-                    conversion_successful = True
-                elif mask.shape == expected_rt_shape:
-                    mask_for_rt = mask
-                    self._log(f"  - {lbl}: Correct shape {mask.shape}")
-                    conversion_successful = True
-                elif mask.ndim == 3:
-                    # Estrategia 2: Intentar diferentes transposiciones
-                    possible_transposes = [
-                        (0, 1, 2),  # sin cambio
-                        (1, 2, 0),  # (Z,Y,X) -> (Y,X,Z)
-                        (2, 1, 0),  # (Z,Y,X) -> (X,Y,Z)
-                        (0, 2, 1),  # (Z,Y,X) -> (Z,X,Y)
-                        (1, 0, 2),  # (Z,Y,X) -> (Y,Z,X)
-                        (2, 0, 1),  # (Z,Y,X) -> (X,Z,Y)
-                    ]
-                    
-                    for perm in possible_transposes:
-                        try:
-                            test_shape = tuple(mask.shape[i] for i in perm)
-                            if test_shape == expected_rt_shape:
-                                mask_for_rt = np.transpose(mask, perm)
-                                self._log(f"  - {lbl}: Successful transpose {mask.shape} → {mask_for_rt.shape} (perm: {perm})")
-                                conversion_successful = True
-                                break
-                        except Exception:
-                            continue
-                
-                # Estrategia 3: Redimensionado inteligente si no coincide
-                if not conversion_successful and mask.ndim == 3:
-                    self._log(f"  - {lbl}: Trying smart resizing {mask.shape} → {expected_rt_shape}")
-                    try:
-                        mask_for_rt = smart_resize_prediction(mask.astype(np.uint8), expected_rt_shape)
-                        if mask_for_rt.shape == expected_rt_shape:
-                            conversion_successful = True
-                            self._log(f"  - {lbl}: Resizing successful")
-                        else:
-                            self._log(f"  - {lbl}: Resizing failed, resulting shape: {mask_for_rt.shape}")
-                    except Exception as e:
-                        self._log(f"  - {lbl}: Error during resizing: {e}")
-
-                if not conversion_successful:
-                    self._log(f"❌ {lbl}: Could not convert shape {mask.shape} to {expected_rt_shape}, skipping")
-                    continue
-
-                # Verificar que la máscara convertida tenga contenido
-                if mask_for_rt.sum() < MIN_PIXELS:
-                    self._log(f"⚠ {lbl}: converted mask too small ({mask_for_rt.sum()} < {MIN_PIXELS}), skipping")
-                    continue
-
-                # Preparar máscara para rt_utils
-                mask_bool = np.ascontiguousarray(mask_for_rt.astype(np.bool_))
-                rgb = get_organ_color(lbl)
-                color = [int(c) for c in rgb]
-
-                try:
-                    rtstruct.add_roi(
-                        mask=mask_bool,
-                        name=dicom_safe_name(lbl),
-                        color=color,
-                    )
-                    rois_added += 1
-                    self._log(f"✔ ROI {lbl} added successfully ({mask_bool.sum()} pixels)")
-                except Exception as e:
-                    self._log(f"❌ Error adding ROI {lbl}: {str(e)}")
-                    # No mostrar traceback completo para errores de ROI individual
+    # ------------------------------------------------------------------
+    # Progreso
+    # ------------------------------------------------------------------
+    def _indeterminate(self, start: bool):
+        """
+        Start or stop the indeterminate progress bar.
 
-            if rois_added == 0:
-                self._log("⚠ No valid ROIs were added")
-                return False
+        This helper wraps calls to the Tk progress widget in a try/except
+        to avoid crashing if the underlying Tk widgets have already been
+        destroyed (for example, after the user closes the main window).
+        """
+        try:
+            if start:
+                # Switch to indeterminate mode and start the animation
+                self.progress.configure(mode="indeterminate")
+                self.progress.start()
+            else:
+                # Stop the animation and reset back to determinate mode
+                self.progress.stop()
+                self.progress.configure(mode="determinate", value=0)
+        except tk.TclError:
+            # If the widget no longer exists (application has been closed),
+            # silently ignore the error instead of crashing.  This prevents
+            # the "can't invoke winfo" exception seen in crash logs.
+            pass
 
-            output_path = os.path.join(ct_dst, "rtss.dcm")
-            self._log(f"💾 Attempting to save RTSTRUCT to {output_path}...")
-            try:
-                from pydicom.uid import ExplicitVRLittleEndian
-                rtstruct.ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    # ------------------------------------------------------------------
+    # Hooks del motor de procesamiento
+    # ------------------------------------------------------------------
+    def _ui_call(self, func, *args) -> None:
+        self.after(0, func, *args)
 
-                rtstruct.ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
-                rtstruct.ds.is_implicit_VR = False
-                rtstruct.ds.is_little_endian = True
+    def _set_run_enabled(self, enabled: bool) -> None:
+        self.btn_one["state"] = self.btn_all["state"] = "normal" if enabled else "disabled"
 
-                rtstruct.save(output_path)
-                self._log(f"✅ RTSTRUCT saved successfully with {rois_added} ROIs")
-                
-                if os.path.exists(output_path):
-                    file_size = os.path.getsize(output_path) / 1024
-                    self._log(f"📏 RTSTRUCT file size: {file_size:.2f} KB")
-                    if file_size < 10:
-                        self._log("⚠ Warning: The RTSTRUCT file is very small; it may be empty.")
-                    return True
-                else:
-                    self._log("❌ Error: The RTSTRUCT file was not created")
-                    return False
-                    
-            except Exception as e:
-                self._log(f"❌ Error saving RTSTRUCT: {str(e)}")
-                return False
+    def _output_root(self) -> str:
+        return self.out_entry.get()
 
-        except Exception as e:
-            # Manejar cualquier excepción no contemplada en _save_rt
-            self._log(f"‼ Error inesperado en _save_rt: {str(e)}")
-            self._log(traceback.format_exc())
-            return False
+    def _on_progress(self, event: str, **fields) -> None:
+        if event == "batch_start":
+            self._ui_call(lambda: self.progress.configure(mode="determinate", maximum=fields["total"], value=0))
+        elif event == "batch_progress":
+            self._ui_call(lambda: self.progress.configure(value=fields["done"]))
 
     # ------------------------------------------------------------------
     # Configuración persistente
@@ -4437,9 +7608,6 @@ class AutoSegApp(tk.Tk):
         win.bind("<Return>", lambda _event: apply(False))
         win.bind("<Escape>", lambda _event: win.destroy())
 
-    def _is_task_enabled(self, task_name: str) -> bool:
-        return bool(self.task_enabled.get(task_name, False))
-
     def _load_config(self):
         """
         Carga la configuración desde un archivo JSON en el directorio de usuario.
@@ -4452,37 +7620,8 @@ class AutoSegApp(tk.Tk):
                     cfg = json.load(f)
                 # Tema
                 self.style_name = cfg.get('theme', self.style_name)
-                # Orientaciones
-                self.flip_lr = bool(cfg.get('flip_lr', self.flip_lr))
-                self.flip_ap = bool(cfg.get('flip_ap', self.flip_ap))
-                self.flip_si = bool(cfg.get('flip_si', self.flip_si))
-                # Uso de recorte
-                self.use_crop = bool(cfg.get('use_crop', self.use_crop))
-                # Limpieza de máscaras
-                self.clean_masks = bool(cfg.get('clean_masks', self.clean_masks))
-                self.smooth_masks = bool(cfg.get('smooth_masks', self.smooth_masks))
-                method_cfg = cfg.get('smoothing_method', self.smoothing_method)
-                if isinstance(method_cfg, str):
-                    self.smoothing_method = method_cfg.lower()
-                if self.smoothing_method not in {'gaussian', 'morphological'}:
-                    self.smoothing_method = 'gaussian'
-                sigma_cfg = cfg.get('smoothing_sigma_mm', self.smoothing_sigma_mm)
-                try:
-                    self.smoothing_sigma_mm = max(0.5, min(15.0, float(sigma_cfg)))
-                except Exception:
-                    pass
-                default_tasks = {task: (task in DEFAULT_ENABLED_TASKS) for task in TOTALSEG_TASK_KEYS}
-                task_cfg = cfg.get('task_enabled', {})
-                if isinstance(task_cfg, dict):
-                    for task in TOTALSEG_TASK_KEYS:
-                        if task in task_cfg:
-                            self.task_enabled[task] = bool(task_cfg[task])
-                        else:
-                            self.task_enabled[task] = default_tasks[task]
-                else:
-                    self.task_enabled = default_tasks
-                # Margen de recorte
-                self.crop_margin = int(cfg.get('crop_margin', self.crop_margin))
+                # Ajustes de procesamiento
+                self._apply_config(cfg)
                 # Directorios
                 in_dir = cfg.get('in_entry', '')
                 out_dir = cfg.get('out_entry', '')
@@ -4492,49 +7631,6 @@ class AutoSegApp(tk.Tk):
                 if out_dir:
                     self.out_entry.delete(0, tk.END)
                     self.out_entry.insert(0, out_dir)
-                # Dispositivo
-                device_str = cfg.get('device', str(self.device))
-                try:
-                    new_dev = torch.device(device_str)
-                    if new_dev.type == 'cuda' and torch.cuda.is_available():
-                        self.device = new_dev
-                        self.device_preference = 'gpu'
-                    else:
-                        self.device = torch.device('cpu')
-                        self.device_preference = 'cpu'
-                except Exception:
-                    pass
-                # Resolución para TotalSegmentator (highres indica que se utiliza
-                # el modelo de alta resolución; fast=False)
-                self.highres = bool(cfg.get('highres', self.highres))
-                # Indicar si ya se mostró el diálogo de instalación de TotalSegmentator
-                self.totalseg_prompted = bool(cfg.get('totalseg_prompted', self.totalseg_prompted))
-                self.totalseg_task = cfg.get('totalseg_task', self.totalseg_task)
-
-                # NUEVO: Cargar task_assignments
-                task_assignments_cfg = cfg.get('task_assignments', {})
-                if isinstance(task_assignments_cfg, dict):
-                    # Convertir list → set
-                    self._task_assignments = {
-                        task: set(organs) for task, organs in task_assignments_cfg.items()
-                        if isinstance(organs, list)
-                    }
-
-                prefs = cfg.get('organs_by_task', {})
-                if isinstance(prefs, dict):
-                    cleaned: dict[str, list[str]] = {}
-                    for key, organs in prefs.items():
-                        if isinstance(key, str) and isinstance(organs, list):
-                            valid = [str(o) for o in organs if isinstance(o, str)]
-                            if valid:
-                                cleaned[key] = valid
-                    if cleaned:
-                        self.organ_preferences.update(cleaned)
-                else:
-                    legacy_organs = cfg.get('organs')
-                    if isinstance(legacy_organs, list):
-                        key = self._selection_key(model='totalseg', task='total')
-                        self.organ_preferences[key] = [str(o) for o in legacy_organs if isinstance(o, str)]
                 # Actualizar variables de checkbuttons
                 try:
                     self.use_crop_var.set(self.use_crop)
@@ -4570,11 +7666,24 @@ class AutoSegApp(tk.Tk):
                 'flip_si': bool(self.flip_si),
                 'use_crop': bool(self.use_crop),
                 'clean_masks': bool(self.clean_masks),
+                'pack_masks': bool(self.pack_masks),
+                'postprocess_workers': int(self.postprocess_workers),
+                'contour_workers': int(self.contour_workers),
+                'contour_tolerance_mm': float(self.contour_tolerance_mm),
+                'contour_max_volume_change_pct': float(self.contour_max_volume_change_pct),
                 'smooth_masks': bool(self.smooth_masks),
                 'smoothing_method': self.smoothing_method,
                 'smoothing_sigma_mm': float(self.smoothing_sigma_mm),
+                'ct_export_mode': self.ct_export_mode,
+                'export_formats': list(self.export_formats),
                 'task_enabled': {task: bool(self.task_enabled.get(task, False)) for task in TOTALSEG_TASK_KEYS},
                 'crop_margin': int(self.crop_margin),
+                'scan_workers': int(self.scan_workers),
+                'use_dicom_index': bool(self.use_dicom_index),
+                'use_volume_cache': bool(self.use_volume_cache),
+                'volume_cache_max_gb': float(self.volume_cache_max_gb),
+                'use_seg_cache': bool(self.use_seg_cache),
+                'seg_cache_max_gb': float(self.seg_cache_max_gb),
                 'in_entry': self.in_entry.get(),
                 'out_entry': self.out_entry.get(),
                 'device': str(self.device),
@@ -4648,53 +7757,6 @@ class AutoSegApp(tk.Tk):
             # Log any unexpected error during this check
             self._log(f"⚠ Error checking TotalSegmentator availability: {e}")
 
-    def _ensure_custom_trainer(self) -> None:
-        """
-        Ensure that the custom nnUNet trainer required by some TotalSegmentator
-        models exists. TotalSegmentator v2 models reference a class named
-        ``nnUNetTrainer_4000epochs_NoMirroring`` which is not part of the
-        standard nnunetv2 distribution. When this class cannot be imported,
-        this method attempts to create a fallback implementation in the
-        nnunetv2 package directory. If the directory is not writable or
-        nnunetv2 is unavailable, a warning is logged and the method returns.
-        """
-        try:
-            from importlib.util import find_spec  # type: ignore
-            # If the module already exists, nothing to do
-            if find_spec('nnunetv2.training.nnUNetTrainer.nnUNetTrainer_4000epochs_NoMirroring'):
-                return
-            import nnunetv2.training.nnUNetTrainer as trainer_mod  # type: ignore
-            trainer_dir = os.path.dirname(trainer_mod.__file__)
-            custom_path = os.path.join(trainer_dir, 'nnUNetTrainer_4000epochs_NoMirroring.py')
-            # Only create the file if it does not already exist
-            if not os.path.exists(custom_path):
-                try:
-                    with open(custom_path, 'w', encoding='utf-8') as f:
-                        f.write('from .nnUNetTrainer import nnUNetTrainer\n\n')
-                        f.write('class nnUNetTrainer_4000epochs_NoMirroring(nnUNetTrainer):\n')
-                        f.write('    """Fallback trainer created by AURA.\n')
-                        f.write('\n')
-                        f.write('    This class exists solely to satisfy TotalSegmentator\n')
-                        f.write('    references during inference and derives behaviour from\n')
-                        f.write('    the default nnUNetTrainer. It disables mirroring and\n')
-                        f.write('    increases the epoch count. These settings are irrelevant\n')
-                        f.write('    for inference but match the original TotalSegmentator\n')
-                        f.write('    training configuration.\n')
-                        f.write('    """\n')
-                        f.write('    def __init__(self, *args, **kwargs):\n')
-                        f.write('        super().__init__(*args, **kwargs)\n')
-                        f.write('        # Do not use mirroring during training/inference\n')
-                        f.write('        self.allowed_mirroring_axes = None\n')
-                        f.write('        # Increase maximum number of epochs\n')
-                        f.write('        self.max_num_epochs = 4000\n')
-                except Exception as exc:
-                    # If writing fails, inform the user via the log
-                    self._log(f"⚠ Could not create fallback nnUNet trainer: {exc}")
-        except Exception as exc:
-            # If nnunetv2 is not installed or another error occurs, log and return
-            self._log(f"⚠ Could not ensure custom trainer class: {exc}")
-
-
     # ------------------------------------------------------------------
     # Procesar UN paciente
     # ------------------------------------------------------------------
@@ -4704,39 +7766,7 @@ class AutoSegApp(tk.Tk):
             if not os.path.isdir(folder):
                 messagebox.showerror("Error", "Select a valid folder.")
                 return
-
-            name = self._dicom_name(folder)
-            self._log(f"🚀 Processing patient: {name}")
-
-            if self.cancel_requested:
-                self._log("❌ Process cancelled by user")
-                return
-
-            series_files = self._collect_ct_series(folder)
-
-            if self.cancel_requested:
-                self._log("❌ Process cancelled by user")
-                return
-
-            masks = self._segment_from_files(series_files)
-            if not masks:
-                self._log("⚠ No segmentation results were produced; skipping RTSTRUCT creation.")
-                return
-
-            if self.cancel_requested:
-                self._log("❌ Process cancelled by user")
-                return
-
-            success = self._save_rt(folder, masks, name, series_files=series_files)
-
-            if success:
-                self._log(f"✅ Processing completed for {name}")
-            else:
-                self._log(f"⚠ Processing completed with errors for {name}")
-
-        except Exception as e:
-            self._log(f"❌ Error processing patient: {e}")
-            self._log(traceback.format_exc())
+            self._run_patient(folder)
         finally:
             self._indeterminate(False)
 
@@ -4749,66 +7779,124 @@ class AutoSegApp(tk.Tk):
             if not os.path.isdir(root):
                 messagebox.showerror("Error", "Select a valid folder.")
                 return
+            self._run_batch(root)
+        finally:
+            self.progress["value"] = 0
+            self._indeterminate(False)
 
-            subs = [d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d))]
-            total = len(subs)
-            if total == 0:
-                self._log("ℹ No subfolders found to process")
-                return
-
-            self.progress.configure(mode="determinate", maximum=total, value=0)
 
-            for i, folder_name in enumerate(subs, 1):
-                if self.cancel_requested:
-                    self._log("❌ Batch processing cancelled by user")
-                    break
+# -------------------------------------------------------------------------
+# Modo sin interfaz (línea de comandos)
+# -------------------------------------------------------------------------
+class HeadlessAutoSeg(AutoSegEngine):
+    """
+    Ejecuta el motor de AURA sin ventana Tk.  Los mensajes de registro van
+    al ``logger`` y el progreso se emite como una línea JSON por evento en
+    ``stdout``, de modo que varios procesos pueden lanzarse en un mismo nodo
+    sin servidor gráfico y su salida puede analizarse automáticamente.
+    """
 
-                folder_path = os.path.join(root, folder_name)
-                name = self._dicom_name(folder_path)
-                self._log(f"{i}/{total} ➡ Processing {name}...")
+    def __init__(self, output_root: str, config: Optional[dict] = None, stream=None):
+        self._init_engine_state()
+        self.output_root = output_root
+        self._stream = stream if stream is not None else sys.stdout
+        self._stream_lock = threading.Lock()
+        if config:
+            self._apply_config(config)
 
-                try:
-                    if self.cancel_requested:
-                        self._log("❌ Batch processing cancelled by user")
-                        break
+    def _on_progress(self, event: str, **fields) -> None:
+        record = {"ts": datetime.now().isoformat(timespec="seconds"), "event": event}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._stream_lock:
+            self._stream.write(line + "\n")
+            self._stream.flush()
 
-                    series_files = self._collect_ct_series(folder_path)
 
-                    if self.cancel_requested:
-                        self._log("❌ Batch processing cancelled by user")
-                        break
-
-                    masks = self._segment_from_files(series_files)
-                    if not masks:
-                        self._log(f"⚠ No segmentation results for {name}; skipping RTSTRUCT.")
-                        self.progress["value"] = i
-                        self.update_idletasks()
-                        continue
+# Opciones que seleccionan el modo sin interfaz; cualquier otro argumento
+# (p. ej. los que añade un lanzador) abre la GUI como siempre.
+HEADLESS_OPTIONS = ("--input", "--seg-cache-info", "--seg-cache-purge", "-h", "--help")
 
-                    if self.cancel_requested:
-                        self._log("❌ Batch processing cancelled by user")
-                        break
 
-                    success = self._save_rt(folder_path, masks, name, series_files=series_files)
-                    if success:
-                        self._log(f"✅ {name} completed")
-                    else:
-                        self._log(f"⚠ {name} completed with errors")
-                except Exception as e:
-                    self._log(f"❌ Error processing {name}: {e}")
-                    # Do not log full traceback in batch to avoid cluttering the log
+def wants_headless(argv) -> bool:
+    """True if ``argv`` explicitly asks for the headless CLI (:func:`run_headless`)."""
+    return any(arg.split("=", 1)[0] in HEADLESS_OPTIONS for arg in argv)
 
-                self.progress["value"] = i
-                self.update_idletasks()
 
-            self._log("🟢 Batch processing completed")
+def run_headless(argv=None) -> int:
+    """Command line entry point; returns the process exit code."""
+    import argparse
 
+    parser = argparse.ArgumentParser(
+        prog="aura",
+        description="AURA headless batch segmentation (DICOM CT -> RTSTRUCT).",
+    )
+    parser.add_argument("--input",
+                        help="Input root: one sub-folder per patient (or a single patient with --single).")
+    parser.add_argument("--output", help="Output root for the RTSTRUCT files.")
+    parser.add_argument("--config", help="JSON settings in the same format as ~/.autoseg_config.json.")
+    parser.add_argument("--single", action="store_true", help="Treat --input as one patient folder.")
+    parser.add_argument("--ct-export", choices=CT_EXPORT_MODES,
+                        help="How the CT series is written next to the RTSTRUCT (overrides ct_export_mode).")
+    parser.add_argument("--export",
+                        help=f"Comma-separated output formats among {', '.join(EXPORT_FORMATS)} "
+                             "(overrides export_formats).")
+    parser.add_argument("--seg-cache-info", action="store_true",
+                        help=f"Print a JSON summary of the segmentation result cache ({SEG_CACHE_DIR}) and exit.")
+    parser.add_argument("--seg-cache-purge", action="store_true",
+                        help="Delete every entry of the segmentation result cache and exit.")
+    args = parser.parse_args(argv)
+
+    if args.seg_cache_info or args.seg_cache_purge:
+        cache = SegmentationResultCache()
+        if args.seg_cache_purge:
+            freed = cache.clear()
+            print(json.dumps({"purged_bytes": freed}))
+        if args.seg_cache_info:
+            print(json.dumps(cache.summary(), indent=1))
+        return 0
+
+    if not args.input or not args.output:
+        parser.error("--input and --output are required")
+    if not os.path.isdir(args.input):
+        parser.error(f"input folder not found: {args.input}")
+    cfg = {}
+    if args.config:
+        try:
+            with open(args.config, "r", encoding="utf-8") as f:
+                cfg = json.load(f)
         except Exception as e:
-            self._log(f"❌ Error in batch processing: {e}")
-            self._log(traceback.format_exc())
-        finally:
-            self.progress["value"] = 0
-            self._indeterminate(False)
+            parser.error(f"could not read config {args.config}: {e}")
+        if not isinstance(cfg, dict):
+            parser.error(f"config {args.config} must contain a JSON object")
+    if args.ct_export:
+        cfg["ct_export_mode"] = args.ct_export
+    if args.export:
+        formats = [f.strip().lower() for f in args.export.split(",") if f.strip()]
+        unknown = sorted(set(formats) - set(EXPORT_FORMATS))
+        if unknown or not formats:
+            parser.error(f"unknown export format(s): {', '.join(unknown) or args.export}")
+        cfg["export_formats"] = formats
+    os.makedirs(args.output, exist_ok=True)
+
+    # Registro legible en stderr; stdout queda reservado para eventos JSON
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+
+    load_heavy_modules()
+    engine = HeadlessAutoSeg(args.output, cfg)
+    engine._load_model()
+    if not engine.ready:
+        logger.error("Segmentation model is not available; aborting")
+        return 1
+
+    if args.single:
+        status = engine._run_patient(args.input)
+        return 0 if status in ("ok", "no_masks") else 1
+    summary = engine._run_batch(args.input)
+    failed = "error" in summary or any(s in ("failed", "errors") for s in summary["statuses"].values())
+    return 1 if failed else 0
 
 
 # -------------------------------------------------------------------------
@@ -4844,12 +7932,17 @@ if __name__ == "__main__":
         _print_optional_dependencies()
         sys.exit(1)
 
-    # Preparar entorno GPU (detecta tarjetas y trata de instalar el wheel correspondiente)
-    try:
-        prepare_gpu_environment(logger.info)
-    except Exception as exc:
-        logger.warning(f"No se pudo preparar automaticamente el entorno GPU: {exc}")
-        logger.debug("Detalle del fallo preparando entorno GPU", exc_info=exc)
+    # Modo sin interfaz: python "AURA VER 1.0.py" --input ... --output ...
+    headless = wants_headless(sys.argv[1:])
+
+    # Preparar entorno GPU (detecta tarjetas y trata de instalar el wheel
+    # correspondiente).  Solo en la GUI: en modo sin interfaz no se instala nada.
+    if not headless:
+        try:
+            prepare_gpu_environment(logger.info)
+        except Exception as exc:
+            logger.warning(f"No se pudo preparar automaticamente el entorno GPU: {exc}")
+            logger.debug("Detalle del fallo preparando entorno GPU", exc_info=exc)
 
     # Verificamos torch tras la preparacion (puede haber sido instalado en el paso anterior)
     try:
@@ -4864,6 +7957,13 @@ if __name__ == "__main__":
         _print_optional_dependencies()
         sys.exit(1)
 
+    if headless:
+        sys.exit(run_headless(sys.argv[1:]))
+    if tk is None:
+        print("Error: tkinter no está disponible; la interfaz gráfica no puede iniciarse.")
+        print('Usa el modo sin interfaz: python "AURA VER 1.0.py" --input <carpeta> --output <carpeta>')
+        sys.exit(1)
+
     def show_splash_and_start():
         """
         Muestra una ventana de presentación mientras se cargan las dependencias pesadas.
@@ -59,7 +59,7 @@ def crop_to_bbox_nifti(image: nib.Nifti1Image, bbox, dtype=None) -> nib.Nifti1Im
     returns: nib.Nifti1Image
     """
     assert len(image.shape) == 3, "only supports 3d images"
-    data = image.get_fdata()
+    data = np.asanyarray(image.dataobj)  # native dtype, avoid float64 copy of the full image
 
     # Crop the image
     data_cropped = crop_to_bbox(data, bbox)
@@ -94,7 +94,7 @@ def crop_to_mask(img_in, mask_img, addon=[0,0,0], dtype=None, verbose=False):
     # mask_img = nibabel.processing.resample_from_to(mask_img, img_in, order=0)
     # print(f"  after: {mask_img.shape}")
 
-    mask = mask_img.get_fdata()
+    mask = np.asanyarray(mask_img.dataobj)
 
     addon = (np.array(addon) / img_in.header.get_zooms()).astype(int)  # mm to voxels
     bbox = get_bbox_from_mask(mask, outside_value=0, addon=addon)
@@ -128,8 +128,9 @@ def undo_crop(img, ref_img, bbox):
     """
     Fit the image which was cropped by bbox back into the shape of ref_img.
     """
-    img_out = np.zeros(ref_img.shape)
-    img_out[bbox[0][0]:bbox[0][1], bbox[1][0]:bbox[1][1], bbox[2][0]:bbox[2][1]] = img.get_fdata()
+    data = np.asanyarray(img.dataobj)
+    img_out = np.zeros(ref_img.shape, dtype=data.dtype)  # keep label dtype (uint8) instead of float64
+    img_out[bbox[0][0]:bbox[0][1], bbox[1][0]:bbox[1][1], bbox[2][0]:bbox[2][1]] = data
     return nib.Nifti1Image(img_out, ref_img.affine)
 
 
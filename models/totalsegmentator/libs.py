@@ -400,10 +400,10 @@ def combine_masks_to_multilabel_file(masks_dir, multilabel_file):
 
     for idx, mask in enumerate(masks):
         if os.path.exists(f"{masks_dir}/{mask}.nii.gz"):
-            img = nib.load(f"{masks_dir}/{mask}.nii.gz").get_fdata()
+            img = np.asanyarray(nib.load(f"{masks_dir}/{mask}.nii.gz").dataobj)
         else:
             print(f"Mask {mask} is missing. Filling with zeros.")
-            img = np.zeros(ref_img.shape)
+            img = np.zeros(ref_img.shape, dtype=np.uint8)
         img_out[img > 0.5] = idx+1
 
     nib.save(nib.Nifti1Image(img_out, ref_img.affine), multilabel_file)
@@ -443,7 +443,7 @@ def combine_masks(mask_dir, class_type):
         img, label_map = load_multilabel_nifti(mask_dir)  # label_map: {id:name}
         label_map_inv = {name: id for id, name in label_map.items()}
         target_label_ids = [label_map_inv[mask_name] for mask_name in masks]
-        img_data = img.get_fdata()
+        img_data = np.asanyarray(img.dataobj)
         combined = np.zeros(img_data.shape, dtype=np.uint8)
         for label_id in target_label_ids:
             combined[img_data == label_id] = 1
@@ -459,7 +459,7 @@ def combine_masks(mask_dir, class_type):
         combined = np.zeros(ref_img.shape, dtype=np.uint8)
         for idx, mask in enumerate(masks):
             if (mask_dir / f"{mask}.nii.gz").exists():
-                img = nib.load(mask_dir / f"{mask}.nii.gz").get_fdata()
+                img = np.asanyarray(nib.load(mask_dir / f"{mask}.nii.gz").dataobj)
                 combined[img > 0.5] = 1
 
         return nib.Nifti1Image(combined, ref_img.affine)
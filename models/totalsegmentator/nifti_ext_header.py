@@ -18,7 +18,7 @@ def add_label_map_to_nifti(img_in, label_map):
 
     returns: nifti image
     """
-    data = img_in.get_fdata()
+    data = np.asanyarray(img_in.dataobj)
 
     if label_map is None:
         label_map = {idx+1: f"L{val}" for idx, val in enumerate(np.unique(data)[1:])}
@@ -15,6 +15,8 @@ import tempfile
 import inspect
 import warnings
 import atexit
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import nibabel as nib
@@ -115,7 +117,7 @@ def contains_empty_img(imgs):
     """
     is_empty = True
     for img in imgs:
-        this_is_empty = len(np.unique(nib.load(img).get_fdata())) == 1
+        this_is_empty = len(np.unique(np.asanyarray(nib.load(img).dataobj))) == 1
         is_empty = is_empty and this_is_empty
     return is_empty
 
@@ -182,22 +184,156 @@ def nnUNet_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
                         step_size=step_size, checkpoint_name=chk)
 
 
-def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
-                     trainer="nnUNetTrainer", tta=False,
-                     num_threads_preprocessing=3, num_threads_nifti_save=2,
-                     plans="nnUNetPlans", device="cuda", quiet=False, step_size=0.5,
-                     save_probabilities_path=None):
+# Process-wide cache of initialised nnUNetPredictors. Building a predictor
+# (reading the plans, rebuilding the network and loading every fold checkpoint)
+# takes several seconds, so keep the most recently used ones around and evict
+# the least recently used once the host / device memory budget is exceeded.
+# Budgets in GB can be set with TOTALSEG_PREDICTOR_CACHE_GB and
+# TOTALSEG_PREDICTOR_CACHE_VRAM_GB or with set_predictor_cache_budget();
+# a budget of 0 disables caching.
+_predictor_cache = OrderedDict()  # key -> [predictor, host_bytes, device_bytes]
+_predictor_cache_lock = threading.Lock()
+_predictor_cache_budget = {
+    "host": float(os.environ.get("TOTALSEG_PREDICTOR_CACHE_GB", 8)) * 1024**3,
+    "device": float(os.environ.get("TOTALSEG_PREDICTOR_CACHE_VRAM_GB", 4)) * 1024**3,
+}
+
+
+def set_predictor_cache_budget(host_gb=None, device_gb=None):
     """
-    Identical to bash function nnUNetv2_predict
+    Set the memory budget (GB) of the predictor cache and evict entries if needed.
     """
-    dir_in = str(dir_in)
-    dir_out = str(dir_out)
+    with _predictor_cache_lock:
+        if host_gb is not None:
+            _predictor_cache_budget["host"] = float(host_gb) * 1024**3
+        if device_gb is not None:
+            _predictor_cache_budget["device"] = float(device_gb) * 1024**3
+        _prune_predictor_cache()
 
-    # if task_id in [291, 292, 293, 294, 295, 957]:
-    #     plans = "nnUNetResEncUNetLPlans_8"
 
-    model_folder = get_output_folder(task_id, trainer, plans, model)
+def clear_predictor_cache():
+    """
+    Drop all cached predictors and release cached GPU memory.
+    """
+    with _predictor_cache_lock:
+        _predictor_cache.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
+
+def _predictor_memory(predictor):
+    """
+    Bytes held by a predictor as (host, device): network weights plus the
+    per-fold state dicts.
+    """
+    tensors = []
+    if predictor.network is not None:
+        tensors.extend(predictor.network.parameters())
+        tensors.extend(predictor.network.buffers())
+    for params in predictor.list_of_parameters or []:
+        tensors.extend(v for v in params.values() if torch.is_tensor(v))
+    host = device = 0
+    for t in tensors:
+        nbytes = t.numel() * t.element_size()
+        if t.device.type == "cpu":
+            host += nbytes
+        else:
+            device += nbytes
+    return host, device
+
+
+def _prune_predictor_cache():
+    """
+    Evict least recently used predictors until both budgets are met. Caller holds the lock.
+    """
+    evicted = False
+    while _predictor_cache:
+        host = sum(e[1] for e in _predictor_cache.values())
+        device = sum(e[2] for e in _predictor_cache.values())
+        if host <= _predictor_cache_budget["host"] and device <= _predictor_cache_budget["device"]:
+            break
+        _predictor_cache.popitem(last=False)
+        evicted = True
+    if evicted and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def get_predictor(model_folder, folds, device, step_size=0.5, tta=False, quiet=False, verbose=False,
+                  checkpoint_name="checkpoint_final.pth"):
+    """
+    Return an initialised nnUNetPredictor for model_folder, reusing a cached one if possible.
+
+    The cache key is (model_folder, folds, checkpoint, device); model_folder already encodes
+    task_id, trainer, plans and model. Step size, TTA and progress bar settings are
+    per-call and are updated on the cached predictor. A predictor is not thread-safe:
+    do not run two predictions with the same model concurrently in one process.
+    """
+    key = (str(model_folder), tuple(folds) if folds is not None else None, checkpoint_name, str(device))
+    with _predictor_cache_lock:
+        entry = _predictor_cache.get(key)
+        if entry is not None:
+            _predictor_cache.move_to_end(key)
+    if entry is not None:
+        predictor = entry[0]
+        predictor.tile_step_size = step_size
+        predictor.use_mirroring = tta
+        predictor.allow_tqdm = not quiet
+        return predictor
+
+    # nnUNet 2.2.1
+    if supports_keyword_argument(nnUNetPredictor, "perform_everything_on_gpu"):
+        predictor = nnUNetPredictor(
+            tile_step_size=step_size,
+            use_gaussian=True,
+            use_mirroring=tta,
+            perform_everything_on_gpu=True,  # for nnunetv2<=2.2.1
+            device=device,
+            verbose=verbose,
+            verbose_preprocessing=verbose,
+            allow_tqdm=not quiet
+        )
+    # nnUNet >= 2.2.2
+    else:
+        predictor = nnUNetPredictor(
+            tile_step_size=step_size,
+            use_gaussian=True,
+            use_mirroring=tta,
+            perform_everything_on_device=True,  # for nnunetv2>=2.2.2
+            device=device,
+            verbose=verbose,
+            verbose_preprocessing=verbose,
+            allow_tqdm=not quiet
+        )
+    predictor.initialize_from_trained_model_folder(
+        model_folder,
+        use_folds=folds,
+        checkpoint_name=checkpoint_name,
+    )
+    with _predictor_cache_lock:
+        _predictor_cache[key] = [predictor, 0, 0]
+    return predictor
+
+
+def release_predictor(predictor):
+    """
+    Update the memory accounting of a cached predictor after use and apply the budget.
+
+    The network is only moved to the device during the first prediction, so sizes
+    are measured after use rather than after initialisation.
+    """
+    host, device = _predictor_memory(predictor)
+    with _predictor_cache_lock:
+        for entry in _predictor_cache.values():
+            if entry[0] is predictor:
+                entry[1], entry[2] = host, device
+                break
+        _prune_predictor_cache()
+
+
+def _prepare_device(device):
+    """
+    Convert the device argument to a torch.device and set the torch thread count accordingly.
+    """
     assert device in ['cpu', 'cuda',
                            'mps'] or isinstance(device, torch.device), f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {device}.'
     if device == 'cpu':
@@ -215,6 +351,26 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
         device = device
     else:
         device = torch.device('mps')
+    return device
+
+
+def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
+                     trainer="nnUNetTrainer", tta=False,
+                     num_threads_preprocessing=3, num_threads_nifti_save=2,
+                     plans="nnUNetPlans", device="cuda", quiet=False, step_size=0.5,
+                     save_probabilities_path=None):
+    """
+    Identical to bash function nnUNetv2_predict
+    """
+    dir_in = str(dir_in)
+    dir_out = str(dir_out)
+
+    # if task_id in [291, 292, 293, 294, 295, 957]:
+    #     plans = "nnUNetResEncUNetLPlans_8"
+
+    model_folder = get_output_folder(task_id, trainer, plans, model)
+
+    device = _prepare_device(device)
     disable_tta = not tta
     verbose = False
     if save_probabilities_path is None:
@@ -228,7 +384,6 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
     prev_stage_predictions = None
     num_parts = 1
     part_id = 0
-    allow_tqdm = not quiet
 
     # nnUNet 2.1
     # predict_from_raw_data(dir_in,
@@ -250,61 +405,54 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
     #                       part_id=part_id,
     #                       device=device)
 
-    # nnUNet 2.2.1
-    if supports_keyword_argument(nnUNetPredictor, "perform_everything_on_gpu"):
-        predictor = nnUNetPredictor(
-            tile_step_size=step_size,
-            use_gaussian=True,
-            use_mirroring=not disable_tta,
-            perform_everything_on_gpu=True,  # for nnunetv2<=2.2.1
-            device=device,
-            verbose=verbose,
-            verbose_preprocessing=verbose,
-            allow_tqdm=allow_tqdm
-        )
-    # nnUNet >= 2.2.2
-    else:
-        predictor = nnUNetPredictor(
-            tile_step_size=step_size,
-            use_gaussian=True,
-            use_mirroring=not disable_tta,
-            perform_everything_on_device=True,  # for nnunetv2>=2.2.2
-            device=device,
-            verbose=verbose,
-            verbose_preprocessing=verbose,
-            allow_tqdm=allow_tqdm
-        )
-    predictor.initialize_from_trained_model_folder(
-        model_folder,
-        use_folds=folds,
-        checkpoint_name=chk,
-    )
-    # new nnunetv2 feature: keep dir_out empty to return predictions as return value
-    predictor.predict_from_files(dir_in, dir_out,
-                                 save_probabilities=save_probabilities, overwrite=not continue_prediction,
-                                 num_processes_preprocessing=npp, num_processes_segmentation_export=nps,
-                                 folder_with_segs_from_prev_stage=prev_stage_predictions,
-                                 num_parts=num_parts, part_id=part_id)
+    # Reuse a warm predictor across tasks and patients (see get_predictor)
+    predictor = get_predictor(model_folder, folds, device, step_size=step_size, tta=not disable_tta,
+                              quiet=quiet, verbose=verbose, checkpoint_name=chk)
+    try:
+        # new nnunetv2 feature: keep dir_out empty to return predictions as return value
+        predictor.predict_from_files(dir_in, dir_out,
+                                     save_probabilities=save_probabilities, overwrite=not continue_prediction,
+                                     num_processes_preprocessing=npp, num_processes_segmentation_export=nps,
+                                     folder_with_segs_from_prev_stage=prev_stage_predictions,
+                                     num_parts=num_parts, part_id=part_id)
+    finally:
+        release_predictor(predictor)
 
     if save_probabilities:
         shutil.copy(Path(dir_out) / "s01.npz", save_probabilities_path)
         shutil.copy(Path(dir_out) / "s01.pkl", save_probabilities_path.with_suffix(".pkl"))
 
-    # # Use numpy as input. TODO: In entire pipeline do not save to disk
-    # input_image = nib.load(Path(dir_in) / "s01_0000.nii.gz")
-    # input_data = np.asanyarray(input_image.dataobj).transpose(2, 1, 0)[None,...].astype(np.float32)
-    # spacing = input_image.header.get_zooms()
-    # affine = input_image.affine
-    # # Do i have to transpose spacing? does not matter because anyways isotropic at this point.
-    # spacing = (spacing[2], spacing[1], spacing[0])
-    # props = {"spacing": spacing}
-    # # from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
-    # # input_data, props = SimpleITKIO().read_images([os.path.join(dir_in, "s01_0000.nii.gz")])
-    # seg = predictor.predict_single_npy_array(input_data, props,
-    #                                          prev_stage_predictions, None,
-    #                                          save_probabilities)
-    # seg = seg.transpose(2, 1, 0)
-    # nib.save(nib.Nifti1Image(seg.astype(np.uint8), affine), Path(dir_out) / "s01.nii.gz")
+
+def nnUNetv2_predict_npy(images, spacing, task_id, model="3d_fullres", folds=None,
+                         trainer="nnUNetTrainer", tta=False, plans="nnUNetPlans",
+                         device="cuda", quiet=False, step_size=0.5):
+    """
+    In-memory counterpart of nnUNetv2_predict: no nifti files are written or read.
+
+    images: dict name -> float32 array of shape (channels, z, y, x), i.e. the nifti data
+            transposed to the axis order nnU-Net's image readers produce
+    spacing: voxel spacing in the same (z, y, x) order
+    Returns dict name -> label array of shape (z, y, x).
+    """
+    model_folder = get_output_folder(task_id, trainer, plans, model)
+    device = _prepare_device(device)
+    predictor = get_predictor(model_folder, folds, device, step_size=step_size, tta=tta,
+                              quiet=quiet, checkpoint_name="checkpoint_final.pth")
+    segs = {}
+    try:
+        for name, data in images.items():
+            # the properties dict is filled by the preprocessor, so pass a fresh one each time
+            segs[name] = predictor.predict_single_npy_array(data, {"spacing": list(spacing)}, None, None, False)
+    finally:
+        release_predictor(predictor)
+    return segs
+
+
+def supports_in_memory_prediction():
+    """
+    True if the installed nnunetv2 can predict from numpy arrays (nnunetv2>=2.2).
+    """
+    return hasattr(nnUNetPredictor, "predict_single_npy_array")
 
 
 def save_segmentation_nifti(class_map_item, tmp_dir=None, file_out=None, nora_tag=None, header=None, task_name=None, quiet=None):
@@ -313,7 +461,7 @@ def save_segmentation_nifti(class_map_item, tmp_dir=None, file_out=None, nora_ta
     if not task_name.startswith("total") and not quiet:
         print(f"Creating {v}.nii.gz")
     img = nib.load(tmp_dir / "s01.nii.gz")
-    img_data = img.get_fdata()
+    img_data = np.asanyarray(img.dataobj)
     binary_img = img_data == k
     output_path = str(file_out / f"{v}.nii.gz")
     nib.save(nib.Nifti1Image(binary_img.astype(np.uint8), img.affine, header), output_path)
@@ -330,11 +478,14 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                          device="cuda", exclude_masks_at_border=True, no_derived_masks=False,
                          v1_order=False, stats_aggregation="mean", remove_small_blobs=False,
                          normalized_intensities=False, nnunet_resampling=False,
-                         save_probabilities=None, cascade=None, remove_outside_mask=None, remove_outside_dilation=None):
+                         save_probabilities=None, cascade=None, remove_outside_mask=None, remove_outside_dilation=None,
+                         in_memory=None):
     """
     crop: string or a nibabel image
     resample: None or float (target spacing for all dimensions) or list of floats
     cascade: nibabel image or None
+    in_memory: pass the resampled image to nnU-Net as numpy array instead of going through
+               nifti files in the temp dir. None: use it if nnunetv2 supports it.
     """
     if not isinstance(file_in, Nifti1Image):
         file_in = Path(file_in)
@@ -365,6 +516,12 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
     
     if type(resample) is float:
         resample = [resample, resample, resample]
+
+    if in_memory is None:
+        in_memory = supports_in_memory_prediction()
+    # probabilities and reference segmentations for testing go through files
+    if save_probabilities is not None or test != 0:
+        in_memory = False
     
     if v1_order and task_name == "total":
         label_map = class_map["total_v1"]
@@ -431,7 +588,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             else:
                 crop_mask_img = crop
                 
-            if crop_mask_img.get_fdata().sum() == 0:
+            if not np.any(np.asanyarray(crop_mask_img.dataobj)):
                 if not quiet: 
                     print("INFO: Crop is empty. Returning empty segmentation.")
                 img_out = nib.Nifti1Image(np.zeros(img_in.shape, dtype=np.uint8), img_in.affine)
@@ -476,10 +633,11 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
         else:
             img_in_rsp = img_in
 
-        nib.save(img_in_rsp, tmp_dir / "s01_0000.nii.gz")
+        if not in_memory:
+            nib.save(img_in_rsp, tmp_dir / "s01_0000.nii.gz")
 
-        if cascade:
-            nib.save(cascade, tmp_dir / "s01_0001.nii.gz")
+            if cascade:
+                nib.save(cascade, tmp_dir / "s01_0001.nii.gz")
 
         # todo important: change
         nr_voxels_thr = 512*512*900
@@ -493,18 +651,32 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             do_triple_split = True
         if cascade:
             do_triple_split = False
+        part_slices = {"s01": slice(None)}
         if do_triple_split:
             if not quiet: print("Splitting into subparts...")
             img_parts = ["s01", "s02", "s03"]
             third = img_in_rsp.shape[2] // 3
             margin = 20  # set margin with fixed values to avoid rounding problem if using percentage of third
-            img_in_rsp_data = img_in_rsp.get_fdata()
-            nib.save(nib.Nifti1Image(img_in_rsp_data[:, :, :third+margin], img_in_rsp.affine),
-                    tmp_dir / "s01_0000.nii.gz")
-            nib.save(nib.Nifti1Image(img_in_rsp_data[:, :, third+1-margin:third*2+margin], img_in_rsp.affine),
-                    tmp_dir / "s02_0000.nii.gz")
-            nib.save(nib.Nifti1Image(img_in_rsp_data[:, :, third*2+1-margin:], img_in_rsp.affine),
-                    tmp_dir / "s03_0000.nii.gz")
+            part_slices = {"s01": slice(None, third+margin),
+                           "s02": slice(third+1-margin, third*2+margin),
+                           "s03": slice(third*2+1-margin, None)}
+            if not in_memory:
+                img_in_rsp_data = img_in_rsp.get_fdata()
+                for img_part in img_parts:
+                    nib.save(nib.Nifti1Image(img_in_rsp_data[:, :, part_slices[img_part]], img_in_rsp.affine),
+                             tmp_dir / f"{img_part}_0000.nii.gz")
+
+        if in_memory:
+            # Same arrays nnU-Net would read back from s0X_0000.nii.gz (+ _0001 for the cascade):
+            # float32, transposed to (channel, z, y, x) with the spacing reversed accordingly.
+            channels = [img_in_rsp.get_fdata(dtype=np.float32)]
+            if cascade:
+                channels.append(cascade.get_fdata(dtype=np.float32))
+            img_in_rsp_data = np.stack(channels).transpose(0, 3, 2, 1)
+            nnunet_inputs = {img_part: np.ascontiguousarray(img_in_rsp_data[:, part_slices[img_part]])
+                             for img_part in img_parts}
+            nnunet_spacing = [float(z) for z in img_in_rsp.header.get_zooms()[::-1]]
+            del channels, img_in_rsp_data
 
         if task_name == "total" and resample is not None and resample[0] < 3.0:
             # overall speedup for 15mm model roughly 11% (GPU) and 100% (CPU)
@@ -538,7 +710,10 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 seg_combined = {}
                 # iterate over subparts of image
                 for img_part in img_parts:
-                    img_shape = nib.load(tmp_dir / f"{img_part}_0000.nii.gz").shape
+                    if in_memory:
+                        img_shape = nnunet_inputs[img_part].shape[:0:-1]
+                    else:
+                        img_shape = nib.load(tmp_dir / f"{img_part}_0000.nii.gz").shape
                     seg_combined[img_part] = np.zeros(img_shape, dtype=np.uint8)
                 # Run several tasks and combine results into one segmentation
                 for idx, tid in enumerate(task_id):
@@ -546,19 +721,30 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                     with nostdout(verbose):
                         # nnUNet_predict(tmp_dir, tmp_dir, tid, model, folds, trainer, tta,
                         #                nr_threads_resampling, nr_threads_saving)
-                        nnUNetv2_predict(tmp_dir, tmp_dir, tid, model, folds, trainer, tta,
-                                         nr_threads_resampling, nr_threads_saving,
-                                         device=device, quiet=quiet, step_size=step_size,
-                                         save_probabilities_path=save_probabilities)
+                        if in_memory:
+                            part_segs = nnUNetv2_predict_npy(nnunet_inputs, nnunet_spacing, tid, model, folds,
+                                                             trainer, tta, device=device, quiet=quiet,
+                                                             step_size=step_size)
+                        else:
+                            nnUNetv2_predict(tmp_dir, tmp_dir, tid, model, folds, trainer, tta,
+                                             nr_threads_resampling, nr_threads_saving,
+                                             device=device, quiet=quiet, step_size=step_size,
+                                             save_probabilities_path=save_probabilities)
                     # iterate over models (different sets of classes)
                     for img_part in img_parts:
-                        (tmp_dir / f"{img_part}.nii.gz").rename(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz")
-                        seg = nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").get_fdata()
+                        if in_memory:
+                            seg = part_segs.pop(img_part).transpose(2, 1, 0)
+                        else:
+                            (tmp_dir / f"{img_part}.nii.gz").rename(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz")
+                            seg = np.asanyarray(nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").dataobj)
                         for jdx, class_name in class_map_parts[map_taskid_to_partname[tid]].items():
                             seg_combined[img_part][seg == jdx] = class_map_inv[class_name]
                 # iterate over subparts of image
-                for img_part in img_parts:
-                    nib.save(nib.Nifti1Image(seg_combined[img_part], img_in_rsp.affine), tmp_dir / f"{img_part}.nii.gz")
+                if in_memory:
+                    pred_parts = seg_combined
+                else:
+                    for img_part in img_parts:
+                        nib.save(nib.Nifti1Image(seg_combined[img_part], img_in_rsp.affine), tmp_dir / f"{img_part}.nii.gz")
             elif test == 1:
                 print("WARNING: Using reference seg instead of prediction for testing.")
                 shutil.copy(Path("tests") / "reference_files" / "example_seg.nii.gz", tmp_dir / "s01.nii.gz")
@@ -568,10 +754,16 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 with nostdout(verbose):
                     # nnUNet_predict(tmp_dir, tmp_dir, task_id, model, folds, trainer, tta,
                     #                nr_threads_resampling, nr_threads_saving)
-                    nnUNetv2_predict(tmp_dir, tmp_dir, task_id, model, folds, trainer, tta,
-                                     nr_threads_resampling, nr_threads_saving,
-                                     device=device, quiet=quiet, step_size=step_size,
-                                     save_probabilities_path=save_probabilities)
+                    if in_memory:
+                        pred_parts = nnUNetv2_predict_npy(nnunet_inputs, nnunet_spacing, task_id, model, folds,
+                                                          trainer, tta, device=device, quiet=quiet,
+                                                          step_size=step_size)
+                        pred_parts = {k: v.transpose(2, 1, 0) for k, v in pred_parts.items()}
+                    else:
+                        nnUNetv2_predict(tmp_dir, tmp_dir, task_id, model, folds, trainer, tta,
+                                         nr_threads_resampling, nr_threads_saving,
+                                         device=device, quiet=quiet, step_size=step_size,
+                                         save_probabilities_path=save_probabilities)
             # elif test == 2:
             #     print("WARNING: Using reference seg instead of prediction for testing.")
             #     shutil.copy(Path("tests") / "reference_files" / "example_seg_fast.nii.gz", tmp_dir / f"s01.nii.gz")
@@ -580,29 +772,42 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 shutil.copy(Path("tests") / "reference_files" / "example_seg_lung_vessels.nii.gz", tmp_dir / "s01.nii.gz")
         if not quiet: print(f"  Predicted in {time.time() - st:.2f}s")
 
+        if in_memory:
+            del nnunet_inputs
+
         # Combine image subparts back to one image
         if do_triple_split:
+            def load_part(img_part):
+                if in_memory:
+                    return pred_parts[img_part]
+                return np.asanyarray(nib.load(tmp_dir / f"{img_part}.nii.gz").dataobj)
             combined_img = np.zeros(img_in_rsp.shape, dtype=np.uint8)
-            combined_img[:,:,:third] = nib.load(tmp_dir / "s01.nii.gz").get_fdata()[:,:,:-margin]
-            combined_img[:,:,third:third*2] = nib.load(tmp_dir / "s02.nii.gz").get_fdata()[:,:,margin-1:-margin]
-            combined_img[:,:,third*2:] = nib.load(tmp_dir / "s03.nii.gz").get_fdata()[:,:,margin-1:]
-            nib.save(nib.Nifti1Image(combined_img, img_in_rsp.affine), tmp_dir / "s01.nii.gz")
+            combined_img[:,:,:third] = load_part("s01")[:,:,:-margin]
+            combined_img[:,:,third:third*2] = load_part("s02")[:,:,margin-1:-margin]
+            combined_img[:,:,third*2:] = load_part("s03")[:,:,margin-1:]
+            if in_memory:
+                pred_parts = {"s01": combined_img}
+            else:
+                nib.save(nib.Nifti1Image(combined_img, img_in_rsp.affine), tmp_dir / "s01.nii.gz")
 
-        img_pred = nib.load(tmp_dir / "s01.nii.gz")
+        if in_memory:
+            img_pred = nib.Nifti1Image(np.asarray(pred_parts.pop("s01"), dtype=np.uint8), img_in_rsp.affine)
+        else:
+            img_pred = nib.load(tmp_dir / "s01.nii.gz")
 
         # Currently only relevant for T304 (appendicular bones)
         img_pred = remove_auxiliary_labels(img_pred, task_name)
 
         # Postprocessing multilabel (run here on lower resolution)
         if task_name == "body":
-            img_pred_pp = keep_largest_blob_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = keep_largest_blob_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                        class_map[task_name], ["body_trunc"], debug=False, quiet=quiet)
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
 
         if task_name == "body":
             vox_vol = np.prod(img_pred.header.get_zooms())
             size_thr_mm3 = 50000
-            img_pred_pp = remove_small_blobs_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = remove_small_blobs_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                         class_map[task_name], ["body_extremities"],
                                                         interval=[size_thr_mm3/vox_vol, 1e10], debug=False, quiet=quiet)
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
@@ -613,7 +818,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             st = time.time()
             vox_vol = np.prod(img_pred.header.get_zooms())
             size_thr_mm3 = 200
-            img_pred_pp = remove_small_blobs_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = remove_small_blobs_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                         class_map[task_name], list(class_map[task_name].values()),
                                                         interval=[size_thr_mm3/vox_vol, 1e10], debug=False, quiet=quiet)  # ~24s
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
@@ -630,7 +835,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 st = time.time()
                 smoothing = 20
                 preview_dir = file_out.parent if multilabel_image else file_out
-                generate_preview(img_in_rsp, preview_dir / f"preview_{task_name}.png", img_pred.get_fdata(), smoothing, task_name)
+                generate_preview(img_in_rsp, preview_dir / f"preview_{task_name}.png", np.asanyarray(img_pred.dataobj), smoothing, task_name)
                 if not quiet: print(f"  Generated in {time.time() - st:.2f}s")
 
         # Statistics calculated on the 3mm downsampled image are very similar to statistics
@@ -650,7 +855,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 stats_file = stats_dir / "statistics.json"
             else:
                 stats_file = None
-            stats = get_basic_statistics(img_pred.get_fdata(), img_in_rsp, stats_file, 
+            stats = get_basic_statistics(np.asanyarray(img_pred.dataobj), img_in_rsp, stats_file, 
                                          quiet, task_name, exclude_masks_at_border, roi_subset,
                                          metric=stats_aggregation, 
                                          normalized_intensities=normalized_intensities)
@@ -667,7 +872,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             # Ok if using with "roi_subset" because then only a few labels, otherwise infeasible runtime+memory.
             if nnunet_resampling:
                 if roi_subset is not None:
-                    img_data_tmp = img_pred.get_fdata()
+                    img_data_tmp = np.asanyarray(img_pred.dataobj).astype(np.uint8)
                     img_data_tmp *= np.isin(img_data_tmp, list(label_map.keys()))
                     img_pred = nib.Nifti1Image(img_data_tmp, img_pred.affine)
             
@@ -694,7 +899,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
 
         check_if_shape_and_affine_identical(img_in_orig, img_pred)
 
-        img_data = img_pred.get_fdata().astype(np.uint8)
+        img_data = np.asanyarray(img_pred.dataobj).astype(np.uint8)
         if save_binary:
             img_data = (img_data > 0).astype(np.uint8)
 
@@ -711,7 +916,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             if not quiet: print("Applying postprocessing: remove outside of crop mask...")
             st = time.time()
             remove_outside_dilation_vx = int(remove_outside_dilation / np.mean(img_in_orig.header.get_zooms()))
-            img_data = remove_outside_of_mask(img_data, remove_outside_mask.get_fdata(), addon=remove_outside_dilation_vx)
+            img_data = remove_outside_of_mask(img_data, np.asanyarray(remove_outside_mask.dataobj), addon=remove_outside_dilation_vx)
             if not quiet: print(f"  Applied in {time.time() - st:.2f}s")
 
         # Prepare output nifti
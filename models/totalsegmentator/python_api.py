@@ -5,6 +5,8 @@ import time
 import textwrap
 from typing import Union
 import tempfile
+import weakref
+from collections import OrderedDict
 
 import numpy as np
 import nibabel as nib
@@ -93,6 +95,57 @@ def show_license_info():
         sys.exit(1)
 
 
+# Rough organ segmentations (the 6mm/3mm "total" pass used for cropping) of recent inputs.
+# Several tasks with a crop list run on the same image would otherwise run the same coarse
+# model again each time. A full "total" result of the same input is just as good for cropping,
+# so it is stored here as well. Entries: (input key, class map, spacing) -> organ seg image.
+_rough_seg_cache = OrderedDict()
+_ROUGH_SEG_CACHE_SIZE = 4
+
+
+def _input_cache_key(input):
+    """
+    Identity of an input: the image object itself, or the path with its modification time.
+    """
+    if isinstance(input, Nifti1Image):
+        return ("nifti", id(input)), weakref.ref(input)
+    try:
+        st = input.stat()
+        return ("path", str(input.resolve()), st.st_mtime_ns, st.st_size), None
+    except OSError:
+        return None, None
+
+
+def _get_rough_seg(input, crop_task, max_spacing):
+    """
+    Cached segmentation of input with the labels of crop_task at a resolution of at least max_spacing.
+    """
+    key, _ = _input_cache_key(input)
+    if key is None:
+        return None
+    for dead in [k for k, (ref, _) in _rough_seg_cache.items() if ref is not None and ref() is None]:
+        del _rough_seg_cache[dead]
+    candidates = [k for k in _rough_seg_cache if k[0] == key and k[1] == crop_task and k[2] <= max_spacing]
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda k: k[2])  # coarsest compatible one is what would have been computed
+    _rough_seg_cache.move_to_end(best)
+    return _rough_seg_cache[best][1]
+
+
+def _put_rough_seg(input, crop_task, spacing, seg_img):
+    key, ref = _input_cache_key(input)
+    if key is None:
+        return
+    _rough_seg_cache[(key, crop_task, float(spacing))] = (ref, seg_img)
+    while len(_rough_seg_cache) > _ROUGH_SEG_CACHE_SIZE:
+        _rough_seg_cache.popitem(last=False)
+
+
+def clear_rough_seg_cache():
+    _rough_seg_cache.clear()
+
+
 def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Path, None]=None, ml=False, nr_thr_resamp=1, nr_thr_saving=6,
                      fast=False, nora_tag="None", preview=False, task="total", roi_subset=None,
                      statistics=False, radiomics=False, crop_path=None, body_seg=False,
@@ -672,14 +725,19 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                 crop_spacing = 6.0
                 crop_trainer = "nnUNetTrainer"
                 crop_task = "body"
-            download_pretrained_weights(crop_model_task)
-            
-            organ_seg, _, _ = nnUNet_predict_image(input, None, crop_model_task, model="3d_fullres", folds=[0],
-                                trainer=crop_trainer, tta=False, multilabel_image=True, resample=crop_spacing,
-                                crop=None, crop_path=None, task_name=crop_task, nora_tag="None", preview=False,
-                                save_binary=False, nr_threads_resampling=nr_thr_resamp, nr_threads_saving=1,
-                                crop_addon=None, output_type=output_type, statistics=False,
-                                quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device)
+            organ_seg = _get_rough_seg(input, crop_task, crop_spacing)
+            if organ_seg is not None:
+                if not quiet: print("  (Reusing rough segmentation of this input.)")
+            else:
+                download_pretrained_weights(crop_model_task)
+
+                organ_seg, _, _ = nnUNet_predict_image(input, None, crop_model_task, model="3d_fullres", folds=[0],
+                                    trainer=crop_trainer, tta=False, multilabel_image=True, resample=crop_spacing,
+                                    crop=None, crop_path=None, task_name=crop_task, nora_tag="None", preview=False,
+                                    save_binary=False, nr_threads_resampling=nr_thr_resamp, nr_threads_saving=1,
+                                    crop_addon=None, output_type=output_type, statistics=False,
+                                    quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device)
+                _put_rough_seg(input, crop_task, crop_spacing, organ_seg)
             class_map_inv = {v: k for k, v in class_map[crop_task].items()}
             
         else:
@@ -689,7 +747,7 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
             class_map_inv = {v: k for k, v in class_map[crop_model].items()}
 
         crop_mask = np.zeros(organ_seg.shape, dtype=np.uint8)
-        organ_seg_data = organ_seg.get_fdata()
+        organ_seg_data = np.asanyarray(organ_seg.dataobj)
         # roi_subset_crop = [map_to_total[roi] if roi in map_to_total else roi for roi in roi_subset]
         roi_subset_crop = crop if crop is not None else roi_subset
         for roi in roi_subset_crop:
@@ -735,7 +793,11 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                             normalized_intensities=statistics_normalized_intensities, 
                             nnunet_resampling=higher_order_resampling, save_probabilities=save_probabilities,
                             cascade=cascade, remove_outside_mask=remove_mask, remove_outside_dilation=remove_outside_dilation)
-    seg = seg_img.get_fdata().astype(np.uint8)
+    # A complete total/total_mr/body result can serve as rough segmentation for later crop tasks
+    if task in ("total", "total_mr", "body") and roi_subset is None and not v1_order and test == 0 \
+            and cascade is None and type(resample) in (float, int):
+        _put_rough_seg(input, task, resample, seg_img)
+    seg = np.asanyarray(seg_img.dataobj).astype(np.uint8)
 
     try:
         # this can result in error if running multiple processes in parallel because all try to write the same file.
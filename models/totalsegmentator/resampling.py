@@ -153,7 +153,12 @@ def change_spacing(img_in, new_spacing=1.25, target_shape=None, order=0, nr_cpus
 
     Note: Only works properly if affine is all 0 except for diagonal and offset (=no rotation and sheering)
     """
-    data = img_in.get_fdata()  # quite slow
+    if order == 0 and not nnunet_resample and np.issubdtype(img_in.get_data_dtype(), np.integer):
+        # Label images: nearest neighbour keeps the integer dtype, no need for a float64 copy
+        # (8x the memory of a uint8 segmentation at full resolution).
+        data = np.asanyarray(img_in.dataobj)
+    else:
+        data = img_in.get_fdata()  # quite slow
     old_shape = np.array(data.shape)
     img_spacing = np.array(img_in.header.get_zooms())
 
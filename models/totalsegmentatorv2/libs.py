@@ -308,10 +308,10 @@ def combine_masks_to_multilabel_file(masks_dir, multilabel_file):
 
     for idx, mask in enumerate(masks):
         if os.path.exists(f"{masks_dir}/{mask}.nii.gz"):
-            img = nib.load(f"{masks_dir}/{mask}.nii.gz").get_fdata()
+            img = np.asanyarray(nib.load(f"{masks_dir}/{mask}.nii.gz").dataobj)
         else:
             print(f"Mask {mask} is missing. Filling with zeros.")
-            img = np.zeros(ref_img.shape)
+            img = np.zeros(ref_img.shape, dtype=np.uint8)
         img_out[img > 0.5] = idx+1
 
     nib.save(nib.Nifti1Image(img_out, ref_img.affine), multilabel_file)
@@ -354,7 +354,7 @@ def combine_masks(mask_dir, class_type):
     combined = np.zeros(ref_img.shape, dtype=np.uint8)
     for idx, mask in enumerate(masks):
         if (mask_dir / f"{mask}.nii.gz").exists():
-            img = nib.load(mask_dir / f"{mask}.nii.gz").get_fdata()
+            img = np.asanyarray(nib.load(mask_dir / f"{mask}.nii.gz").dataobj)
             combined[img > 0.5] = 1
 
     return nib.Nifti1Image(combined, ref_img.affine)
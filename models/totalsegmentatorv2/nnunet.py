@@ -75,7 +75,7 @@ def contains_empty_img(imgs):
     """
     is_empty = True
     for img in imgs:
-        this_is_empty = len(np.unique(nib.load(img).get_fdata())) == 1
+        this_is_empty = len(np.unique(np.asanyarray(nib.load(img).dataobj))) == 1
         is_empty = is_empty and this_is_empty
     return is_empty
 
@@ -220,7 +220,7 @@ def save_segmentation_nifti(class_map_item, tmp_dir=None, file_out=None, nora_ta
     if not task_name.startswith("total") and not quiet:
         print(f"Creating {v}.nii.gz")
     img = nib.load(tmp_dir / "s01.nii.gz")
-    img_data = img.get_fdata()
+    img_data = np.asanyarray(img.dataobj)
     binary_img = img_data == k
     output_path = str(file_out / f"{v}.nii.gz")
     nib.save(nib.Nifti1Image(binary_img.astype(np.uint8), img.affine, header), output_path)
@@ -374,7 +374,7 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
                     # iterate over models (different sets of classes)
                     for img_part in img_parts:
                         (tmp_dir / f"{img_part}.nii.gz").rename(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz")
-                        seg = nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").get_fdata()
+                        seg = np.asanyarray(nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").dataobj)
                         for jdx, class_name in class_map_5_parts[map_taskid_to_partname[tid]].items():
                             seg_combined[img_part][seg == jdx] = class_map_inv[class_name]
                 # iterate over subparts of image
@@ -402,9 +402,9 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
         # Combine image subparts back to one image
         if do_triple_split:
             combined_img = np.zeros(img_in_rsp.shape, dtype=np.uint8)
-            combined_img[:,:,:third] = nib.load(tmp_dir / "s01.nii.gz").get_fdata()[:,:,:-margin]
-            combined_img[:,:,third:third*2] = nib.load(tmp_dir / "s02.nii.gz").get_fdata()[:,:,margin-1:-margin]
-            combined_img[:,:,third*2:] = nib.load(tmp_dir / "s03.nii.gz").get_fdata()[:,:,margin-1:]
+            combined_img[:,:,:third] = np.asanyarray(nib.load(tmp_dir / "s01.nii.gz").dataobj)[:,:,:-margin]
+            combined_img[:,:,third:third*2] = np.asanyarray(nib.load(tmp_dir / "s02.nii.gz").dataobj)[:,:,margin-1:-margin]
+            combined_img[:,:,third*2:] = np.asanyarray(nib.load(tmp_dir / "s03.nii.gz").dataobj)[:,:,margin-1:]
             nib.save(nib.Nifti1Image(combined_img, img_in_rsp.affine), tmp_dir / "s01.nii.gz")
 
         img_pred = nib.load(tmp_dir / "s01.nii.gz")
@@ -414,14 +414,14 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
 
         # Postprocessing multilabel (run here on lower resolution)
         if task_name == "body":
-            img_pred_pp = keep_largest_blob_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = keep_largest_blob_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                        class_map[task_name], ["body_trunc"])
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
 
         if task_name == "body":
             vox_vol = np.prod(img_pred.header.get_zooms())
             size_thr_mm3 = 50000 / vox_vol
-            img_pred_pp = remove_small_blobs_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = remove_small_blobs_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                         class_map[task_name], ["body_extremities"],
                                                         interval=[size_thr_mm3, 1e10])
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
@@ -434,7 +434,7 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
             st = time.time()
             smoothing = 20
             preview_dir = file_out.parent if multilabel_image else file_out
-            generate_preview(img_in_rsp, preview_dir / f"preview_{task_name}.png", img_pred.get_fdata(), smoothing, task_name)
+            generate_preview(img_in_rsp, preview_dir / f"preview_{task_name}.png", np.asanyarray(img_pred.dataobj), smoothing, task_name)
             if not quiet: print("  Generated in {:.2f}s".format(time.time() - st))
 
         # Statistics calculated on the 3mm downsampled image are very similar to statistics
@@ -449,7 +449,7 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
             st = time.time()
             stats_dir = file_out.parent if multilabel_image else file_out
             stats_dir.mkdir(exist_ok=True)
-            get_basic_statistics(img_pred.get_fdata(), img_in_rsp, stats_dir / "statistics.json", quiet, task_name,
+            get_basic_statistics(np.asanyarray(img_pred.dataobj), img_in_rsp, stats_dir / "statistics.json", quiet, task_name,
                                  exclude_masks_at_border)
             if not quiet: print(f"  calculated in {time.time()-st:.2f}s")
 
@@ -471,7 +471,7 @@ def nnUNet_predict_image(file_in, file_out, task_id, model="3d_fullres", folds=N
 
         check_if_shape_and_affine_identical(img_in_orig, img_pred)
 
-        img_data = img_pred.get_fdata().astype(np.uint8)
+        img_data = np.asanyarray(img_pred.dataobj).astype(np.uint8)
         if save_binary:
             img_data = (img_data > 0).astype(np.uint8)
 
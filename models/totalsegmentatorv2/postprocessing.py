@@ -1,4 +1,3 @@
-import time
 from pathlib import Path
 import numpy as np
 import nibabel as nib
@@ -19,26 +18,56 @@ def keep_largest_blob(data, debug=False):
     return (blob_map == key_second).astype(np.uint8)
 
 
+def _blob_cleanup_multilabel(data, label_ids, select_blobs, quiet=False):
+    """
+    Remove connected components (blobs) of several classes in one go.
+
+    The bounding boxes of all classes come from a single find_objects pass; each class is then
+    labelled inside its own box only and the blob sizes are computed with one bincount.
+
+    data: multilabel image (np.array), modified in place
+    label_ids: label indices to process
+    select_blobs: function(counts) -> boolean array of the blobs to keep,
+                  counts[i] = size of blob i (counts[0] is the background inside the box)
+
+    return multilabel image (np.array)
+    """
+    label_ids = [int(idx) for idx in label_ids]
+    if len(label_ids) == 0:
+        return data
+    boxes = ndimage.find_objects(data, max_label=max(label_ids))
+    for idx in tqdm(label_ids, disable=quiet):
+        box = boxes[idx - 1] if idx > 0 else None
+        if box is None:
+            continue  # class not present
+        region = data[box]  # view -> changes are written to data
+        roi = region == idx
+        blob_map, nr_of_blobs = ndimage.label(roi)
+        counts = np.bincount(blob_map.ravel(), minlength=nr_of_blobs + 1)
+        keep = np.asarray(select_blobs(counts), dtype=bool)
+        region[roi & ~keep[blob_map]] = 0
+    return data
+
+
 def keep_largest_blob_multilabel(data, class_map, rois):
     """
     Keep the largest blob for the classes defined in rois.
 
-    data: multilabel image (np.array)
+    data: multilabel image (np.array), modified in place
     class_map: class map {label_idx: label_name}
     rois: list of labels where to filter for the largest blob
 
     return multilabel image (np.array)
     """
-    st = time.time()
     class_map_inv = {v: k for k, v in class_map.items()}
-    for roi in tqdm(rois):
-        idx = class_map_inv[roi]
-        data_roi = data == idx
-        cleaned_roi = keep_largest_blob(data_roi) > 0.5
-        data[data_roi] = 0   # Clear the original ROI in data
-        data[cleaned_roi] = idx   # Write back the cleaned ROI into data
-    # print(f"  keep_largest_blob_multilabel took {time.time() - st:.2f}s")
-    return data
+
+    def select_largest(counts):
+        keep = np.zeros(len(counts), dtype=bool)
+        if len(counts) > 1:
+            keep[np.argmax(counts[1:]) + 1] = True  # +1 because blob labels start from 1
+        return keep
+
+    return _blob_cleanup_multilabel(data, [class_map_inv[roi] for roi in rois], select_largest)
 
 
 def remove_small_blobs(img: np.ndarray, interval=[10, 30], debug=False) -> np.ndarray:
@@ -76,24 +105,19 @@ def remove_small_blobs_multilabel(data, class_map, rois, interval=[10, 30], debu
     """
     Remove small blobs for the classes defined in rois.
 
-    data: multilabel image (np.array)
+    data: multilabel image (np.array), modified in place
     class_map: class map {label_idx: label_name}
     rois: list of labels where to filter for the largest blob
 
     return multilabel image (np.array)
     """
-    st = time.time()
     class_map_inv = {v: k for k, v in class_map.items()}
 
-    for roi in tqdm(rois):
-        idx = class_map_inv[roi]
-        data_roi = (data == idx)
-        cleaned_roi = remove_small_blobs(data_roi, interval, debug) > 0.5  # Remove small blobs from this ROI
-        data[data_roi] = 0  # Clear the original ROI in data
-        data[cleaned_roi] = idx  # Write back the cleaned ROI into data
+    def select_in_interval(counts):
+        if debug: print(f"counts: {sorted(counts[1:])[::-1]}")
+        return (counts > interval[0]) & (counts <= interval[1])
 
-    # print(f"  remove_small_blobs_multilabel took {time.time() - st:.2f}s")
-    return data
+    return _blob_cleanup_multilabel(data, [class_map_inv[roi] for roi in rois], select_in_interval)
 
 
 def remove_outside_of_mask(seg_path, mask_path, addon=1):
@@ -104,8 +128,8 @@ def remove_outside_of_mask(seg_path, mask_path, addon=1):
     mask_path: path to nifti file
     """
     seg_img = nib.load(seg_path)
-    seg = seg_img.get_fdata()
-    mask = nib.load(mask_path).get_fdata()
+    seg = np.asanyarray(seg_img.dataobj)  # freshly read from disk, safe to modify
+    mask = np.asanyarray(nib.load(mask_path).dataobj)
     mask = binary_dilation(mask, iterations=addon)
     seg[mask == 0] = 0
     nib.save(nib.Nifti1Image(seg.astype(np.uint8), seg_img.affine), seg_path)
@@ -121,7 +145,7 @@ def extract_skin(ct_img, body_img):
     returns: nifti image
     """
     ct = ct_img.get_fdata()
-    body = body_img.get_fdata()
+    body = np.asanyarray(body_img.dataobj)
 
     # Select skin region
     body = binary_dilation(body, iterations=1).astype(np.uint8)  # add 1 voxel margin at the outside
@@ -148,10 +172,10 @@ def remove_auxiliary_labels(img, task_name):
     task_name_aux = task_name + "_auxiliary"
     if task_name_aux in class_map:
         class_map_aux = class_map[task_name]
-        data = img.get_fdata()
+        data = np.asanyarray(img.dataobj).astype(np.uint8)  # copy, modified below
         # remove auxiliary labels
         for idx in class_map_aux.keys():
             data[data == idx] = 0
-        return nib.Nifti1Image(data.astype(np.uint8), img.affine)
+        return nib.Nifti1Image(data, img.affine)
     else:
         return img
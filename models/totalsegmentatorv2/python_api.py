@@ -265,7 +265,7 @@ def totalsegmentator(input, output, task_ids=[291, 292, 293, 294, 295], ml=False
                             quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device)
         class_map_inv = {v: k for k, v in class_map["total"].items()}
         crop_mask = np.zeros(organ_seg.shape, dtype=np.uint8)
-        organ_seg_data = organ_seg.get_fdata()
+        organ_seg_data = np.asanyarray(organ_seg.dataobj)
         # roi_subset_crop = [map_to_total[roi] if roi in map_to_total else roi for roi in roi_subset]        
         roi_subset_crop = crop if crop is not None else roi_subset
         for roi in roi_subset_crop:
@@ -299,7 +299,7 @@ def totalsegmentator(input, output, task_ids=[291, 292, 293, 294, 295], ml=False
                          quiet=quiet, verbose=verbose, test=test, skip_saving=skip_saving, device=device,
                          exclude_masks_at_border=statistics_exclude_masks_at_border,
                          no_derived_masks=no_derived_masks, v1_order=v1_order)
-    seg = seg_img.get_fdata().astype(np.uint8)
+    seg = np.asanyarray(seg_img.dataobj).astype(np.uint8)
 
     config = increase_prediction_counter()
     send_usage_stats(config, {"task": task, "fast": fast, "preview": preview,
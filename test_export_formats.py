@@ -0,0 +1,191 @@
+"""Pruebas de la exportación DICOM-SEG / NIfTI junto al RTSTRUCT."""
+
+import importlib.util
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("rt_utils")
+pytest.importorskip("cv2")
+
+from pydicom.dataset import FileDataset, FileMetaDataset  # noqa: E402
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AURA VER 1.0.py")
+SHAPE = (24, 20, 6)  # (filas, columnas, cortes) de la rejilla RTSTRUCT
+
+
+@pytest.fixture(scope="module")
+def aura():
+    spec = importlib.util.spec_from_file_location("aura_export", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_series(folder, patient_name="TEST"):
+    """Serie CT sintética con las etiquetas de estudio que pide el RTSTRUCT."""
+    os.makedirs(folder, exist_ok=True)
+    series_uid, study_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    rows, cols, slices = SHAPE
+    for i in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(folder, f"IM{i}.dcm")
+        ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = "CT"
+        ds.SeriesInstanceUID = series_uid
+        ds.StudyInstanceUID = study_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.PatientName = patient_name
+        ds.PatientID = "1"
+        ds.StudyDate = "20240101"
+        ds.StudyTime = "101010"
+        ds.StudyID = "1"
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, i * 2.5]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.SliceThickness = 2.5
+        ds.Rows, ds.Columns = rows, cols
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelData = np.zeros((rows, cols), np.int16).tobytes()
+        ds.save_as(path, enforce_file_format=True)
+    return folder
+
+
+def overlapping_masks():
+    """``body`` contiene por completo a ``liver``."""
+    body = np.zeros(SHAPE, bool)
+    body[2:-2, 2:-2, 1:-1] = True
+    liver = np.zeros(SHAPE, bool)
+    liver[6:12, 5:10, 2:4] = True
+    return {"body": body, "liver": liver}
+
+
+def make_engine(aura, monkeypatch, tmp_path, formats):
+    monkeypatch.setattr(aura, "torch", SimpleNamespace(
+        device=lambda name: name, cuda=SimpleNamespace(is_available=lambda: False)))
+    engine = aura.AutoSegEngine()
+    engine._init_engine_state()
+    engine._log = lambda message: None
+    out = str(tmp_path / "out")
+    engine._output_root = lambda: out
+    engine._apply_config({"export_formats": formats})
+    return engine, out
+
+
+def find_output(out, name):
+    for root, _, files in os.walk(out):
+        if name in files:
+            return os.path.join(root, name)
+    return None
+
+
+def test_failed_rtstruct_fails_the_export(aura, tmp_path, monkeypatch):
+    from rt_utils.rtstruct import RTStruct
+
+    study = aura.discover_study(write_series(str(tmp_path / "ct")))
+    engine, out = make_engine(aura, monkeypatch, tmp_path, ["rtstruct", "seg"])
+
+    def broken_save(self, path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(RTStruct, "save", broken_save)
+    assert engine._save_rt(study, overlapping_masks()) is False
+    assert find_output(out, "seg.dcm") is not None
+    assert find_output(out, "rtss.dcm") is None
+
+
+def test_seg_keeps_overlapping_segments(aura, tmp_path, monkeypatch):
+    study = aura.discover_study(write_series(str(tmp_path / "ct")))
+    engine, out = make_engine(aura, monkeypatch, tmp_path, ["seg", "nifti"])
+    masks = overlapping_masks()
+    assert engine._save_rt(study, masks) is True
+
+    seg = pydicom.dcmread(find_output(out, "seg.dcm"))
+    assert [s.SegmentLabel for s in seg.SegmentSequence] == ["body", "liver"]
+    frames = seg.pixel_array.reshape(-1, SHAPE[0], SHAPE[1])
+    series_data = aura.rtstruct_from_series(study.primary_series()).series_data
+    sop_to_slice = {ds.SOPInstanceUID: k for k, ds in enumerate(series_data)}
+    decoded = {name: np.zeros(SHAPE, bool) for name in masks}
+    for frame, group in zip(frames, seg.PerFrameFunctionalGroupsSequence):
+        number = group.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+        sop = group.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        decoded[list(masks)[number - 1]][:, :, sop_to_slice[sop]] = frame.astype(bool)
+    for name, mask in masks.items():
+        np.testing.assert_array_equal(decoded[name], mask)
+
+
+def test_seg_is_a_valid_segmentation(aura, tmp_path):
+    hd = pytest.importorskip("highdicom")
+    study = aura.discover_study(write_series(str(tmp_path / "ct"), patient_name="Muñoz^José"))
+    series_data = aura.rtstruct_from_series(study.primary_series()).series_data
+    masks = overlapping_masks()
+    segments = aura.SegmentFrames(SHAPE)
+    for name, mask in masks.items():
+        segments.add(name, aura.CompactMask.from_dense(mask))
+    path = str(tmp_path / "seg.dcm")
+    aura.write_dicom_seg(segments, series_data, path)
+
+    ds = pydicom.dcmread(path)
+    assert str(ds.PatientName) == "Muñoz^José"
+    assert "SpecificCharacterSet" in ds
+    # highdicom comprueba el IOD al leerlo, no solo el lector de este repo
+    seg = hd.seg.Segmentation.from_dataset(ds)
+    assert seg.SegmentsOverlap == "YES"
+    # los índices de posición numeran solo las posiciones que usan los marcos
+    positions = {}
+    for group in seg.PerFrameFunctionalGroupsSequence:
+        index = group.FrameContentSequence[0].DimensionIndexValues[1]
+        positions.setdefault(index, tuple(group.PlanePositionSequence[0].ImagePositionPatient))
+    assert sorted(positions) == list(range(1, len(set(positions.values())) + 1))
+    assert [positions[i][2] for i in sorted(positions)] == sorted(p[2] for p in positions.values())
+    pixels = seg.get_pixels_by_source_instance(
+        [img.SOPInstanceUID for img in series_data], combine_segments=False)
+    for number, mask in enumerate(masks.values()):
+        np.testing.assert_array_equal(pixels[..., number].transpose(1, 2, 0).astype(bool), mask)
+
+
+def test_export_pools_share_the_cores(aura, monkeypatch):
+    monkeypatch.setattr(aura.os, "cpu_count", lambda: 8)
+    assert aura.default_export_workers() == (4, 4)
+    assert aura.default_export_workers(pipelined=True) == (2, 2)
+    assert aura.default_export_workers(contours=False) == (8, 1)
+    assert aura.default_export_workers(postprocess=3) == (3, 5)
+    assert aura.default_export_workers(postprocess=3, contour=3) == (3, 3)
+
+
+def test_cancel_closes_the_mask_stream(aura, tmp_path, monkeypatch):
+    study = aura.discover_study(write_series(str(tmp_path / "ct")))
+    engine, _ = make_engine(aura, monkeypatch, tmp_path, ["rtstruct"])
+    closed, streams = [], []
+
+    def generate():
+        try:
+            for name, mask in overlapping_masks().items():
+                engine.cancel_requested = True
+                yield name, aura.CompactMask.from_dense(mask)
+        finally:
+            closed.append(True)
+
+    def masks(stream, workers=1):
+        # mantener una referencia: sin close() el generador quedaría suspendido
+        streams.append(generate())
+        return streams[-1]
+
+    monkeypatch.setattr(engine, "_iter_masks", masks)
+    stream = aura.MaskStream(selection={"body", "liver"})
+    assert engine._save_rt(study, stream) is False
+    assert closed == [True]
@@ -0,0 +1,42 @@
+"""Pruebas del modo sin interfaz (sin tkinter disponible)."""
+
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pydicom")
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AURA VER 1.0.py")
+
+
+def load_without_tkinter(monkeypatch):
+    for name in ("tkinter", "tkinter.filedialog", "tkinter.messagebox", "tkinter.ttk",
+                 "tkinter.scrolledtext", "_tkinter"):
+        monkeypatch.setitem(sys.modules, name, None)  # import -> ImportError
+    spec = importlib.util.spec_from_file_location("aura_headless", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_import_and_cli_without_tkinter(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("USERPROFILE", str(tmp_path))
+    aura = load_without_tkinter(monkeypatch)
+    assert aura.tk is None
+    assert aura.run_headless(["--seg-cache-info"]) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert isinstance(summary, dict)
+
+
+def test_wants_headless(monkeypatch):
+    aura = load_without_tkinter(monkeypatch)
+    assert aura.wants_headless(["--input", "in", "--output", "out"])
+    assert aura.wants_headless(["--input=in", "--output=out"])
+    assert aura.wants_headless(["--seg-cache-purge"])
+    assert not aura.wants_headless([])
+    assert not aura.wants_headless(["-psn_0_12345"])
+    assert not aura.wants_headless(["--single"])
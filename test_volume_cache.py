@@ -0,0 +1,95 @@
+"""Pruebas de la caché de volúmenes compartida por los backends."""
+
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+nib = pytest.importorskip("nibabel")
+
+from pydicom.dataset import FileDataset, FileMetaDataset  # noqa: E402
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AURA VER 1.0.py")
+
+
+@pytest.fixture(scope="module")
+def aura():
+    spec = importlib.util.spec_from_file_location("aura_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_series(folder, slices=4, size=8):
+    """Serie CT sintética con rescale (-1024) y cortes en orden inverso."""
+    os.makedirs(folder, exist_ok=True)
+    series_uid, study_uid = generate_uid(), generate_uid()
+    rng = np.random.default_rng(0)
+    for i in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(folder, f"IM{i}.dcm")
+        ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = "CT"
+        ds.SeriesInstanceUID = series_uid
+        ds.StudyInstanceUID = study_uid
+        ds.PatientName = "TEST"
+        ds.ImagePositionPatient = [0.0, 0.0, float(slices - i) * 2.5]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.SliceThickness = 2.5
+        ds.Rows = ds.Columns = size
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.PixelData = rng.integers(0, 2000, (size, size)).astype(np.int16).tobytes()
+        ds.save_as(path, enforce_file_format=True)
+    return folder
+
+
+def test_lnq_backend_gets_engine_cache(aura, tmp_path, monkeypatch):
+    cache = aura.SeriesVolumeCache(root=str(tmp_path / "cache"))
+    monkeypatch.setattr(aura.LNQ2023Backend, "load_model", lambda self: (True, "ok"))
+    engine = aura.LymphNodeSegmentationEngine(volume_cache=cache)
+    assert engine.load_backend("lnq2023")[0]
+    assert engine.backends["lnq2023"].volume_cache is cache
+
+
+def test_second_lnq_backend_hits_cache(aura, tmp_path, monkeypatch):
+    series = write_series(str(tmp_path / "ct"))
+    cache = aura.SeriesVolumeCache(root=str(tmp_path / "cache"))
+
+    first = aura.LNQ2023Backend(volume_cache=cache)
+    out1 = first._dicom_to_nifti(series, str(tmp_path))
+    expected = np.asarray(nib.load(out1).dataobj)
+    assert len(cache.entries()) == 1
+
+    def no_decode(*args, **kwargs):
+        raise AssertionError("series decoded again instead of read from the cache")
+
+    monkeypatch.setattr(aura, "decode_series_volume", no_decode)
+    os.makedirs(tmp_path / "second")
+    second = aura.LNQ2023Backend(volume_cache=cache)
+    out2 = second._dicom_to_nifti(series, str(tmp_path / "second"))
+    np.testing.assert_array_equal(np.asarray(nib.load(out2).dataobj), expected)
+
+
+def test_lnq_input_is_stored_values(aura, tmp_path):
+    series = write_series(str(tmp_path / "ct"))
+    backend = aura.LNQ2023Backend(volume_cache=aura.SeriesVolumeCache(root=str(tmp_path / "cache")))
+    volume = np.asarray(nib.load(backend._dicom_to_nifti(series, str(tmp_path))).dataobj)
+    slices = sorted((pydicom.dcmread(os.path.join(series, f)) for f in os.listdir(series)),
+                    key=lambda ds: float(ds.ImagePositionPatient[2]))
+    stored = np.stack([ds.pixel_array for ds in slices], axis=-1)
+    np.testing.assert_array_equal(volume, stored.astype(np.int16))